@@ -15,6 +15,17 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 7  # 7 days
+    PRINCIPAL_CACHE_TTL_SECONDS: float = 30.0
+    PRINCIPAL_CACHE_MAX_SIZE: int = 10000
+    BCRYPT_ROUNDS: int = 12  # raising this rehashes passwords on next login
+    PASSWORD_HASH_WORKERS: int = 0  # 0 = one process per CPU core
+    PASSWORD_HASH_MAX_QUEUE: int = 200
+    PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS: float = 5.0
+    INSIGHT_CACHE_TTL_SECONDS: float = 60.0  # spending/performance/earnings figures
+    INSIGHT_CACHE_MAX_SIZE: int = 5000
+    PAGINATION_COUNT_CACHE_TTL_SECONDS: float = 30.0  # approximate totals on paginated listings
+    CATEGORY_CACHE_TTL_SECONDS: float = 300.0
+    CATEGORY_CACHE_WATCH_CHANGES: bool = False  # change-stream invalidation across workers (replica set only)
     
     # MongoDB
     MONGODB_URL: str
@@ -29,6 +40,7 @@ class Settings(BaseSettings):
     MAX_OTP_VERIFICATION_ATTEMPTS: int = 5
     OTP_VERIFICATION_LOCKOUT_MINUTES: int = 30
     MIN_PAYOUT_AMOUNT: float = 100.0
+    PAYOUT_SETTLE_DELAY_SECONDS: float = 600.0  # unfinished payout requests are resolved after this
 
     
     # Stripe
@@ -36,6 +48,9 @@ class Settings(BaseSettings):
     STRIPE_PUBLISHABLE_KEY: str
     STRIPE_WEBHOOK_SECRET: str
     STRIPE_CURRENCY: str = "inr"
+    STRIPE_TIMEOUT_SECONDS: float = 20.0
+    STRIPE_MAX_NETWORK_RETRIES: int = 2
+    PAYMENT_GATEWAY: str = "stripe"  # "stripe" or "fake" (local development / tests)
     
     # SMTP / Email
     SMTP_HOST: str
@@ -44,18 +59,83 @@ class Settings(BaseSettings):
     SMTP_PASSWORD: str
     SMTP_FROM_EMAIL: str
     SMTP_FROM_NAME: str = "Service Provider Platform"
+    SMTP_TIMEOUT_SECONDS: float = 15.0
+    SMTP_POOL_SIZE: int = 4  # long-lived SMTP sessions
+    SMTP_MAX_MESSAGES_PER_SESSION: int = 100
+    SMTP_SESSION_IDLE_SECONDS: float = 60.0
+    EMAIL_QUEUE_SIZE: int = 5000
+    EMAIL_MAX_RETRIES: int = 3
+    EMAIL_RETRY_BACKOFF_SECONDS: float = 1.0
     
     # Platform Fees & Configuration
     PLATFORM_FEE_PERCENTAGE: float = 15.0  # 15% platform fee
     
     MAX_SERVICE_RADIUS_KM: float = 50.0
+    
+    # Live tracking ingest
+    TRACKING_FLUSH_INTERVAL_SECONDS: float = 5.0
+    TRACKING_MIN_MOVE_METERS: float = 25.0  # closer fixes are not stored...
+    TRACKING_MAX_POINT_INTERVAL_SECONDS: float = 60.0  # ...unless this long since the last stored one
+    TRACKING_SESSION_TTL_SECONDS: float = 1800.0
+    LOCATION_STREAM_MIN_INTERVAL_SECONDS: float = 1.0  # per booking
+    LOCATION_STREAM_MAX_BATCH: int = 50
+    COVERAGE_GEOHASH_PRECISION: int = 5  # ~4.9 km cells in service_area_coverage
+    
+    # Emergency dispatch (bookings.dispatch)
+    EMERGENCY_SEARCH_RADIUS_KM: float = 25.0
+    EMERGENCY_MAX_CANDIDATES: int = 50
+    EMERGENCY_FIRST_WAVE_SIZE: int = 3  # nearest servicers paged first...
+    EMERGENCY_WAVE_GROWTH: int = 2  # ...each later wave this many times larger
+    EMERGENCY_MAX_WAVES: int = 4
+    EMERGENCY_WAVE_TIMEOUT_SECONDS: float = 30.0  # wait for an accept before the next wave
+    EMERGENCY_POLL_SECONDS: float = 1.0  # accepts on other workers are noticed this fast
+    EMERGENCY_MAX_ATTEMPTS: int = 3  # failed runs before a dispatch is marked failed
+    
+    # Notification write-behind
+    NOTIFICATION_FLUSH_INTERVAL_SECONDS: float = 0.5
+    NOTIFICATION_QUEUE_SIZE: int = 10000
+    NOTIFICATION_COALESCE_WINDOW_SECONDS: float = 3.0  # chat notifications per conversation
+    
+    # Chat
+    CHAT_ROOM_CACHE_SECONDS: float = 300.0  # participants/booking metadata per room
+    CHAT_ROOM_CACHE_SIZE: int = 10000
+    CHAT_BATCH_WINDOW_SECONDS: float = 0.005  # group-commit window for message writes
+    CHAT_BATCH_MAX: int = 500
+    BROADCAST_CHUNK_SIZE: int = 1000
+    BROADCAST_LEASE_SECONDS: float = 60.0
+    BROADCAST_MAX_ATTEMPTS: int = 5  # failed runs before a broadcast is marked failed
     OTP_EXPIRY_MINUTES: int = 10
     OTP_MAX_ATTEMPTS: int = 3
     
+    # Admin analytics rollups (platform_analytics)
+    ANALYTICS_REFRESH_INTERVAL_SECONDS: float = 60.0
+    ANALYTICS_HOURLY_RETENTION_DAYS: int = 90
+    ANALYTICS_RECONCILE_DAYS: int = 3
+    
+    # Unread badge counters (user_counters / pre_booking_chats)
+    UNREAD_COUNTER_RECONCILE_HOURS: int = 6
+    
+    # Durable job queue (jobs / dead_jobs)
+    JOB_QUEUE_CONCURRENCY: int = 8  # jobs running at once per worker
+    JOB_POLL_INTERVAL_SECONDS: float = 2.0
+    JOB_LEASE_SECONDS: float = 300.0  # also the per-job timeout
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_SECONDS: float = 30.0  # doubled per attempt...
+    JOB_RETRY_MAX_SECONDS: float = 3600.0  # ...up to this
+    JOB_RETENTION_HOURS: int = 72  # finished jobs (their dedupe keys) kept this long
+    MAINTENANCE_REMINDER_LEAD_HOURS: int = 24
+    
     # File Upload Limits (in MB)
     MAX_PROFILE_IMAGE_SIZE: int = 5
     MAX_DOCUMENT_SIZE: int = 10
     MAX_CHAT_FILE_SIZE: int = 20
+    UPLOAD_MAX_REQUEST_MB: int = 60  # whole multipart body, refused while streaming in
+    UPLOAD_MAX_CONCURRENCY: int = 8  # upload threads per worker
+    UPLOAD_REQUEST_CONCURRENCY: int = 4  # files of one request uploaded at once
+    UPLOAD_CHUNK_MB: int = 6  # Cloudinary chunked upload part size (minimum 5)
+    UPLOAD_STORAGE: str = "cloudinary"  # "cloudinary" or "local" (local development / tests)
+    UPLOAD_LOCAL_DIR: str = "uploads"
+    UPLOAD_LOCAL_BASE_URL: str = "/uploads"
     USER_ADDRESSES: ClassVar[str] = "user_addresses"
     USER_SETTINGS: ClassVar[str] = "user_settings"
     USER_WISHLIST: ClassVar[str] = "user_wishlist"
@@ -73,6 +153,13 @@ class Settings(BaseSettings):
     
     # WebSocket
     SOCKET_IO_CORS_ALLOWED_ORIGINS: str = "*"
+    SOCKET_MANAGER: str = "memory"  # "memory" (single worker), "redis" (multi-worker) or "fake" (tests)
+    SOCKET_REDIS_URL: str = "redis://localhost:6379/0"
+    SOCKET_CHANNEL: str = "servicedti-socketio"
+    SOCKET_WRITE_ONLY: bool = False  # emit-only process: publishes events, serves no sockets
+    PRESENCE_TTL_SECONDS: float = 90.0  # sockets of a worker that stops heartbeating go offline after this
+    PRESENCE_HEARTBEAT_SECONDS: float = 30.0
+    PRESENCE_MAX_BATCH: int = 500
     
     # Frontend URL (for email links)
     FRONTEND_URL: str = "http://localhost:3000"
@@ -111,6 +198,13 @@ class Collections:
     PROMO_USAGE = "promo_usage"
     REFERRALS = "referrals"
     PLATFORM_ANALYTICS = "platform_analytics"
+    BROADCASTS = "broadcasts"
+    USER_COUNTERS = "user_counters"
+    JOBS = "jobs"
+    DEAD_JOBS = "dead_jobs"
+    WALLET_LEDGER = "wallet_ledger"
+    WALLET_SNAPSHOTS = "wallet_snapshots"
+    PRESENCE = "presence"
     AUDIT_LOGS = "audit_logs"
     # NEW COLLECTIONS FOR USER FEATURES
     PROBLEM_DIAGNOSIS = "problem_diagnosis"
@@ -156,6 +250,7 @@ class CloudinaryFolders:
     ISSUE_EVIDENCE = "service-platform/issue-evidence"
     WORK_PROGRESS = "service-platform/work-progress"
     COMPLAINT_EVIDENCE = "complaints/evidence"
+    CHAT_ATTACHMENTS = "service-platform/chat/attachments"
 
 
 # Email Templates
@@ -208,6 +303,7 @@ class SocketEvents:
     
     # Tracking
     LOCATION_UPDATE = "location_update"
+    LOCATION_STREAM = "location_stream"
     ETA_UPDATE = "eta_update"
     ROUTE_UPDATE = "route_update"
     SERVICE_STARTED = "service_started"
@@ -232,6 +328,8 @@ class SocketEvents:
     PAYMENT_COMPLETED = "payment_completed"
     PAYMENT_FAILED = "payment_failed"
     CASH_PAYMENT_CONFIRMED = "cash_payment_confirmed"
+    EMERGENCY_REQUEST = "emergency_request"
+    EMERGENCY_CLAIMED = "emergency_claimed"
     
     # Notifications
     NEW_NOTIFICATION = "new_notification"
@@ -311,6 +409,7 @@ class Messages:
     BOOKING_COMPLETED = "Booking completed successfully"
     BOOKING_NOT_FOUND = "Booking not found"
     CANNOT_CANCEL_BOOKING = "Cannot cancel booking at this stage"
+    EMERGENCY_ALREADY_TAKEN = "This emergency request has already been accepted by another servicer"
     
     # Payment Messages
     PAYMENT_SUCCESS = "Payment completed successfully"
@@ -0,0 +1,243 @@
+"""
+Queued SMTP delivery over a small pool of persistent sessions.
+
+Messages go onto an in-process priority queue drained by a few workers, each
+holding a long-lived authenticated SMTP session that is reused for many
+messages. Urgent mail (OTPs) jumps ahead of bulk mail and is never dropped
+when the bulk backlog is full. Transient failures are retried with
+exponential backoff; 5xx replies and refused recipients are not.
+
+Kept import-light (settings are passed in) so delivery can be checked
+against a local SMTP sink without loading main.py:
+    python email_delivery.py --messages 100 --workers 4
+
+The check needs aiosmtpd (pip install aiosmtpd).
+"""
+import argparse
+import asyncio
+import itertools
+import socket
+import time
+from collections import deque
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from types import SimpleNamespace
+from typing import List, Optional
+
+import aiosmtplib
+
+PRIORITY_URGENT = 0
+PRIORITY_BULK = 1
+
+
+class EmailDeliveryService:
+    """Queued SMTP delivery over a small pool of persistent sessions"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.pool_size = settings.SMTP_POOL_SIZE
+        # Unbounded so urgent mail always fits; bulk mail is capped in enqueue()
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.capacity = settings.EMAIL_QUEUE_SIZE
+        self._seq = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        self._latencies = deque(maxlen=500)
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "retried": 0, "dropped": 0, "sessions_opened": 0}
+
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(i)) for i in range(self.pool_size)
+            ]
+            print(f"✅ Email delivery started ({self.pool_size} SMTP sessions)")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Email queue not drained on shutdown ({self.queue.qsize()} pending)")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def enqueue(self, to_email: str, subject: str, body: str, priority: int = PRIORITY_BULK) -> bool:
+        """Queue a message; returns False if bulk mail finds the queue full"""
+        if priority != PRIORITY_URGENT and self.queue.qsize() >= self.capacity:
+            self.stats["dropped"] += 1
+            print(f"⚠️ Email queue full, dropped message to {to_email}")
+            return False
+        msg = MIMEMultipart('alternative')
+        msg['From'] = f"{self.settings.SMTP_FROM_NAME} <{self.settings.SMTP_FROM_EMAIL}>"
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+        # The sequence number keeps FIFO order within a priority and stops
+        # the tuple comparison from ever reaching the message object
+        self.queue.put_nowait((priority, next(self._seq), msg, time.monotonic()))
+        self.stats["queued"] += 1
+        return True
+
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            **self.stats,
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.capacity,
+            "workers": len(self._workers),
+            "latency_avg_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None
+        }
+
+    async def _open_session(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(
+            hostname=self.settings.SMTP_HOST,
+            port=self.settings.SMTP_PORT,
+            username=self.settings.SMTP_USERNAME or None,
+            password=self.settings.SMTP_PASSWORD or None,
+            timeout=self.settings.SMTP_TIMEOUT_SECONDS
+        )
+        await smtp.connect()  # STARTTLS (when offered) and LOGIN happen once per session
+        self.stats["sessions_opened"] += 1
+        return smtp
+
+    async def _close_session(self, smtp: Optional[aiosmtplib.SMTP]):
+        if smtp is None:
+            return
+        try:
+            if smtp.is_connected:
+                await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def _worker(self, worker_id: int):
+        smtp = None
+        sent_on_session = 0
+        while True:
+            try:
+                _, _, msg, enqueued_at = await asyncio.wait_for(
+                    self.queue.get(), timeout=self.settings.SMTP_SESSION_IDLE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # Idle - release the session before the server drops it
+                await self._close_session(smtp)
+                smtp, sent_on_session = None, 0
+                continue
+            except asyncio.CancelledError:
+                await self._close_session(smtp)
+                raise
+
+            try:
+                for attempt in range(self.settings.EMAIL_MAX_RETRIES + 1):
+                    try:
+                        if smtp is None or not smtp.is_connected or sent_on_session >= self.settings.SMTP_MAX_MESSAGES_PER_SESSION:
+                            await self._close_session(smtp)
+                            smtp, sent_on_session = await self._open_session(), 0
+                        await smtp.send_message(msg)
+                        sent_on_session += 1
+                        self.stats["sent"] += 1
+                        self._latencies.append(time.monotonic() - enqueued_at)
+                        break
+                    except aiosmtplib.SMTPResponseException as e:
+                        permanent = 500 <= e.code < 600
+                        if permanent or attempt == self.settings.EMAIL_MAX_RETRIES:
+                            raise
+                    except aiosmtplib.SMTPRecipientsRefused as e:
+                        # The session is still healthy; only retry greylisting (4xx)
+                        permanent = all(500 <= r.code < 600 for r in e.recipients)
+                        if permanent or attempt == self.settings.EMAIL_MAX_RETRIES:
+                            raise
+                    except aiosmtplib.SMTPNotSupported:
+                        raise
+                    except (aiosmtplib.SMTPException, OSError):
+                        # Connection-level failure - reconnect on the next attempt
+                        await self._close_session(smtp)
+                        smtp = None
+                        if attempt == self.settings.EMAIL_MAX_RETRIES:
+                            raise
+                    self.stats["retried"] += 1
+                    await asyncio.sleep(self.settings.EMAIL_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+            except asyncio.CancelledError:
+                await self._close_session(smtp)
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"❌ Email to {msg['To']} failed (worker {worker_id}): {e}")
+            finally:
+                self.queue.task_done()
+
+
+# ============= DELIVERY CHECK =============
+
+async def check_delivery(messages: int = 100, workers: int = 4, timeout: float = 30.0) -> dict:
+    """
+    Send `messages` through the service to an aiosmtpd sink on localhost and
+    count what arrives. Sessions are reused, so `sessions_opened` should stay
+    at about `workers`. One urgent message is queued behind the bulk batch and
+    must still be among the first `workers` deliveries.
+    """
+    from aiosmtpd.controller import Controller
+
+    received = []
+
+    class Sink:
+        async def handle_DATA(self, server, session, envelope):
+            received.append(envelope.rcpt_tos[0])
+            return "250 OK"
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    controller = Controller(Sink(), hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        service = EmailDeliveryService(SimpleNamespace(
+            SMTP_HOST="127.0.0.1",
+            SMTP_PORT=port,
+            SMTP_USERNAME="",
+            SMTP_PASSWORD="",
+            SMTP_FROM_EMAIL="check@localhost",
+            SMTP_FROM_NAME="Delivery check",
+            SMTP_TIMEOUT_SECONDS=5.0,
+            SMTP_POOL_SIZE=workers,
+            SMTP_MAX_MESSAGES_PER_SESSION=messages,
+            SMTP_SESSION_IDLE_SECONDS=60.0,
+            EMAIL_QUEUE_SIZE=messages,
+            EMAIL_MAX_RETRIES=1,
+            EMAIL_RETRY_BACKOFF_SECONDS=0.1
+        ))
+        service.start()
+        started = time.perf_counter()
+        for number in range(messages):
+            service.enqueue(f"user{number}@example.com", f"Check {number}", "<p>delivery check</p>")
+        service.enqueue("urgent@example.com", "Urgent check", "<p>otp</p>", PRIORITY_URGENT)
+        await asyncio.wait_for(service.queue.join(), timeout=timeout)
+        elapsed = time.perf_counter() - started
+        await service.stop()
+    finally:
+        controller.stop()
+
+    return {
+        "messages": messages + 1,
+        "received": len(received),
+        "urgent_position": received.index("urgent@example.com") if "urgent@example.com" in received else None,
+        "unique_recipients": len(set(received)),
+        "seconds": round(elapsed, 3),
+        **service.metrics()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SMTP delivery pool check against a local aiosmtpd sink")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    result = asyncio.run(check_delivery(args.messages, args.workers))
+    print(f"📧 {result['received']}/{result['messages']} delivered in {result['seconds']}s over "
+          f"{result['sessions_opened']} sessions ({result['failed']} failed, {result['retried']} retried), "
+          f"urgent message delivered #{result['urgent_position']}")
+    if result['received'] != result['messages'] or result['unique_recipients'] != result['messages']:
+        raise SystemExit(1)
+    if result['urgent_position'] is None or result['urgent_position'] >= args.workers:
+        raise SystemExit(1)
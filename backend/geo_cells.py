@@ -0,0 +1,84 @@
+"""
+Geohash cells for the service coverage grid.
+
+Pure functions, no dependencies: encode a point into its cell and list the
+cells a service circle touches. At precision 5 a cell is about 4.9 x 4.9 km,
+so a 10 km service radius covers roughly 20-25 cells.
+"""
+import math
+from typing import List, Tuple
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_EARTH_RADIUS_KM = 6371.0088
+
+
+def encode(latitude: float, longitude: float, precision: int) -> str:
+    """Geohash of a point"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    cell, bits, value, even = [], 0, 0, True
+    while len(cell) < precision:
+        span, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            cell.append(_BASE32[value])
+            bits, value = 0, 0
+    return "".join(cell)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """(height, width) of a cell in degrees"""
+    total_bits = precision * 5
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Haversine distance - close enough to decide which cells a circle touches"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def covering(latitude: float, longitude: float, radius_km: float, precision: int) -> List[str]:
+    """Every cell with at least one point within radius_km of the centre"""
+    height, width = cell_size(precision)
+    # Small margin so haversine/geodesic differences never drop an edge cell
+    reach = radius_km * 1.01 + 0.05
+    d_lat = reach / 111.32
+    d_lng = reach / max(111.32 * math.cos(math.radians(latitude)), 1e-6)
+
+    south = max(latitude - d_lat, -90.0)
+    north = min(latitude + d_lat, 90.0)
+    west = longitude - d_lng
+    east = longitude + d_lng
+
+    cells = []
+    row = math.floor((south + 90.0) / height)
+    while row * height - 90.0 <= north:
+        cell_south = row * height - 90.0
+        cell_north = cell_south + height
+        column = math.floor((west + 180.0) / width)
+        while column * width - 180.0 <= east:
+            cell_west = column * width - 180.0
+            cell_east = cell_west + width
+            # Nearest point of the cell to the centre
+            nearest_lat = min(max(latitude, cell_south), cell_north)
+            nearest_lng = min(max(longitude, cell_west), cell_east)
+            if distance_km(latitude, longitude, nearest_lat, nearest_lng) <= reach:
+                centre_lng = (cell_west + cell_east) / 2
+                centre_lng = (centre_lng + 180.0) % 360.0 - 180.0
+                cells.append(encode(min((cell_south + cell_north) / 2, 89.999999), centre_lng, precision))
+            column += 1
+        row += 1
+    return cells
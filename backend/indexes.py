@@ -0,0 +1,346 @@
+"""
+Declarative MongoDB index registry.
+
+Every index the API relies on is listed in INDEXES. reconcile_indexes()
+diffs it against the deployment: missing indexes are built (one
+createIndexes per collection), indexes whose options drifted from the
+registry are reported (and rebuilt with fix_drift), and indexes the
+registry doesn't know about are reported as unmanaged. It runs at API
+startup and can be run by hand:
+
+    python indexes.py              # build missing indexes, report drift
+    python indexes.py --check      # report only; exit 1 if anything is missing, drifted
+                                   # or if a HOT_QUERIES entry collection-scans
+    python indexes.py --fix-drift  # also rebuild drifted indexes
+    python indexes.py --explain    # check HOT_QUERIES are served by an index (no COLLSCAN)
+
+The HOT_QUERIES explain check also runs at API startup, after the
+reconcile, and logs every query that would collection-scan.
+tests/test_indexes.py runs it against a scratch database.
+"""
+import argparse
+import asyncio
+import sys
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+
+from config import settings, Collections
+
+# Options compared when deciding whether an existing index matches the registry
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def index(*keys: Tuple[str, object], **options) -> IndexModel:
+    """Registry entry; builds never block other operations on the collection"""
+    return IndexModel(list(keys), background=True, **options)
+
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    Collections.USERS: [
+        index(("email", ASCENDING), unique=True),
+        index(("role", ASCENDING)),
+        index(("role", ASCENDING), ("created_at", ASCENDING)),
+        index(("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("role", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+    ],
+    Collections.SERVICERS: [
+        index(("user_id", ASCENDING)),
+        index(("verification_status", ASCENDING)),
+        index(("service_categories", ASCENDING)),
+        index(("location", GEOSPHERE)),
+    ],
+    Collections.BOOKINGS: [
+        index(("booking_number", ASCENDING), unique=True),
+        index(("user_id", ASCENDING)),
+        index(("servicer_id", ASCENDING)),
+        index(("booking_status", ASCENDING)),
+        index(("created_at", ASCENDING)),
+        index(("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("booking_status", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("user_id", ASCENDING), ("booking_status", ASCENDING), ("completed_at", DESCENDING), ("_id", DESCENDING)),
+        index(("dispatch.status", ASCENDING), partialFilterExpression={"is_emergency": True}),
+        index(("dispatch.offered", ASCENDING), ("created_at", DESCENDING), partialFilterExpression={"is_emergency": True}),
+    ],
+    Collections.BOOKING_TRACKING: [
+        index(("booking_id", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.TRANSACTIONS: [
+        index(("user_id", ASCENDING)),
+        index(("booking_id", ASCENDING)),
+        index(("created_at", ASCENDING)),
+        index(("servicer_id", ASCENDING), ("transaction_status", ASCENDING)),
+        index(("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("servicer_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+    ],
+    Collections.WALLETS: [
+        index(("user_id", ASCENDING)),
+    ],
+    Collections.WALLET_LEDGER: [
+        index(("wallet_id", ASCENDING), ("seq", ASCENDING), unique=True),
+        index(("idempotency_key", ASCENDING), unique=True, partialFilterExpression={"idempotency_key": {"$exists": True}}),
+        index(("wallet_id", ASCENDING), ("created_at", ASCENDING)),
+    ],
+    Collections.WALLET_SNAPSHOTS: [
+        index(("wallet_id", ASCENDING), ("seq", DESCENDING)),
+        index(("drift", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.PAYOUT_REQUESTS: [
+        index(("status", ASCENDING), ("created_at", DESCENDING)),
+        index(("servicer_id", ASCENDING), ("status", ASCENDING)),
+    ],
+    Collections.OTPS: [
+        index(("email", ASCENDING)),
+        index(("expires_at", ASCENDING), expireAfterSeconds=0),
+    ],
+    Collections.RATINGS: [
+        index(("booking_id", ASCENDING)),
+        index(("servicer_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("user_id", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.NOTIFICATIONS: [
+        index(("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("user_id", ASCENDING), ("is_read", ASCENDING), ("created_at", DESCENDING)),
+        index(("metadata.broadcast_id", ASCENDING), sparse=True),
+    ],
+    Collections.CHAT_MESSAGES: [
+        index(("booking_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)),
+    ],
+    Collections.PRE_BOOKING_CHATS: [
+        index(("user_id", ASCENDING), ("last_message_at", DESCENDING)),
+        index(("servicer_id", ASCENDING), ("last_message_at", DESCENDING)),
+    ],
+    Collections.PRE_BOOKING_MESSAGES: [
+        index(("chat_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)),
+    ],
+    Collections.FAVORITE_SERVICERS: [
+        index(("user_id", ASCENDING), ("servicer_id", ASCENDING)),
+    ],
+    Collections.SERVICER_PRICING: [
+        index(("servicer_id", ASCENDING), ("category_id", ASCENDING)),
+    ],
+    Collections.SERVICER_AVAILABILITY: [
+        index(("servicer_id", ASCENDING)),
+    ],
+    Collections.SERVICER_WARNINGS: [
+        index(("servicer_id", ASCENDING)),
+    ],
+    Collections.SUPPORT_TICKETS: [
+        index(("user_id", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.TICKET_REPLIES: [
+        index(("ticket_id", ASCENDING)),
+    ],
+    Collections.TRANSACTION_ISSUES: [
+        index(("user_id", ASCENDING)),
+        index(("booking_id", ASCENDING)),
+    ],
+    Collections.TRANSACTION_ISSUE_MESSAGES: [
+        index(("issue_id", ASCENDING), ("created_at", ASCENDING)),
+    ],
+    Collections.BOOKING_ISSUES: [
+        index(("status", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.COMPLAINTS: [
+        index(("priority", DESCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("filed_by", ASCENDING), ("created_at", DESCENDING)),
+        index(("complaint_against_id", ASCENDING), ("complaint_against_type", ASCENDING)),
+        index(("status", ASCENDING)),
+    ],
+    Collections.COMPLAINT_RESPONSES: [
+        index(("complaint_id", ASCENDING)),
+    ],
+    Collections.BLACKLIST: [
+        index(("user_id", ASCENDING)),
+        index(("created_at", DESCENDING)),
+        index(("is_permanent", ASCENDING), ("ban_until", ASCENDING)),
+    ],
+    Collections.AUDIT_LOGS: [
+        index(("created_at", DESCENDING), ("_id", DESCENDING)),
+        index(("target_id", ASCENDING), ("created_at", DESCENDING)),
+    ],
+    Collections.PLATFORM_ANALYTICS: [
+        index(("dimension", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING)),
+        index(("expires_at", ASCENDING), expireAfterSeconds=0),
+    ],
+    Collections.BROADCASTS: [
+        index(("status", ASCENDING)),
+    ],
+    Collections.JOBS: [
+        index(("key", ASCENDING), unique=True, partialFilterExpression={"key": {"$exists": True}}),
+        index(("status", ASCENDING), ("run_at", ASCENDING)),
+        index(("status", ASCENDING), ("lease_until", ASCENDING)),
+        index(("expires_at", ASCENDING), expireAfterSeconds=0),
+    ],
+    Collections.DEAD_JOBS: [
+        index(("key", ASCENDING)),
+        index(("failed_at", DESCENDING)),
+    ],
+    Collections.SERVICE_AREA_COVERAGE: [
+        index(("entries.servicer_id", ASCENDING)),
+    ],
+    Collections.PRESENCE: [
+        index(("user_id", ASCENDING), ("expires_at", ASCENDING)),
+        index(("worker_id", ASCENDING)),
+        index(("expires_at", ASCENDING), expireAfterSeconds=0),
+    ],
+    Collections.SERVICE_CATEGORIES: [
+        index(("name", ASCENDING)),
+    ],
+    # Keyed by the user's _id; the default _id index serves every lookup
+    Collections.USER_COUNTERS: [],
+    Collections.MAINTENANCE_REMINDERS: [
+        index(("user_id", ASCENDING), ("is_active", ASCENDING), ("next_service_date", ASCENDING)),
+        index(("is_active", ASCENDING), ("next_service_date", ASCENDING)),
+    ],
+}
+
+# Most frequent query shapes: (collection, filter, sort). --explain checks none of them collection-scans.
+_ANY_ID = ObjectId()
+HOT_QUERIES = [
+    (Collections.NOTIFICATIONS, {"user_id": _ANY_ID}, [("created_at", -1), ("_id", -1)]),
+    (Collections.NOTIFICATIONS, {"user_id": _ANY_ID, "is_read": False}, [("created_at", -1)]),
+    (Collections.CHAT_MESSAGES, {"booking_id": _ANY_ID}, [("created_at", 1), ("_id", 1)]),
+    (Collections.PRE_BOOKING_MESSAGES, {"chat_id": _ANY_ID}, [("created_at", 1), ("_id", 1)]),
+    (Collections.PRE_BOOKING_CHATS, {"user_id": _ANY_ID}, [("last_message_at", -1)]),
+    (Collections.BOOKING_TRACKING, {"booking_id": _ANY_ID}, [("created_at", -1)]),
+    (Collections.RATINGS, {"servicer_id": _ANY_ID}, [("created_at", -1), ("_id", -1)]),
+    (Collections.RATINGS, {"booking_id": _ANY_ID}, None),
+    (Collections.COMPLAINTS, {"complaint_against_id": _ANY_ID, "complaint_against_type": "servicer"}, None),
+    (Collections.COMPLAINTS, {}, [("priority", -1), ("created_at", -1), ("_id", -1)]),
+    (Collections.AUDIT_LOGS, {}, [("created_at", -1), ("_id", -1)]),
+    (Collections.BLACKLIST, {"user_id": _ANY_ID}, None),
+    (Collections.PAYOUT_REQUESTS, {"status": "pending"}, [("created_at", -1)]),
+    (Collections.TRANSACTIONS, {"user_id": _ANY_ID}, [("created_at", -1), ("_id", -1)]),
+    (Collections.BOOKINGS, {"booking_status": "pending"}, [("created_at", -1), ("_id", -1)]),
+    (Collections.BOOKINGS, {"is_emergency": True, "dispatch.offered": _ANY_ID, "dispatch.status": "dispatching"}, [("created_at", -1)]),
+    (Collections.WALLETS, {"user_id": _ANY_ID}, None),
+    (Collections.JOBS, {"status": "queued"}, [("run_at", 1)]),
+    (Collections.PRESENCE, {"user_id": {"$in": [str(_ANY_ID)]}}, None),
+    (Collections.USER_COUNTERS, {"_id": _ANY_ID}, None),
+    (Collections.SERVICE_CATEGORIES, {"name": "Plumbing"}, None),
+]
+
+
+def _key(spec) -> tuple:
+    """Normalised key pattern; servers may report directions as floats"""
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in spec)
+
+
+def _options(info: dict) -> dict:
+    # unique/sparse default to False; expireAfterSeconds=0 is a real setting
+    return {
+        option: info[option] for option in COMPARED_OPTIONS
+        if info.get(option) is not None and info.get(option) is not False
+    }
+
+
+async def reconcile_indexes(db, create: bool = True, fix_drift: bool = False) -> dict:
+    """
+    Diff INDEXES against the database.
+    Returns {"created": [...], "missing": [...], "drift": [...], "unmanaged": [...], "errors": [...]}
+    with "collection.index_name" entries.
+    """
+    report = {"created": [], "missing": [], "drift": [], "unmanaged": [], "errors": []}
+
+    for collection, models in INDEXES.items():
+        try:
+            existing = await db[collection].index_information()
+        except Exception as e:
+            report["errors"].append(f"{collection}: {e}")
+            continue
+        by_key = {_key(info["key"]): (name, info) for name, info in existing.items()}
+
+        to_build = []
+        managed = set()
+        for model in models:
+            document = model.document
+            key = _key(document["key"].items())
+            managed.add(key)
+            label = f"{collection}.{document['name']}"
+            if key not in by_key:
+                report["missing"].append(label)
+                to_build.append(model)
+                continue
+            name, info = by_key[key]
+            if _options(info) != _options(document):
+                report["drift"].append(f"{collection}.{name}: has {_options(info)}, registry wants {_options(document)}")
+                if fix_drift:
+                    await db[collection].drop_index(name)
+                    to_build.append(model)
+
+        for name, info in existing.items():
+            if name != "_id_" and _key(info["key"]) not in managed:
+                report["unmanaged"].append(f"{collection}.{name}")
+
+        if to_build and create:
+            try:
+                names = await db[collection].create_indexes(to_build)
+                report["created"].extend(f"{collection}.{name}" for name in names)
+            except Exception as e:
+                report["errors"].append(f"{collection}: {e}")
+
+    return report
+
+
+def _collscans(plan: dict) -> bool:
+    if plan.get("stage") == "COLLSCAN":
+        return True
+    children = [plan.get("inputStage")] + plan.get("inputStages", [])
+    return any(_collscans(child) for child in children if child)
+
+
+async def explain_hot_queries(db) -> List[str]:
+    """Hot queries whose winning plan collection-scans"""
+    scanning = []
+    for collection, query, sort in HOT_QUERIES:
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = dict(sort)
+        result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        plan = result["queryPlanner"]["winningPlan"]
+        if _collscans(plan.get("queryPlan", plan)):
+            scanning.append(f"{collection} {query} sort={sort}")
+    return scanning
+
+
+async def _main(args) -> int:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(settings.MONGODB_URL, serverSelectionTimeoutMS=5000)
+    db = client[settings.DATABASE_NAME]
+    try:
+        report = await reconcile_indexes(db, create=not args.check, fix_drift=args.fix_drift)
+        for label in report["created"]:
+            print(f"✅ created {label}")
+        if args.check:
+            for label in report["missing"]:
+                print(f"❌ missing {label}")
+        for line in report["drift"]:
+            print(f"⚠️ drift {line}")
+        for label in report["unmanaged"]:
+            print(f"ℹ️ unmanaged {label}")
+        for line in report["errors"]:
+            print(f"❌ error {line}")
+
+        failed = bool(report["errors"]) or (args.check and bool(report["missing"] or report["drift"]))
+        if args.explain or args.check:
+            scanning = await explain_hot_queries(db)
+            for line in scanning:
+                print(f"❌ COLLSCAN {line}")
+            if not scanning:
+                print(f"✅ all {len(HOT_QUERIES)} hot queries use an index")
+            failed = failed or bool(scanning)
+        return 1 if failed else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile MongoDB indexes with the registry")
+    parser.add_argument("--check", action="store_true", help="report only, build nothing; includes --explain")
+    parser.add_argument("--fix-drift", action="store_true", help="drop and rebuild indexes whose options drifted")
+    parser.add_argument("--explain", action="store_true", help="verify hot queries are index-backed")
+    sys.exit(asyncio.run(_main(parser.parse_args())))
@@ -2,27 +2,33 @@ from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, F
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
-from passlib.context import CryptContext
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
-from bson import ObjectId
+from typing import Optional, List, Dict, Any, Tuple
+from bson import ObjectId, json_util
+import base64
+import copy
+import json
 import random
 import string
+import shutil
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
 import stripe
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import socketio
 from geopy.distance import geodesic
 import math
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 import time
+from collections import deque, OrderedDict
 from pydantic import BaseModel
+from types import SimpleNamespace
 
 import stripe
 # Import models and config
@@ -30,7 +36,14 @@ from models import *
 from config import settings, Collections, CloudinaryFolders, EmailTemplates, NotificationTypes, SocketEvents, Messages
 
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
+import password_hashing
+import indexes
+import socket_bus
+import email_delivery
+import geo_cells
 
 # Thread pool for blocking operations
 executor = ThreadPoolExecutor(max_workers=4)
@@ -42,15 +55,6 @@ app = FastAPI(
 )
 
 
-# CORS Middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],   # <-- allows all domains
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 class TimeoutMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         start_time = time.time()
@@ -69,7 +73,6 @@ class TimeoutMiddleware(BaseHTTPMiddleware):
 app.add_middleware(TimeoutMiddleware)
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
 # MongoDB Client
@@ -83,26 +86,148 @@ cloudinary.config(
     api_secret=settings.CLOUDINARY_API_SECRET
 )
 
-# Stripe Configuration
-if stripe:
+# ============= PAYMENT GATEWAY =============
+# All Stripe calls go through `payment_gateway`, which is awaitable end to end
+# (httpx connection pool, no blocking HTTPS on the event loop). Writes take an
+# idempotency key so client and network retries never double-charge or
+# double-refund. Set PAYMENT_GATEWAY=fake to run without Stripe.
+
+def booking_idempotency_key(booking_id, operation: str) -> str:
+    """Stable per-booking key, e.g. booking-<id>-payment_intent"""
+    return f"booking-{booking_id}-{operation}"
+
+class StripeGateway:
+    """Async Stripe client over pooled keep-alive connections"""
+
+    def __init__(self, api_key: str):
+        self._http_client = stripe.HTTPXClient(timeout=settings.STRIPE_TIMEOUT_SECONDS)
+        self._client = stripe.StripeClient(
+            api_key,
+            http_client=self._http_client,
+            max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES
+        )
+
+    async def create_payment_intent(self, amount: float, metadata: dict, idempotency_key: str, description: Optional[str] = None):
+        params = {
+            "amount": int(round(amount * 100)),  # Convert to smallest currency unit (paise)
+            "currency": settings.STRIPE_CURRENCY or "inr",
+            "metadata": metadata,
+            "automatic_payment_methods": {"enabled": True}
+        }
+        if description:
+            params["description"] = description
+        return await self._client.payment_intents.create_async(
+            params=params, options={"idempotency_key": idempotency_key}
+        )
+
+    async def retrieve_payment_intent(self, payment_intent_id: str):
+        return await self._client.payment_intents.retrieve_async(payment_intent_id)
+
+    async def create_refund(self, payment_intent_id: str, idempotency_key: str, amount: Optional[float] = None):
+        params = {"payment_intent": payment_intent_id}
+        if amount is not None:
+            params["amount"] = int(round(amount * 100))
+        return await self._client.refunds.create_async(
+            params=params, options={"idempotency_key": idempotency_key}
+        )
+
+    async def verify_credentials(self):
+        return await self._client.accounts.retrieve_current_async()
+
+    async def close(self):
+        await self._http_client.close_async()
+
+class FakePaymentGateway:
+    """In-memory gateway for local development and tests - every intent succeeds"""
+
+    def __init__(self):
+        self.payment_intents = {}
+        self.refunds = {}
+        self._idempotent_results = {}
+
+    def _idempotent(self, idempotency_key: str, create):
+        if idempotency_key not in self._idempotent_results:
+            self._idempotent_results[idempotency_key] = create()
+        return self._idempotent_results[idempotency_key]
+
+    async def create_payment_intent(self, amount: float, metadata: dict, idempotency_key: str, description: Optional[str] = None):
+        def create():
+            intent_id = f"pi_fake_{ObjectId()}"
+            intent = SimpleNamespace(
+                id=intent_id,
+                client_secret=f"{intent_id}_secret",
+                status="succeeded",
+                amount=int(round(amount * 100)),
+                currency=settings.STRIPE_CURRENCY or "inr",
+                metadata=metadata,
+                description=description
+            )
+            self.payment_intents[intent_id] = intent
+            return intent
+        return self._idempotent(idempotency_key, create)
+
+    async def retrieve_payment_intent(self, payment_intent_id: str):
+        intent = self.payment_intents.get(payment_intent_id)
+        if not intent:
+            raise stripe.error.InvalidRequestError(f"No such payment_intent: '{payment_intent_id}'", "intent")
+        return intent
+
+    async def create_refund(self, payment_intent_id: str, idempotency_key: str, amount: Optional[float] = None):
+        intent = await self.retrieve_payment_intent(payment_intent_id)
+        def create():
+            refund = SimpleNamespace(
+                id=f"re_fake_{ObjectId()}",
+                payment_intent=payment_intent_id,
+                amount=int(round(amount * 100)) if amount is not None else intent.amount,
+                status="succeeded"
+            )
+            self.refunds[refund.id] = refund
+            return refund
+        return self._idempotent(idempotency_key, create)
+
+    async def verify_credentials(self):
+        return SimpleNamespace(id="acct_fake")
+
+    async def close(self):
+        pass
+
+def build_payment_gateway():
+    if settings.PAYMENT_GATEWAY == "fake":
+        print("⚠️ Using fake payment gateway - no real charges will be made")
+        return FakePaymentGateway()
+    return StripeGateway(settings.STRIPE_SECRET_KEY)
+
+payment_gateway = build_payment_gateway()
+
+async def verify_payment_gateway_background():
+    """Check the Stripe key at startup without blocking the event loop"""
     try:
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        # Test the API key
-        stripe.Account.retrieve()
+        await payment_gateway.verify_credentials()
         print("✅ Stripe configured successfully")
     except stripe.error.AuthenticationError as e:
         print(f"❌ Stripe authentication failed: {e}")
         print("Check your STRIPE_SECRET_KEY in settings")
     except Exception as e:
         print(f"⚠️ Stripe configuration warning: {e}")
-else:
-    print("⚠️ Stripe not available - payment features disabled")
 
 
-# Socket.IO
+# ============= SOCKET.IO =============
+# Rooms are per worker, so with more than one uvicorn worker every emit has to
+# go through a shared pub/sub channel to reach sockets held elsewhere
+# (SOCKET_MANAGER=redis). "memory" is socketio's single-process manager and
+# "fake" an in-process bus for tests. SOCKET_WRITE_ONLY=true makes a process
+# emit-only: it publishes to the workers holding the sockets but never
+# subscribes (dedicated job/scheduler runners).
+socket_manager = socket_bus.build_socket_manager(
+    settings.SOCKET_MANAGER,
+    url=settings.SOCKET_REDIS_URL,
+    channel=settings.SOCKET_CHANNEL,
+    write_only=settings.SOCKET_WRITE_ONLY
+)
 sio = socketio.AsyncServer(
     async_mode='asgi',
-    cors_allowed_origins=settings.SOCKET_IO_CORS_ALLOWED_ORIGINS
+    cors_allowed_origins=settings.SOCKET_IO_CORS_ALLOWED_ORIGINS,
+    client_manager=socket_manager
 )
 socket_app = socketio.ASGIApp(sio, app)
 
@@ -130,57 +255,182 @@ async def startup_db_client():
     db = mongodb_client[settings.DATABASE_NAME]
     print("Connected to MongoDB!")
     
-    # ✅ CREATE INDEXES ONLY IF NEEDED
-    await create_indexes_if_needed()
-
-async def create_indexes_if_needed():
-    """Create indexes only if they don't exist"""
+    # ✅ CREATE MISSING INDEXES (diffed against the registry in indexes.py)
+    # Builds run in the background so a large build never delays startup
+    asyncio.create_task(ensure_indexes())
+    await wallet_ledger.detect_transactions()
+    asyncio.create_task(prepare_servicer_geo())
+    asyncio.create_task(verify_payment_gateway_background())
+    email_service.start()
+    location_tracker.start()
+    presence.start()
+    password_hasher.start()
+    notification_pipeline.start()
+    category_cache.start()
+    job_queue.start()
+    asyncio.create_task(broadcast_engine.resume_pending())
+    asyncio.create_task(dispatch_engine.resume_pending())
+    metrics_store.start()
+    asyncio.create_task(metrics_store.backfill_if_empty())
+    asyncio.create_task(reconcile_rating_aggregates_background(only_missing=True))
+    asyncio.create_task(reconcile_unread_counters_background(only_if_missing=True))
+
+async def ensure_indexes():
+    """Build registry indexes missing on this deployment and log drift (see indexes.py)"""
     try:
-        indexes = await db[Collections.USERS].index_information()
-        if 'email_1' not in indexes:
-            print("Creating indexes...")
-            await create_indexes()
-        else:
-            print("Indexes already exist, skipping")
+        report = await indexes.reconcile_indexes(db)
+        for label in report["created"]:
+            print(f"✅ Index created: {label}")
+        for line in report["drift"]:
+            print(f"⚠️ Index drift: {line}")
+        if report["unmanaged"]:
+            print(f"ℹ️ {len(report['unmanaged'])} indexes not in the registry: {', '.join(report['unmanaged'])}")
+        for line in report["errors"]:
+            print(f"❌ Index error: {line}")
+        for line in await indexes.explain_hot_queries(db):
+            print(f"❌ Hot query not served by an index (COLLSCAN): {line}")
     except Exception as e:
-        print(f"Error checking indexes: {e}")
+        print(f"Error reconciling indexes: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Flush in-memory buffers while the database is still reachable
+    await location_tracker.stop()
+    await presence.stop()
+    await metrics_store.stop()
+    await job_queue.stop()
+    await broadcast_engine.stop()
+    await dispatch_engine.stop()
+    await category_cache.stop()
+    await chat_service.stop()
+    await notification_pipeline.stop()
+    await email_service.stop()
+    await socket_bus.stop_socket_manager(socket_manager)
+    await payment_gateway.close()
+    password_hasher.stop()
     if mongodb_client:
         mongodb_client.close()
         print("Disconnected from MongoDB!")
 
-async def create_indexes():
-    """Create database indexes for better performance"""
-    # Users
-    await db[Collections.USERS].create_index("email", unique=True)
-    await db[Collections.USERS].create_index("role")
-    
-    # Servicers
-    await db[Collections.SERVICERS].create_index("user_id")
-    await db[Collections.SERVICERS].create_index("verification_status")
-    await db[Collections.SERVICERS].create_index([("service_categories", 1)])
-    
-    # Bookings
-    await db[Collections.BOOKINGS].create_index("booking_number", unique=True)
-    await db[Collections.BOOKINGS].create_index("user_id")
-    await db[Collections.BOOKINGS].create_index("servicer_id")
-    await db[Collections.BOOKINGS].create_index("booking_status")
-    
-    # Transactions
-    await db[Collections.TRANSACTIONS].create_index("user_id")
-    await db[Collections.TRANSACTIONS].create_index("booking_id")
-    
-    # OTPs
-    await db[Collections.OTPS].create_index("email")
-    await db[Collections.OTPS].create_index("expires_at", expireAfterSeconds=0)
+# ============= CREDENTIAL HASHING =============
+# bcrypt is ~100-300 ms of CPU per call, so it never runs on the event loop.
+# Hashes and verifications go to a process pool sized to the cores. At most
+# one job per worker is in flight; the rest wait here, so queue wait can be
+# measured and capped. Past PASSWORD_HASH_MAX_QUEUE waiters (or
+# PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS of waiting) requests get a 503 instead
+# of starving everything else in the worker.
+
+class PasswordHasher:
+    """bcrypt in a process pool with bounded admission"""
+
+    def __init__(self):
+        self.workers = settings.PASSWORD_HASH_WORKERS or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._wait_times = deque(maxlen=500)
+        self._hash_times = deque(maxlen=500)
+        self.stats = {"hashes": 0, "verifications": 0, "rehashes": 0, "rejected": 0}
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=password_hashing.init_worker,
+                initargs=(settings.BCRYPT_ROUNDS,)
+            )
+            self._slots = asyncio.Semaphore(self.workers)
+            print(f"✅ Password hashing pool started ({self.workers} workers)")
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _busy(self):
+        self.stats["rejected"] += 1
+        return HTTPException(
+            status_code=503,
+            detail="Too many sign-in attempts right now, please retry shortly",
+            headers={"Retry-After": "2"}
+        )
+
+    async def _run(self, fn, *args):
+        self.start()
+        # Pin the pool and its semaphore: a concurrent restart swaps both, and
+        # the slot must go back to the semaphore it was taken from
+        pool, slots = self._pool, self._slots
+        if self._waiting >= settings.PASSWORD_HASH_MAX_QUEUE:
+            raise self._busy()
+
+        self._waiting += 1
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(slots.acquire(), settings.PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise self._busy()
+        finally:
+            self._waiting -= 1
+
+        try:
+            self._wait_times.append(time.perf_counter() - queued_at)
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # A worker died; replace the pool once, not once per in-flight call
+            if self._pool is pool:
+                print("⚠️ Password hashing pool broken, restarting")
+                self.stop()
+                self.start()
+            raise self._busy()
+        finally:
+            slots.release()
+
+        self._hash_times.append(elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        self.stats["hashes"] += 1
+        return await self._run(password_hashing.hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(valid, new_hash); new_hash is set when the stored hash uses outdated parameters"""
+        self.stats["verifications"] += 1
+        return await self._run(password_hashing.verify_and_update, password, hashed or "")
+
+    def metrics(self) -> dict:
+        waits = sorted(self._wait_times)
+        hashes = sorted(self._hash_times)
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "waiting": self._waiting,
+            "queue_wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+            "queue_wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else None,
+            "hash_time_avg_ms": round(sum(hashes) / len(hashes) * 1000, 1) if hashes else None,
+            "hash_time_p95_ms": round(hashes[int(len(hashes) * 0.95)] * 1000, 1) if hashes else None
+        }
+
+password_hasher = PasswordHasher()
+
+async def update_password_hash_background(user_id: ObjectId, old_hash: str, new_hash: str):
+    """Store a rehashed password unless it was changed in the meantime"""
+    try:
+        result = await db[Collections.USERS].update_one(
+            {"_id": user_id, "password_hash": old_hash},
+            {"$set": {"password_hash": new_hash}}
+        )
+        if result.modified_count:
+            password_hasher.stats["rehashes"] += 1
+    except Exception as e:
+        print(f"Password rehash failed: {e}")
 
 # ============= HELPER FUNCTIONS =============
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    valid, _ = await password_hasher.verify(plain_password, hashed_password)
+    return valid
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -216,6 +466,8 @@ async def create_servicer_profile_background(user_id: str, category_ids: List[st
             "verification_status": VerificationStatus.PENDING,
             "average_rating": 0.0,
             "total_ratings": 0,
+            "rating_sum": 0,
+            "rating_histogram": empty_rating_histogram(),
             "total_jobs_completed": 0,
             "service_radius_km": 10.0,
             "availability_status": AvailabilityStatus.OFFLINE,
@@ -224,6 +476,7 @@ async def create_servicer_profile_background(user_id: str, category_ids: List[st
         }
         
         await db[Collections.SERVICERS].insert_one(servicer)
+        invalidate_principal(user_id=user_id)
         print(f"✅ Servicer profile created for {user_id}")
         
     except Exception as e:
@@ -241,6 +494,8 @@ async def create_servicer_profile_with_validated_categories(user_id: str, catego
             "verification_status": VerificationStatus.PENDING,
             "average_rating": 0.0,
             "total_ratings": 0,
+            "rating_sum": 0,
+            "rating_histogram": empty_rating_histogram(),
             "total_jobs_completed": 0,
             "service_radius_km": 10.0,
             "availability_status": AvailabilityStatus.OFFLINE,
@@ -249,11 +504,12 @@ async def create_servicer_profile_with_validated_categories(user_id: str, catego
         }
         
         result = await db[Collections.SERVICERS].insert_one(servicer)
+        invalidate_principal(user_id=user_id)
         print(f"✅ Servicer profile created: {result.inserted_id}")
         
         # Log categories for debugging
         for cat_id in category_ids:
-            category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": cat_id})
+            category = await category_cache.get(cat_id)
             print(f"  - Category: {category['name'] if category else 'Unknown'}")
         
     except Exception as e:
@@ -300,6 +556,263 @@ def calculate_eta(distance_km: float, avg_speed_kmh: float = 30) -> int:
     """Calculate ETA in minutes"""
     return int((distance_km / avg_speed_kmh) * 60)
 
+# ============= GEO DISCOVERY =============
+# Servicer locations are denormalized from users.latitude/longitude into a
+# GeoJSON point on servicers.location (2dsphere indexed) so radius search,
+# filtering, distance sort and pagination run in a single $geoNear pipeline.
+
+def build_geo_point(latitude: float, longitude: float) -> dict:
+    """GeoJSON point - note MongoDB expects [longitude, latitude]"""
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+def category_match_values(category: str) -> list:
+    """Categories are stored as ObjectIds on new profiles and strings on old ones"""
+    if ObjectId.is_valid(category):
+        return [ObjectId(category), category]
+    return [category]
+
+async def backfill_servicer_locations():
+    """Populate servicers.location for profiles created before the geo index"""
+    try:
+        pipeline = [
+            {"$match": {"location": {"$exists": False}}},
+            {"$lookup": {
+                "from": Collections.USERS,
+                "localField": "user_id",
+                "foreignField": "_id",
+                "pipeline": [{"$project": {"latitude": 1, "longitude": 1}}],
+                "as": "user"
+            }},
+            {"$unwind": "$user"},
+            {"$match": {"user.latitude": {"$ne": None}, "user.longitude": {"$ne": None}}},
+            {"$project": {"latitude": "$user.latitude", "longitude": "$user.longitude"}}
+        ]
+        updates = []
+        async for doc in db[Collections.SERVICERS].aggregate(pipeline):
+            updates.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"location": build_geo_point(doc["latitude"], doc["longitude"])}}
+            ))
+        if updates:
+            await db[Collections.SERVICERS].bulk_write(updates, ordered=False)
+            print(f"📍 Backfilled location for {len(updates)} servicers")
+    except Exception as e:
+        print(f"⚠️ Servicer location backfill failed: {e}")
+
+async def find_servicers(
+    query: dict,
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+    radius_km: Optional[float] = None,
+    sort: Optional[list] = None,
+    skip: int = 0,
+    limit: int = 20
+) -> tuple:
+    """
+    Single round-trip servicer discovery.
+
+    With coordinates, $geoNear applies the radius and `query` filters and sorts
+    by distance. Owners are joined in the same pipeline so blocked accounts are
+    excluded before pagination, keeping pages full and `total` exact.
+    Returns (servicers, total); each servicer carries a `user` sub-document and,
+    for geo queries, `distance_km`.
+    """
+    pipeline = []
+    if latitude is not None and longitude is not None:
+        geo_near = {
+            "near": build_geo_point(latitude, longitude),
+            "distanceField": "distance_m",
+            "spherical": True,
+            "key": "location",
+            "query": query
+        }
+        if radius_km is not None:
+            geo_near["maxDistance"] = radius_km * 1000
+        pipeline.append({"$geoNear": geo_near})
+    else:
+        pipeline.append({"$match": query})
+        if sort:
+            pipeline.append({"$sort": dict(sort)})
+
+    pipeline += [
+        {"$lookup": {
+            "from": Collections.USERS,
+            "localField": "user_id",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {
+                "name": 1, "email": 1, "phone": 1,
+                "profile_image_url": 1, "is_blocked": 1
+            }}],
+            "as": "user"
+        }},
+        {"$unwind": "$user"},
+        {"$match": {"user.is_blocked": {"$ne": True}}},
+        {"$facet": {
+            "servicers": [{"$skip": skip}, {"$limit": limit}],
+            "total": [{"$count": "count"}]
+        }}
+    ]
+
+    result = await db[Collections.SERVICERS].aggregate(pipeline).to_list(1)
+    facet = result[0] if result else {"servicers": [], "total": []}
+    total = facet["total"][0]["count"] if facet["total"] else 0
+
+    servicers = facet["servicers"]
+    for servicer in servicers:
+        if "distance_m" in servicer:
+            servicer["distance_km"] = round(servicer.pop("distance_m") / 1000, 2)
+    return servicers, total
+
+# ============= SERVICE COVERAGE GRID =============
+# Coverage checks run on every address change in the app. Rather than scanning
+# approved servicers, each one is indexed into the geohash cells (geo_cells,
+# COVERAGE_GEOHASH_PRECISION) its service circle touches. A cell document in
+# service_area_coverage lists those servicers with location, radius and
+# categories, plus category_ids - the union of categories served there. A
+# check reads the single cell holding the point and finishes with exact
+# distances in memory. A servicer's cells are rewritten when its location,
+# radius, categories, approval or suspension change; a daily rebuild repairs
+# anything missed.
+
+COVERAGE_SERVICER_PROJECTION = {
+    "verification_status": 1, "is_suspended": 1, "location": 1,
+    "service_radius_km": 1, "service_categories": 1
+}
+
+class CoverageIndex:
+    """Geohash cell -> servicers whose service area reaches it"""
+
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.stats = {"lookups": 0, "refreshes": 0, "rebuilds": 0}
+
+    @staticmethod
+    def _entry(servicer: dict) -> Optional[dict]:
+        """Cell entry for a servicer, or None if it should not be in the grid"""
+        coordinates = (servicer.get('location') or {}).get('coordinates')
+        if (servicer.get('verification_status') != VerificationStatus.APPROVED
+                or servicer.get('is_suspended') or not coordinates):
+            return None
+        longitude, latitude = coordinates
+        return {
+            "servicer_id": str(servicer['_id']),
+            "latitude": latitude,
+            "longitude": longitude,
+            "radius_km": float(servicer.get('service_radius_km', 10)),
+            "categories": [str(c) for c in servicer.get('service_categories', [])]
+        }
+
+    def _cells(self, entry: dict) -> List[str]:
+        return geo_cells.covering(entry['latitude'], entry['longitude'], entry['radius_km'], self.precision)
+
+    @staticmethod
+    def _summarise() -> dict:
+        return {"$set": {
+            "category_ids": {"$reduce": {
+                "input": "$entries.categories",
+                "initialValue": [],
+                "in": {"$setUnion": ["$$value", "$$this"]}
+            }},
+            "updated_at": datetime.utcnow()
+        }}
+
+    async def refresh_servicer(self, servicer_id):
+        """Re-index one servicer after a change to anything the grid depends on"""
+        servicer = await db[Collections.SERVICERS].find_one(
+            {"_id": ObjectId(servicer_id)}, COVERAGE_SERVICER_PROJECTION
+        )
+        entry = self._entry(servicer) if servicer else None
+        cells = self._cells(entry) if entry else []
+        others = {"$filter": {
+            "input": {"$ifNull": ["$entries", []]},
+            "cond": {"$ne": ["$$this.servicer_id", str(servicer_id)]}
+        }}
+
+        if cells:
+            await db[Collections.SERVICE_AREA_COVERAGE].bulk_write([
+                UpdateOne(
+                    {"_id": cell},
+                    [{"$set": {"entries": {"$concatArrays": [others, [{"$literal": entry}]]}}}, self._summarise()],
+                    upsert=True
+                )
+                for cell in cells
+            ], ordered=False)
+        # Leave the cells it no longer reaches
+        await db[Collections.SERVICE_AREA_COVERAGE].update_many(
+            {"entries.servicer_id": str(servicer_id), "_id": {"$nin": cells}},
+            [{"$set": {"entries": others}}, self._summarise()]
+        )
+        self.stats["refreshes"] += 1
+
+    async def servicer_changed(self, servicer_id):
+        """refresh_servicer for request handlers - a failure waits for the daily rebuild"""
+        try:
+            await self.refresh_servicer(servicer_id)
+        except Exception as e:
+            print(f"⚠️ Coverage refresh failed for servicer {servicer_id}: {e}")
+
+    async def rebuild(self) -> int:
+        """Recompute every cell from the servicers collection; returns the cell count"""
+        cells: Dict[str, List[dict]] = {}
+        async for servicer in db[Collections.SERVICERS].find(
+            {"verification_status": VerificationStatus.APPROVED, "location": {"$exists": True}},
+            COVERAGE_SERVICER_PROJECTION
+        ):
+            entry = self._entry(servicer)
+            if entry:
+                for cell in self._cells(entry):
+                    cells.setdefault(cell, []).append(entry)
+
+        now = datetime.utcnow()
+        writes = [
+            ReplaceOne(
+                {"_id": cell},
+                {
+                    "entries": entries,
+                    "category_ids": sorted({c for entry in entries for c in entry['categories']}),
+                    "updated_at": now
+                },
+                upsert=True
+            )
+            for cell, entries in cells.items()
+        ]
+        for start in range(0, len(writes), 1000):
+            await db[Collections.SERVICE_AREA_COVERAGE].bulk_write(writes[start:start + 1000], ordered=False)
+        await db[Collections.SERVICE_AREA_COVERAGE].delete_many({"_id": {"$nin": list(cells)}})
+        self.stats["rebuilds"] += 1
+        return len(cells)
+
+    async def rebuild_if_empty(self):
+        try:
+            if not await db[Collections.SERVICE_AREA_COVERAGE].find_one({}, {"_id": 1}):
+                count = await self.rebuild()
+                print(f"🗺️ Coverage grid built ({count} cells)")
+        except Exception as e:
+            print(f"⚠️ Coverage grid build failed: {e}")
+
+    async def lookup(self, latitude: float, longitude: float) -> List[Tuple[dict, float]]:
+        """(entry, distance_km) for every servicer whose service area contains the point"""
+        self.stats["lookups"] += 1
+        cell = await db[Collections.SERVICE_AREA_COVERAGE].find_one(
+            {"_id": geo_cells.encode(latitude, longitude, self.precision)}, {"entries": 1}
+        )
+        in_range = []
+        for entry in (cell or {}).get('entries', []):
+            distance = calculate_distance(latitude, longitude, entry['latitude'], entry['longitude'])
+            if distance <= entry['radius_km']:
+                in_range.append((entry, distance))
+        return in_range
+
+    def metrics(self) -> dict:
+        return {**self.stats, "precision": self.precision}
+
+coverage_index = CoverageIndex(precision=settings.COVERAGE_GEOHASH_PRECISION)
+
+async def prepare_servicer_geo():
+    """Startup: backfill servicer locations, then build the coverage grid if it is missing"""
+    await backfill_servicer_locations()
+    await coverage_index.rebuild_if_empty()
+
 # async def send_email(to_email: str, subject: str, body: str):
 #     """Send email using SMTP"""
 #     try:
@@ -321,51 +834,15 @@ def calculate_eta(distance_km: float, avg_speed_kmh: float = 30) -> int:
 #         print(f"Email sending failed: {e}")
 #         return False
 
-async def send_email(to_email: str, subject: str, body: str):
-    """Send email in background - non-blocking"""
-    try:
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(executor, _send_email_sync, to_email, subject, body)
-        return True
-    except Exception as e:
-        print(f"⚠️ Email failed (non-blocking): {e}")
-        return False
-# In main.py, update _send_email_sync function:
+# ============= EMAIL DELIVERY =============
+# Queued delivery over a pool of persistent SMTP sessions (email_delivery.py).
 
-def _send_email_sync(to_email: str, subject: str, body: str):
-    """Synchronous email sending with detailed logging"""
-    try:
-        print(f"📧 Attempting to send email to: {to_email}")
-        print(f"📧 Subject: {subject}")
-        print(f"📧 SMTP Host: {settings.SMTP_HOST}:{settings.SMTP_PORT}")
-        
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{settings.SMTP_FROM_NAME} <{settings.SMTP_FROM_EMAIL}>"
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        html_part = MIMEText(body, 'html')
-        msg.attach(html_part)
-        
-        with smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=10) as server:
-            server.set_debuglevel(1)  # ✅ Enable SMTP debug output
-            server.starttls()
-            print(f"✅ TLS started")
-            
-            server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-            print(f"✅ SMTP login successful")
-            
-            result = server.send_message(msg)
-            print(f"✅ Email sent successfully to {to_email}")
-            print(f"📊 Server response: {result}")
-            
-        return True
-    except smtplib.SMTPException as e:
-        print(f"❌ SMTP Error sending to {to_email}: {e}")
-        return False
-    except Exception as e:
-        print(f"❌ General Error sending to {to_email}: {e}")
-        return False
+email_service = email_delivery.EmailDeliveryService(settings)
+
+async def send_email(to_email: str, subject: str, body: str,
+                     priority: int = email_delivery.PRIORITY_BULK):
+    """Queue email for delivery - non-blocking"""
+    return email_service.enqueue(to_email, subject, body, priority)
 
 async def send_otp_email(email: str, otp: str, purpose: str):
     """Send OTP email"""
@@ -380,65 +857,232 @@ async def send_otp_email(email: str, otp: str, purpose: str):
         </body>
     </html>
     """
-    await send_email(email, subject, body)
-async def upload_to_cloudinary(file: UploadFile, folder: str, allowed_types: list = None) -> dict:
+    await send_email(email, subject, body, priority=email_delivery.PRIORITY_URGENT)
+# ============= FILE UPLOADS =============
+# Starlette already spools multipart files to disk past 1 MB. Uploads hand
+# that file handle to the storage backend instead of reading it into memory.
+# Type and size are checked first, and the size comes from the spooled file,
+# not its bytes. Whole multipart bodies over UPLOAD_MAX_REQUEST_MB are refused
+# while they stream in, before they are parsed. Cloudinary gets the spooled
+# file in UPLOAD_CHUNK_MB chunks (upload_large), so at most one chunk per
+# upload is in memory. The Cloudinary SDK is blocking, so uploads run on a
+# dedicated pool of UPLOAD_MAX_CONCURRENCY threads. upload_many sends one
+# request's files concurrently, at most UPLOAD_REQUEST_CONCURRENCY at a time.
+# Clients can also upload straight to Cloudinary with a signature from
+# /api/servicer/documents/upload-signature and pass us the signed response.
+# Set UPLOAD_STORAGE=local to write under UPLOAD_LOCAL_DIR instead (local
+# development / tests).
+
+class UploadSizeLimitMiddleware:
+    """Refuse multipart bodies over UPLOAD_MAX_REQUEST_MB as they arrive"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/"):
+            return await self.app(scope, receive, send)
+
+        limit = settings.UPLOAD_MAX_REQUEST_MB * 1024 * 1024
+        detail = f"Upload too large. Maximum {settings.UPLOAD_MAX_REQUEST_MB}MB per request."
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+# CORS Middleware - registered last so it is the outermost layer and every
+# response, including a 413 from UploadSizeLimitMiddleware, gets CORS headers
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],   # <-- allows all domains
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+class CloudinaryStorage:
+    """Cloudinary uploads on a thread pool, plus signed direct uploads"""
+
+    def __init__(self, pool: ThreadPoolExecutor):
+        self._pool = pool
+
+    async def store(self, fileobj, filename: str, folder: str, params: dict) -> dict:
+        # upload() would read() the whole file into memory; upload_large sends it chunk by chunk
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._pool, lambda: cloudinary.uploader.upload_large(
+                fileobj,
+                folder=folder,
+                filename=filename or "upload",
+                chunk_size=settings.UPLOAD_CHUNK_MB * 1024 * 1024,
+                **params
+            )
+        )
+        return {
+            "url": result['secure_url'],
+            "public_id": result['public_id'],
+            "resource_type": result['resource_type']
+        }
+
+    def sign(self, folder: str) -> dict:
+        params = {"folder": folder, "timestamp": int(time.time())}
+        return {
+            **params,
+            "signature": cloudinary.utils.api_sign_request(params, settings.CLOUDINARY_API_SECRET),
+            "api_key": settings.CLOUDINARY_API_KEY,
+            "upload_url": f"https://api.cloudinary.com/v1_1/{settings.CLOUDINARY_CLOUD_NAME}/auto/upload"
+        }
+
+    def verify(self, upload: dict, folder: str) -> dict:
+        """Result of a direct upload, if Cloudinary signed it and it landed in folder"""
+        try:
+            public_id, version = upload['public_id'], upload['version']
+            signed = cloudinary.utils.verify_api_response_signature(public_id, version, upload['signature'])
+        except (KeyError, TypeError, ValueError):
+            signed = False
+        url = upload.get('secure_url') or ""
+        # secure_url is not covered by the signature, so it has to name the signed asset
+        if (
+            not signed
+            or not public_id.startswith(folder + "/")
+            or not url.startswith(f"https://res.cloudinary.com/{settings.CLOUDINARY_CLOUD_NAME}/")
+            or f"/v{version}/{public_id}" not in url
+        ):
+            raise HTTPException(status_code=400, detail="Invalid direct upload")
+        return {"url": url, "public_id": public_id, "resource_type": upload.get('resource_type')}
+
+
+class LocalStorage:
+    """Writes uploads under UPLOAD_LOCAL_DIR, served from UPLOAD_LOCAL_BASE_URL"""
+
+    def __init__(self, root: str, base_url: str, pool: ThreadPoolExecutor):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self._pool = pool
+
+    def _write(self, fileobj, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(fileobj, out)
+
+    async def store(self, fileobj, filename: str, folder: str, params: dict) -> dict:
+        extension = os.path.splitext(filename or "")[1].lower()[:10]
+        public_id = f"{folder}/{ObjectId()}"
+        await asyncio.get_running_loop().run_in_executor(
+            self._pool, self._write, fileobj, os.path.join(self.root, public_id + extension)
+        )
+        return {
+            "url": f"{self.base_url}/{public_id}{extension}",
+            "public_id": public_id,
+            "resource_type": params['resource_type']
+        }
+
+    def sign(self, folder: str) -> dict:
+        raise HTTPException(status_code=501, detail="Direct uploads need Cloudinary storage")
+
+    def verify(self, upload: dict, folder: str) -> dict:
+        raise HTTPException(status_code=501, detail="Direct uploads need Cloudinary storage")
+
+def build_upload_storage():
+    pool = ThreadPoolExecutor(max_workers=settings.UPLOAD_MAX_CONCURRENCY, thread_name_prefix="upload")
+    if settings.UPLOAD_STORAGE == "local":
+        print(f"⚠️ Using local upload storage in {settings.UPLOAD_LOCAL_DIR}")
+        os.makedirs(settings.UPLOAD_LOCAL_DIR, exist_ok=True)
+        app.mount(settings.UPLOAD_LOCAL_BASE_URL, StaticFiles(directory=settings.UPLOAD_LOCAL_DIR), name="uploads")
+        return LocalStorage(settings.UPLOAD_LOCAL_DIR, settings.UPLOAD_LOCAL_BASE_URL, pool)
+    return CloudinaryStorage(pool)
+
+upload_storage = build_upload_storage()
+
+
+def _upload_size(file: UploadFile) -> int:
+    """Bytes in an UploadFile, measured on the spooled file without reading it"""
+    if getattr(file, 'size', None) is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+def validate_upload(file: UploadFile, allowed_types: list = None, max_size_mb: float = None):
+    """Raise 400 for a file of the wrong type or over max_size_mb (default MAX_DOCUMENT_SIZE)"""
+    max_size_mb = max_size_mb or settings.MAX_DOCUMENT_SIZE
+    content_type = file.content_type or ""
+    file_size_mb = _upload_size(file) / (1024 * 1024)
+    
+    if file_size_mb > max_size_mb:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"File too large: {file_size_mb:.2f}MB. Maximum {max_size_mb}MB allowed."
+        )
+    
+    # Validate file type if allowed_types is specified
+    if allowed_types:
+        is_allowed = False
+        for allowed_type in allowed_types:
+            if allowed_type.endswith('/*'):
+                # Wildcard matching (e.g., 'image/*')
+                type_prefix = allowed_type.split('/')[0]
+                if content_type.startswith(type_prefix + '/'):
+                    is_allowed = True
+                    break
+            elif content_type == allowed_type:
+                # Exact match (e.g., 'application/pdf')
+                is_allowed = True
+                break
+        
+        if not is_allowed:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file type: {content_type}. Allowed types: {', '.join(allowed_types)}"
+            )
+    
+    return file_size_mb
+
+async def upload_to_cloudinary(file: UploadFile, folder: str, allowed_types: list = None, max_size_mb: float = None) -> dict:
     """
-    Upload file to Cloudinary with validation
+    Upload file to the configured storage (Cloudinary) with validation
     
     Args:
         file: UploadFile to upload
         folder: Cloudinary folder path
         allowed_types: List of allowed MIME types (e.g., ['image/*', 'application/pdf'])
                       If None, allows all types
+        max_size_mb: Size limit, MAX_DOCUMENT_SIZE if None
     """
     try:
-        # Read file content
-        contents = await file.read()
-        file_size_mb = len(contents) / (1024 * 1024)
-        
-        print(f"📤 Uploading: {file.filename} ({file.content_type}, {file_size_mb:.2f}MB)")
-        
-        # Validate file size (max 10MB)
-        if file_size_mb > 10:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"File too large: {file_size_mb:.2f}MB. Maximum 10MB allowed."
-            )
+        file_size_mb = validate_upload(file, allowed_types, max_size_mb)
+        content_type = file.content_type or ""
         
-        # Validate file type if allowed_types is specified
-        if allowed_types:
-            is_allowed = False
-            for allowed_type in allowed_types:
-                if allowed_type.endswith('/*'):
-                    # Wildcard matching (e.g., 'image/*')
-                    type_prefix = allowed_type.split('/')[0]
-                    if file.content_type.startswith(type_prefix + '/'):
-                        is_allowed = True
-                        break
-                elif file.content_type == allowed_type:
-                    # Exact match (e.g., 'application/pdf')
-                    is_allowed = True
-                    break
-            
-            if not is_allowed:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid file type: {file.content_type}. Allowed types: {', '.join(allowed_types)}"
-                )
+        print(f"📤 Uploading: {file.filename} ({content_type}, {file_size_mb:.2f}MB)")
         
         # Determine resource type based on content type
-        if file.content_type.startswith('image/'):
+        if content_type.startswith('image/'):
             resource_type = "image"
-        elif file.content_type == 'application/pdf':
+        elif content_type == 'application/pdf':
             resource_type = "raw"  # PDFs should be uploaded as 'raw'
         else:
             resource_type = "auto"
         
-        print(f"📦 Resource type: {resource_type}")
-        
-        # Upload to Cloudinary
         upload_params = {
-            "folder": folder,
             "resource_type": resource_type,
             "unique_filename": True,
             "overwrite": True
@@ -448,15 +1092,13 @@ async def upload_to_cloudinary(file: UploadFile, folder: str, allowed_types: lis
         if resource_type == "image":
             upload_params["format"] = "jpg"
         
-        result = cloudinary.uploader.upload(contents, **upload_params)
+        # Stream the spooled file rather than its bytes
+        file.file.seek(0)
+        result = await upload_storage.store(file.file, file.filename, folder, upload_params)
         
-        print(f"✅ Upload successful: {result['secure_url']}")
+        print(f"✅ Upload successful: {result['url']}")
         
-        return {
-            "url": result['secure_url'],
-            "public_id": result['public_id'],
-            "resource_type": result['resource_type']
-        }
+        return result
         
     except HTTPException:
         raise
@@ -464,8 +1106,180 @@ async def upload_to_cloudinary(file: UploadFile, folder: str, allowed_types: lis
         print(f"❌ Upload failed: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Upload failed: {str(e)}")
 
-async def create_notification(user_id: str, notification_type: str, title: str, message: str, metadata: dict = None):
-    """Create notification - non-blocking"""
+async def upload_many(files: List[UploadFile], folder, allowed_types: list = None, max_size_mb: float = None) -> List[dict]:
+    """
+    Upload a request's files concurrently (UPLOAD_REQUEST_CONCURRENCY at a time).
+    folder is one folder for all files or a list with one per file; results are in input order.
+    """
+    folders = folder if isinstance(folder, list) else [folder] * len(files)
+    # Reject the whole batch before anything is sent
+    for file in files:
+        validate_upload(file, allowed_types, max_size_mb)
+    
+    slots = asyncio.Semaphore(settings.UPLOAD_REQUEST_CONCURRENCY)
+    
+    async def upload(file, file_folder):
+        async with slots:
+            return await upload_to_cloudinary(file, file_folder, allowed_types, max_size_mb)
+    
+    return await asyncio.gather(*(upload(file, file_folder) for file, file_folder in zip(files, folders)))
+
+def parse_direct_uploads(direct_uploads: Optional[str]) -> dict:
+    """Form field holding JSON signed Cloudinary responses: {"field": {...}} or {"field": [{...}]}"""
+    if not direct_uploads:
+        return {}
+    try:
+        parsed = json.loads(direct_uploads)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="direct_uploads must be JSON")
+    if not isinstance(parsed, dict):
+        raise HTTPException(status_code=400, detail="direct_uploads must be a JSON object")
+    return parsed
+
+# ============= NOTIFICATION PIPELINE =============
+# Notifications are written behind: create_notification assigns the _id,
+# buffers the document and returns immediately. A background loop stores
+# the buffer with one insert_many per NOTIFICATION_FLUSH_INTERVAL_SECONDS and
+# then emits the socket events for what was stored. Notifications created
+# with a coalesce_key (e.g. chat messages per conversation) are held for
+# NOTIFICATION_COALESCE_WINDOW_SECONDS, and later ones for the same user
+# and key are merged into them instead of producing a document each.
+
+class NotificationPipeline:
+    """Write-behind notification buffer with coalescing and batched fan-out"""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._ready: List[dict] = []
+        self._coalescing: Dict[tuple, dict] = {}  # (user_id, coalesce_key) -> held notification
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {
+            "submitted": 0, "coalesced": 0, "inserted": 0, "flushes": 0,
+            "backpressure_flushes": 0, "dropped": 0, "duplicates": 0, "flush_errors": 0
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush(force=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.NOTIFICATION_FLUSH_INTERVAL_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Notification flush failed: {e}")
+
+    def pending(self) -> int:
+        return len(self._ready) + len(self._coalescing)
+
+    @staticmethod
+    def _public(notification: dict) -> dict:
+        doc = {key: value for key, value in notification.items() if key != "_flush_after"}
+        doc['_id'] = str(doc['_id'])
+        doc['user_id'] = str(doc['user_id'])
+        return doc
+
+    async def submit(self, notification: dict, coalesce_key: Optional[str] = None) -> Optional[dict]:
+        """Buffer a notification; returns it (with its final _id) or None if dropped"""
+        self.stats["submitted"] += 1
+        slot = (str(notification['user_id']), coalesce_key)
+
+        if coalesce_key is not None and slot in self._coalescing:
+            held = self._coalescing[slot]
+            count = held['metadata'].get('coalesced_count', 1) + 1
+            held['title'] = f"{notification['title']} ({count} new)"
+            held['message'] = notification['message']
+            held['metadata'] = {**notification['metadata'], "coalesced_count": count}
+            held['created_at'] = notification['created_at']
+            self.stats["coalesced"] += 1
+            return self._public(held)
+
+        if self.pending() >= self.max_pending:
+            # Backpressure: make room by flushing before accepting more
+            self.stats["backpressure_flushes"] += 1
+            await self.flush(force=True)
+            if self.pending() >= self.max_pending:
+                self.stats["dropped"] += 1
+                print(f"⚠️ Notification buffer full, dropped notification for {slot[0]}")
+                return None
+
+        notification['_id'] = ObjectId()
+        if coalesce_key is not None:
+            notification['_flush_after'] = time.monotonic() + settings.NOTIFICATION_COALESCE_WINDOW_SECONDS
+            self._coalescing[slot] = notification
+        else:
+            self._ready.append(notification)
+        return self._public(notification)
+
+    async def flush(self, force: bool = False):
+        async with self._flush_lock:
+            now = time.monotonic()
+            for slot, held in list(self._coalescing.items()):
+                if force or held['_flush_after'] <= now:
+                    self._ready.append(self._coalescing.pop(slot))
+
+            batch, self._ready = self._ready, []
+            if not batch:
+                return
+            docs = [{key: value for key, value in doc.items() if key != "_flush_after"} for doc in batch]
+
+            stored = docs
+            try:
+                await db[Collections.NOTIFICATIONS].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Duplicate _ids mean a retried batch was already stored; they are
+                # neither counted nor pushed again (reconcile repairs their counters)
+                errors = e.details.get('writeErrors', [])
+                duplicates = sum(1 for err in errors if err.get('code') == 11000)
+                self.stats["duplicates"] += duplicates
+                self.stats["dropped"] += len(errors) - duplicates
+                not_inserted = {err.get('index') for err in errors}
+                stored = [doc for index, doc in enumerate(docs) if index not in not_inserted]
+            except Exception as e:
+                # Keep what fits for the next flush
+                self.stats["flush_errors"] += 1
+                room = max(self.max_pending - self.pending(), 0)
+                self._ready = batch[:room] + self._ready
+                self.stats["dropped"] += len(batch) - len(batch[:room])
+                print(f"⚠️ Notification insert failed, {min(room, len(batch))} kept for retry: {e}")
+                return
+
+            self.stats["inserted"] += len(stored)
+            self.stats["flushes"] += 1
+            if not stored:
+                return
+            try:
+                await count_new_notifications([doc['user_id'] for doc in stored])
+            except Exception as e:
+                # Reconcile repairs the counters later
+                print(f"⚠️ Unread counter update failed: {e}")
+            asyncio.create_task(self._fan_out([self._public(doc) for doc in stored]))
+
+    async def _fan_out(self, notifications: List[dict]):
+        for notification in notifications:
+            await emit_notification_socket(notification['user_id'], notification)
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "pending": len(self._ready),
+            "coalescing": len(self._coalescing),
+            "capacity": self.max_pending
+        }
+
+notification_pipeline = NotificationPipeline(max_pending=settings.NOTIFICATION_QUEUE_SIZE)
+
+async def create_notification(user_id: str, notification_type: str, title: str, message: str, metadata: dict = None, coalesce_key: str = None):
+    """Create notification - buffered, stored by the notification pipeline"""
     try:
         notification = {
             "user_id": ObjectId(user_id),
@@ -476,16 +1290,7 @@ async def create_notification(user_id: str, notification_type: str, title: str,
             "metadata": metadata or {},
             "created_at": datetime.utcnow()
         }
-        result = await db[Collections.NOTIFICATIONS].insert_one(notification)
-        notification['_id'] = str(result.inserted_id)
-        notification['user_id'] = str(notification['user_id'])
-        
-        # ✅ Emit socket in background
-        asyncio.create_task(
-            emit_notification_socket(user_id, notification)
-        )
-        
-        return notification
+        return await notification_pipeline.submit(notification, coalesce_key)
     except Exception as e:
         print(f"⚠️ Notification failed: {e}")
         return None
@@ -497,55 +1302,2129 @@ async def emit_notification_socket(user_id: str, notification: dict):
         await sio.emit(SocketEvents.NEW_NOTIFICATION, notification, room=f"user-{user_id}")
     except Exception as e:
         print(f"Socket emit failed: {e}")
-# ============= AUTHENTICATION =============
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """Get current authenticated user"""
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        user_id = payload.get("sub")
-        
-        if user_id is None:
-            raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
-        
-        user = await db[Collections.USERS].find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
-        
-        if user.get("is_blocked"):
-            raise HTTPException(status_code=403, detail=Messages.ACCOUNT_BLOCKED)
-        
-        user['_id'] = str(user['_id'])
-        return user
-        
-    except JWTError:
-        raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
 
-async def get_current_servicer(current_user: dict = Depends(get_current_user)) -> dict:
-    """Get current servicer (must be servicer role)"""
-    if current_user['role'] != UserRole.SERVICER:
-        raise HTTPException(status_code=403, detail=Messages.FORBIDDEN)
-    
-    servicer = await db[Collections.SERVICERS].find_one({"user_id": ObjectId(current_user['_id'])})
-    if not servicer:
-        raise HTTPException(status_code=404, detail="Servicer profile not found")
-    
-    servicer['_id'] = str(servicer['_id'])
-    servicer['user_id'] = str(servicer['user_id'])
-    return servicer
+# ============= UNREAD COUNTERS =============
+# Badge counts are polled constantly, so they are maintained on write
+# instead of counted on every view:
+#   user_counters      {_id: user_id, notifications_total, notifications_unread}
+#   pre_booking_chats  unread_counts.{receiver_id} and a last_message snapshot
+# Writers adjust them together with the change they make;
+# reconcile_unread_counters recomputes both from the source collections.
+
+async def count_new_notifications(user_ids: list):
+    """Bump total/unread for freshly inserted (unread) notifications"""
+    per_user = {}
+    for user_id in user_ids:
+        per_user[str(user_id)] = per_user.get(str(user_id), 0) + 1
+    if not per_user:
+        return
+    await db[Collections.USER_COUNTERS].bulk_write([
+        UpdateOne(
+            {"_id": ObjectId(user_id)},
+            {"$inc": {"notifications_total": count, "notifications_unread": count}},
+            upsert=True
+        )
+        for user_id, count in per_user.items()
+    ], ordered=False)
 
-async def get_current_admin(current_user: dict = Depends(get_current_user)) -> dict:
-    """Get current admin (must be admin role)"""
-    if current_user['role'] != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail=Messages.FORBIDDEN)
-    return current_user
+async def adjust_notification_counters(user_id: str, total: int = 0, unread: int = 0):
+    """Apply deltas to a user's notification counters, never going below zero"""
+    await db[Collections.USER_COUNTERS].update_one(
+        {"_id": ObjectId(user_id)},
+        [{"$set": {
+            "notifications_total": {"$max": [{"$add": [{"$ifNull": ["$notifications_total", 0]}, total]}, 0]},
+            "notifications_unread": {"$max": [{"$add": [{"$ifNull": ["$notifications_unread", 0]}, unread]}, 0]}
+        }}],
+        upsert=True
+    )
 
+async def get_notification_counters(user_id: str) -> dict:
+    """{'total', 'unread'} for a user; seeds the counter document on first use"""
+    counters = await db[Collections.USER_COUNTERS].find_one({"_id": ObjectId(user_id)})
+    if counters is None:
+        counters = {
+            "notifications_total": await db[Collections.NOTIFICATIONS].count_documents({"user_id": ObjectId(user_id)}),
+            "notifications_unread": await db[Collections.NOTIFICATIONS].count_documents({
+                "user_id": ObjectId(user_id),
+                "is_read": False
+            })
+        }
+        await db[Collections.USER_COUNTERS].update_one(
+            {"_id": ObjectId(user_id)},
+            {"$setOnInsert": counters},
+            upsert=True
+        )
+    return {
+        "total": max(counters.get('notifications_total', 0), 0),
+        "unread": max(counters.get('notifications_unread', 0), 0)
+    }
 
-def convert_objectid_to_str(document):
-    """
-    Recursively convert all ObjectId instances in a document to strings.
-    Useful for preparing MongoDB documents for JSON serialization.
-    """
+async def mark_notification_as_read(notification_id: str, user_id: str) -> bool:
+    """Mark one notification read and keep the unread counter in step; False if not found"""
+    result = await db[Collections.NOTIFICATIONS].update_one(
+        {
+            "_id": ObjectId(notification_id),
+            "user_id": ObjectId(user_id),
+            "is_read": False
+        },
+        {
+            "$set": {
+                "is_read": True,
+                "read_at": datetime.utcnow()
+            }
+        }
+    )
+    if result.modified_count:
+        await adjust_notification_counters(user_id, unread=-1)
+        return True
+    # Already read still counts as success
+    return await db[Collections.NOTIFICATIONS].count_documents(
+        {"_id": ObjectId(notification_id), "user_id": ObjectId(user_id)}, limit=1
+    ) > 0
+
+async def delete_user_notification(notification_id: str, user_id: str) -> bool:
+    """Delete one notification and keep the counters in step"""
+    deleted = await db[Collections.NOTIFICATIONS].find_one_and_delete(
+        {
+            "_id": ObjectId(notification_id),
+            "user_id": ObjectId(user_id)
+        },
+        projection={"is_read": 1}
+    )
+    if not deleted:
+        return False
+    await adjust_notification_counters(user_id, total=-1, unread=0 if deleted.get('is_read') else -1)
+    return True
+
+def last_message_snapshot(message: dict) -> dict:
+    """Denormalised last message kept on the chat document"""
+    return {
+        "message_text": message.get('message_text'),
+        "message_type": message.get('message_type', 'text'),
+        "sender_id": ObjectId(message['sender_id']),
+        "created_at": message['created_at']
+    }
+
+async def record_pre_booking_message(chat_id: str, message: dict):
+    """Refresh the chat's last message and bump the receiver's unread count"""
+    await db[Collections.PRE_BOOKING_CHATS].update_one(
+        {"_id": ObjectId(chat_id)},
+        {
+            "$set": {
+                "last_message_at": message['created_at'],
+                "last_message": last_message_snapshot(message)
+            },
+            "$inc": {f"unread_counts.{message['receiver_id']}": 1}
+        }
+    )
+
+# The reconcilers read the counter documents first, then count their sources,
+# and only write where the counters still hold the values read. A live $inc
+# landing in between makes the guard miss rather than being overwritten; the
+# document is picked up again on the next run.
+
+async def _reconcile_notification_counters(batch: List[dict]) -> int:
+    ids = [counters['_id'] for counters in batch]
+    actual = {}
+    async for row in db[Collections.NOTIFICATIONS].aggregate([
+        {"$match": {"user_id": {"$in": ids}}},
+        {"$group": {
+            "_id": "$user_id",
+            "total": {"$sum": 1},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$is_read", False]}, 1, 0]}}
+        }}
+    ]):
+        actual[str(row['_id'])] = row
+
+    updates = []
+    for counters in batch:
+        row = actual.get(str(counters['_id']))
+        expected = {
+            "notifications_total": row['total'] if row else 0,
+            "notifications_unread": row['unread'] if row else 0
+        }
+        if any(counters.get(field) != value for field, value in expected.items()):
+            guard = {field: counters.get(field) for field in expected}
+            updates.append(UpdateOne({"_id": counters['_id'], **guard}, {"$set": expected}))
+    if not updates:
+        return 0
+    result = await db[Collections.USER_COUNTERS].bulk_write(updates, ordered=False)
+    return result.modified_count
+
+async def _reconcile_chat_badges(batch: List[dict]) -> int:
+    ids = [chat['_id'] for chat in batch]
+    chats = {}
+    # $max over {created_at, ...} picks the newest message (documents compare field by field)
+    async for row in db[Collections.PRE_BOOKING_MESSAGES].aggregate([
+        {"$match": {"chat_id": {"$in": ids + [str(chat_id) for chat_id in ids]}}},
+        {"$group": {
+            "_id": {"chat_id": "$chat_id", "receiver_id": "$receiver_id"},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$is_read", False]}, 1, 0]}},
+            "last": {"$max": {
+                "created_at": "$created_at",
+                "message_text": "$message_text",
+                "message_type": "$message_type",
+                "sender_id": "$sender_id"
+            }}
+        }}
+    ]):
+        chat = chats.setdefault(str(row['_id']['chat_id']), {"unread_counts": {}, "last_message": None})
+        if row['unread']:
+            receiver = str(row['_id']['receiver_id'])
+            chat['unread_counts'][receiver] = chat['unread_counts'].get(receiver, 0) + row['unread']
+        if chat['last_message'] is None or row['last']['created_at'] > chat['last_message']['created_at']:
+            chat['last_message'] = row['last']
+
+    updates = []
+    for chat in batch:
+        expected = chats.get(str(chat['_id']), {"unread_counts": {}, "last_message": None})
+        if chat.get('unread_counts') != expected['unread_counts'] or chat.get('last_message') != expected['last_message']:
+            guard = {"unread_counts": chat.get('unread_counts'), "last_message": chat.get('last_message')}
+            updates.append(UpdateOne({"_id": chat['_id'], **guard}, {"$set": expected}))
+    if not updates:
+        return 0
+    result = await db[Collections.PRE_BOOKING_CHATS].bulk_write(updates, ordered=False)
+    return result.modified_count
+
+async def reconcile_unread_counters() -> int:
+    """Recompute notification counters and pre-booking chat badges; returns how many documents were corrected"""
+    corrected = 0
+
+    batch = []
+    async for counters in db[Collections.USER_COUNTERS].find({}):
+        batch.append(counters)
+        if len(batch) >= 500:
+            corrected += await _reconcile_notification_counters(batch)
+            batch = []
+    if batch:
+        corrected += await _reconcile_notification_counters(batch)
+
+    # Users with notifications but no counter document yet. $setOnInsert
+    # leaves a document created meanwhile by count_new_notifications alone.
+    updates = []
+    async for row in db[Collections.NOTIFICATIONS].aggregate([
+        {"$group": {
+            "_id": "$user_id",
+            "total": {"$sum": 1},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$is_read", False]}, 1, 0]}}
+        }},
+        {"$lookup": {"from": Collections.USER_COUNTERS, "localField": "_id", "foreignField": "_id", "as": "counters"}},
+        {"$match": {"counters": [], "_id": {"$ne": None}}}
+    ]):
+        updates.append(UpdateOne(
+            {"_id": row['_id']},
+            {"$setOnInsert": {"notifications_total": row['total'], "notifications_unread": row['unread']}},
+            upsert=True
+        ))
+        if len(updates) >= 500:
+            result = await db[Collections.USER_COUNTERS].bulk_write(updates, ordered=False)
+            corrected += result.upserted_count
+            updates = []
+    if updates:
+        result = await db[Collections.USER_COUNTERS].bulk_write(updates, ordered=False)
+        corrected += result.upserted_count
+
+    batch = []
+    async for chat in db[Collections.PRE_BOOKING_CHATS].find({}, {"unread_counts": 1, "last_message": 1}):
+        batch.append(chat)
+        if len(batch) >= 500:
+            corrected += await _reconcile_chat_badges(batch)
+            batch = []
+    if batch:
+        corrected += await _reconcile_chat_badges(batch)
+
+    return corrected
+
+async def reconcile_unread_counters_background(only_if_missing: bool = False):
+    try:
+        if only_if_missing:
+            legacy_chat = await db[Collections.PRE_BOOKING_CHATS].find_one({"unread_counts": {"$exists": False}}, {"_id": 1})
+            has_counters = await db[Collections.USER_COUNTERS].find_one({}, {"_id": 1})
+            if has_counters and not legacy_chat:
+                return
+        corrected = await reconcile_unread_counters()
+        if corrected:
+            print(f"🔔 Unread counters corrected for {corrected} documents")
+    except Exception as e:
+        print(f"❌ Unread counter reconcile error: {e}")
+
+# ============= CHAT =============
+# Chat is the highest-frequency write path. Everything a message needs apart
+# from its text - who may post, their names and roles, the booking number for
+# the notification - is resolved once per room (on join or the first message)
+# and cached for CHAT_ROOM_CACHE_SECONDS. Senders are checked against that
+# membership; a miss reloads the room once, so a servicer assigned after the
+# room was cached is not turned away.
+# Messages get their _id up front and are group-committed: whatever is posted
+# within CHAT_BATCH_WINDOW_SECONDS is written with one insert_many per message
+# collection and one bulk_write for the pre-booking chats' last message and
+# unread counters. Posters await their batch, so a message is stored before it
+# is acknowledged or emitted. Notifications go through notification_pipeline.
+
+CHAT_MESSAGE_COLLECTIONS = {
+    "pre_booking": Collections.PRE_BOOKING_MESSAGES,
+    "booking": Collections.CHAT_MESSAGES,
+    "issue": Collections.TRANSACTION_ISSUE_MESSAGES,
+}
+
+class ChatService:
+    """Cached room membership and group-committed chat writes"""
+
+    def __init__(self, max_rooms: int):
+        self.max_rooms = max_rooms
+        self._rooms: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._pending: List[tuple] = []  # (kind, message, future)
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats = {"room_hits": 0, "room_loads": 0, "rejected": 0, "messages": 0, "batches": 0, "write_errors": 0}
+
+    async def stop(self):
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+
+    async def room(self, kind: str, room_id: str, refresh: bool = False) -> Optional[dict]:
+        """Participants and metadata of a chat room, from cache when fresh"""
+        key = (kind, str(room_id))
+        cached = self._rooms.get(key)
+        if cached and not refresh and cached['expires_at'] > time.monotonic():
+            self._rooms.move_to_end(key)
+            self.stats["room_hits"] += 1
+            return cached
+        if kind not in CHAT_MESSAGE_COLLECTIONS or not ObjectId.is_valid(str(room_id)):
+            return None
+
+        room = await self._load(kind, ObjectId(room_id))
+        self.stats["room_loads"] += 1
+        if room is None:
+            self._rooms.pop(key, None)
+            return None
+        now = time.monotonic()
+        room.update(kind=kind, id=str(room_id), loaded_at=now, expires_at=now + settings.CHAT_ROOM_CACHE_SECONDS)
+        self._rooms[key] = room
+        self._rooms.move_to_end(key)
+        while len(self._rooms) > self.max_rooms:
+            self._rooms.popitem(last=False)
+        return room
+
+    async def member_room(self, kind: str, room_id: str, user_id: str) -> Optional[dict]:
+        """The room if user_id takes part in it, else None"""
+        started = time.monotonic()
+        room = await self.room(kind, room_id)
+        if room and str(user_id) not in room['participants'] and room['loaded_at'] < started:
+            # Membership may have changed since it was cached (servicer assigned)
+            room = await self.room(kind, room_id, refresh=True)
+        if room and str(user_id) in room['participants']:
+            return room
+        self.stats["rejected"] += 1
+        return None
+
+    def invalidate(self, kind: str, room_id: str):
+        self._rooms.pop((kind, str(room_id)), None)
+
+    async def _load(self, kind: str, room_id: ObjectId) -> Optional[dict]:
+        room = {}
+        members = {}  # user ObjectId -> role
+        if kind == "pre_booking":
+            source = await db[Collections.PRE_BOOKING_CHATS].find_one({"_id": room_id}, {"user_id": 1, "servicer_id": 1})
+            if not source:
+                return None
+            servicer_id = source.get('servicer_id')
+        elif kind == "booking":
+            source = await db[Collections.BOOKINGS].find_one(
+                {"_id": room_id}, {"user_id": 1, "servicer_id": 1, "booking_number": 1}
+            )
+            if not source:
+                return None
+            servicer_id = source.get('servicer_id')
+            room['booking_number'] = source.get('booking_number')
+        else:
+            source = await db[Collections.TRANSACTION_ISSUES].find_one(
+                {"_id": room_id}, {"user_id": 1, "servicer_id": 1, "booking_id": 1}
+            )
+            if not source:
+                return None
+            servicer_id = source.get('servicer_id')
+            if source.get('booking_id'):
+                # The booking decides which servicer is involved
+                booking = await db[Collections.BOOKINGS].find_one(
+                    {"_id": ObjectId(source['booking_id'])}, {"servicer_id": 1, "booking_number": 1}
+                )
+                servicer_id = booking.get('servicer_id') if booking else None
+                room['booking_number'] = booking.get('booking_number') if booking else None
+            admins = await db[Collections.USERS].find({"role": UserRole.ADMIN}, {"_id": 1}).to_list(100)
+            for admin in admins:
+                members[admin['_id']] = "admin"
+
+        room['servicer_id'] = str(servicer_id) if servicer_id else None
+        if servicer_id:
+            servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(servicer_id)}, {"user_id": 1})
+            if servicer:
+                members[servicer['user_id']] = "servicer"
+        if source.get('user_id'):
+            members[ObjectId(source['user_id'])] = "user"
+
+        users = await fetch_by_ids(Collections.USERS, list(members), {"name": 1, "profile_image_url": 1})
+        room['participants'] = {
+            str(user_id): {
+                "role": role,
+                "name": (users.get(str(user_id)) or {}).get('name', 'Someone'),
+                "image": (users.get(str(user_id)) or {}).get('profile_image_url', '')
+            }
+            for user_id, role in members.items()
+        }
+        return room
+
+    @staticmethod
+    def receiver(room: dict, sender_id: str, requested: Optional[str] = None) -> Optional[str]:
+        """The other side of a one-to-one room; a requested receiver must be a participant"""
+        if requested and requested != sender_id and requested in room['participants']:
+            return requested
+        for user_id, participant in room['participants'].items():
+            if user_id != sender_id and participant['role'] != "admin":
+                return user_id
+        return None
+
+    @staticmethod
+    def recipients(room: dict, sender_id: str) -> Dict[str, dict]:
+        """Everyone in the room except the sender"""
+        return {user_id: p for user_id, p in room['participants'].items() if user_id != str(sender_id)}
+
+    @staticmethod
+    def public(message: dict) -> dict:
+        doc = dict(message)
+        for field in ("_id", "chat_id", "booking_id", "issue_id", "sender_id", "receiver_id"):
+            if isinstance(doc.get(field), ObjectId):
+                doc[field] = str(doc[field])
+        return doc
+
+    async def post(self, kind: str, message: dict) -> dict:
+        """Store a message with the current batch; returns its public form once written"""
+        message.setdefault('_id', ObjectId())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, message, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+        await future
+        self.stats["messages"] += 1
+        return self.public(message)
+
+    async def _flush_soon(self):
+        # Give concurrent senders a moment to join the batch
+        await asyncio.sleep(settings.CHAT_BATCH_WINDOW_SECONDS)
+        while self._pending:
+            batch = self._pending[:settings.CHAT_BATCH_MAX]
+            self._pending = self._pending[settings.CHAT_BATCH_MAX:]
+            try:
+                await self._write(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _write(self, batch: List[tuple]):
+        by_kind: Dict[str, List[tuple]] = {}
+        for kind, message, future in batch:
+            by_kind.setdefault(kind, []).append((message, future))
+
+        for kind, entries in by_kind.items():
+            failed = {}
+            try:
+                await db[CHAT_MESSAGE_COLLECTIONS[kind]].insert_many([m for m, _ in entries], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    if error.get('code') != 11000:  # duplicate _id: already stored by a retry
+                        failed[error['index']] = RuntimeError(error.get('errmsg', 'Message not stored'))
+            except Exception as e:
+                failed = {index: e for index in range(len(entries))}
+
+            stored = []
+            for index, (message, future) in enumerate(entries):
+                if index in failed:
+                    self.stats["write_errors"] += 1
+                    if not future.done():
+                        future.set_exception(failed[index])
+                else:
+                    stored.append((message, future))
+
+            if kind == "pre_booking" and stored:
+                try:
+                    await self._record_pre_booking([m for m, _ in stored])
+                except Exception as e:
+                    # reconcile_unread_counters repairs the chat documents
+                    print(f"⚠️ Chat summary update failed: {e}")
+            for _, future in stored:
+                if not future.done():
+                    future.set_result(None)
+        self.stats["batches"] += 1
+
+    async def _record_pre_booking(self, messages: List[dict]):
+        """Last message and unread counters for every chat in the batch, one bulk_write"""
+        chats: Dict[ObjectId, dict] = {}
+        for message in messages:
+            chat = chats.setdefault(message['chat_id'], {"last": None, "unread": {}})
+            chat['last'] = message
+            receiver = str(message['receiver_id'])
+            chat['unread'][receiver] = chat['unread'].get(receiver, 0) + 1
+        await db[Collections.PRE_BOOKING_CHATS].bulk_write([
+            UpdateOne(
+                {"_id": chat_id},
+                {
+                    "$set": {
+                        "last_message_at": chat['last']['created_at'],
+                        "last_message": last_message_snapshot(chat['last'])
+                    },
+                    "$inc": {f"unread_counts.{receiver}": count for receiver, count in chat['unread'].items()}
+                }
+            )
+            for chat_id, chat in chats.items()
+        ], ordered=False)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "rooms_cached": len(self._rooms), "pending": len(self._pending)}
+
+chat_service = ChatService(max_rooms=settings.CHAT_ROOM_CACHE_SIZE)
+
+
+# Identifies this worker process as the owner of leases (broadcasts, jobs,
+# emergency dispatches) and of its presence sessions
+WORKER_ID = f"{os.getpid()}-{ObjectId()}"
+
+# ============= BROADCAST ENGINE =============
+# Admin broadcasts run as background jobs stored in the broadcasts
+# collection. Recipients are streamed with an _id-only cursor in _id order
+# and their notifications inserted in BROADCAST_CHUNK_SIZE batches, with the
+# last processed _id saved after every chunk. A job holds a short lease while
+# it runs, so after a restart (or on another worker) it resumes from its
+# checkpoint; a scheduler job resumes broadcasts whose lease has lapsed, and
+# one that fails BROADCAST_MAX_ATTEMPTS times is marked failed. Online
+# recipients are reached with one emit per role room once the job completes.
+
+BROADCAST_TARGETS = {
+    "all": ({}, [f"role-{role.value}" for role in UserRole]),
+    "users": ({"role": UserRole.USER}, [f"role-{UserRole.USER.value}"]),
+    "servicers": ({"role": UserRole.SERVICER}, [f"role-{UserRole.SERVICER.value}"])
+}
+
+class BroadcastEngine:
+    """Chunked, checkpointed notification broadcasts"""
+
+    def __init__(self):
+        self._running: Dict[str, asyncio.Task] = {}
+
+    async def create(self, admin_id: str, title: str, message: str, target: str, notification_type: str) -> dict:
+        query, _ = BROADCAST_TARGETS[target]
+        broadcast = {
+            "admin_id": ObjectId(admin_id),
+            "title": title,
+            "message": message,
+            "notification_type": notification_type,
+            "target": target,
+            "status": "pending",
+            "recipients_estimated": await db[Collections.USERS].count_documents(query),
+            "recipients_done": 0,
+            "last_user_id": None,
+            "lease_until": None,
+            "attempts": 0,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+        result = await db[Collections.BROADCASTS].insert_one(broadcast)
+        broadcast['_id'] = result.inserted_id
+        self.start(str(result.inserted_id))
+        return broadcast
+
+    def start(self, broadcast_id: str):
+        task = self._running.get(broadcast_id)
+        if task is None or task.done():
+            self._running[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+
+    async def resume_pending(self):
+        """Pick up broadcasts interrupted by a restart or a failure"""
+        try:
+            async for broadcast in db[Collections.BROADCASTS].find(
+                {
+                    "status": {"$in": ["pending", "running"]},
+                    "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime.utcnow()}}]
+                },
+                {"_id": 1}
+            ):
+                self.start(str(broadcast['_id']))
+        except Exception as e:
+            print(f"⚠️ Broadcast resume failed: {e}")
+
+    async def _claim(self, broadcast_id: ObjectId) -> Optional[dict]:
+        """Take or renew the job lease; None if another worker holds it or it is finished"""
+        now = datetime.utcnow()
+        return await db[Collections.BROADCASTS].find_one_and_update(
+            {
+                "_id": broadcast_id,
+                "status": {"$in": ["pending", "running"]},
+                "$or": [
+                    {"lease_until": None},
+                    {"lease_until": {"$lt": now}},
+                    {"lease_owner": WORKER_ID}
+                ]
+            },
+            {"$set": {
+                "status": "running",
+                "lease_owner": WORKER_ID,
+                "lease_until": now + timedelta(seconds=settings.BROADCAST_LEASE_SECONDS),
+                "updated_at": now
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self, broadcast_id: str):
+        job_id = ObjectId(broadcast_id)
+        try:
+            broadcast = await self._claim(job_id)
+            if not broadcast:
+                return
+
+            query, rooms = BROADCAST_TARGETS[broadcast['target']]
+            resuming = broadcast['last_user_id'] is not None
+            print(f"📣 Broadcast {broadcast_id} {'resumed' if resuming else 'started'}")
+            # A failed attempt may have stored part of its chunk before the first
+            # checkpoint, so that chunk needs the dedupe too
+            dedupe = resuming or broadcast.get('attempts', 0) > 0
+
+            while True:
+                page_query = dict(query)
+                if broadcast['last_user_id'] is not None:
+                    page_query["_id"] = {"$gt": broadcast['last_user_id']}
+                recipients = await db[Collections.USERS].find(
+                    page_query, {"_id": 1}
+                ).sort("_id", 1).limit(settings.BROADCAST_CHUNK_SIZE).to_list(settings.BROADCAST_CHUNK_SIZE)
+                if not recipients:
+                    break
+
+                user_ids = [user['_id'] for user in recipients]
+                if dedupe:
+                    # The chunk after a checkpoint may have been stored before the crash
+                    delivered = await db[Collections.NOTIFICATIONS].distinct(
+                        "user_id", {"metadata.broadcast_id": broadcast_id, "user_id": {"$in": user_ids}}
+                    )
+                    delivered = set(delivered)
+                    user_ids = [user_id for user_id in user_ids if user_id not in delivered]
+                    dedupe = False
+
+                now = datetime.utcnow()
+                if user_ids:
+                    await db[Collections.NOTIFICATIONS].insert_many([
+                        {
+                            "user_id": user_id,
+                            "notification_type": broadcast['notification_type'],
+                            "title": broadcast['title'],
+                            "message": broadcast['message'],
+                            "is_read": False,
+                            "metadata": {
+                                "broadcast": True,
+                                "broadcast_id": broadcast_id,
+                                "admin_id": str(broadcast['admin_id'])
+                            },
+                            "created_at": now
+                        }
+                        for user_id in user_ids
+                    ], ordered=False)
+                    await count_new_notifications(user_ids)
+
+                await db[Collections.BROADCASTS].update_one(
+                    {"_id": job_id, "lease_owner": WORKER_ID},
+                    {
+                        "$set": {"last_user_id": recipients[-1]['_id'], "updated_at": now},
+                        "$inc": {"recipients_done": len(user_ids)}
+                    }
+                )
+                broadcast = await self._claim(job_id)
+                if not broadcast:
+                    print(f"⚠️ Broadcast {broadcast_id} lease lost, stopping")
+                    return
+
+            for room in rooms:
+                await sio.emit(SocketEvents.NEW_NOTIFICATION, {
+                    "notification_type": broadcast['notification_type'],
+                    "title": broadcast['title'],
+                    "message": broadcast['message'],
+                    "is_read": False,
+                    "metadata": {"broadcast": True, "broadcast_id": broadcast_id},
+                    "created_at": broadcast['created_at'].isoformat()
+                }, room=room)
+
+            await db[Collections.BROADCASTS].update_one(
+                {"_id": job_id},
+                {"$set": {
+                    "status": "completed",
+                    "lease_until": None,
+                    "completed_at": datetime.utcnow(),
+                    "updated_at": datetime.utcnow()
+                }}
+            )
+            print(f"✅ Broadcast {broadcast_id} delivered to {broadcast['recipients_done']} users")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Lease is released and the job picked up again by the next resume.
+            # Only while we still hold it - otherwise the new owner's lease stays
+            print(f"❌ Broadcast {broadcast_id} failed: {e}")
+            failed = await db[Collections.BROADCASTS].find_one_and_update(
+                {"_id": job_id, "lease_owner": WORKER_ID},
+                {
+                    "$set": {"last_error": str(e), "lease_until": None, "updated_at": datetime.utcnow()},
+                    "$inc": {"attempts": 1}
+                },
+                return_document=ReturnDocument.AFTER
+            )
+            if failed and failed['attempts'] >= settings.BROADCAST_MAX_ATTEMPTS:
+                await db[Collections.BROADCASTS].update_one(
+                    {"_id": job_id},
+                    {"$set": {"status": "failed", "failed_at": datetime.utcnow()}}
+                )
+                print(f"❌ Broadcast {broadcast_id} gave up after {failed['attempts']} attempts")
+        finally:
+            self._running.pop(broadcast_id, None)
+
+    async def stop(self):
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+broadcast_engine = BroadcastEngine()
+
+# ============= EMERGENCY DISPATCH =============
+# Emergency requests page the nearest available servicers first. Candidates
+# are ranked once, at request time, by a $geoNear on servicers.location
+# (within EMERGENCY_SEARCH_RADIUS_KM and each servicer's own service radius)
+# and stored on the booking with distance and ETA. They are offered in waves:
+# the nearest EMERGENCY_FIRST_WAVE_SIZE, then EMERGENCY_WAVE_GROWTH times as
+# many per wave, each wave's notifications and emits sent concurrently. A
+# wave waits up to EMERGENCY_WAVE_TIMEOUT_SECONDS for an accept before the
+# next goes out. Accepting is one find_one_and_update on the still unassigned
+# booking, so exactly one offered servicer wins and the fan-out stops.
+# Dispatch state lives in booking.dispatch under a lease, so a dispatch cut
+# short by a restart is resumed from its last wave. A dispatch whose booking
+# stops being pending (cancelled) is closed, and one that fails
+# EMERGENCY_MAX_ATTEMPTS times is marked failed.
+
+class DispatchEngine:
+    """Proximity-ranked emergency offers in waves; the first accept wins"""
+
+    def __init__(self):
+        self._running: Dict[str, asyncio.Task] = {}
+        self._settled: Dict[str, asyncio.Event] = {}
+        self._time_to_accept = deque(maxlen=500)
+        self._wave_times = deque(maxlen=500)
+        self.stats = {
+            "dispatches": 0, "waves": 0, "offers": 0, "accepted": 0,
+            "exhausted": 0, "closed": 0, "failed": 0, "no_candidates": 0, "claim_conflicts": 0
+        }
+
+    async def rank(self, category_id: str, latitude: float, longitude: float) -> List[dict]:
+        """Available servicers whose service area reaches the point, nearest first"""
+        servicers, _ = await find_servicers(
+            {
+                "verification_status": VerificationStatus.APPROVED,
+                "availability_status": AvailabilityStatus.AVAILABLE,
+                "is_suspended": {"$ne": True},
+                "service_categories": {"$in": category_match_values(category_id)}
+            },
+            latitude=latitude,
+            longitude=longitude,
+            radius_km=settings.EMERGENCY_SEARCH_RADIUS_KM,
+            limit=settings.EMERGENCY_MAX_CANDIDATES
+        )
+        return [
+            {
+                "servicer_id": servicer['_id'],
+                "user_id": servicer['user_id'],
+                "distance_km": servicer['distance_km'],
+                "eta_minutes": calculate_eta(servicer['distance_km'])
+            }
+            for servicer in servicers
+            if servicer['distance_km'] <= float(servicer.get('service_radius_km', 10.0))
+        ]
+
+    @staticmethod
+    def wave_bounds(wave: int) -> Tuple[int, int]:
+        """[start, end) of the ranked candidates offered in wave `wave` (0-based)"""
+        start, size = 0, settings.EMERGENCY_FIRST_WAVE_SIZE
+        for _ in range(wave):
+            start += size
+            size *= settings.EMERGENCY_WAVE_GROWTH
+        return start, start + size
+
+    async def create(self, booking: dict, latitude: float, longitude: float) -> dict:
+        """Rank candidates, store the booking with its dispatch plan and start the first wave"""
+        candidates = await self.rank(str(booking['service_category_id']), latitude, longitude)
+        booking['dispatch'] = {
+            "status": "dispatching" if candidates else "exhausted",
+            "candidates": candidates,
+            "offered": [],
+            "wave": 0,
+            "next_wave_at": None,
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_until": None,
+            "started_at": datetime.utcnow()
+        }
+        result = await db[Collections.BOOKINGS].insert_one(booking)
+        booking['_id'] = result.inserted_id
+        self.stats["dispatches"] += 1
+        if candidates:
+            self.start(str(result.inserted_id))
+        else:
+            self.stats["no_candidates"] += 1
+        return booking
+
+    def start(self, booking_id: str):
+        task = self._running.get(booking_id)
+        if task is None or task.done():
+            self._running[booking_id] = asyncio.create_task(self._run(booking_id))
+
+    async def resume_pending(self):
+        """Pick up dispatches whose worker stopped (restart or crash)"""
+        try:
+            await self._close()
+            async for booking in db[Collections.BOOKINGS].find(
+                {
+                    "is_emergency": True,
+                    "dispatch.status": "dispatching",
+                    "booking_status": BookingStatus.PENDING,
+                    "$or": [{"dispatch.lease_until": None}, {"dispatch.lease_until": {"$lt": datetime.utcnow()}}]
+                },
+                {"_id": 1}
+            ):
+                self.start(str(booking['_id']))
+        except Exception as e:
+            print(f"⚠️ Emergency dispatch resume failed: {e}")
+
+    async def _close(self, booking_id: Optional[ObjectId] = None):
+        """Close dispatches (one, or all) whose booking is no longer pending, e.g. cancelled"""
+        query = {"is_emergency": True, "dispatch.status": "dispatching", "booking_status": {"$ne": BookingStatus.PENDING}}
+        if booking_id is not None:
+            query["_id"] = booking_id
+        result = await db[Collections.BOOKINGS].update_many(query, {"$set": {
+            "dispatch.status": "closed",
+            "dispatch.lease_until": None,
+            "dispatch.closed_at": datetime.utcnow()
+        }})
+        self.stats["closed"] += result.modified_count
+
+    async def _claim_lease(self, booking_id: ObjectId) -> Optional[dict]:
+        """Take the dispatch lease; None if another worker holds it or the dispatch is over"""
+        now = datetime.utcnow()
+        return await db[Collections.BOOKINGS].find_one_and_update(
+            {
+                "_id": booking_id,
+                "booking_status": BookingStatus.PENDING,
+                "dispatch.status": "dispatching",
+                "$or": [
+                    {"dispatch.lease_until": None},
+                    {"dispatch.lease_until": {"$lt": now}},
+                    {"dispatch.lease_owner": WORKER_ID}
+                ]
+            },
+            {"$set": {
+                "dispatch.lease_owner": WORKER_ID,
+                "dispatch.lease_until": now + timedelta(seconds=settings.EMERGENCY_WAVE_TIMEOUT_SECONDS * 2)
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self, booking_id: str):
+        job_id = ObjectId(booking_id)
+        settled = self._settled.setdefault(booking_id, asyncio.Event())
+        try:
+            booking = await self._claim_lease(job_id)
+            if not booking:
+                await self._close(job_id)
+                return
+            dispatch = booking['dispatch']
+            wave = dispatch['wave']
+
+            # Resumed while a wave was still open
+            if dispatch.get('next_wave_at') and await self._wait(job_id, settled, dispatch['next_wave_at']):
+                await self._close(job_id)
+                return
+
+            while wave < settings.EMERGENCY_MAX_WAVES:
+                start, end = self.wave_bounds(wave)
+                offers = dispatch['candidates'][start:end]
+                if not offers:
+                    break
+                wave += 1
+                now = datetime.utcnow()
+                deadline = now + timedelta(seconds=settings.EMERGENCY_WAVE_TIMEOUT_SECONDS)
+                # Offers are recorded before they are sent: only offered servicers may claim
+                booking = await db[Collections.BOOKINGS].find_one_and_update(
+                    {
+                        "_id": job_id,
+                        "booking_status": BookingStatus.PENDING,
+                        "dispatch.status": "dispatching",
+                        "dispatch.lease_owner": WORKER_ID
+                    },
+                    {
+                        "$addToSet": {"dispatch.offered": {"$each": [offer['servicer_id'] for offer in offers]}},
+                        "$set": {
+                            "dispatch.wave": wave,
+                            "dispatch.next_wave_at": deadline,
+                            "dispatch.lease_until": deadline + timedelta(seconds=settings.EMERGENCY_WAVE_TIMEOUT_SECONDS),
+                            "updated_at": now
+                        }
+                    },
+                    return_document=ReturnDocument.AFTER
+                )
+                if not booking:
+                    # Accepted, cancelled or taken over by another worker
+                    await self._close(job_id)
+                    return
+                await self._offer(booking, offers, wave)
+                if await self._wait(job_id, settled, deadline):
+                    await self._close(job_id)
+                    return
+
+            result = await db[Collections.BOOKINGS].update_one(
+                {"_id": job_id, "dispatch.status": "dispatching", "dispatch.lease_owner": WORKER_ID},
+                {"$set": {
+                    "dispatch.status": "exhausted",
+                    "dispatch.lease_until": None,
+                    "dispatch.exhausted_at": datetime.utcnow()
+                }}
+            )
+            if result.modified_count:
+                self.stats["exhausted"] += 1
+                print(f"⚠️ Emergency {booking['booking_number']}: no accept after {wave} waves")
+                await create_notification(
+                    str(booking['user_id']),
+                    NotificationTypes.BOOKING_UPDATE,
+                    "No servicer available yet",
+                    f"No nearby servicer has accepted emergency request #{booking['booking_number']}. "
+                    "Please try again shortly or contact local emergency services.",
+                    metadata={"booking_id": booking_id, "emergency": True}
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Lease is released and the dispatch resumed by the next resume_pending
+            print(f"❌ Emergency dispatch {booking_id} failed: {e}")
+            failed = await db[Collections.BOOKINGS].find_one_and_update(
+                {"_id": job_id, "dispatch.lease_owner": WORKER_ID},
+                {
+                    "$set": {"dispatch.last_error": str(e), "dispatch.lease_until": None},
+                    "$inc": {"dispatch.attempts": 1}
+                },
+                return_document=ReturnDocument.AFTER
+            )
+            if failed and failed['dispatch']['attempts'] >= settings.EMERGENCY_MAX_ATTEMPTS:
+                result = await db[Collections.BOOKINGS].update_one(
+                    {"_id": job_id, "dispatch.status": "dispatching"},
+                    {"$set": {"dispatch.status": "failed", "dispatch.failed_at": datetime.utcnow()}}
+                )
+                if result.modified_count:
+                    self.stats["failed"] += 1
+                    print(f"❌ Emergency dispatch {booking_id} gave up after {failed['dispatch']['attempts']} attempts")
+                    await create_notification(
+                        str(failed['user_id']),
+                        NotificationTypes.BOOKING_UPDATE,
+                        "Emergency request not sent",
+                        f"We could not reach nearby servicers for emergency request #{failed['booking_number']}. "
+                        "Please try again or contact local emergency services.",
+                        metadata={"booking_id": booking_id, "emergency": True}
+                    )
+        finally:
+            self._running.pop(booking_id, None)
+            self._settled.pop(booking_id, None)
+
+    async def _offer(self, booking: dict, offers: List[dict], wave: int):
+        """Notify one wave concurrently"""
+        started = time.perf_counter()
+        booking_id = str(booking['_id'])
+        description = booking.get('problem_description') or ""
+
+        async def notify(offer: dict):
+            await asyncio.gather(
+                create_notification(
+                    str(offer['user_id']),
+                    NotificationTypes.BOOKING_UPDATE,
+                    "⚠️ EMERGENCY SERVICE REQUEST",
+                    f"Urgent service needed {offer['distance_km']} km away: {description[:50]}...",
+                    metadata={"booking_id": booking_id, "emergency": True}
+                ),
+                sio.emit(
+                    SocketEvents.EMERGENCY_REQUEST,
+                    {
+                        "booking_id": booking_id,
+                        "booking_number": booking['booking_number'],
+                        "location": booking.get('service_location'),
+                        "description": description,
+                        "distance_km": offer['distance_km'],
+                        "eta_minutes": offer['eta_minutes'],
+                        "wave": wave,
+                        "expires_at": booking['dispatch']['next_wave_at'].isoformat()
+                    },
+                    room=f"user-{str(offer['user_id'])}"
+                )
+            )
+
+        results = await asyncio.gather(*[notify(offer) for offer in offers], return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        self._wave_times.append(time.perf_counter() - started)
+        self.stats["waves"] += 1
+        self.stats["offers"] += len(offers) - failed
+        if failed:
+            print(f"⚠️ Emergency {booking['booking_number']}: {failed} offers failed in wave {wave}")
+
+    async def _wait(self, booking_id: ObjectId, settled: asyncio.Event, deadline: datetime) -> bool:
+        """Wait out a wave; True as soon as the booking is claimed or cancelled"""
+        while True:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(settled.wait(), timeout=min(remaining, settings.EMERGENCY_POLL_SECONDS))
+                return True
+            except asyncio.TimeoutError:
+                pass
+            # Accepts and cancellations handled by other workers
+            if not await db[Collections.BOOKINGS].find_one(
+                {"_id": booking_id, "booking_status": BookingStatus.PENDING, "dispatch.status": "dispatching"},
+                {"_id": 1}
+            ):
+                return True
+
+    async def claim(self, booking_id: str, servicer_id: str) -> Optional[dict]:
+        """Assign the booking to an offered servicer if it is still unassigned; None if not"""
+        now = datetime.utcnow()
+        servicer_id = ObjectId(servicer_id)
+        # Pipeline update so time-to-accept is computed from created_at in the same write
+        booking = await db[Collections.BOOKINGS].find_one_and_update(
+            {
+                "_id": ObjectId(booking_id),
+                "is_emergency": True,
+                "booking_status": BookingStatus.PENDING,
+                "servicer_id": None,
+                "dispatch.offered": servicer_id
+            },
+            [{"$set": {
+                "servicer_id": servicer_id,
+                "booking_status": BookingStatus.ACCEPTED,
+                "accepted_at": now,
+                "updated_at": now,
+                "dispatch.status": "accepted",
+                "dispatch.accepted_by": servicer_id,
+                "dispatch.accepted_at": now,
+                "dispatch.lease_until": None,
+                "dispatch.time_to_accept_ms": {"$subtract": [now, "$created_at"]}
+            }}],
+            return_document=ReturnDocument.AFTER
+        )
+        if not booking:
+            self.stats["claim_conflicts"] += 1
+            return None
+
+        self.stats["accepted"] += 1
+        self._time_to_accept.append((now - booking['created_at']).total_seconds())
+        settled = self._settled.get(booking_id)
+        if settled:
+            settled.set()
+        return booking
+
+    async def stop(self):
+        tasks = list(self._running.values())
+        booking_ids = [ObjectId(booking_id) for booking_id in self._running]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if booking_ids:
+            # Let another worker resume these right away instead of waiting out the lease
+            await db[Collections.BOOKINGS].update_many(
+                {"_id": {"$in": booking_ids}, "dispatch.lease_owner": WORKER_ID},
+                {"$set": {"dispatch.lease_until": None}}
+            )
+
+    def metrics(self) -> dict:
+        accepts = sorted(self._time_to_accept)
+        waves = sorted(self._wave_times)
+        return {
+            **self.stats,
+            "running": len(self._running),
+            "time_to_accept_avg_s": round(sum(accepts) / len(accepts), 2) if accepts else None,
+            "time_to_accept_p95_s": round(accepts[int(len(accepts) * 0.95)], 2) if accepts else None,
+            "wave_send_avg_ms": round(sum(waves) / len(waves) * 1000, 1) if waves else None,
+            "wave_send_p95_ms": round(waves[int(len(waves) * 0.95)] * 1000, 1) if waves else None
+        }
+
+dispatch_engine = DispatchEngine()
+
+# ============= JOB QUEUE =============
+# Durable background work (auto-refunds, ban expiry, maintenance reminders).
+# Periodic scans only enqueue: one job per item, deduplicated by a unique key,
+# so every worker can scan without double-enqueuing. Workers claim a job with
+# find_one_and_update and hold a lease while it runs; jobs of a worker that
+# died are reclaimed once the lease lapses. Each worker runs up to
+# JOB_QUEUE_CONCURRENCY jobs at once. Failures retry with exponential backoff
+# and after JOB_MAX_ATTEMPTS the job moves to dead_jobs, where its key keeps
+# the scans from queuing it again until an admin retries it. A job can run
+# more than once, so handlers must be idempotent.
+
+JOB_HANDLERS: Dict[str, Any] = {}
+
+
+def job_handler(job_type: str):
+    """Register a coroutine function(payload) as the handler for job_type"""
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+
+class JobQueue:
+    """Mongo-backed queue with leases, bounded concurrency, retries and dead-lettering"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+        self.stats = {"enqueued": 0, "completed": 0, "retried": 0, "dead": 0}
+
+    def _new_job(self, job_type: str, payload: dict, run_at: Optional[datetime] = None) -> dict:
+        now = datetime.utcnow()
+        return {
+            "type": job_type,
+            "payload": payload,
+            "status": "queued",
+            "run_at": run_at or now,
+            "attempts": 0,
+            "max_attempts": settings.JOB_MAX_ATTEMPTS,
+            "lease_owner": None,
+            "lease_until": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+
+    async def enqueue(self, job_type: str, payload: dict, key: Optional[str] = None, run_at: Optional[datetime] = None) -> bool:
+        """Queue one job; with a key, a no-op if that key is already queued, done or dead"""
+        if key is None:
+            await db[Collections.JOBS].insert_one(self._new_job(job_type, payload, run_at))
+            self.stats["enqueued"] += 1
+            self._wakeup.set()
+            return True
+        return await self.enqueue_many(job_type, [(key, payload)], run_at) == 1
+
+    async def enqueue_many(self, job_type: str, items: List[Tuple[str, dict]], run_at: Optional[datetime] = None) -> int:
+        """Queue (key, payload) jobs in one bulk upsert; returns how many were new"""
+        keys = [key for key, _ in items]
+        dead = {
+            job['key'] async for job in db[Collections.DEAD_JOBS].find({"key": {"$in": keys}}, {"key": 1})
+        }
+        operations = [
+            UpdateOne({"key": key}, {"$setOnInsert": {**self._new_job(job_type, payload, run_at), "key": key}}, upsert=True)
+            for key, payload in items
+            if key not in dead
+        ]
+        if not operations:
+            return 0
+        try:
+            result = await db[Collections.JOBS].bulk_write(operations, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as e:
+            # Concurrent scans upserting the same key lose on the unique index
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            inserted = e.details.get('nUpserted', 0)
+        if inserted:
+            self.stats["enqueued"] += inserted
+            self._wakeup.set()
+        return inserted
+
+    async def enqueue_cursor(self, job_type: str, cursor, build, batch_size: int = 500) -> int:
+        """Queue a job per document of cursor; build(doc) returns (key, payload)"""
+        queued = 0
+        batch = []
+        async for doc in cursor:
+            batch.append(build(doc))
+            if len(batch) >= batch_size:
+                queued += await self.enqueue_many(job_type, batch)
+                batch = []
+        if batch:
+            queued += await self.enqueue_many(job_type, batch)
+        return queued
+
+    async def _claim(self) -> Optional[dict]:
+        """Atomically take the next due job, or one whose lease lapsed"""
+        now = datetime.utcnow()
+        return await db[Collections.JOBS].find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "lease_until": {"$lt": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_owner": WORKER_ID,
+                    "lease_until": now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+                    "started_at": now,
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Let running jobs finish briefly; anything cut off is reclaimed after its lease
+        if self._running:
+            await asyncio.wait(list(self._running), timeout=10)
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+            except Exception as e:
+                self._slots.release()
+                print(f"❌ Job claim failed: {e}")
+                await asyncio.sleep(settings.JOB_POLL_INTERVAL_SECONDS)
+                continue
+
+            if job is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: dict):
+        try:
+            handler = JOB_HANDLERS.get(job['type'])
+            if handler is None:
+                await self._dead(job, f"No handler for job type {job['type']}")
+            elif job['attempts'] > job['max_attempts']:
+                # Reclaimed after lapsed leases more often than it may be tried
+                await self._dead(job, job.get('last_error') or "Lease expired")
+            else:
+                try:
+                    await asyncio.wait_for(handler(job['payload']), timeout=settings.JOB_LEASE_SECONDS)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    await self._failed(job, e)
+                else:
+                    await self._finish(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Job {job['_id']} bookkeeping failed: {e}")
+        finally:
+            self._slots.release()
+
+    async def _finish(self, job: dict):
+        now = datetime.utcnow()
+        await db[Collections.JOBS].update_one(
+            {"_id": job['_id'], "lease_owner": WORKER_ID},
+            {"$set": {
+                "status": "done",
+                "lease_until": None,
+                "finished_at": now,
+                "updated_at": now,
+                # TTL; the key stays reserved until then so scans don't re-queue it
+                "expires_at": now + timedelta(hours=settings.JOB_RETENTION_HOURS)
+            }}
+        )
+        self.stats["completed"] += 1
+
+    async def _failed(self, job: dict, error: Exception):
+        message = f"{type(error).__name__}: {error}"
+        if job['attempts'] >= job['max_attempts']:
+            await self._dead(job, message)
+            return
+        delay = min(
+            settings.JOB_RETRY_BASE_SECONDS * (2 ** (job['attempts'] - 1)),
+            settings.JOB_RETRY_MAX_SECONDS
+        )
+        await db[Collections.JOBS].update_one(
+            {"_id": job['_id'], "lease_owner": WORKER_ID},
+            {"$set": {
+                "status": "queued",
+                "run_at": datetime.utcnow() + timedelta(seconds=delay),
+                "lease_owner": None,
+                "lease_until": None,
+                "last_error": message,
+                "updated_at": datetime.utcnow()
+            }}
+        )
+        self.stats["retried"] += 1
+        print(f"⚠️ Job {job['type']} {job['_id']} failed (attempt {job['attempts']}), retrying in {delay:.0f}s: {message}")
+
+    async def _dead(self, job: dict, message: str):
+        now = datetime.utcnow()
+        dead = {**job, "status": "dead", "last_error": message, "lease_until": None, "failed_at": now, "updated_at": now}
+        # Upsert by _id: a crash between the two writes just repeats them
+        await db[Collections.DEAD_JOBS].replace_one({"_id": job['_id']}, dead, upsert=True)
+        await db[Collections.JOBS].delete_one({"_id": job['_id'], "lease_owner": WORKER_ID})
+        self.stats["dead"] += 1
+        print(f"❌ Job {job['type']} {job['_id']} moved to dead letters: {message}")
+
+    async def retry_dead(self, job_id: ObjectId) -> bool:
+        """Move a dead job back onto the queue with a fresh attempt budget"""
+        dead = await db[Collections.DEAD_JOBS].find_one({"_id": job_id})
+        if not dead:
+            return False
+        job = {
+            **self._new_job(dead['type'], dead['payload']),
+            "_id": dead['_id'],
+            "last_error": dead.get('last_error')
+        }
+        if dead.get('key'):
+            job['key'] = dead['key']
+        await db[Collections.JOBS].replace_one({"_id": job_id}, job, upsert=True)
+        await db[Collections.DEAD_JOBS].delete_one({"_id": job_id})
+        self._wakeup.set()
+        return True
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "running": len(self._running),
+            "concurrency": self.concurrency,
+            "active": bool(self._task and not self._task.done())
+        }
+
+job_queue = JobQueue(concurrency=settings.JOB_QUEUE_CONCURRENCY)
+
+# ============= LIVE TRACKING =============
+# GPS pings are absorbed in memory: each active booking keeps its latest fix
+# and destination, socket updates are emitted straight from that state, and
+# booking_tracking points are thinned and written with periodic insert_many.
+# bookings.servicer_current_location is refreshed on the same flush so other
+# workers (and restarts) still see a recent position. Sessions are per
+# worker, so that write is conditional on the booking still being active; a
+# session whose booking was completed or cancelled elsewhere is dropped at
+# its next flush.
+
+# Bookings whose servicer location is tracked (on the way, then on site)
+TRACKING_ACTIVE_STATUSES = [BookingStatus.ACCEPTED, BookingStatus.IN_PROGRESS]
+
+class LocationTracker:
+    """Per-process live tracking state with batched persistence"""
+
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}
+        self._pending_points: List[dict] = []
+        self._dirty_bookings = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "pings": 0, "points_persisted": 0, "points_thinned": 0, "flushes": 0,
+            "sessions_ended_elsewhere": 0
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.TRACKING_FLUSH_INTERVAL_SECONDS)
+            try:
+                await self.flush()
+                self._evict_idle()
+            except Exception as e:
+                print(f"⚠️ Tracking flush failed: {e}")
+
+    def register(self, booking: dict) -> dict:
+        """Cache the parts of a booking needed to handle pings for it"""
+        booking_id = str(booking['_id'])
+        service_location = booking.get('service_location') or {}
+        current = booking.get('servicer_current_location') or {}
+        session = {
+            "booking_id": booking_id,
+            "servicer_id": str(booking['servicer_id']),
+            "user_id": str(booking['user_id']),
+            "booking_status": booking.get('booking_status'),
+            "servicer_arrived": booking.get('servicer_arrived', False),
+            "destination": (service_location.get('latitude'), service_location.get('longitude')),
+            "latest": {
+                "latitude": current.get('latitude'),
+                "longitude": current.get('longitude'),
+                "speed": current.get('speed'),
+                "heading": current.get('heading'),
+                "updated_at": current.get('updated_at')
+            } if current else None,
+            "distance_km": None,
+            "eta_minutes": None,
+            "last_persisted": None,
+            "last_point_id": None,
+            "last_seen": time.monotonic()
+        }
+        self.sessions[booking_id] = session
+        return session
+
+    async def get_session(self, booking_id: str, query: dict) -> Optional[dict]:
+        """Session from memory, or load the booking matching `query` once and cache it"""
+        session = self.sessions.get(booking_id)
+        if session:
+            return session
+        booking = await db[Collections.BOOKINGS].find_one(query)
+        return self.register(booking) if booking else None
+
+    def ingest(self, session: dict, latitude: float, longitude: float,
+               speed: Optional[float] = None, heading: Optional[float] = None,
+               status: str = "on_the_way", force_persist: bool = False) -> dict:
+        """Apply a GPS fix in memory; returns the LOCATION_UPDATE payload"""
+        now = datetime.utcnow()
+        self.stats["pings"] += 1
+
+        user_lat, user_lng = session['destination']
+        distance_km = None
+        eta_minutes = None
+        if user_lat and user_lng:
+            distance_km = calculate_distance(latitude, longitude, user_lat, user_lng)
+            actual_speed = speed if speed and speed > 0 else 30
+            eta_minutes = calculate_eta(distance_km, actual_speed)
+
+        session['latest'] = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "speed": speed,
+            "heading": heading,
+            "updated_at": now
+        }
+        session['distance_km'] = distance_km
+        session['eta_minutes'] = eta_minutes
+        session['last_seen'] = time.monotonic()
+        self._dirty_bookings.add(session['booking_id'])
+
+        # Thin out stationary / near-duplicate points
+        last = session['last_persisted']
+        persist = force_persist or last is None
+        if not persist:
+            moved_m = calculate_distance(last['latitude'], last['longitude'], latitude, longitude) * 1000
+            elapsed = (now - last['timestamp']).total_seconds()
+            persist = moved_m >= settings.TRACKING_MIN_MOVE_METERS or elapsed >= settings.TRACKING_MAX_POINT_INTERVAL_SECONDS
+
+        if persist:
+            point_id = ObjectId()
+            self._pending_points.append({
+                "_id": point_id,
+                "booking_id": ObjectId(session['booking_id']),
+                "servicer_id": ObjectId(session['servicer_id']),
+                "user_id": ObjectId(session['user_id']),
+                "servicer_latitude": latitude,
+                "servicer_longitude": longitude,
+                "user_latitude": user_lat,
+                "user_longitude": user_lng,
+                "distance_remaining_km": distance_km,
+                "eta_minutes": eta_minutes,
+                "speed": speed,
+                "heading": heading,
+                "status": status,
+                "timestamp": now,
+                "created_at": now
+            })
+            session['last_persisted'] = {"latitude": latitude, "longitude": longitude, "timestamp": now}
+            session['last_point_id'] = str(point_id)
+        else:
+            self.stats["points_thinned"] += 1
+
+        return {
+            "booking_id": session['booking_id'],
+            "servicer_location": {
+                "lat": latitude,
+                "lng": longitude,
+                "speed": speed,
+                "heading": heading
+            },
+            "user_location": {"lat": user_lat, "lng": user_lng},
+            "distance_km": round(distance_km, 2) if distance_km else None,
+            "eta_minutes": eta_minutes,
+            "status": status,
+            "timestamp": now.isoformat()
+        }
+
+    def pending_points(self, booking_id: str) -> List[dict]:
+        """Points accepted but not yet flushed, oldest first"""
+        return [p for p in self._pending_points if str(p['booking_id']) == booking_id]
+
+    def end(self, booking_id: str):
+        """Stop tracking a booking; its remaining points go out on the next flush"""
+        self.sessions.pop(booking_id, None)
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - settings.TRACKING_SESSION_TTL_SECONDS
+        for booking_id in [b for b, s in self.sessions.items() if s['last_seen'] < cutoff]:
+            self.sessions.pop(booking_id, None)
+
+    async def flush(self):
+        points, self._pending_points = self._pending_points, []
+        dirty, self._dirty_bookings = self._dirty_bookings, set()
+
+        if points:
+            try:
+                await db[Collections.BOOKING_TRACKING].insert_many(points, ordered=False)
+                self.stats["points_persisted"] += len(points)
+            except Exception as e:
+                print(f"⚠️ Tracking insert failed, re-queueing {len(points)} points: {e}")
+                self._pending_points = points + self._pending_points
+
+        updates, booking_ids = [], []
+        for booking_id in dirty:
+            session = self.sessions.get(booking_id)
+            if session and session['latest']:
+                booking_ids.append(ObjectId(booking_id))
+                # Sessions are per worker: a booking completed or cancelled elsewhere must not be overwritten
+                updates.append(UpdateOne(
+                    {"_id": ObjectId(booking_id), "booking_status": {"$in": TRACKING_ACTIVE_STATUSES}},
+                    {"$set": {"servicer_current_location": session['latest']}}
+                ))
+        if updates:
+            result = await db[Collections.BOOKINGS].bulk_write(updates, ordered=False)
+            if result.matched_count < len(updates):
+                ended = await db[Collections.BOOKINGS].distinct("_id", {
+                    "_id": {"$in": booking_ids},
+                    "booking_status": {"$nin": TRACKING_ACTIVE_STATUSES}
+                })
+                for booking_id in ended:
+                    self.end(str(booking_id))
+                self.stats["sessions_ended_elsewhere"] += len(ended)
+        self.stats["flushes"] += 1
+
+location_tracker = LocationTracker()
+
+# ============= PRESENCE =============
+# Who is online, across every worker. Each worker indexes its own sockets both
+# ways (sid -> user, user -> sids), so disconnect is O(1) and one user can be
+# connected from several devices. Sessions are mirrored to the presence
+# collection with an expires_at lease; the owning worker renews the sockets
+# it holds with one update_many per heartbeat (and deletes its documents for
+# sockets it no longer holds), so if a worker dies its users drop offline
+# after PRESENCE_TTL_SECONDS (the TTL index deletes them later).
+# Online checks are batched: users with a socket here are answered from
+# memory, the rest with a single query.
+
+class PresenceRegistry:
+    """Multi-device socket presence shared through MongoDB"""
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self._sid_user: Dict[str, str] = {}
+        self._user_sids: Dict[str, set] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "connects": 0, "disconnects": 0, "heartbeats": 0, "restored": 0, "orphans_removed": 0, "lookups": 0
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # This worker's sockets are going away with it
+        if self._sid_user:
+            await db[Collections.PRESENCE].delete_many({"worker_id": self.worker_id})
+            self._sid_user.clear()
+            self._user_sids.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_SECONDS)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                print(f"⚠️ Presence heartbeat failed: {e}")
+
+    def _lease(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=settings.PRESENCE_TTL_SECONDS)
+
+    def _session_doc(self, user_id: str) -> dict:
+        return {"user_id": user_id, "worker_id": self.worker_id, "connected_at": datetime.utcnow()}
+
+    def _forget(self, sid: str) -> Optional[str]:
+        user_id = self._sid_user.pop(sid, None)
+        sids = self._user_sids.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._user_sids[user_id]
+        return user_id
+
+    async def connect(self, sid: str, user_id: str):
+        """Register an authenticated socket; re-authenticating as someone else moves it"""
+        if self._sid_user.get(sid) == user_id:
+            return
+        self._forget(sid)
+        self._sid_user[sid] = user_id
+        self._user_sids.setdefault(user_id, set()).add(sid)
+        self.stats["connects"] += 1
+        await db[Collections.PRESENCE].replace_one(
+            {"_id": sid},
+            {**self._session_doc(user_id), "expires_at": self._lease()},
+            upsert=True
+        )
+
+    async def disconnect(self, sid: str):
+        if self._forget(sid) is None:
+            return  # never authenticated
+        self.stats["disconnects"] += 1
+        await db[Collections.PRESENCE].delete_one({"_id": sid})
+
+    async def heartbeat(self):
+        """Extend the lease on the sockets this worker holds; drop documents for any it doesn't"""
+        held = list(self._sid_user)
+        # connect() and disconnect() writes can land out of order, leaving a
+        # document for a socket that is already gone - never renew those
+        removed = await db[Collections.PRESENCE].delete_many(
+            {"worker_id": self.worker_id, "_id": {"$nin": held}}
+        )
+        self.stats["orphans_removed"] += removed.deleted_count
+        if not held:
+            return
+        result = await db[Collections.PRESENCE].update_many(
+            {"_id": {"$in": held}, "worker_id": self.worker_id},
+            {"$set": {"expires_at": self._lease()}}
+        )
+        self.stats["heartbeats"] += 1
+        if result.matched_count < len(held):
+            # Sessions expired while this worker was stalled - put back the ones still held
+            lease = self._lease()
+            restore = [
+                UpdateOne(
+                    {"_id": sid},
+                    {"$set": {"expires_at": lease}, "$setOnInsert": self._session_doc(self._sid_user[sid])},
+                    upsert=True
+                )
+                for sid in held
+                if sid in self._sid_user
+            ]
+            if restore:
+                await db[Collections.PRESENCE].bulk_write(restore, ordered=False)
+            self.stats["restored"] += len(held) - result.matched_count
+
+    def user_for(self, sid: str) -> Optional[str]:
+        return self._sid_user.get(sid)
+
+    def local_sessions(self, user_id: str) -> int:
+        return len(self._user_sids.get(user_id, ()))
+
+    async def online(self, user_ids: List[str]) -> Dict[str, bool]:
+        """Online status for many users in at most one query"""
+        self.stats["lookups"] += 1
+        statuses = {user_id: user_id in self._user_sids for user_id in user_ids}
+        remote = [user_id for user_id, is_online in statuses.items() if not is_online]
+        if remote:
+            online_elsewhere = await db[Collections.PRESENCE].distinct(
+                "user_id",
+                {"user_id": {"$in": remote}, "expires_at": {"$gt": datetime.utcnow()}}
+            )
+            for user_id in online_elsewhere:
+                statuses[user_id] = True
+        return statuses
+
+    async def is_online(self, user_id: str) -> bool:
+        return (await self.online([user_id]))[user_id]
+
+    def metrics(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "local_sockets": len(self._sid_user),
+            "local_users": len(self._user_sids),
+            **self.stats
+        }
+
+presence = PresenceRegistry(worker_id=WORKER_ID)
+
+# ============= PLATFORM METRICS =============
+# Admin dashboards read pre-aggregated rollups from platform_analytics instead
+# of loading raw bookings/transactions. One document per (dimension,
+# granularity, bucket) holds a row per key (category, servicer, payment
+# method, ...). Writes that change a booking or transaction mark its
+# created_at hour as dirty; a background loop recomputes dirty hours from the
+# source collections and rebuilds their days from the hourly rows, so a
+# rollup is always a full recompute of its bucket and never drifts.
+
+BOOKING_ROLLUP_FIELDS = ("bookings_created", "bookings_completed", "bookings_cancelled", "completed_earnings")
+TRANSACTION_ROLLUP_FIELDS = ("transactions", "amount", "platform_fees", "servicer_earnings")
+
+ROLLUP_FIELDS = {
+    "platform": BOOKING_ROLLUP_FIELDS + ("new_users",),
+    "category": BOOKING_ROLLUP_FIELDS,
+    "servicer": BOOKING_ROLLUP_FIELDS,
+    "payment_method": TRANSACTION_ROLLUP_FIELDS,
+    "transaction_type": TRANSACTION_ROLLUP_FIELDS,
+}
+
+ROLLUP_SPANS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+
+def floor_hour(when: datetime) -> datetime:
+    return when.replace(minute=0, second=0, microsecond=0)
+
+def floor_day(when: datetime) -> datetime:
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _booking_rollup_group(key):
+    completed = {"$eq": ["$booking_status", BookingStatus.COMPLETED]}
+    return {"$group": {
+        "_id": key,
+        "bookings_created": {"$sum": 1},
+        "bookings_completed": {"$sum": {"$cond": [completed, 1, 0]}},
+        "bookings_cancelled": {"$sum": {"$cond": [{"$eq": ["$booking_status", BookingStatus.CANCELLED]}, 1, 0]}},
+        "completed_earnings": {"$sum": {"$cond": [completed, {"$ifNull": ["$servicer_amount", 0]}, 0]}}
+    }}
+
+def _transaction_rollup_group(key):
+    return {"$group": {
+        "_id": {"$ifNull": [key, "unknown"]},
+        "transactions": {"$sum": 1},
+        "amount": {"$sum": {"$ifNull": ["$amount", 0]}},
+        "platform_fees": {"$sum": {"$ifNull": ["$platform_fee", 0]}},
+        "servicer_earnings": {"$sum": {"$ifNull": ["$servicer_earnings", 0]}}
+    }}
+
+
+class MetricsRollupStore:
+    """Hourly/daily platform rollups, refreshed for the buckets writes touch"""
+
+    def __init__(self):
+        self._dirty_hours = set()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.stats = {"buckets_refreshed": 0, "refresh_errors": 0, "last_refresh_at": None}
+
+    @property
+    def hourly_retention(self) -> timedelta:
+        return timedelta(days=settings.ANALYTICS_HOURLY_RETENTION_DAYS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"⚠️ Final metrics refresh failed: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.ANALYTICS_REFRESH_INTERVAL_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.stats["refresh_errors"] += 1
+                print(f"⚠️ Metrics refresh failed: {e}")
+
+    def touch(self, *items):
+        """Mark the buckets of changed bookings/transactions (docs or created_at datetimes)"""
+        for item in items:
+            when = item.get('created_at') if isinstance(item, dict) else item
+            if isinstance(when, datetime):
+                self._dirty_hours.add(floor_hour(when))
+
+    async def refresh(self):
+        """Recompute dirty hours (plus the current and previous hour) and their days"""
+        current = floor_hour(datetime.utcnow())
+        hours = self._dirty_hours | {current, current - timedelta(hours=1)}
+        self._dirty_hours = set()
+        try:
+            async with self._lock:
+                for hour in sorted(hours):
+                    await self._rollup_from_source("hour", hour)
+                for day in sorted({floor_day(hour) for hour in hours}):
+                    await self._rollup_day(day)
+        except Exception:
+            self._dirty_hours |= hours
+            raise
+        self.stats["last_refresh_at"] = datetime.utcnow().isoformat()
+
+    async def backfill(self, days: Optional[int] = None):
+        """Rebuild rollups for the last `days` days, or for all history when None"""
+        today = floor_day(datetime.utcnow())
+        if days is None:
+            oldest = []
+            for collection in (Collections.BOOKINGS, Collections.TRANSACTIONS):
+                doc = await db[collection].find_one(
+                    {"created_at": {"$type": "date"}}, {"created_at": 1}, sort=[("created_at", 1)]
+                )
+                if doc:
+                    oldest.append(floor_day(doc['created_at']))
+            start = min(oldest) if oldest else today
+        else:
+            start = today - timedelta(days=max(days - 1, 0))
+
+        print(f"📊 Rebuilding platform metrics from {start.date()}...")
+        day = start
+        while day <= today:
+            async with self._lock:
+                if self._has_hourly(day):
+                    for offset in range(24):
+                        await self._rollup_from_source("hour", day + timedelta(hours=offset))
+                await self._rollup_day(day)
+            day += timedelta(days=1)
+        print(f"✅ Platform metrics rebuilt through {today.date()}")
+
+    async def backfill_if_empty(self):
+        try:
+            if not await db[Collections.PLATFORM_ANALYTICS].find_one({"granularity": "day"}, {"_id": 1}):
+                await self.backfill()
+        except Exception as e:
+            print(f"⚠️ Platform metrics backfill failed: {e}")
+
+    def _has_hourly(self, day: datetime) -> bool:
+        """Hourly rows are kept (and used to build days) only inside the retention window"""
+        return day >= floor_day(datetime.utcnow() - self.hourly_retention) + timedelta(days=1)
+
+    async def _rollup_day(self, day: datetime):
+        if self._has_hourly(day):
+            await self._rollup_day_from_hours(day)
+        else:
+            await self._rollup_from_source("day", day)
+
+    async def _rollup_from_source(self, granularity: str, start: datetime):
+        as_of = datetime.utcnow()
+        window = {"$gte": start, "$lt": start + ROLLUP_SPANS[granularity]}
+        booking_facets, transaction_facets, new_users = await asyncio.gather(
+            db[Collections.BOOKINGS].aggregate([
+                {"$match": {"created_at": window}},
+                {"$facet": {
+                    "platform": [_booking_rollup_group("all")],
+                    "category": [_booking_rollup_group("$service_category_id")],
+                    "servicer": [_booking_rollup_group("$servicer_id")]
+                }}
+            ]).to_list(1),
+            db[Collections.TRANSACTIONS].aggregate([
+                {"$match": {"created_at": window, "transaction_status": PaymentStatus.COMPLETED}},
+                {"$facet": {
+                    "payment_method": [_transaction_rollup_group("$payment_method")],
+                    "transaction_type": [_transaction_rollup_group("$transaction_type")]
+                }}
+            ]).to_list(1),
+            db[Collections.USERS].count_documents({"role": UserRole.USER, "created_at": window})
+        )
+
+        rows = {}
+        for facets in (booking_facets[0], transaction_facets[0]):
+            for dimension, groups in facets.items():
+                rows[dimension] = [
+                    {"key": str(group.pop('_id')), **group} for group in groups if group['_id'] is not None
+                ]
+
+        if new_users:
+            if not rows["platform"]:
+                rows["platform"].append({"key": "all", **{f: 0 for f in BOOKING_ROLLUP_FIELDS}})
+            rows["platform"][0]["new_users"] = new_users
+
+        await self._write(granularity, start, rows, as_of)
+
+    async def _rollup_day_from_hours(self, day: datetime):
+        as_of = datetime.utcnow()
+        fields = set(BOOKING_ROLLUP_FIELDS + TRANSACTION_ROLLUP_FIELDS + ("new_users",))
+        pipeline = [
+            {"$match": {"granularity": "hour", "bucket": {"$gte": day, "$lt": day + ROLLUP_SPANS["day"]}}},
+            {"$unwind": "$rows"},
+            {"$group": {
+                "_id": {"dimension": "$dimension", "key": "$rows.key"},
+                **{field: {"$sum": f"$rows.{field}"} for field in fields}
+            }}
+        ]
+        rows = {}
+        async for group in db[Collections.PLATFORM_ANALYTICS].aggregate(pipeline):
+            dimension = group['_id']['dimension']
+            row = {"key": group['_id']['key']}
+            row.update({field: group[field] for field in ROLLUP_FIELDS.get(dimension, ())})
+            rows.setdefault(dimension, []).append(row)
+        await self._write("day", day, rows, as_of)
+
+    async def _write(self, granularity: str, start: datetime, rows: dict, as_of: datetime):
+        """
+        Store a bucket computed from a read that started at `as_of`. Other
+        workers refresh the same buckets, so a write only replaces a bucket
+        built from an older read - a slow refresh never overwrites a newer one.
+        """
+        now = datetime.utcnow()
+        operations = []
+        for dimension in ROLLUP_FIELDS:
+            bucket_id = f"{dimension}:{granularity}:{start.isoformat()}"
+            doc = {
+                "_id": bucket_id,
+                "dimension": dimension,
+                "granularity": granularity,
+                "bucket": start,
+                "rows": rows.get(dimension, []),
+                "as_of": as_of,
+                "refreshed_at": now
+            }
+            if granularity == "hour":
+                doc["expires_at"] = start + self.hourly_retention
+            operations.append(UpdateOne(
+                {"_id": bucket_id},
+                [{"$replaceWith": {"$cond": [
+                    {"$gt": [{"$ifNull": ["$as_of", datetime.min]}, as_of]},
+                    "$$ROOT",
+                    {"$literal": doc}
+                ]}}],
+                upsert=True
+            ))
+        await db[Collections.PLATFORM_ANALYTICS].bulk_write(operations, ordered=False)
+        self.stats["buckets_refreshed"] += 1
+
+    def _bucket_filter(self, start: Optional[datetime], end: Optional[datetime]) -> dict:
+        """
+        Rollup documents covering [start, end] at hour precision: whole days come
+        from day buckets and the partial days at either edge from hour buckets.
+        Ranges older than the hourly retention fall back to whole days.
+        """
+        if start is None:
+            return {"granularity": "day"}
+
+        low = floor_hour(start)
+        high = floor_hour(end or datetime.utcnow()) + ROLLUP_SPANS["hour"]
+        if not self._has_hourly(floor_day(low)):
+            return {"granularity": "day", "bucket": {"$gte": floor_day(low), "$lt": high}}
+
+        first_day = floor_day(low) if low == floor_day(low) else floor_day(low) + ROLLUP_SPANS["day"]
+        last_day = floor_day(high)
+        if first_day >= last_day:
+            return {"granularity": "hour", "bucket": {"$gte": low, "$lt": high}}
+
+        segments = [{"granularity": "day", "bucket": {"$gte": first_day, "$lt": last_day}}]
+        if low < first_day:
+            segments.append({"granularity": "hour", "bucket": {"$gte": low, "$lt": first_day}})
+        if last_day < high:
+            segments.append({"granularity": "hour", "bucket": {"$gte": last_day, "$lt": high}})
+        return {"$or": segments}
+
+    async def totals(self, dimension: str, start: Optional[datetime] = None, end: Optional[datetime] = None, key: str = None) -> Dict[str, dict]:
+        """Rollup rows summed per key over [start, end] (all time when start is None)"""
+        fields = ROLLUP_FIELDS[dimension]
+        pipeline = [
+            {"$match": {"dimension": dimension, **self._bucket_filter(start, end)}},
+            {"$unwind": "$rows"}
+        ]
+        if key is not None:
+            pipeline.append({"$match": {"rows.key": key}})
+        pipeline.append({"$group": {"_id": "$rows.key", **{field: {"$sum": f"$rows.{field}"} for field in fields}}})
+
+        results = {}
+        async for row in db[Collections.PLATFORM_ANALYTICS].aggregate(pipeline):
+            results[row.pop('_id')] = row
+        return results
+
+    async def daily_series(self, dimension: str, field: str, start: datetime, end: datetime) -> List[dict]:
+        """[{_id: 'YYYY-MM-DD', count}] for one rollup field"""
+        pipeline = [
+            {"$match": {"dimension": dimension, **self._bucket_filter(start, end)}},
+            {"$unwind": "$rows"},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$bucket"}},
+                "count": {"$sum": f"$rows.{field}"}
+            }},
+            {"$sort": {"_id": 1}}
+        ]
+        return await db[Collections.PLATFORM_ANALYTICS].aggregate(pipeline).to_list(None)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "dirty_hours": len(self._dirty_hours)}
+
+
+metrics_store = MetricsRollupStore()
+
+
+# ============= AUTHENTICATION =============
+# Principals (user doc + servicer profile) are cached per process for a short
+# TTL in a bounded LRU, so authenticated requests skip loading the full users /
+# servicers documents. The cache is process-local, so access-control fields
+# (blocking, suspension, role, verification) are never served from it: they
+# are re-read on every request with a projection-only find_one on an indexed
+# key. Profile changes must call invalidate_principal(); other workers
+# converge within PRINCIPAL_CACHE_TTL_SECONDS.
+
+_MISSING = object()
+USER_ACCESS_FIELDS = {"_id": 0, "is_blocked": 1, "is_suspended": 1, "role": 1}
+SERVICER_ACCESS_FIELDS = {"_id": 0, "is_suspended": 1, "verification_status": 1}
+
+class PrincipalCache:
+    """TTL + LRU cache of {user_id: (expires_at, user, servicer)}"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._servicer_owner: Dict[str, str] = {}  # servicer_id -> user_id
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def _entry(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(user_id)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        entry = self._entry(user_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put_user(self, user_id: str, user: dict):
+        self._drop(user_id)
+        self._entries[user_id] = [time.monotonic() + self.ttl_seconds, user, _MISSING]
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def get_servicer(self, user_id: str):
+        """Cached servicer profile, None if known not to exist, _MISSING if unknown"""
+        entry = self._entry(user_id)
+        return entry[2] if entry else _MISSING
+
+    def put_servicer(self, user_id: str, servicer: Optional[dict]):
+        entry = self._entry(user_id)
+        if entry is not None:
+            entry[2] = servicer
+            if servicer:
+                self._servicer_owner[servicer['_id']] = user_id
+
+    def invalidate(self, user_id: Optional[str] = None, servicer_id: Optional[str] = None):
+        if servicer_id is not None:
+            user_id = user_id or self._servicer_owner.get(str(servicer_id))
+        if user_id is not None:
+            self._drop(str(user_id))
+            self.stats["invalidations"] += 1
+
+    def _drop(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry and entry[2] not in (None, _MISSING):
+            self._servicer_owner.pop(entry[2]['_id'], None)
+
+principal_cache = PrincipalCache(
+    ttl_seconds=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+    max_size=settings.PRINCIPAL_CACHE_MAX_SIZE
+)
+
+def invalidate_principal(user_id=None, servicer_id=None):
+    """Drop a cached principal after its user or servicer document changed"""
+    principal_cache.invalidate(
+        str(user_id) if user_id is not None else None,
+        str(servicer_id) if servicer_id is not None else None
+    )
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Get current authenticated user"""
+    try:
+        token = credentials.credentials
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        user_id = payload.get("sub")
+        
+        if user_id is None:
+            raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
+        
+        user = principal_cache.get_user(user_id)
+        if user is None:
+            user = await db[Collections.USERS].find_one({"_id": ObjectId(user_id)})
+            if not user:
+                raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
+            user['_id'] = str(user['_id'])
+            principal_cache.put_user(user_id, user)
+            # Handlers may mutate what they get - hand out a copy of the cached doc
+            user = dict(user)
+        else:
+            # Another worker may have blocked or demoted this user since we cached it
+            access = await db[Collections.USERS].find_one({"_id": ObjectId(user_id)}, USER_ACCESS_FIELDS)
+            if access is None:
+                invalidate_principal(user_id=user_id)
+                raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
+            user = {**user, **{field: access.get(field) for field in USER_ACCESS_FIELDS if field != "_id"}}
+        
+        if user.get("is_blocked"):
+            raise HTTPException(status_code=403, detail=Messages.ACCOUNT_BLOCKED)
+        
+        return user
+        
+    except JWTError:
+        raise HTTPException(status_code=401, detail=Messages.UNAUTHORIZED)
+
+async def get_current_servicer(current_user: dict = Depends(get_current_user)) -> dict:
+    """Get current servicer (must be servicer role)"""
+    if current_user['role'] != UserRole.SERVICER:
+        raise HTTPException(status_code=403, detail=Messages.FORBIDDEN)
+    
+    servicer = principal_cache.get_servicer(current_user['_id'])
+    if servicer is _MISSING:
+        servicer = await db[Collections.SERVICERS].find_one({"user_id": ObjectId(current_user['_id'])})
+        if servicer:
+            servicer['_id'] = str(servicer['_id'])
+            servicer['user_id'] = str(servicer['user_id'])
+        principal_cache.put_servicer(current_user['_id'], servicer)
+    elif servicer:
+        # Suspension and verification may have changed on another worker
+        access = await db[Collections.SERVICERS].find_one(
+            {"user_id": ObjectId(current_user['_id'])}, SERVICER_ACCESS_FIELDS
+        )
+        if access is None:
+            invalidate_principal(user_id=current_user['_id'])
+            raise HTTPException(status_code=404, detail="Servicer profile not found")
+        servicer = {**servicer, **{field: access.get(field) for field in SERVICER_ACCESS_FIELDS if field != "_id"}}
+    
+    if not servicer:
+        raise HTTPException(status_code=404, detail="Servicer profile not found")
+    
+    return dict(servicer)
+
+async def get_current_admin(current_user: dict = Depends(get_current_user)) -> dict:
+    """Get current admin (must be admin role)"""
+    if current_user['role'] != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail=Messages.FORBIDDEN)
+    return current_user
+
+
+def convert_objectid_to_str(document):
+    """
+    Recursively convert all ObjectId instances in a document to strings.
+    Useful for preparing MongoDB documents for JSON serialization.
+    """
     if document is None:
         return None
     
@@ -564,6 +3443,660 @@ def convert_objectid_to_str(document):
     return document
 
 
+# ============= BATCHED LOOKUPS =============
+# List endpoints enrich a page of rows with related users/servicers/bookings.
+# Instead of a find_one per row, collect the referenced ids for the whole page
+# and resolve each collection with a single $in query, then stitch by id.
+
+def collect_object_ids(values) -> list:
+    """Unique, valid ObjectIds from a mix of ObjectId/str/None values"""
+    ids = []
+    seen = set()
+    for value in values:
+        if value is None:
+            continue
+        key = str(value)
+        if key in seen or not ObjectId.is_valid(key):
+            continue
+        seen.add(key)
+        ids.append(ObjectId(key))
+    return ids
+
+async def fetch_by_ids(collection: str, ids, projection: dict = None, key: str = "_id", extra_query: dict = None) -> dict:
+    """
+    Resolve many documents in one round trip.
+    Returns {str(doc[key]): doc}; for non-unique keys the last match wins.
+    """
+    object_ids = collect_object_ids(ids)
+    if not object_ids:
+        return {}
+
+    query = {key: {"$in": object_ids}}
+    if extra_query:
+        query.update(extra_query)
+
+    docs = await db[collection].find(query, projection).to_list(None)
+    return {str(doc[key]): doc for doc in docs}
+
+async def fetch_servicers_with_users(servicer_ids, servicer_projection: dict = None, user_projection: dict = None) -> dict:
+    """
+    Resolve servicers and their owning users with two $in queries.
+    Returns {str(servicer_id): servicer} with the owner attached as servicer['user'] (or None).
+    """
+    if servicer_projection is not None:
+        servicer_projection = {**servicer_projection, "user_id": 1}
+    servicers = await fetch_by_ids(Collections.SERVICERS, servicer_ids, servicer_projection)
+    users = await fetch_by_ids(
+        Collections.USERS,
+        [s.get('user_id') for s in servicers.values()],
+        user_projection
+    )
+    for servicer in servicers.values():
+        servicer['user'] = users.get(str(servicer.get('user_id')))
+    return servicers
+
+
+# ============= INSIGHT CACHE =============
+# Insight endpoints aggregate a user's or servicer's whole history. Their
+# final figures are kept for INSIGHT_CACHE_TTL_SECONDS so dashboards that
+# poll or re-render don't rerun the pipelines on every request.
+
+class ResultCache:
+    """TTL + LRU cache of computed responses keyed by tuples"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.stats["misses"] += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key: tuple, value):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key: tuple, compute):
+        """Cached value for key, else await compute() and cache it"""
+        value = self.get(key)
+        if value is _MISSING:
+            value = await compute()
+            self.put(key, value)
+        return value
+
+insight_cache = ResultCache(
+    ttl_seconds=settings.INSIGHT_CACHE_TTL_SECONDS,
+    max_size=settings.INSIGHT_CACHE_MAX_SIZE
+)
+
+
+# ============= KEYSET PAGINATION =============
+# List endpoints page on their sort key plus _id instead of skip(). The
+# response carries next_cursor, an opaque token holding the last row's sort
+# values; passing it back as ?cursor= continues with an indexed range query,
+# so a deep page costs the same as the first. page= still works for old
+# clients. Totals are approximate: estimated_document_count for unfiltered
+# collections, otherwise a count cached for PAGINATION_COUNT_CACHE_TTL_SECONDS.
+
+count_cache = ResultCache(
+    ttl_seconds=settings.PAGINATION_COUNT_CACHE_TTL_SECONDS,
+    max_size=settings.INSIGHT_CACHE_MAX_SIZE
+)
+
+def encode_cursor(doc: dict, sort: List[Tuple[str, int]]) -> str:
+    payload = json_util.dumps([doc.get(field) for field, _ in sort])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: List[Tuple[str, int]]) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json_util.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def _after_value(field: str, value, direction: int) -> Optional[dict]:
+    """Condition for values strictly after `value` in sort order (null sorts lowest); None if nothing can follow"""
+    if direction < 0:
+        if value is None:
+            return None
+        return {"$or": [{field: {"$lt": value}}, {field: None}]}
+    if value is None:
+        return {field: {"$ne": None}}
+    return {field: {"$gt": value}}
+
+def keyset_query(query: dict, sort: List[Tuple[str, int]], values: list) -> dict:
+    """Restrict query to rows after the cursor row for a (field..., _id) sort"""
+    branches = []
+    for index, (field, direction) in enumerate(sort):
+        after = _after_value(field, values[index], direction)
+        if after is None:
+            continue
+        branch = {sort[i][0]: values[i] for i in range(index)}
+        branches.append({"$and": [branch, after]} if branch else after)
+    after_cursor = {"$or": branches} if branches else {"_id": {"$exists": False}}
+    return {"$and": [query, after_cursor]} if query else after_cursor
+
+async def fetch_page(
+    collection: str,
+    query: dict,
+    sort: List[Tuple[str, int]],
+    limit: int,
+    page: int = 1,
+    cursor: Optional[str] = None,
+    projection: dict = None
+) -> Tuple[list, Optional[str]]:
+    """One page of documents plus the cursor for the next page (None on the last page)"""
+    limit = max(limit, 1)
+    sort = list(sort) + [("_id", sort[-1][1])]
+    if cursor:
+        find = db[collection].find(keyset_query(query, sort, decode_cursor(cursor, sort)), projection)
+    else:
+        find = db[collection].find(query, projection).skip((max(page, 1) - 1) * limit)
+    docs = await find.sort(sort).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(docs[limit - 1], sort) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+async def count_for_listing(collection: str, query: dict) -> int:
+    """Approximate total for a listing"""
+    if not query:
+        return await db[collection].estimated_document_count()
+    return await count_cache.get_or_compute(
+        (collection, json_util.dumps(query, sort_keys=True)),
+        lambda: db[collection].count_documents(query)
+    )
+
+
+# ============= WALLET LEDGER =============
+# Every wallet balance change goes through wallet_ledger. It does one
+# conditional find_one_and_update on the wallet. Debits only match while
+# balance >= amount, so concurrent spends cannot overdraw. It also writes an
+# append-only wallet_ledger entry (signed amount, per-wallet seq,
+# balance_after) and optionally the matching transactions document.
+# On replica sets / sharded clusters all of that is a single multi-document
+# transaction. On a standalone server the writes are sequential and the
+# reconciliation below catches any partial write. Entries may carry a unique
+# idempotency key, so a repeated top-up confirmation, refund or earning
+# credit is a no-op. A daily queued job snapshots each changed wallet's
+# balance and seq and checks the balance against the last snapshot plus the
+# entries since. Statements take their opening and closing balances from
+# balance_after instead of summing history.
+
+class WalletLedger:
+    """Atomic wallet credits/debits with an append-only ledger"""
+
+    def __init__(self):
+        self.transactions_supported = False
+        self.stats = {"credits": 0, "debits": 0, "declined": 0, "duplicates": 0}
+
+    async def detect_transactions(self):
+        """Multi-document transactions need a replica set or mongos"""
+        try:
+            hello = await db.command("hello")
+            self.transactions_supported = bool(hello.get('setName') or hello.get('msg') == "isdbgrid")
+        except Exception as e:
+            print(f"⚠️ Could not detect MongoDB topology: {e}")
+        if not self.transactions_supported:
+            print("⚠️ MongoDB has no transactions (standalone); wallet ledger writes are sequential")
+
+    async def credit(self, user_id, amount: float, entry_type: str, **kwargs) -> Optional[dict]:
+        return await self.apply(user_id, abs(amount), entry_type, **kwargs)
+
+    async def debit(self, user_id, amount: float, entry_type: str, **kwargs) -> Optional[dict]:
+        """None when the wallet is missing or holds less than amount"""
+        return await self.apply(user_id, -abs(amount), entry_type, **kwargs)
+
+    async def apply(
+        self,
+        user_id,
+        amount: float,
+        entry_type: str,
+        idempotency_key: Optional[str] = None,
+        reference_id=None,
+        transaction: Optional[dict] = None,
+        inc: Optional[dict] = None,
+        upsert: bool = False,
+        allow_negative: bool = False,
+        metadata: Optional[dict] = None
+    ) -> Optional[dict]:
+        """
+        Change a wallet balance by amount (negative = debit) and record it.
+        Returns the ledger entry (the earlier one, with duplicate=True, for a
+        repeated idempotency key), or None if the wallet is missing or the
+        debit would overdraw it.
+        """
+        now = datetime.utcnow()
+        user_id = ObjectId(user_id)
+        wallet_filter = {"user_id": user_id}
+        if amount < 0 and not allow_negative:
+            wallet_filter["balance"] = {"$gte": -amount}
+        update = {
+            "$inc": {"balance": amount, "ledger_seq": 1, **(inc or {})},
+            "$set": {"last_transaction_at": now, "updated_at": now}
+        }
+        if upsert:
+            update["$setOnInsert"] = {"currency": "INR", "created_at": now}
+        entry = {
+            "user_id": user_id,
+            "amount": amount,
+            "entry_type": getattr(entry_type, 'value', entry_type),
+            "reference_id": ObjectId(reference_id) if reference_id else None,
+            "metadata": metadata or {},
+            "created_at": now
+        }
+        if idempotency_key:
+            entry["idempotency_key"] = idempotency_key
+        if transaction is not None:
+            transaction.setdefault("_id", ObjectId())
+            entry["transaction_id"] = transaction["_id"]
+
+        try:
+            if self.transactions_supported:
+                async with await mongodb_client.start_session() as session:
+                    result = await session.with_transaction(
+                        lambda s: self._write(s, wallet_filter, update, upsert and amount >= 0, entry, transaction)
+                    )
+            else:
+                if idempotency_key:
+                    existing = await self._existing(idempotency_key)
+                    if existing:
+                        return existing
+                result = await self._write(None, wallet_filter, update, upsert and amount >= 0, entry, transaction)
+        except DuplicateKeyError:
+            existing = await self._existing(idempotency_key) if idempotency_key else None
+            if existing:
+                return existing
+            raise
+
+        if result is None:
+            self.stats["declined"] += 1
+            return None
+        self.stats["credits" if amount >= 0 else "debits"] += 1
+        return result
+
+    async def _write(self, session, wallet_filter: dict, update: dict, upsert: bool, entry: dict, transaction: Optional[dict]) -> Optional[dict]:
+        wallet = await db[Collections.WALLETS].find_one_and_update(
+            wallet_filter, update,
+            projection={"balance": 1, "ledger_seq": 1},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not wallet:
+            return None
+        entry.pop("_id", None)
+        entry.update({"wallet_id": wallet['_id'], "seq": wallet['ledger_seq'], "balance_after": wallet['balance']})
+        try:
+            await db[Collections.WALLET_LEDGER].insert_one(entry, session=session)
+        except DuplicateKeyError:
+            if session is None:
+                # Lost a race on the idempotency key after moving the balance:
+                # keep the entry (so seq has no gap) and reverse it
+                await self._reverse(entry, update)
+            raise
+        if transaction is not None:
+            await db[Collections.TRANSACTIONS].insert_one(transaction, session=session)
+        return entry
+
+    async def _existing(self, idempotency_key: str) -> Optional[dict]:
+        existing = await db[Collections.WALLET_LEDGER].find_one({"idempotency_key": idempotency_key})
+        if existing:
+            existing['duplicate'] = True
+            self.stats["duplicates"] += 1
+        return existing
+
+    async def _reverse(self, entry: dict, update: dict):
+        entry.pop("_id", None)
+        entry["metadata"] = {**entry["metadata"], "duplicate_of": entry.pop("idempotency_key", None)}
+        await db[Collections.WALLET_LEDGER].insert_one(entry)
+        await self.apply(
+            entry["user_id"], -entry["amount"], TransactionType.REVERSAL,
+            reference_id=entry["_id"],
+            inc={field: -value for field, value in update["$inc"].items() if field not in ("balance", "ledger_seq")},
+            allow_negative=True
+        )
+
+    async def reconcile(self) -> dict:
+        """Snapshot changed wallets and compare each balance with its ledger"""
+        report = {"checked": 0, "drift": 0, "skipped": 0}
+        async for wallet in db[Collections.WALLETS].find({}, {"user_id": 1, "balance": 1, "ledger_seq": 1}):
+            seq = wallet.get('ledger_seq', 0)
+            balance = wallet.get('balance', 0)
+            snapshot = await db[Collections.WALLET_SNAPSHOTS].find_one(
+                {"wallet_id": wallet['_id']}, sort=[("seq", -1)]
+            )
+            from_seq = snapshot['seq'] if snapshot else 0
+            if snapshot and from_seq == seq and round(snapshot['balance'] - balance, 2) == 0:
+                continue
+
+            rows = await db[Collections.WALLET_LEDGER].aggregate([
+                {"$match": {"wallet_id": wallet['_id'], "seq": {"$gt": from_seq, "$lte": seq}}},
+                {"$group": {"_id": None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+            ]).to_list(1)
+            total = rows[0]['total'] if rows else 0
+            if (rows[0]['count'] if rows else 0) != seq - from_seq:
+                # Entries still being written (standalone server); next run
+                report["skipped"] += 1
+                continue
+
+            record = {
+                "wallet_id": wallet['_id'],
+                "user_id": wallet['user_id'],
+                "seq": seq,
+                "balance": balance,
+                "created_at": datetime.utcnow()
+            }
+            if snapshot is None:
+                # First snapshot; wallets older than the ledger start from this balance
+                record["opening_balance"] = round(balance - total, 2)
+                record["drift"] = 0
+            else:
+                record["expected_balance"] = round(snapshot['balance'] + total, 2)
+                record["drift"] = round(balance - record["expected_balance"], 2)
+            await db[Collections.WALLET_SNAPSHOTS].insert_one(record)
+            report["checked"] += 1
+            if record["drift"]:
+                report["drift"] += 1
+                print(f"⚠️ Wallet {wallet['_id']} drift: balance ₹{balance}, ledger ₹{record['expected_balance']}")
+        return report
+
+    def metrics(self) -> dict:
+        return {**self.stats, "transactions": self.transactions_supported}
+
+wallet_ledger = WalletLedger()
+
+
+@job_handler("wallet_reconcile")
+async def run_wallet_reconcile(payload: dict):
+    report = await wallet_ledger.reconcile()
+    print(f"✅ Wallet reconcile: {report['checked']} snapshots, {report['drift']} drifted, {report['skipped']} skipped")
+
+
+@job_handler("coverage_rebuild")
+async def run_coverage_rebuild(payload: dict):
+    count = await coverage_index.rebuild()
+    print(f"✅ Coverage grid rebuilt ({count} cells)")
+
+
+# ============= CATEGORY CACHE =============
+# Service categories are reference data: read on most request paths but
+# changed only by the admin category endpoints. All categories are held in
+# memory for CATEGORY_CACHE_TTL_SECONDS, and those endpoints drop the copy
+# as soon as they write. Approved-servicer counts per category are cached the
+# same way and marked stale when a servicer is approved, rejected,
+# suspended, unsuspended or gains a category. With
+# CATEGORY_CACHE_WATCH_CHANGES (replica sets only) a change stream applies
+# the same invalidation on every worker.
+
+class CategoryCache:
+    """In-process copy of service_categories plus approved-servicer counts"""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._by_id: "OrderedDict[str, dict]" = OrderedDict()
+        self._by_name: Dict[str, dict] = {}
+        self._expires_at = 0.0
+        self._generation = 0
+        self._counts: Dict[str, int] = {}
+        self._counts_expire_at = 0.0
+        self._counts_generation = 0
+        self._lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "loads": 0, "count_refreshes": 0, "invalidations": 0}
+
+    async def _ensure_loaded(self):
+        if time.monotonic() < self._expires_at:
+            self.stats["hits"] += 1
+            return
+        async with self._lock:
+            if time.monotonic() < self._expires_at:
+                return
+            generation = self._generation
+            categories = await db[Collections.SERVICE_CATEGORIES].find({}).to_list(None)
+            self._by_id = OrderedDict((str(category['_id']), category) for category in categories)
+            self._by_name = {category.get('name'): category for category in categories}
+            self.stats["loads"] += 1
+            # An invalidation during the read means this copy may already be stale
+            if generation == self._generation:
+                self._expires_at = time.monotonic() + self.ttl_seconds
+
+    async def get(self, category_id) -> Optional[dict]:
+        """Category by id (ObjectId or str); None if unknown or not a valid id"""
+        await self._ensure_loaded()
+        category = self._by_id.get(str(category_id))
+        return copy.deepcopy(category) if category else None
+
+    async def get_by_name(self, name: str) -> Optional[dict]:
+        await self._ensure_loaded()
+        category = self._by_name.get(name)
+        return copy.deepcopy(category) if category else None
+
+    async def get_many(self, category_ids) -> Dict[str, dict]:
+        """{str(id): category} for the ids that exist"""
+        await self._ensure_loaded()
+        return {
+            str(category_id): copy.deepcopy(self._by_id[str(category_id)])
+            for category_id in category_ids
+            if str(category_id) in self._by_id
+        }
+
+    async def all(self, active_only: bool = False) -> List[dict]:
+        await self._ensure_loaded()
+        return [
+            copy.deepcopy(category) for category in self._by_id.values()
+            if not active_only or category.get('is_active', True)
+        ]
+
+    async def servicer_counts(self) -> Dict[str, int]:
+        """{str(category_id): approved, unsuspended servicers offering it}"""
+        if time.monotonic() < self._counts_expire_at:
+            return self._counts
+        generation = self._counts_generation
+        counts = {}
+        async for row in db[Collections.SERVICERS].aggregate([
+            {"$match": {"verification_status": VerificationStatus.APPROVED, "is_suspended": {"$ne": True}}},
+            {"$unwind": "$service_categories"},
+            {"$group": {"_id": "$service_categories", "count": {"$sum": 1}}}
+        ]):
+            # Categories are stored as ObjectIds or their string form
+            key = str(row['_id'])
+            counts[key] = counts.get(key, 0) + row['count']
+        self._counts = counts
+        self.stats["count_refreshes"] += 1
+        if generation == self._counts_generation:
+            self._counts_expire_at = time.monotonic() + self.ttl_seconds
+        return counts
+
+    def invalidate(self):
+        """Drop cached categories (after a category write)"""
+        self._generation += 1
+        self._expires_at = 0.0
+        self.stats["invalidations"] += 1
+
+    def invalidate_servicer_counts(self):
+        """Recount on next read (after a servicer's approval, suspension or categories changed)"""
+        self._counts_generation += 1
+        self._counts_expire_at = 0.0
+
+    def start(self):
+        if settings.CATEGORY_CACHE_WATCH_CHANGES and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+    async def _watch(self):
+        """Invalidate on writes made by other workers"""
+        servicer_fields = ("verification_status", "is_suspended", "service_categories")
+        pipeline = [{"$match": {"$or": [
+            {"ns.coll": Collections.SERVICE_CATEGORIES},
+            {"ns.coll": Collections.SERVICERS, "operationType": {"$in": ["insert", "replace", "delete"]}},
+            *[
+                {"ns.coll": Collections.SERVICERS, f"updateDescription.updatedFields.{field}": {"$exists": True}}
+                for field in servicer_fields
+            ]
+        ]}}]
+        try:
+            async with db.watch(pipeline) as stream:
+                print("👀 Category cache watching for changes")
+                async for change in stream:
+                    if change['ns']['coll'] == Collections.SERVICE_CATEGORIES:
+                        self.invalidate()
+                    else:
+                        self.invalidate_servicer_counts()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Standalone servers have no change streams; the TTL still bounds staleness
+            print(f"⚠️ Category change stream unavailable, relying on TTL: {e}")
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "categories": len(self._by_id),
+            "watching": bool(self._watch_task and not self._watch_task.done())
+        }
+
+category_cache = CategoryCache(ttl_seconds=settings.CATEGORY_CACHE_TTL_SECONDS)
+
+
+# ============= RATING AGGREGATES =============
+# Servicers carry rating_sum, total_ratings and a per-star rating_histogram.
+# Adding, changing or deleting a review folds a delta into them with a single
+# pipeline update, which also derives average_rating atomically. A scheduled
+# reconciliation recomputes them from the ratings collection to repair drift.
+
+RATING_STARS = (1, 2, 3, 4, 5)
+
+def empty_rating_histogram() -> dict:
+    return {str(star): 0 for star in RATING_STARS}
+
+def _rating_counter(field: str, delta, default=0):
+    return {"$add": [{"$ifNull": [f"${field}", default]}, delta]}
+
+async def apply_rating_delta(servicer_id, added: Optional[int] = None, removed: Optional[int] = None, projection: dict = None) -> Optional[dict]:
+    """
+    Fold one added/removed/changed rating into a servicer's aggregates.
+    Returns the updated servicer (limited to projection).
+    """
+    changes = {
+        # Profiles written before rating_sum existed start from average * count
+        "rating_sum": _rating_counter(
+            "rating_sum",
+            (added or 0) - (removed or 0),
+            {"$multiply": [{"$ifNull": ["$average_rating", 0]}, {"$ifNull": ["$total_ratings", 0]}]}
+        ),
+        "total_ratings": _rating_counter("total_ratings", (1 if added else 0) - (1 if removed else 0))
+    }
+    histogram = {}
+    for star, delta in ((added, 1), (removed, -1)):
+        if star:
+            histogram[star] = histogram.get(star, 0) + delta
+    for star, delta in histogram.items():
+        if delta:
+            changes[f"rating_histogram.{star}"] = _rating_counter(f"rating_histogram.{star}", delta)
+
+    return await db[Collections.SERVICERS].find_one_and_update(
+        {"_id": ObjectId(servicer_id)},
+        [
+            {"$set": changes},
+            {"$set": {"average_rating": {"$cond": [
+                {"$gt": ["$total_ratings", 0]},
+                {"$round": [{"$divide": ["$rating_sum", "$total_ratings"]}, 2]},
+                0
+            ]}}}
+        ],
+        projection=projection or {"average_rating": 1, "total_ratings": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+RATING_AGGREGATE_FIELDS = ("rating_sum", "total_ratings", "rating_histogram")
+
+async def _reconcile_rating_batch(servicers: List[dict]) -> int:
+    """
+    Servicers are read before their ratings are aggregated, and each write is
+    guarded on the aggregate values read. A live apply_rating_delta() landing
+    in between makes the guard miss instead of being overwritten; that
+    servicer is picked up again on the next run.
+    """
+    ids = [servicer['_id'] for servicer in servicers]
+    actual = {}
+    async for row in db[Collections.RATINGS].aggregate([
+        {"$match": {"servicer_id": {"$in": ids + [str(servicer_id) for servicer_id in ids]}}},
+        {"$group": {
+            "_id": "$servicer_id",
+            "total": {"$sum": 1},
+            "sum": {"$sum": "$overall_rating"},
+            **{
+                str(star): {"$sum": {"$cond": [{"$eq": ["$overall_rating", star]}, 1, 0]}}
+                for star in RATING_STARS
+            }
+        }}
+    ]):
+        key = str(row['_id'])
+        if key in actual:
+            # Legacy string ids alongside ObjectIds - merge the two groups
+            for field in ("total", "sum", *map(str, RATING_STARS)):
+                actual[key][field] += row[field]
+        else:
+            actual[key] = row
+
+    updates = []
+    for servicer in servicers:
+        row = actual.get(str(servicer['_id']))
+        expected = {
+            "rating_sum": row['sum'] if row else 0,
+            "total_ratings": row['total'] if row else 0,
+            "rating_histogram": {str(star): row[str(star)] if row else 0 for star in RATING_STARS}
+        }
+        expected["average_rating"] = round(expected["rating_sum"] / expected["total_ratings"], 2) if expected["total_ratings"] else 0
+        if any(servicer.get(field) != value for field, value in expected.items()):
+            guard = {field: servicer.get(field) for field in RATING_AGGREGATE_FIELDS}
+            updates.append(UpdateOne({"_id": servicer['_id'], **guard}, {"$set": expected}))
+    if not updates:
+        return 0
+    result = await db[Collections.SERVICERS].bulk_write(updates, ordered=False)
+    return result.modified_count
+
+async def reconcile_rating_aggregates(only_missing: bool = False) -> int:
+    """Recompute servicer rating aggregates from ratings; returns how many servicers were corrected"""
+    query = {"rating_sum": {"$exists": False}} if only_missing else {}
+    projection = {"rating_sum": 1, "total_ratings": 1, "rating_histogram": 1, "average_rating": 1}
+    corrected = 0
+    batch = []
+    async for servicer in db[Collections.SERVICERS].find(query, projection):
+        batch.append(servicer)
+        if len(batch) >= 500:
+            corrected += await _reconcile_rating_batch(batch)
+            batch = []
+    if batch:
+        corrected += await _reconcile_rating_batch(batch)
+    return corrected
+
+async def reconcile_rating_aggregates_background(only_missing: bool = False):
+    try:
+        corrected = await reconcile_rating_aggregates(only_missing)
+        if corrected:
+            print(f"⭐ Rating aggregates corrected for {corrected} servicers")
+    except Exception as e:
+        print(f"❌ Rating reconcile error: {e}")
+
+
 # Around line 3500 - After booking endpoints
 
 @app.post("/api/user/bookings/{booking_id}/report-refund-delay")
@@ -599,9 +4132,8 @@ async def report_refund_delay(
     # Upload evidence
     evidence_urls = []
     if evidence_images:
-        for img in evidence_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.ISSUE_EVIDENCE)
-            evidence_urls.append(result['url'])
+        uploaded = await upload_many(evidence_images, CloudinaryFolders.ISSUE_EVIDENCE)
+        evidence_urls.extend(result['url'] for result in uploaded)
     
     # Create booking issue
     issue = {
@@ -657,8 +4189,82 @@ async def report_refund_delay(
     )
 # ============= SOCKET.IO CHAT EVENTS (Add after existing socket events) =============
 
-# Store connected users
-connected_users = {}  # {user_id: sid}
+# Store connected users
+async def save_socket_principal(sid: str, user: Optional[dict]):
+    """Resolve the principal once per connection and keep it on the socket session"""
+    if not user:
+        return
+    principal = {"user_id": str(user['_id']), "role": user.get('role')}
+    role = user.get('role')
+    await sio.enter_room(sid, f"role-{getattr(role, 'value', role)}")
+    if user.get('role') == UserRole.SERVICER:
+        servicer = await db[Collections.SERVICERS].find_one({"user_id": user['_id']}, {"_id": 1})
+        principal["servicer_id"] = str(servicer['_id']) if servicer else None
+    await sio.save_session(sid, principal)
+
+async def handle_location_stream(sid: str, data: dict) -> dict:
+    """
+    Streamed servicer fixes: {booking_id, fixes: [{latitude, longitude, speed?, heading?}]}
+    or a single fix inline. Uses the principal saved at authentication, so
+    fixes cost no auth queries; the booking is checked once via the tracker.
+    """
+    principal = await sio.get_session(sid)
+    servicer_id = principal.get('servicer_id') if principal else None
+    if not servicer_id:
+        return {"status": "error", "message": "Authenticate as a servicer first"}
+    
+    booking_id = data.get('booking_id')
+    if not booking_id or not ObjectId.is_valid(booking_id):
+        return {"status": "error", "message": "booking_id required"}
+    
+    fixes = data.get('fixes') or [data]
+    fixes = [f for f in fixes if f.get('latitude') is not None and f.get('longitude') is not None]
+    if not fixes:
+        return {"status": "error", "message": "No location fixes"}
+    fixes = fixes[-settings.LOCATION_STREAM_MAX_BATCH:]
+    
+    session = await location_tracker.get_session(booking_id, {
+        "_id": ObjectId(booking_id),
+        "servicer_id": ObjectId(servicer_id),
+        "booking_status": {"$in": TRACKING_ACTIVE_STATUSES}
+    })
+    if not session or session['servicer_id'] != servicer_id:
+        return {"status": "error", "message": Messages.BOOKING_NOT_FOUND}
+    
+    # Per-booking rate limit - extra batches inside the window are dropped
+    now = time.monotonic()
+    if now - session.get('last_stream_at', 0) < settings.LOCATION_STREAM_MIN_INTERVAL_SECONDS:
+        return {"status": "rate_limited", "retry_after": settings.LOCATION_STREAM_MIN_INTERVAL_SECONDS}
+    session['last_stream_at'] = now
+    
+    payload = None
+    for fix in fixes:
+        payload = location_tracker.ingest(
+            session,
+            float(fix['latitude']),
+            float(fix['longitude']),
+            fix.get('speed'),
+            fix.get('heading')
+        )
+    
+    # Only the newest position is fanned out to the customer
+    await sio.emit(SocketEvents.LOCATION_UPDATE, payload, room=f"user-{session['user_id']}")
+    
+    return {
+        "status": "ok",
+        "accepted": len(fixes),
+        "distance_km": payload['distance_km'],
+        "eta_minutes": payload['eta_minutes']
+    }
+
+@sio.on(SocketEvents.LOCATION_STREAM)
+async def location_stream(sid, data):
+    """Servicer location streaming channel (replaces HTTP update-location polling)"""
+    try:
+        return await handle_location_stream(sid, data or {})
+    except Exception as e:
+        print(f"Location stream error: {e}")
+        return {"status": "error", "message": "Location update failed"}
 
 @sio.event
 async def connect(sid, environ):
@@ -670,11 +4276,7 @@ async def connect(sid, environ):
 async def disconnect(sid):
     """Handle client disconnection"""
     print(f"Client disconnected: {sid}")
-    # Remove from connected users
-    for user_id, socket_id in list(connected_users.items()):
-        if socket_id == sid:
-            del connected_users[user_id]
-            break
+    await presence.disconnect(sid)
 
 @sio.event
 async def authenticate_socket(sid, data):
@@ -693,9 +4295,6 @@ async def authenticate_socket(sid, data):
             await sio.emit('auth_error', {'message': 'Invalid token'}, room=sid)
             return
         
-        # Store user connection
-        connected_users[user_id] = sid
-        
         # Join user-specific room
         await sio.enter_room(sid, f"user-{user_id}")
         
@@ -706,6 +4305,9 @@ async def authenticate_socket(sid, data):
         if user and user['role'] == UserRole.ADMIN:
             await sio.enter_room(sid, "admins")
         
+        await save_socket_principal(sid, user)
+        await presence.connect(sid, user_id)
+        
         print(f"User {user_id} authenticated with socket {sid}")
         await sio.emit('authenticated', {
             'user_id': user_id,
@@ -727,12 +4329,14 @@ async def join_chat(sid, data):
         booking_id = data.get('booking_id')
         
         if chat_id:
-            # Join pre-booking chat room
+            # Join pre-booking chat room; participants are cached for its messages
+            await chat_service.room('pre_booking', chat_id)
             await sio.enter_room(sid, f"chat-{chat_id}")
             await sio.emit('joined_chat', {'chat_id': chat_id}, room=sid)
             print(f"Socket {sid} joined chat room: chat-{chat_id}")
         elif booking_id:
             # Join booking chat room
+            await chat_service.room('booking', booking_id)
             await sio.enter_room(sid, f"booking-chat-{booking_id}")
             await sio.emit('joined_chat', {'booking_id': booking_id}, room=sid)
             print(f"Socket {sid} joined booking chat room: booking-chat-{booking_id}")
@@ -763,44 +4367,50 @@ async def send_chat_message(sid, data):
         chat_type = data.get('chat_type', 'pre_booking')
         chat_id = data.get('chat_id')
         booking_id = data.get('booking_id')
-        sender_id = data.get('sender_id')
-        receiver_id = data.get('receiver_id')
         message_text = data.get('message_text')
         message_type = data.get('message_type', 'text')
         
-        if not message_text or not sender_id or not receiver_id:
+        # The sender is always the authenticated principal, never a client-supplied id
+        principal = await sio.get_session(sid)
+        sender_id = (principal or {}).get('user_id')
+        if not sender_id:
+            await sio.emit('message_error', {'message': 'Authenticate first'}, room=sid)
+            return
+        
+        if chat_type == 'pre_booking' and chat_id:
+            kind, room_id = 'pre_booking', chat_id
+        elif chat_type == 'booking' and booking_id:
+            kind, room_id = 'booking', booking_id
+        else:
+            kind, room_id = None, None
+        
+        if not message_text or not sender_id or not kind:
             await sio.emit('message_error', {'message': 'Missing required fields'}, room=sid)
             return
         
-        # Get sender info for notification
-        sender = await db[Collections.USERS].find_one({"_id": ObjectId(sender_id)})
-        sender_name = sender.get('name', 'Someone') if sender else 'Someone'
+        # Membership, names and booking number come from the room cache
+        room = await chat_service.member_room(kind, room_id, sender_id)
+        receiver_id = chat_service.receiver(room, sender_id, data.get('receiver_id')) if room else None
+        if not receiver_id:
+            await sio.emit('message_error', {'message': 'You are not a participant in this chat'}, room=sid)
+            return
+        sender_name = room['participants'][sender_id]['name']
+        preview = f"{sender_name}: {message_text[:100]}{'...' if len(message_text) > 100 else ''}"
         
-        # Create message based on chat type
-        if chat_type == 'pre_booking' and chat_id:
-            # Pre-booking chat
-            message = {
-                "chat_id": ObjectId(chat_id),
-                "sender_id": ObjectId(sender_id),
-                "receiver_id": ObjectId(receiver_id),
-                "message_type": message_type,
-                "message_text": message_text,
-                "timestamp": datetime.utcnow(),
-                "created_at": datetime.utcnow(),
-                "is_read": False
-            }
-            
-            result = await db[Collections.PRE_BOOKING_MESSAGES].insert_one(message)
-            message['_id'] = str(result.inserted_id)
-            message['chat_id'] = str(message['chat_id'])
-            message['sender_id'] = str(message['sender_id'])
-            message['receiver_id'] = str(message['receiver_id'])
-            
-            # Update chat last message time
-            await db[Collections.PRE_BOOKING_CHATS].update_one(
-                {"_id": ObjectId(chat_id)},
-                {"$set": {"last_message_at": datetime.utcnow()}}
-            )
+        now = datetime.utcnow()
+        message = {
+            "sender_id": ObjectId(sender_id),
+            "receiver_id": ObjectId(receiver_id),
+            "message_type": message_type,
+            "message_text": message_text,
+            "timestamp": now,
+            "created_at": now,
+            "is_read": False
+        }
+        
+        if kind == 'pre_booking':
+            # Pre-booking chat (chat last message and unread count are updated with the batch)
+            message = await chat_service.post(kind, {"chat_id": ObjectId(chat_id), **message})
             
             # Emit to chat room
             await sio.emit('new_message', message, room=f"chat-{chat_id}")
@@ -813,36 +4423,19 @@ async def send_chat_message(sid, data):
                 receiver_id,
                 NotificationTypes.SYSTEM,
                 "New Message",
-                f"{sender_name}: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
+                preview,
                 metadata={
                     "chat_id": chat_id,
                     "sender_name": sender_name,
                     "message_preview": message_text[:100]
-                }
+                },
+                coalesce_key=f"chat-{chat_id}"
             )
             
-        elif chat_type == 'booking' and booking_id:
+        else:
             # Booking chat
-            message = {
-                "booking_id": ObjectId(booking_id),
-                "sender_id": ObjectId(sender_id),
-                "receiver_id": ObjectId(receiver_id),
-                "message_type": message_type,
-                "message_text": message_text,
-                "timestamp": datetime.utcnow(),
-                "created_at": datetime.utcnow(),
-                "is_read": False
-            }
-            
-            result = await db[Collections.CHAT_MESSAGES].insert_one(message)
-            message['_id'] = str(result.inserted_id)
-            message['booking_id'] = str(message['booking_id'])
-            message['sender_id'] = str(message['sender_id'])
-            message['receiver_id'] = str(message['receiver_id'])
-            
-            # Get booking details for notification
-            booking = await db[Collections.BOOKINGS].find_one({"_id": ObjectId(booking_id)})
-            booking_number = booking.get('booking_number', 'N/A') if booking else 'N/A'
+            message = await chat_service.post(kind, {"booking_id": ObjectId(booking_id), **message})
+            booking_number = room.get('booking_number') or 'N/A'
             
             # Emit to booking chat room
             await sio.emit('new_message', message, room=f"booking-chat-{booking_id}")
@@ -855,13 +4448,14 @@ async def send_chat_message(sid, data):
                 receiver_id,
                 NotificationTypes.SYSTEM,
                 f"New Message - Booking #{booking_number}",
-                f"{sender_name}: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
+                preview,
                 metadata={
                     "booking_id": booking_id,
                     "booking_number": booking_number,
                     "sender_name": sender_name,
                     "message_preview": message_text[:100]
-                }
+                },
+                coalesce_key=f"booking-chat-{booking_id}"
             )
         
         print(f"✅ Message and notification sent from {sender_id} to {receiver_id}")
@@ -924,6 +4518,11 @@ async def message_read(sid, data):
                 {"_id": ObjectId(message_id)}
             )
             if message:
+                if chat_type == 'pre_booking':
+                    await db[Collections.PRE_BOOKING_CHATS].update_one(
+                        {"_id": message['chat_id'], f"unread_counts.{user_id}": {"$gt": 0}},
+                        {"$inc": {f"unread_counts.{user_id}": -1}}
+                    )
                 await sio.emit('message_read_receipt', {
                     'message_id': message_id,
                     'reader_id': user_id
@@ -937,7 +4536,7 @@ async def get_online_status(sid, data):
     """Check if user is online"""
     try:
         user_id = data.get('user_id')
-        is_online = user_id in connected_users
+        is_online = await presence.is_online(user_id)
         
         await sio.emit('online_status', {
             'user_id': user_id,
@@ -946,6 +4545,32 @@ async def get_online_status(sid, data):
         
     except Exception as e:
         print(f"Error getting online status: {e}")
+
+@sio.event
+async def get_online_statuses(sid, data):
+    """Online status for a list of users (chat list, servicer list) in one round trip"""
+    try:
+        user_ids = [str(u) for u in (data.get('user_ids') or [])][:settings.PRESENCE_MAX_BATCH]
+        statuses = await presence.online(user_ids)
+        
+        await sio.emit('online_statuses', {'statuses': statuses}, room=sid)
+        
+    except Exception as e:
+        print(f"Error getting online statuses: {e}")
+
+# ============= PRESENCE ENDPOINTS =============
+@app.get("/api/presence", response_model=SuccessResponse)
+async def get_presence(
+    user_ids: str,  # comma-separated
+    current_user: dict = Depends(get_current_user)
+):
+    """Online status for a batch of users"""
+    ids = [u.strip() for u in user_ids.split(',') if u.strip()]
+    if len(ids) > settings.PRESENCE_MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {settings.PRESENCE_MAX_BATCH} users per request")
+    
+    statuses = await presence.online(ids)
+    return SuccessResponse(message="Presence retrieved", data={"statuses": statuses})
 # ============= AUTHENTICATION ENDPOINTS =============
 @app.post("/api/auth/signup", response_model=SuccessResponse)
 async def signup(user_data: UserCreate):
@@ -964,7 +4589,7 @@ async def signup(user_data: UserCreate):
             try:
                 # Convert to ObjectId and check if exists
                 obj_id = ObjectId(cat_id)
-                category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": obj_id})
+                category = await category_cache.get(obj_id)
                 
                 if category:
                     valid_category_ids.append(obj_id)
@@ -997,7 +4622,7 @@ async def signup(user_data: UserCreate):
     
     # 3. Create user
     user_dict = user_data.dict(exclude={'service_categories'})
-    user_dict['password_hash'] = hash_password(user_dict.pop('password'))
+    user_dict['password_hash'] = await hash_password(user_dict.pop('password'))
     user_dict['created_at'] = datetime.utcnow()
     user_dict['updated_at'] = datetime.utcnow()
     user_dict['email_verified'] = False
@@ -1129,8 +4754,11 @@ async def login(credentials: UserLogin):
     if not user:
         raise HTTPException(status_code=401, detail=Messages.INVALID_CREDENTIALS)
     
-    if not verify_password(credentials.password, user['password_hash']):
+    valid, new_hash = await password_hasher.verify(credentials.password, user.get('password_hash'))
+    if not valid:
         raise HTTPException(status_code=401, detail=Messages.INVALID_CREDENTIALS)
+    if new_hash:
+        asyncio.create_task(update_password_hash_background(user['_id'], user['password_hash'], new_hash))
     
     if user.get('is_blocked'):
         raise HTTPException(status_code=403, detail=Messages.ACCOUNT_BLOCKED)
@@ -1146,6 +4774,8 @@ async def login(credentials: UserLogin):
                 "verification_status": VerificationStatus.PENDING,
                 "average_rating": 0.0,
                 "total_ratings": 0,
+                "rating_sum": 0,
+                "rating_histogram": empty_rating_histogram(),
                 "total_jobs_completed": 0,
                 "service_radius_km": 10.0,
                 "availability_status": AvailabilityStatus.OFFLINE,
@@ -1183,7 +4813,7 @@ async def reset_password(
     await verify_otp(email, otp_code)
     
     # Update password
-    hashed_password = hash_password(new_password)
+    hashed_password = await hash_password(new_password)
     await db[Collections.USERS].update_one(
         {"email": email},
         {"$set": {"password_hash": hashed_password, "updated_at": datetime.utcnow()}}
@@ -1200,14 +4830,15 @@ async def change_password(
     """Change password for authenticated user"""
     user = await db[Collections.USERS].find_one({"_id": ObjectId(current_user['_id'])})
     
-    if not verify_password(old_password, user['password_hash']):
+    if not await verify_password(old_password, user['password_hash']):
         raise HTTPException(status_code=400, detail="Invalid old password")
     
-    hashed_password = hash_password(new_password)
+    hashed_password = await hash_password(new_password)
     await db[Collections.USERS].update_one(
         {"_id": ObjectId(current_user['_id'])},
         {"$set": {"password_hash": hashed_password, "updated_at": datetime.utcnow()}}
     )
+    invalidate_principal(user_id=current_user['_id'])
     
     return SuccessResponse(message=Messages.PASSWORD_CHANGED)
 
@@ -1228,7 +4859,7 @@ async def confirm_payment(
     """
     try:
         # Retrieve payment intent from Stripe to verify status
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = await payment_gateway.retrieve_payment_intent(payment_intent_id)
         
         # Find transaction in database
         transaction = await db[Collections.TRANSACTIONS].find_one({
@@ -1244,9 +4875,9 @@ async def confirm_payment(
         
         # Verify payment succeeded
         if payment_intent.status == 'succeeded':
-            # Update transaction status
-            await db[Collections.TRANSACTIONS].update_one(
-                {"_id": transaction['_id']},
+            # Update transaction status (only one concurrent confirmation gets to act on it)
+            result = await db[Collections.TRANSACTIONS].update_one(
+                {"_id": transaction['_id'], "transaction_status": {"$ne": PaymentStatus.COMPLETED}},
                 {
                     "$set": {
                         "transaction_status": PaymentStatus.COMPLETED,
@@ -1255,27 +4886,30 @@ async def confirm_payment(
                     }
                 }
             )
+            if not result.modified_count:
+                return SuccessResponse(message="Payment already processed")
+            metrics_store.touch(transaction)
             
             # Handle wallet topup
             if payment_intent.metadata.get('purpose') == 'wallet_topup':
                 user_id = payment_intent.metadata.get('user_id')
                 amount = payment_intent.amount / 100  # Convert from paise to rupees
                 
-                await db[Collections.WALLETS].update_one(
-                    {"user_id": ObjectId(user_id)},
-                    {
-                        "$inc": {"balance": amount},
-                        "$set": {"last_transaction_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
-                    }
+                # Keyed by payment intent, shared with the Stripe webhook
+                entry = await wallet_ledger.credit(
+                    user_id, amount, TransactionType.WALLET_TOPUP,
+                    idempotency_key=f"topup:{payment_intent.id}",
+                    reference_id=transaction['_id']
                 )
                 
                 # Send notification
-                await create_notification(
-                    user_id,
-                    NotificationTypes.PAYMENT,
-                    "Wallet Topped Up",
-                    f"₹{amount} added to your wallet successfully"
-                )
+                if entry and not entry.get('duplicate'):
+                    await create_notification(
+                        user_id,
+                        NotificationTypes.PAYMENT,
+                        "Wallet Topped Up",
+                        f"₹{amount} added to your wallet successfully"
+                    )
                 
                 return SuccessResponse(
                     message="Payment successful! Wallet topped up",
@@ -1474,7 +5108,7 @@ async def get_booking_statistics(current_user: dict = Depends(get_current_user))
     favorite_service = None
     
     if most_used:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": most_used[0]['_id']})
+        category = await category_cache.get(most_used[0]['_id'])
         favorite_service = category.get('name') if category else None
     
     return {
@@ -1546,6 +5180,7 @@ async def cancel_booking(
             }
         }
     )
+    metrics_store.touch(booking)
     
     refund_info = None
     
@@ -1671,6 +5306,7 @@ async def reject_service_request(
             }
         }
     )
+    metrics_store.touch(booking)
     
     refund_info = None
     
@@ -1686,8 +5322,9 @@ async def reject_service_request(
                 })
                 
                 if transaction and transaction.get('stripe_payment_intent_id'):
-                    refund = stripe.Refund.create(
-                        payment_intent=transaction['stripe_payment_intent_id']
+                    refund = await payment_gateway.create_refund(
+                        transaction['stripe_payment_intent_id'],
+                        idempotency_key=booking_idempotency_key(request_id, "refund")
                     )
                     
                     await db[Collections.TRANSACTIONS].update_one(
@@ -1700,6 +5337,7 @@ async def reject_service_request(
                             }
                         }
                     )
+                    metrics_store.touch(transaction)
                     
                     refund_info = {
                         "method": "stripe",
@@ -1710,12 +5348,10 @@ async def reject_service_request(
             except Exception as e:
                 print(f"Stripe refund failed: {e}")
                 # Fallback to wallet
-                await db[Collections.WALLETS].update_one(
-                    {"user_id": booking['user_id']},
-                    {
-                        "$inc": {"balance": refund_amount},
-                        "$set": {"last_transaction_at": datetime.utcnow()}
-                    }
+                await wallet_ledger.credit(
+                    booking['user_id'], refund_amount, TransactionType.REFUND,
+                    idempotency_key=f"rejection-refund:{request_id}",
+                    reference_id=request_id
                 )
                 
                 refund_info = {
@@ -1726,12 +5362,10 @@ async def reject_service_request(
                 }
         
         elif booking['payment_method'] == PaymentMethod.WALLET:
-            await db[Collections.WALLETS].update_one(
-                {"user_id": booking['user_id']},
-                {
-                    "$inc": {"balance": refund_amount},
-                    "$set": {"last_transaction_at": datetime.utcnow()}
-                }
+            await wallet_ledger.credit(
+                booking['user_id'], refund_amount, TransactionType.REFUND,
+                idempotency_key=f"rejection-refund:{request_id}",
+                reference_id=request_id
             )
             
             refund_info = {
@@ -1811,6 +5445,7 @@ async def get_servicer_transactions(
     page: int = 1,
     limit: int = 20,
     transaction_type: Optional[str] = None,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
 ):
@@ -1825,11 +5460,9 @@ async def get_servicer_transactions(
     if transaction_type:
         query["transaction_type"] = transaction_type
     
-    skip = (page - 1) * limit
-    
-    transactions = await db[Collections.TRANSACTIONS].find(query).sort(
-        "created_at", -1
-    ).skip(skip).limit(limit).to_list(limit)
+    transactions, next_cursor = await fetch_page(
+        Collections.TRANSACTIONS, query, [("created_at", -1)], limit, page, cursor
+    )
     
     # Convert ObjectIds to strings
     for txn in transactions:
@@ -1843,13 +5476,14 @@ async def get_servicer_transactions(
         if txn.get('servicer_id'):
             txn['servicer_id'] = str(txn['servicer_id'])
     
-    total = await db[Collections.TRANSACTIONS].count_documents(query)
+    total = await count_for_listing(Collections.TRANSACTIONS, query)
     
     return {
         "transactions": transactions,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 # 3. ADD NEW ENDPOINT TO GET REFUND POLICY
 @app.get("/api/public/refund-policy")
@@ -2149,10 +5783,7 @@ async def get_user_dashboard(current_user: dict = Depends(get_current_user)):
     wallet_balance = float(wallet['balance']) if wallet else 0.0
     
     # Get unread notifications
-    unread_notifications = await db[Collections.NOTIFICATIONS].count_documents({
-        "user_id": user_id,
-        "is_read": False
-    })
+    unread_notifications = (await get_notification_counters(user_id))['unread']
     
     # Get recent bookings
     recent_bookings = await db[Collections.BOOKINGS].find(
@@ -2305,41 +5936,28 @@ async def search_servicers(
     
     # ✅ Handle category filtering (both ObjectId and string formats)
     if category:
-        try:
-            category_obj = ObjectId(category)
-            query["service_categories"] = {"$in": [category_obj, category]}
-            print(f"🔍 Searching for category: {category} (as ObjectId: {category_obj})")
-        except:
-            query["service_categories"] = {"$in": [category]}
-            print(f"🔍 Searching for category: {category} (as string)")
+        query["service_categories"] = {"$in": category_match_values(category)}
     
     # ✅ Rating filter
     if min_rating:
         query["average_rating"] = {"$gte": min_rating}
     
-    print(f"🔍 Full search query: {query}")
-    print(f"📍 Location: lat={lat}, lng={lng}, radius={radius}km")
-    
     skip = (page - 1) * limit
     
-    # Fetch servicers matching query
-    servicers = await db[Collections.SERVICERS].find(query).skip(skip).limit(limit).to_list(limit)
-    
-    print(f"📊 Found {len(servicers)} servicers matching query")
+    # ✅ Radius, blocked-owner filter and pagination all happen in one pipeline
+    has_location = lat is not None and lng is not None
+    servicers, total = await find_servicers(
+        query,
+        latitude=lat if has_location else None,
+        longitude=lng if has_location else None,
+        radius_km=radius,
+        skip=skip,
+        limit=limit
+    )
     
     result = []
     for servicer in servicers:
-        # Fetch user from users collection
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-        
-        if not user:
-            print(f"  ⚠️ User not found for servicer {servicer['_id']}")
-            continue
-        
-        # ✅ CRITICAL: Filter out BLOCKED users only
-        if user.get('is_blocked', False):
-            print(f"  🚫 Skipping {user.get('name')} - Account is blocked")
-            continue
+        user = servicer['user']
         
         # Build clean servicer data
         servicer_data = {
@@ -2360,39 +5978,18 @@ async def search_servicers(
             'total_jobs_completed': servicer.get('total_jobs_completed', 0),
             'service_radius_km': float(servicer.get('service_radius_km', 10.0)),
             'availability_status': servicer.get('availability_status', 'offline'),
+            'distance_km': servicer.get('distance_km')
         }
         
-        # ✅ Calculate distance if coordinates provided
-        if lat and lng and user.get('latitude') and user.get('longitude'):
-            try:
-                distance = calculate_distance(lat, lng, user['latitude'], user['longitude'])
-                servicer_data['distance_km'] = round(distance, 2)
-                
-                # Filter by radius
-                if distance > radius:
-                    print(f"  ⏭️ Skipping {user.get('name')} - distance {distance}km > radius {radius}km")
-                    continue
-                else:
-                    print(f"  ✅ Including {user.get('name')} - distance {distance}km")
-                    
-            except Exception as e:
-                print(f"  ⚠️ Distance calculation error for {user.get('name')}: {e}")
-                servicer_data['distance_km'] = None
-        else:
-            servicer_data['distance_km'] = None
-            print(f"  ✅ Including {user.get('name')} - no location filter")
-        
         result.append(servicer_data)
     
-    print(f"✅ Returning {len(result)} servicers after all filters")
-    if len(result) > 0:
-        print(f"   First servicer: {result[0]['user_name']} with categories: {result[0]['service_categories']}")
+    print(f"✅ Returning {len(result)} of {total} servicers (location filter: {has_location})")
     
     return {
         "servicers": result,
-        "total": len(result),
+        "total": total,
         "page": page,
-        "pages": math.ceil(len(result) / limit) if limit > 0 else 0
+        "pages": math.ceil(total / limit) if limit > 0 else 0
     }
 @app.post("/api/payments/check-status/{payment_intent_id}")
 async def check_payment_status(
@@ -2404,7 +6001,7 @@ async def check_payment_status(
     """
     try:
         # Retrieve from Stripe
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = await payment_gateway.retrieve_payment_intent(payment_intent_id)
         
         # Get transaction from database
         transaction = await db[Collections.TRANSACTIONS].find_one({
@@ -2512,7 +6109,7 @@ async def get_servicer_details(servicer_id: str, current_user: dict = Depends(ge
             }
             
             # Get category name
-            category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": price['category_id']})
+            category = await category_cache.get(price['category_id'])
             price_data['category_name'] = category.get('name', '') if category else ''
             
             pricing_list.append(price_data)
@@ -2659,12 +6256,9 @@ async def create_booking(booking_data: BookingCreate, current_user: dict = Depen
         raise HTTPException(status_code=404, detail="Servicer not found or not verified")
     
     # Validate category
-    try:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({
-            "_id": ObjectId(booking_data.service_category_id)
-        })
-    except Exception as e:
+    if not ObjectId.is_valid(booking_data.service_category_id):
         raise HTTPException(status_code=400, detail="Invalid service category ID format")
+    category = await category_cache.get(booking_data.service_category_id)
     
     if not category:
         raise HTTPException(status_code=404, detail="Service category not found")
@@ -2751,9 +6345,8 @@ async def create_booking(booking_data: BookingCreate, current_user: dict = Depen
         try:
             print(f"Creating Payment Intent: Amount={base_amount}, Currency={settings.STRIPE_CURRENCY}")
             
-            payment_intent = stripe.PaymentIntent.create(
-                amount=int(base_amount * 100),  # Convert to smallest currency unit (paise)
-                currency=settings.STRIPE_CURRENCY or "inr",
+            payment_intent = await payment_gateway.create_payment_intent(
+                base_amount,
                 metadata={
                     'booking_id': booking_id,
                     'user_id': current_user['_id'],
@@ -2761,8 +6354,8 @@ async def create_booking(booking_data: BookingCreate, current_user: dict = Depen
                     'category': category['name'],
                     'purpose': 'booking_payment'
                 },
-                description=f"Booking #{booking_dict['booking_number']} - {category['name']}",
-                automatic_payment_methods={'enabled': True}
+                idempotency_key=booking_idempotency_key(booking_id, "payment_intent"),
+                description=f"Booking #{booking_dict['booking_number']} - {category['name']}"
             )
             
             transaction['stripe_payment_intent_id'] = payment_intent.id
@@ -2816,26 +6409,24 @@ async def create_booking(booking_data: BookingCreate, current_user: dict = Depen
     elif booking_data.payment_method == PaymentMethod.WALLET:
         print("👛 Processing Wallet payment...")
         
-        wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])})
+        # Conditional debit: declined instead of overdrawing when requests race
+        transaction['transaction_status'] = PaymentStatus.COMPLETED
+        entry = await wallet_ledger.debit(
+            current_user['_id'], base_amount, TransactionType.BOOKING_PAYMENT,
+            idempotency_key=f"booking-payment:{booking_id}",
+            reference_id=booking_id,
+            transaction=transaction,
+            inc={"total_spent": base_amount}
+        )
         
-        if not wallet or wallet['balance'] < base_amount:
+        if not entry:
             await db[Collections.BOOKINGS].delete_one({"_id": ObjectId(booking_id)})
+            wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])}, {"balance": 1})
             raise HTTPException(
                 status_code=400,
                 detail=f"Insufficient wallet balance. Required: ₹{base_amount}, Available: ₹{wallet['balance'] if wallet else 0}"
             )
         
-        await db[Collections.WALLETS].update_one(
-            {"user_id": ObjectId(current_user['_id'])},
-            {
-                "$inc": {"balance": -base_amount, "total_spent": base_amount},
-                "$set": {"last_transaction_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
-            }
-        )
-        
-        transaction['transaction_status'] = PaymentStatus.COMPLETED
-        await db[Collections.TRANSACTIONS].insert_one(transaction)
-        
         await db[Collections.BOOKINGS].update_one(
             {"_id": ObjectId(booking_id)},
             {"$set": {"payment_status": PaymentStatus.COMPLETED, "updated_at": datetime.utcnow()}}
@@ -2958,6 +6549,7 @@ async def cancel_booking(
             }
         }
     )
+    metrics_store.touch(booking)
     
     refund_info = None
     
@@ -3028,6 +6620,7 @@ async def get_chat_messages(
     booking_id: str,
     page: int = 1,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get chat messages for booking"""
@@ -3039,14 +6632,14 @@ async def get_chat_messages(
     if not booking:
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
-    skip = (page - 1) * limit
-    
-    messages = await db[Collections.CHAT_MESSAGES].find(
+    messages, next_cursor = await fetch_page(
+        Collections.CHAT_MESSAGES,
         {
             "booking_id": ObjectId(booking_id),
             "deleted_by": {"$ne": ObjectId(current_user['_id'])}
-        }
-    ).sort("created_at", 1).skip(skip).limit(limit).to_list(limit)
+        },
+        [("created_at", 1)], limit, page, cursor
+    )
     
     for message in messages:
         message['_id'] = str(message['_id'])
@@ -3054,7 +6647,7 @@ async def get_chat_messages(
         message['sender_id'] = str(message['sender_id'])
         message['receiver_id'] = str(message['receiver_id'])
     
-    return {"messages": messages}
+    return {"messages": messages, "next_cursor": next_cursor}
 @app.post("/api/user/bookings/{booking_id}/chat")
 async def send_chat_message(
     booking_id: str,
@@ -3064,47 +6657,43 @@ async def send_chat_message(
     current_user: dict = Depends(get_current_user)
 ):
     """Send chat message - WITH NOTIFICATION"""
-    booking = await db[Collections.BOOKINGS].find_one({
-        "_id": ObjectId(booking_id),
-        "user_id": ObjectId(current_user['_id'])
-    })
+    user_id = str(current_user['_id'])
+    room = await chat_service.member_room('booking', booking_id, user_id)
     
-    if not booking:
+    if not room or room['participants'][user_id]['role'] != "user":
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
+    receiver_id = chat_service.receiver(room, user_id, receiver_id)
+    if not receiver_id:
+        raise HTTPException(status_code=400, detail="No servicer assigned to this booking yet")
+    
     # Create message
-    message_dict = {
+    now = datetime.utcnow()
+    message_dict = await chat_service.post('booking', {
         "booking_id": ObjectId(booking_id),
-        "sender_id": ObjectId(current_user['_id']),
+        "sender_id": ObjectId(user_id),
         "receiver_id": ObjectId(receiver_id),
         "message_type": message_type,
         "message_text": message_text,
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow(),
+        "timestamp": now,
+        "created_at": now,
         "is_read": False
-    }
-    
-    result = await db[Collections.CHAT_MESSAGES].insert_one(message_dict)
-    
-    # Convert ObjectIds to strings for response
-    message_dict['_id'] = str(result.inserted_id)
-    message_dict['booking_id'] = str(message_dict['booking_id'])
-    message_dict['sender_id'] = str(message_dict['sender_id'])
-    message_dict['receiver_id'] = str(message_dict['receiver_id'])
+    })
     
     # ✅ CREATE NOTIFICATION FOR SERVICER
     try:
         await create_notification(
             receiver_id,
             NotificationTypes.MESSAGE,  # or NotificationTypes.SYSTEM
-            f"New Message - Booking #{booking['booking_number']}",
+            f"New Message - Booking #{room['booking_number']}",
             f"{current_user['name']}: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
             metadata={
                 "booking_id": booking_id,
-                "booking_number": booking.get('booking_number'),
+                "booking_number": room.get('booking_number'),
                 "sender_name": current_user['name'],
                 "message_preview": message_text[:100]
-            }
+            },
+            coalesce_key=f"booking-chat-{booking_id}"
         )
         print(f"📢 Notification sent to servicer {receiver_id}")
     except Exception as e:
@@ -3155,6 +6744,8 @@ async def create_pre_booking_chat(
         "servicer_id": ObjectId(servicer_id),
         "status": "active",
         "last_message_at": datetime.utcnow(),
+        "unread_counts": {},
+        "last_message": None,
         "created_at": datetime.utcnow()
     }
     
@@ -3174,6 +6765,7 @@ async def create_pre_booking_chat(
     }
     
     await db[Collections.PRE_BOOKING_MESSAGES].insert_one(message)
+    await record_pre_booking_message(chat_id, message)
     
     # Notify servicer
     servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(servicer_id)})
@@ -3199,24 +6791,17 @@ async def get_user_pre_booking_chats(
         "user_id": ObjectId(current_user['_id'])
     }).sort("last_message_at", -1).to_list(100)
     
+    servicers = await fetch_servicers_with_users(
+        [chat['servicer_id'] for chat in chats],
+        {"average_rating": 1},
+        {"name": 1, "profile_image_url": 1}
+    )
+    
     result = []
     for chat in chats:
-        # Get servicer details
-        servicer = await db[Collections.SERVICERS].find_one({"_id": chat['servicer_id']})
-        servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-        
-        # Get last message
-        last_message = await db[Collections.PRE_BOOKING_MESSAGES].find_one(
-            {"chat_id": chat['_id']},
-            sort=[("created_at", -1)]
-        )
-        
-        # Count unread messages
-        unread_count = await db[Collections.PRE_BOOKING_MESSAGES].count_documents({
-            "chat_id": chat['_id'],
-            "receiver_id": ObjectId(current_user['_id']),
-            "is_read": False
-        })
+        servicer = servicers.get(str(chat['servicer_id'])) or {}
+        servicer_user = servicer.get('user') or {}
+        last_message = chat.get('last_message')
         
         result.append({
             "chat_id": str(chat['_id']),
@@ -3226,7 +6811,7 @@ async def get_user_pre_booking_chats(
             "servicer_rating": servicer.get('average_rating', 0),
             "last_message": last_message.get('message_text') if last_message else None,
             "last_message_at": chat.get('last_message_at'),
-            "unread_count": unread_count,
+            "unread_count": chat.get('unread_counts', {}).get(str(current_user['_id']), 0),
             "status": chat.get('status')
         })
     
@@ -3238,14 +6823,14 @@ async def get_pre_booking_chat_messages(
     chat_id: str,
     page: int = 1,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get messages from a pre-booking chat"""
-    skip = (page - 1) * limit
-    
-    messages = await db[Collections.PRE_BOOKING_MESSAGES].find(
-        {"chat_id": ObjectId(chat_id)}
-    ).sort("created_at", 1).skip(skip).limit(limit).to_list(limit)
+    messages, next_cursor = await fetch_page(
+        Collections.PRE_BOOKING_MESSAGES, {"chat_id": ObjectId(chat_id)},
+        [("created_at", 1)], limit, page, cursor
+    )
     
     for message in messages:
         message['_id'] = str(message['_id'])
@@ -3253,7 +6838,7 @@ async def get_pre_booking_chat_messages(
         message['sender_id'] = str(message['sender_id'])
         message['receiver_id'] = str(message['receiver_id'])
     
-    return {"messages": messages}
+    return {"messages": messages, "next_cursor": next_cursor}
 
 
 @app.post("/api/user/pre-booking-chats/{chat_id}/close")
@@ -3288,23 +6873,17 @@ async def get_servicer_pre_booking_chats(
         "servicer_id": ObjectId(servicer['_id'])
     }).sort("last_message_at", -1).to_list(100)
     
+    users = await fetch_by_ids(
+        Collections.USERS,
+        [chat['user_id'] for chat in chats],
+        {"name": 1, "profile_image_url": 1}
+    )
+    
     result = []
     for chat in chats:
-        # Get user details
-        user = await db[Collections.USERS].find_one({"_id": chat['user_id']})
-        
-        # Get last message
-        last_message = await db[Collections.PRE_BOOKING_MESSAGES].find_one(
-            {"chat_id": chat['_id']},
-            sort=[("created_at", -1)]
-        )
-        
-        # Count unread messages
-        unread_count = await db[Collections.PRE_BOOKING_MESSAGES].count_documents({
-            "chat_id": chat['_id'],
-            "receiver_id": ObjectId(current_user['_id']),
-            "is_read": False
-        })
+        user = users.get(str(chat['user_id'])) or {}
+        last_message = chat.get('last_message')
+        unread_count = chat.get('unread_counts', {}).get(str(current_user['_id']), 0)
         
         result.append({
             "chat_id": str(chat['_id']),
@@ -3379,21 +6958,20 @@ async def confirm_cash_payment(
     )
     
     # Update transaction
-    await db[Collections.TRANSACTIONS].update_one(
+    transaction = await db[Collections.TRANSACTIONS].find_one_and_update(
         {"booking_id": ObjectId(booking_id)},
-        {"$set": {"transaction_status": PaymentStatus.COMPLETED, "updated_at": datetime.utcnow()}}
+        {"$set": {"transaction_status": PaymentStatus.COMPLETED, "updated_at": datetime.utcnow()}},
+        projection={"created_at": 1}
     )
+    if transaction:
+        metrics_store.touch(transaction)
     
     # Update servicer wallet
-    await db[Collections.WALLETS].update_one(
-        {"user_id": ObjectId(booking['servicer_id'])},
-        {
-            "$inc": {
-                "balance": booking['servicer_amount'],
-                "total_earned": booking['servicer_amount']
-            },
-            "$set": {"last_transaction_at": datetime.utcnow()}
-        }
+    await wallet_ledger.credit(
+        booking['servicer_id'], booking['servicer_amount'], TransactionType.SERVICE_EARNING,
+        idempotency_key=f"service-earning:{booking_id}",
+        reference_id=booking_id,
+        inc={"total_earned": booking['servicer_amount']}
     )
     
     # Send notification
@@ -3455,22 +7033,15 @@ async def rate_servicer(
     result = await db[Collections.RATINGS].insert_one(rating_doc)
     print(f"✅ Rating created: {result.inserted_id}")
     
-    # Update servicer average rating
-    ratings = await db[Collections.RATINGS].find({"servicer_id": ObjectId(booking['servicer_id'])}).to_list(1000)
-    avg_rating = sum(r['overall_rating'] for r in ratings) / len(ratings) if ratings else overall_rating
-    
-    await db[Collections.SERVICERS].update_one(
-        {"_id": ObjectId(booking['servicer_id'])},
-        {
-            "$set": {"average_rating": round(avg_rating, 2)},
-            "$inc": {"total_ratings": 1}
-        }
+    # Update servicer rating aggregates
+    servicer = await apply_rating_delta(
+        booking['servicer_id'], added=overall_rating, projection={"user_id": 1, "average_rating": 1}
     )
+    avg_rating = servicer['average_rating'] if servicer else overall_rating
     
     print(f"📊 Updated servicer average rating to {round(avg_rating, 2)}")
     
     # Send notification
-    servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(booking['servicer_id'])})
     if servicer:
         await create_notification(
             str(servicer['user_id']),
@@ -3589,9 +7160,98 @@ async def get_wallet(current_user: dict = Depends(get_current_user)):
     
     return wallet
 
+@app.get("/api/user/wallet/statement")
+async def get_wallet_statement(
+    start_date: str,
+    end_date: str,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Wallet ledger entries between two dates (YYYY-MM-DD, inclusive) with opening/closing balances"""
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    
+    wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])}, {"balance": 1})
+    if not wallet:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+    
+    # Balances come from the balance_after of the entries around the range
+    ledger = db[Collections.WALLET_LEDGER]
+    newest_first = [("created_at", -1), ("seq", -1)]
+    before = await ledger.find_one({"wallet_id": wallet['_id'], "created_at": {"$lt": start}}, sort=newest_first)
+    if before:
+        opening = before['balance_after']
+    else:
+        first = await ledger.find_one(
+            {"wallet_id": wallet['_id'], "created_at": {"$gte": start}},
+            sort=[("created_at", 1), ("seq", 1)]
+        )
+        opening = first['balance_after'] - first['amount'] if first else wallet['balance']
+    last = await ledger.find_one(
+        {"wallet_id": wallet['_id'], "created_at": {"$gte": start, "$lt": end}}, sort=newest_first
+    )
+    closing = last['balance_after'] if last else opening
+    
+    entries, next_cursor = await fetch_page(
+        Collections.WALLET_LEDGER,
+        {"wallet_id": wallet['_id'], "created_at": {"$gte": start, "$lt": end}},
+        [("created_at", 1), ("seq", 1)],
+        min(limit, 500),
+        cursor=cursor
+    )
+    
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "opening_balance": round(opening, 2),
+        "closing_balance": round(closing, 2),
+        "entries": [
+            {
+                "entry_id": str(entry['_id']),
+                "entry_type": entry['entry_type'],
+                "amount": entry['amount'],
+                "balance_after": entry['balance_after'],
+                "reference_id": str(entry['reference_id']) if entry.get('reference_id') else None,
+                "transaction_id": str(entry['transaction_id']) if entry.get('transaction_id') else None,
+                "created_at": entry['created_at'].isoformat()
+            }
+            for entry in entries
+        ],
+        "next_cursor": next_cursor
+    }
+
+
+@app.get("/api/admin/wallets/reconciliation")
+async def get_wallet_reconciliation(current_admin: dict = Depends(get_current_admin)):
+    """Wallets whose balance disagreed with their ledger at the latest reconciliations"""
+    drifted = await db[Collections.WALLET_SNAPSHOTS].find(
+        {"drift": {"$ne": 0}}
+    ).sort("created_at", -1).to_list(100)
+    
+    return {
+        "drifted": [
+            {
+                "wallet_id": str(snapshot['wallet_id']),
+                "user_id": str(snapshot['user_id']),
+                "balance": snapshot['balance'],
+                "expected_balance": snapshot.get('expected_balance'),
+                "drift": snapshot['drift'],
+                "seq": snapshot['seq'],
+                "checked_at": snapshot['created_at'].isoformat()
+            }
+            for snapshot in drifted
+        ],
+        "ledger": wallet_ledger.metrics()
+    }
+
 @app.post("/api/user/wallet/add")
 async def add_money_to_wallet(
     amount: float = Form(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: dict = Depends(get_current_user)
 ):
     """Add money to wallet via Stripe"""
@@ -3603,17 +7263,17 @@ async def add_money_to_wallet(
     
     try:
         # Create Stripe Payment Intent
-        payment_intent = stripe.PaymentIntent.create(
-            amount=int(amount * 100),  # Convert to paise
-            currency=settings.STRIPE_CURRENCY,
+        # Clients retrying a top-up should resend the same Idempotency-Key header
+        payment_intent = await payment_gateway.create_payment_intent(
+            amount,
             metadata={
                 'user_id': current_user['_id'],
                 'purpose': 'wallet_topup'
             },
-            automatic_payment_methods={'enabled': True}
+            idempotency_key=f"wallet-topup-{current_user['_id']}-{idempotency_key or ObjectId()}"
         )
         
-        # Create transaction record
+        # Create transaction record (upsert so a retried request doesn't duplicate it)
         transaction = {
             "user_id": ObjectId(current_user['_id']),
             "transaction_type": TransactionType.WALLET_TOPUP,
@@ -3624,7 +7284,11 @@ async def add_money_to_wallet(
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow()
         }
-        await db[Collections.TRANSACTIONS].insert_one(transaction)
+        await db[Collections.TRANSACTIONS].update_one(
+            {"stripe_payment_intent_id": payment_intent.id},
+            {"$setOnInsert": transaction},
+            upsert=True
+        )
         
         return {
             "client_secret": payment_intent.client_secret,
@@ -3641,50 +7305,36 @@ async def add_money_to_wallet(
 async def get_notifications(
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all notifications"""
-    skip = (page - 1) * limit
-    
-    notifications = await db[Collections.NOTIFICATIONS].find(
-        {"user_id": ObjectId(current_user['_id'])}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    notifications, next_cursor = await fetch_page(
+        Collections.NOTIFICATIONS, {"user_id": ObjectId(current_user['_id'])},
+        [("created_at", -1)], limit, page, cursor
+    )
     
     for notif in notifications:
         notif['_id'] = str(notif['_id'])
         notif['user_id'] = str(notif['user_id'])
     
-    total = await db[Collections.NOTIFICATIONS].count_documents({"user_id": ObjectId(current_user['_id'])})
-    unread = await db[Collections.NOTIFICATIONS].count_documents({
-        "user_id": ObjectId(current_user['_id']),
-        "is_read": False
-    })
+    counters = await get_notification_counters(current_user['_id'])
+    total = counters['total']
+    unread = counters['unread']
     
     return {
         "notifications": notifications,
         "total": total,
         "unread": unread,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 @app.put("/api/user/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, current_user: dict = Depends(get_current_user)):
     """Mark notification as read"""
-    result = await db[Collections.NOTIFICATIONS].update_one(
-        {
-            "_id": ObjectId(notification_id),
-            "user_id": ObjectId(current_user['_id'])
-        },
-        {
-            "$set": {
-                "is_read": True,
-                "read_at": datetime.utcnow()
-            }
-        }
-    )
-    
-    if result.modified_count == 0:
+    if not await mark_notification_as_read(notification_id, current_user['_id']):
         raise HTTPException(status_code=404, detail="Notification not found")
     
     return SuccessResponse(message="Notification marked as read")
@@ -3703,12 +7353,7 @@ async def delete_notification(
             raise HTTPException(status_code=400, detail="Invalid notification ID format")
         
         # Find and delete the notification
-        result = await db[Collections.NOTIFICATIONS].delete_one({
-            "_id": ObjectId(notification_id),
-            "user_id": ObjectId(current_user['_id'])
-        })
-        
-        if result.deleted_count == 0:
+        if not await delete_user_notification(notification_id, current_user['_id']):
             raise HTTPException(status_code=404, detail="Notification not found")
         
         return SuccessResponse(message="Notification deleted successfully")
@@ -3767,6 +7412,7 @@ async def update_user_profile(
         {"_id": ObjectId(current_user['_id'])},
         {"$set": update_data}
     )
+    invalidate_principal(user_id=current_user['_id'])
     
     return SuccessResponse(message=Messages.UPDATED)
 
@@ -3776,44 +7422,70 @@ async def get_live_tracking_data(
     current_user: dict = Depends(get_current_user)
 ):
     """Get current live tracking data for user"""
-    booking = await db[Collections.BOOKINGS].find_one({
-        "_id": ObjectId(booking_id),
-        "user_id": ObjectId(current_user['_id'])
-    })
-    
-    if not booking:
-        raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
-    
-    # Check if tracking is active
-    if not booking.get('tracking_started'):
-        return {
-            "tracking_active": False,
-            "message": "Tracking not started yet"
-        }
-    
-    # Get servicer current location
-    servicer_location = booking.get('servicer_current_location', {})
-    service_location = booking.get('service_location', {})
-    
-    # Get latest tracking record
-    latest_tracking = await db[Collections.BOOKING_TRACKING].find_one(
-        {"booking_id": ObjectId(booking_id)},
-        sort=[("created_at", -1)]
-    )
-    
-    # Get servicer details
-    servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(booking['servicer_id'])})
-    servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-    
-    return {
-        "tracking_active": True,
-        "servicer_arrived": booking.get('servicer_arrived', False),
-        "servicer_info": {
+    # ✅ Active bookings are answered from the tracker's memory
+    session = location_tracker.sessions.get(booking_id)
+    if session and session['user_id'] != current_user['_id']:
+        session = None
+    
+    if session:
+        servicer_location = session['latest'] or {}
+        user_lat, user_lng = session['destination']
+        service_location = {"latitude": user_lat, "longitude": user_lng}
+        distance_km = session['distance_km']
+        eta_minutes = session['eta_minutes']
+        servicer_arrived = session['servicer_arrived']
+        booking_status = session['booking_status']
+        servicer_info = session.get('servicer_info')
+        servicer_id = session['servicer_id']
+    else:
+        booking = await db[Collections.BOOKINGS].find_one({
+            "_id": ObjectId(booking_id),
+            "user_id": ObjectId(current_user['_id'])
+        })
+        
+        if not booking:
+            raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
+        
+        # Check if tracking is active
+        if not booking.get('tracking_started'):
+            return {
+                "tracking_active": False,
+                "message": "Tracking not started yet"
+            }
+        
+        # Get servicer current location
+        servicer_location = booking.get('servicer_current_location', {})
+        service_location = booking.get('service_location', {})
+        
+        # Get latest tracking record
+        latest_tracking = await db[Collections.BOOKING_TRACKING].find_one(
+            {"booking_id": ObjectId(booking_id)},
+            sort=[("created_at", -1)]
+        )
+        distance_km = latest_tracking.get('distance_remaining_km') if latest_tracking else None
+        eta_minutes = latest_tracking.get('eta_minutes') if latest_tracking else None
+        servicer_arrived = booking.get('servicer_arrived', False)
+        booking_status = booking['booking_status']
+        servicer_info = None
+        servicer_id = booking['servicer_id']
+    
+    # Get servicer details (cached on the tracking session after the first poll)
+    if not servicer_info:
+        servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(servicer_id)})
+        servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+        servicer_info = {
             "name": servicer_user.get('name', ''),
             "phone": servicer_user.get('phone', ''),
             "image": servicer_user.get('profile_image_url', ''),
             "rating": servicer.get('average_rating', 0)
-        },
+        }
+        if session:
+            session['servicer_info'] = servicer_info
+    
+    return {
+        "tracking_active": True,
+        "servicer_arrived": servicer_arrived,
+        "servicer_info": servicer_info,
         "servicer_location": {
             "lat": servicer_location.get('latitude'),
             "lng": servicer_location.get('longitude'),
@@ -3825,9 +7497,9 @@ async def get_live_tracking_data(
             "lat": service_location.get('latitude'),
             "lng": service_location.get('longitude')
         },
-        "distance_km": latest_tracking.get('distance_remaining_km') if latest_tracking else None,
-        "eta_minutes": latest_tracking.get('eta_minutes') if latest_tracking else None,
-        "booking_status": booking['booking_status']
+        "distance_km": distance_km,
+        "eta_minutes": eta_minutes,
+        "booking_status": booking_status
     }
 
 # Add this test endpoint to main.py
@@ -3865,10 +7537,12 @@ async def get_tracking_history(
     if not booking:
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
-    # Get all tracking records
+    # Get all tracking records - flushed points first, then ones still buffered in memory
     tracking_records = await db[Collections.BOOKING_TRACKING].find(
         {"booking_id": ObjectId(booking_id)}
     ).sort("created_at", 1).limit(limit).to_list(limit)
+    if len(tracking_records) < limit:
+        tracking_records += location_tracker.pending_points(booking_id)[:limit - len(tracking_records)]
     
     route = []
     for record in tracking_records:
@@ -3900,6 +7574,9 @@ async def get_nearby_servicers(
     longitude: float,
     radius: float = 5.0,
     category: Optional[str] = None,
+    min_rating: Optional[float] = None,
+    page: int = 1,
+    limit: int = 20,
     current_user: dict = Depends(get_current_user)
 ):
     """Get servicers nearby user's location using geospatial query"""
@@ -3909,37 +7586,34 @@ async def get_nearby_servicers(
     }
     
     if category:
-        query["service_categories"] = category
+        query["service_categories"] = {"$in": category_match_values(category)}
+    if min_rating:
+        query["average_rating"] = {"$gte": min_rating}
     
-    # Get all servicers and calculate distance
-    servicers = await db[Collections.SERVICERS].find(query).to_list(100)
+    # $geoNear returns them already sorted by distance
+    servicers, total = await find_servicers(
+        query,
+        latitude=latitude,
+        longitude=longitude,
+        radius_km=radius,
+        skip=(page - 1) * limit,
+        limit=limit
+    )
     
     nearby_servicers = []
     for servicer in servicers:
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-        
-        # Calculate distance if user has location
-        if user.get('latitude') and user.get('longitude'):
-            distance = calculate_distance(
-                latitude, longitude,
-                user['latitude'], user['longitude']
-            )
-            
-            if distance <= radius:
-                servicer['_id'] = str(servicer['_id'])
-                servicer['user_id'] = str(servicer['user_id'])
-                servicer['user_name'] = user.get('name', '')
-                servicer['profile_image_url'] = user.get('profile_image_url', '')
-                servicer['distance_km'] = round(distance, 2)
-                servicer['eta_minutes'] = calculate_eta(distance)
-                nearby_servicers.append(servicer)
-    
-    # Sort by distance
-    nearby_servicers.sort(key=lambda x: x['distance_km'])
+        user = servicer.pop('user')
+        servicer = convert_objectid_to_str(servicer)
+        servicer['user_name'] = user.get('name', '')
+        servicer['profile_image_url'] = user.get('profile_image_url', '')
+        servicer['eta_minutes'] = calculate_eta(servicer['distance_km'])
+        nearby_servicers.append(servicer)
     
     return {
         "servicers": nearby_servicers,
-        "total": len(nearby_servicers),
+        "total": total,
+        "page": page,
+        "pages": math.ceil(total / limit) if limit > 0 else 0,
         "search_radius": radius
     }
 
@@ -3964,9 +7638,13 @@ async def get_top_rated_servicers(
         ("total_ratings", -1)
     ]).limit(limit).to_list(limit)
     
+    users = await fetch_by_ids(
+        Collections.USERS, [s['user_id'] for s in servicers], {"name": 1, "profile_image_url": 1}
+    )
+    
     result = []
     for servicer in servicers:
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+        user = users.get(str(servicer['user_id'])) or {}
         servicer['_id'] = str(servicer['_id'])
         servicer['user_id'] = str(servicer['user_id'])
         servicer['user_name'] = user.get('name', '')
@@ -3995,9 +7673,13 @@ async def get_popular_servicers(
         "total_jobs_completed", -1
     ).limit(limit).to_list(limit)
     
+    users = await fetch_by_ids(
+        Collections.USERS, [s['user_id'] for s in servicers], {"name": 1, "profile_image_url": 1}
+    )
+    
     result = []
     for servicer in servicers:
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+        user = users.get(str(servicer['user_id'])) or {}
         servicer['_id'] = str(servicer['_id'])
         servicer['user_id'] = str(servicer['user_id'])
         servicer['user_name'] = user.get('name', '')
@@ -4010,9 +7692,8 @@ async def get_popular_servicers(
 @app.get("/api/user/categories")
 async def get_all_categories(current_user: dict = Depends(get_current_user)):
     """Get all active service categories"""
-    categories = await db[Collections.SERVICE_CATEGORIES].find({
-        "is_active": True
-    }).to_list(100)
+    categories = await category_cache.all(active_only=True)
+    servicer_counts = await category_cache.servicer_counts()
     
     result = []
     for cat in categories:
@@ -4033,12 +7714,8 @@ async def get_all_categories(current_user: dict = Depends(get_current_user)):
         if cat.get('created_by'):
             cat_dict['created_by'] = str(cat['created_by'])
         
-        # Count servicers in this category
-        servicers_count = await db[Collections.SERVICERS].count_documents({
-            "verification_status": VerificationStatus.APPROVED,
-            "service_categories": cat['_id']  # Can use ObjectId here for query
-        })
-        cat_dict['servicers_count'] = servicers_count
+        # Servicers in this category (precomputed)
+        cat_dict['servicers_count'] = servicer_counts.get(str(cat['_id']), 0)
         
         result.append(cat_dict)
     
@@ -4057,7 +7734,7 @@ async def get_servicers_by_category(
 ):
     """Get all servicers offering a specific category"""
     # Validate category exists
-    category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": ObjectId(category_id)})
+    category = await category_cache.get(category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     
@@ -4078,18 +7755,22 @@ async def get_servicers_by_category(
     
     servicers = await db[Collections.SERVICERS].find(query).sort(sort).skip(skip).limit(limit).to_list(limit)
     
+    # ✅ One $in query each for owners and this category's pricing
+    users = await fetch_by_ids(Collections.USERS, [s['user_id'] for s in servicers])
+    pricing_by_servicer = await fetch_by_ids(
+        Collections.SERVICER_PRICING, [s['_id'] for s in servicers],
+        key="servicer_id", extra_query={"category_id": ObjectId(category_id)}
+    )
+    
     result = []
     for servicer in servicers:
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+        user = users.get(str(servicer['user_id']))
         
         if not user:
             continue
         
         # Get pricing for this category
-        pricing = await db[Collections.SERVICER_PRICING].find_one({
-            "servicer_id": servicer['_id'],
-            "category_id": ObjectId(category_id)
-        })
+        pricing = pricing_by_servicer.get(str(servicer['_id']))
         
         # ✅ FIXED: Build clean servicer data with all ObjectIds converted
         servicer_data = {
@@ -4287,9 +7968,8 @@ async def create_support_ticket(
     # Upload attachments
     attachment_urls = []
     if attachments:
-        for file in attachments:
-            result = await upload_to_cloudinary(file, CloudinaryFolders.SUPPORT)
-            attachment_urls.append(result['url'])
+        uploaded = await upload_many(attachments, CloudinaryFolders.SUPPORT)
+        attachment_urls.extend(result['url'] for result in uploaded)
     
     ticket_dict['attachments_urls'] = attachment_urls
     ticket_dict['created_at'] = datetime.utcnow()
@@ -4519,6 +8199,7 @@ async def get_service_history_with_quick_actions(
     category_id: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get service history with one-click rebook options"""
@@ -4530,19 +8211,27 @@ async def get_service_history_with_quick_actions(
     if category_id:
         query["service_category_id"] = ObjectId(category_id)
     
-    skip = (page - 1) * limit
-    bookings = await db[Collections.BOOKINGS].find(query).sort(
-        "completed_at", -1
-    ).skip(skip).limit(limit).to_list(limit)
+    bookings, next_cursor = await fetch_page(
+        Collections.BOOKINGS, query, [("completed_at", -1)], limit, page, cursor
+    )
+    
+    # ✅ Resolve servicers, their users and ratings for the whole page at once
+    servicers = await fetch_servicers_with_users([b.get('servicer_id') for b in bookings])
+    ratings = await fetch_by_ids(
+        Collections.RATINGS, [b['_id'] for b in bookings],
+        {"booking_id": 1, "overall_rating": 1}, key="booking_id"
+    )
     
     history = []
     for booking in bookings:
         # Get servicer info
-        servicer = await db[Collections.SERVICERS].find_one({"_id": booking['servicer_id']})
-        servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+        servicer = servicers.get(str(booking.get('servicer_id')))
+        if not servicer:
+            continue
+        servicer_user = servicer['user'] or {}
         
         # Get rating if exists
-        rating = await db[Collections.RATINGS].find_one({"booking_id": booking['_id']})
+        rating = ratings.get(str(booking['_id']))
         
         # Check if servicer is currently available
         is_available_now = servicer.get('availability_status') == AvailabilityStatus.AVAILABLE
@@ -4565,13 +8254,14 @@ async def get_service_history_with_quick_actions(
             "service_location": booking['service_location'].get('address')
         })
     
-    total = await db[Collections.BOOKINGS].count_documents(query)
+    total = await count_for_listing(Collections.BOOKINGS, query)
     
     return {
         "history": history,
         "total_services": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 
@@ -4586,7 +8276,7 @@ async def estimate_service_cost(
     current_user: dict = Depends(get_current_user)
 ):
     """Get detailed cost breakdown before booking"""
-    category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": ObjectId(category_id)})
+    category = await category_cache.get(category_id)
     
     if not category:
         raise HTTPException(status_code=404, detail="Service not found")
@@ -4661,9 +8351,8 @@ async def diagnose_service_problem(
     # Upload images if provided
     image_urls = []
     if problem_images:
-        for img in problem_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.PROBLEM_DIAGNOSIS)
-            image_urls.append(result['url'])
+        uploaded = await upload_many(problem_images, CloudinaryFolders.PROBLEM_DIAGNOSIS)
+        image_urls.extend(result['url'] for result in uploaded)
     
     # Save diagnosis request
     diagnosis = {
@@ -4679,7 +8368,7 @@ async def diagnose_service_problem(
     result = await db[Collections.PROBLEM_DIAGNOSIS].insert_one(diagnosis)
     
     # Get category info
-    category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": ObjectId(category_id)})
+    category = await category_cache.get(category_id)
     
     # Basic keyword matching for recommendations
     keywords = problem_description.lower()
@@ -4738,100 +8427,110 @@ async def get_servicer_detailed_performance(
     current_user: dict = Depends(get_current_user)
 ):
     """Deep dive into servicer's actual performance metrics"""
-    servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(servicer_id)})
+    servicer = await db[Collections.SERVICERS].find_one(
+        {"_id": ObjectId(servicer_id)},
+        {"user_id": 1, "average_rating": 1, "total_ratings": 1, "rating_histogram": 1}
+    )
     
     if not servicer:
         raise HTTPException(status_code=404, detail="Servicer not found")
     
-    # Get all completed bookings
-    bookings = await db[Collections.BOOKINGS].find({
-        "servicer_id": ObjectId(servicer_id),
-        "booking_status": BookingStatus.COMPLETED
-    }).to_list(1000)
+    return await insight_cache.get_or_compute(
+        ("servicer_performance", servicer_id),
+        lambda: compute_servicer_performance(servicer_id, servicer)
+    )
+
+
+async def compute_servicer_performance(servicer_id: str, servicer: dict) -> dict:
+    """Performance figures for one servicer from two aggregations"""
+    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+    has_timings = {"$and": [
+        {"$ifNull": ["$completed_at", False]},
+        {"$ifNull": ["$started_at", False]}
+    ]}
+    
+    booking_facets, recent_ratings = await asyncio.gather(
+        db[Collections.BOOKINGS].aggregate([
+            {"$match": {"servicer_id": ObjectId(servicer_id)}},
+            {"$facet": {
+                "completed": [
+                    {"$match": {"booking_status": BookingStatus.COMPLETED}},
+                    {"$group": {
+                        "_id": None,
+                        "total_jobs": {"$sum": 1},
+                        "timed_jobs": {"$sum": {"$cond": [has_timings, 1, 0]}},
+                        # Average job duration (hours)
+                        "avg_duration": {"$avg": {"$cond": [
+                            has_timings,
+                            {"$divide": [{"$subtract": ["$completed_at", "$started_at"]}, 3600000]},
+                            None
+                        ]}},
+                        "recent_jobs": {"$sum": {"$cond": [{"$gte": ["$created_at", thirty_days_ago]}, 1, 0]}}
+                    }}
+                ],
+                # Cancellation rate (cancelled by the servicer)
+                "cancellations": [
+                    {"$group": {
+                        "_id": None,
+                        "total_bookings": {"$sum": 1},
+                        "cancelled": {"$sum": {"$cond": [{"$and": [
+                            {"$eq": ["$booking_status", BookingStatus.CANCELLED]},
+                            {"$eq": ["$cancelled_by", servicer['user_id']]}
+                        ]}, 1, 0]}}
+                    }}
+                ],
+                # Response time (minutes to accept a booking)
+                "response": [
+                    {"$match": {
+                        "booking_status": {"$in": [BookingStatus.ACCEPTED, BookingStatus.IN_PROGRESS, BookingStatus.COMPLETED]},
+                        "accepted_at": {"$exists": True}
+                    }},
+                    {"$group": {
+                        "_id": None,
+                        "avg_minutes": {"$avg": {"$divide": [{"$subtract": ["$accepted_at", "$created_at"]}, 60000]}}
+                    }}
+                ]
+            }}
+        ]).to_list(1),
+        # Recent average only; lifetime counts come from the servicer's rating aggregates
+        db[Collections.RATINGS].aggregate([
+            {"$match": {"servicer_id": ObjectId(servicer_id), "created_at": {"$gte": thirty_days_ago}}},
+            {"$group": {"_id": None, "average": {"$avg": "$overall_rating"}}}
+        ]).to_list(1)
+    )
     
-    if not bookings:
+    facets = booking_facets[0]
+    if not facets['completed']:
         return {"message": "No completed services yet", "performance": {}}
     
-    # Calculate metrics
-    total_jobs = len(bookings)
-    
-    # On-time completion rate
-    on_time = sum(1 for b in bookings if b.get('completed_at') and b.get('started_at'))
-    on_time_rate = (on_time / total_jobs) * 100 if total_jobs > 0 else 0
-    
-    # Average job duration
-    durations = []
-    for b in bookings:
-        if b.get('completed_at') and b.get('started_at'):
-            duration = (b['completed_at'] - b['started_at']).total_seconds() / 3600
-            durations.append(duration)
-    
-    avg_duration = sum(durations) / len(durations) if durations else 0
-    
-    # Cancellation rate
-    cancelled = await db[Collections.BOOKINGS].count_documents({
-        "servicer_id": ObjectId(servicer_id),
-        "booking_status": BookingStatus.CANCELLED,
-        "cancelled_by": servicer['user_id']  # Cancelled by servicer
-    })
-    
-    total_bookings = await db[Collections.BOOKINGS].count_documents({
-        "servicer_id": ObjectId(servicer_id)
-    })
-    
-    cancellation_rate = (cancelled / total_bookings) * 100 if total_bookings > 0 else 0
-    
-    # Response time (time to accept booking)
-    accepted_bookings = await db[Collections.BOOKINGS].find({
-        "servicer_id": ObjectId(servicer_id),
-        "booking_status": {"$in": [BookingStatus.ACCEPTED, BookingStatus.IN_PROGRESS, BookingStatus.COMPLETED]},
-        "accepted_at": {"$exists": True}
-    }).to_list(100)
-    
-    response_times = [
-        (b['accepted_at'] - b['created_at']).total_seconds() / 60
-        for b in accepted_bookings
-    ]
-    
-    avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-    
-    # Rating breakdown
-    ratings = await db[Collections.RATINGS].find({
-        "servicer_id": ObjectId(servicer_id)
-    }).to_list(1000)
+    completed = facets['completed'][0]
+    cancellations = facets['cancellations'][0]
+    response = facets['response'][0] if facets['response'] else {}
+    histogram = servicer.get('rating_histogram') or {}
     
-    rating_distribution = {
-        "5_star": sum(1 for r in ratings if r['overall_rating'] == 5),
-        "4_star": sum(1 for r in ratings if r['overall_rating'] == 4),
-        "3_star": sum(1 for r in ratings if r['overall_rating'] == 3),
-        "2_star": sum(1 for r in ratings if r['overall_rating'] == 2),
-        "1_star": sum(1 for r in ratings if r['overall_rating'] == 1)
-    }
-    
-    # Recent performance (last 30 days)
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    recent_bookings = [b for b in bookings if b['created_at'] >= thirty_days_ago]
+    total_jobs = completed['total_jobs']
+    on_time_rate = (completed['timed_jobs'] / total_jobs) * 100 if total_jobs > 0 else 0
+    avg_duration = completed['avg_duration'] or 0
+    cancellation_rate = (cancellations['cancelled'] / cancellations['total_bookings']) * 100
+    avg_response_time = response.get('avg_minutes') or 0
     
     return {
         "servicer_id": servicer_id,
         "overall_metrics": {
             "total_jobs_completed": total_jobs,
             "average_rating": servicer.get('average_rating', 0),
-            "total_ratings": len(ratings),
+            "total_ratings": servicer.get('total_ratings', 0),
             "on_time_completion_rate": round(on_time_rate, 2),
             "cancellation_rate": round(cancellation_rate, 2),
             "average_response_time_minutes": round(avg_response_time, 2),
             "average_job_duration_hours": round(avg_duration, 2)
         },
-        "rating_distribution": rating_distribution,
+        "rating_distribution": {
+            f"{star}_star": histogram.get(str(star), 0) for star in reversed(RATING_STARS)
+        },
         "recent_performance_30days": {
-            "jobs_completed": len(recent_bookings),
-            "average_rating": round(
-                sum(r['overall_rating'] for r in ratings if r['created_at'] >= thirty_days_ago) / 
-                len([r for r in ratings if r['created_at'] >= thirty_days_ago])
-                if [r for r in ratings if r['created_at'] >= thirty_days_ago] else 0,
-                2
-            )
+            "jobs_completed": completed['recent_jobs'],
+            "average_rating": round(recent_ratings[0]['average'] if recent_ratings else 0, 2)
         },
         "reliability_score": round((on_time_rate + (100 - cancellation_rate)) / 2, 2),
         "quality_indicators": {
@@ -4842,7 +8541,6 @@ async def get_servicer_detailed_performance(
         }
     }
 
-
 # 6. BOOKING ISSUE REPORTING
 @app.post("/api/user/bookings/{booking_id}/report-issue")
 async def report_booking_issue(
@@ -4865,9 +8563,8 @@ async def report_booking_issue(
     # Upload evidence
     evidence_urls = []
     if evidence_images:
-        for img in evidence_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.ISSUE_EVIDENCE)
-            evidence_urls.append(result['url'])
+        uploaded = await upload_many(evidence_images, CloudinaryFolders.ISSUE_EVIDENCE)
+        evidence_urls.extend(result['url'] for result in uploaded)
     
     # Create issue report
     issue = {
@@ -4924,61 +8621,53 @@ async def check_service_area_coverage(
     current_user: dict = Depends(get_current_user)
 ):
     """Check which services are available in user's area"""
-    # Get all active servicers
-    servicers = await db[Collections.SERVICERS].find({
-        "verification_status": VerificationStatus.APPROVED
-    }).to_list(500)
+    # Servicers whose service area contains the point, from the coverage grid
+    in_range = await coverage_index.lookup(latitude, longitude)
+    servicers = await fetch_servicers_with_users(
+        [entry['servicer_id'] for entry, _ in in_range],
+        {"average_rating": 1},
+        {"name": 1}
+    )
     
     available_services = {}
     servicers_by_category = {}
     
-    for servicer in servicers:
-        user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-        
-        if not user.get('latitude') or not user.get('longitude'):
+    for entry, distance in in_range:
+        servicer = servicers.get(entry['servicer_id'])
+        if not servicer:
             continue
+        user = servicer.get('user') or {}
         
-        distance = calculate_distance(
-            latitude, longitude,
-            user['latitude'], user['longitude']
-        )
-        
-        # Check if within service radius
-        if distance <= servicer.get('service_radius_km', 10):
-            for category_id in servicer.get('service_categories', []):
-                category = await db[Collections.SERVICE_CATEGORIES].find_one({
-                    "_id": ObjectId(category_id)
-                })
+        for category_id in entry['categories']:
+            category = await category_cache.get(category_id)
+            
+            if category:
+                category_name = category['name']
                 
-                if category:
-                    category_name = category['name']
-                    
-                    if category_name not in available_services:
-                        available_services[category_name] = {
-                            "category_id": str(category['_id']),
-                            "available": True,
-                            "servicer_count": 0,
-                            "nearest_distance_km": distance
-                        }
-                        servicers_by_category[category_name] = []
-                    
-                    available_services[category_name]["servicer_count"] += 1
-                    available_services[category_name]["nearest_distance_km"] = min(
-                        available_services[category_name]["nearest_distance_km"],
-                        distance
-                    )
-                    
-                    servicers_by_category[category_name].append({
-                        "servicer_id": str(servicer['_id']),
-                        "name": user.get('name'),
-                        "distance_km": round(distance, 2),
-                        "rating": servicer.get('average_rating', 0)
-                    })
+                if category_name not in available_services:
+                    available_services[category_name] = {
+                        "category_id": str(category['_id']),
+                        "available": True,
+                        "servicer_count": 0,
+                        "nearest_distance_km": distance
+                    }
+                    servicers_by_category[category_name] = []
+                
+                available_services[category_name]["servicer_count"] += 1
+                available_services[category_name]["nearest_distance_km"] = min(
+                    available_services[category_name]["nearest_distance_km"],
+                    distance
+                )
+                
+                servicers_by_category[category_name].append({
+                    "servicer_id": str(servicer['_id']),
+                    "name": user.get('name'),
+                    "distance_km": round(distance, 2),
+                    "rating": servicer.get('average_rating', 0)
+                })
     
     # Get all categories and mark unavailable ones
-    all_categories = await db[Collections.SERVICE_CATEGORIES].find({
-        "is_active": True
-    }).to_list(100)
+    all_categories = await category_cache.all(active_only=True)
     
     for category in all_categories:
         if category['name'] not in available_services:
@@ -5022,56 +8711,85 @@ async def get_spending_insights(
     else:  # year
         start_date = now - timedelta(days=365)
     
-    # Get transactions
-    transactions = await db[Collections.TRANSACTIONS].find({
-        "user_id": ObjectId(current_user['_id']),
-        "transaction_status": PaymentStatus.COMPLETED,
-        "created_at": {"$gte": start_date}
-    }).to_list(1000)
+    return await insight_cache.get_or_compute(
+        ("spending_insights", current_user['_id'], period),
+        lambda: compute_spending_insights(current_user['_id'], period, start_date, now)
+    )
+
+
+async def compute_spending_insights(user_id: str, period: str, start_date: datetime, now: datetime) -> dict:
+    """Spending figures for one user from a transaction and a booking aggregation"""
+    transaction_facets, booking_facets = await asyncio.gather(
+        db[Collections.TRANSACTIONS].aggregate([
+            {"$match": {
+                "user_id": ObjectId(user_id),
+                "transaction_status": PaymentStatus.COMPLETED,
+                "created_at": {"$gte": start_date}
+            }},
+            {"$facet": {
+                "total_spent": [
+                    {"$match": {"transaction_type": TransactionType.BOOKING_PAYMENT}},
+                    {"$group": {"_id": None, "amount": {"$sum": "$amount"}}}
+                ],
+                # Monthly trend
+                "monthly": [
+                    {"$group": {
+                        "_id": {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+                        "amount": {"$sum": "$amount"}
+                    }},
+                    {"$sort": {"_id": 1}}
+                ]
+            }}
+        ]).to_list(1),
+        db[Collections.BOOKINGS].aggregate([
+            {"$match": {
+                "user_id": ObjectId(user_id),
+                "booking_status": BookingStatus.COMPLETED,
+                "created_at": {"$gte": start_date}
+            }},
+            {"$facet": {
+                "summary": [
+                    {"$group": {"_id": None, "count": {"$sum": 1}, "max_amount": {"$max": "$total_amount"}}}
+                ],
+                # Spending by category
+                "by_category": [
+                    {"$group": {"_id": "$service_category_id", "amount": {"$sum": "$total_amount"}}}
+                ],
+                # Most used servicer
+                "top_servicer": [
+                    {"$group": {"_id": "$servicer_id", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1}},
+                    {"$limit": 1}
+                ]
+            }}
+        ]).to_list(1)
+    )
     
-    # Get completed bookings
-    bookings = await db[Collections.BOOKINGS].find({
-        "user_id": ObjectId(current_user['_id']),
-        "booking_status": BookingStatus.COMPLETED,
-        "created_at": {"$gte": start_date}
-    }).to_list(1000)
+    transactions = transaction_facets[0]
+    bookings = booking_facets[0]
     
-    # Calculate totals
-    total_spent = sum(t['amount'] for t in transactions if t['transaction_type'] == TransactionType.BOOKING_PAYMENT)
+    total_spent = transactions['total_spent'][0]['amount'] if transactions['total_spent'] else 0
+    summary = bookings['summary'][0] if bookings['summary'] else {"count": 0, "max_amount": 0}
+    total_services = summary['count']
     
-    # Spending by category
-    category_spending = {}
-    for booking in bookings:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({
-            "_id": booking['service_category_id']
-        })
-        
+    # Category names come from the category cache
+    categories = await category_cache.get_many(row['_id'] for row in bookings['by_category'])
+    spending_by_category = {}
+    for row in bookings['by_category']:
+        category = categories.get(str(row['_id']))
         if category:
-            cat_name = category['name']
-            category_spending[cat_name] = category_spending.get(cat_name, 0) + booking['total_amount']
-    
-    # Monthly trend
-    monthly_spending = {}
-    for txn in transactions:
-        month_key = txn['created_at'].strftime("%Y-%m")
-        monthly_spending[month_key] = monthly_spending.get(month_key, 0) + txn['amount']
-    
-    # Most used servicer
-    servicer_frequency = {}
-    for booking in bookings:
-        servicer_id = str(booking['servicer_id'])
-        servicer_frequency[servicer_id] = servicer_frequency.get(servicer_id, 0) + 1
-    
-    most_used_servicer_id = max(servicer_frequency, key=servicer_frequency.get) if servicer_frequency else None
+            spending_by_category[category['name']] = spending_by_category.get(category['name'], 0) + row['amount']
     
     most_used_servicer = None
-    if most_used_servicer_id:
-        servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(most_used_servicer_id)})
-        servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-        most_used_servicer = {
-            "name": servicer_user.get('name'),
-            "times_used": servicer_frequency[most_used_servicer_id]
-        }
+    if bookings['top_servicer']:
+        top = bookings['top_servicer'][0]
+        servicers = await fetch_servicers_with_users([top['_id']], {"_id": 1}, {"name": 1})
+        servicer = servicers.get(str(top['_id']))
+        if servicer and servicer['user']:
+            most_used_servicer = {
+                "name": servicer['user'].get('name'),
+                "times_used": top['count']
+            }
     
     return {
         "period": period,
@@ -5081,12 +8799,12 @@ async def get_spending_insights(
         },
         "summary": {
             "total_spent": round(total_spent, 2),
-            "total_services": len(bookings),
-            "average_per_service": round(total_spent / len(bookings), 2) if bookings else 0,
-            "most_expensive_service": max([b['total_amount'] for b in bookings]) if bookings else 0
+            "total_services": total_services,
+            "average_per_service": round(total_spent / total_services, 2) if total_services else 0,
+            "most_expensive_service": summary['max_amount'] or 0
         },
-        "spending_by_category": category_spending,
-        "monthly_trend": monthly_spending,
+        "spending_by_category": spending_by_category,
+        "monthly_trend": {row['_id']: row['amount'] for row in transactions['monthly']},
         "most_used_servicer": most_used_servicer,
         "recommendations": {
             "potential_savings": round(total_spent * 0.15, 2),  # 15% potential savings with better planning
@@ -5094,7 +8812,6 @@ async def get_spending_insights(
         }
     }
 
-
 # 9. SERVICE REMINDERS & MAINTENANCE SCHEDULE
 @app.post("/api/user/maintenance/schedule")
 async def schedule_maintenance_reminder(
@@ -5104,9 +8821,15 @@ async def schedule_maintenance_reminder(
     preferred_servicer_id: Optional[str] = Form(None),
     next_service_date: str = Form(...),
     notes: Optional[str] = Form(None),
+    auto_book: bool = Form(False),  # book the preferred servicer when a reminder falls due
     current_user: dict = Depends(get_current_user)
 ):
     """Schedule recurring service reminders (AC maintenance, pest control, etc.)"""
+    if frequency not in MAINTENANCE_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"Frequency must be one of: {', '.join(MAINTENANCE_INTERVALS)}")
+    if auto_book and not preferred_servicer_id:
+        raise HTTPException(status_code=400, detail="Auto-booking needs a preferred servicer")
+    
     reminder = {
         "user_id": ObjectId(current_user['_id']),
         "category_id": ObjectId(category_id),
@@ -5115,6 +8838,7 @@ async def schedule_maintenance_reminder(
         "preferred_servicer_id": ObjectId(preferred_servicer_id) if preferred_servicer_id else None,
         "next_service_date": datetime.fromisoformat(next_service_date),
         "notes": notes,
+        "auto_book": auto_book,
         "is_active": True,
         "reminders_sent": 0,
         "services_completed": 0,
@@ -5128,7 +8852,8 @@ async def schedule_maintenance_reminder(
         data={
             "reminder_id": str(result.inserted_id),
             "next_reminder": next_service_date,
-            "frequency": frequency
+            "frequency": frequency,
+            "auto_book": auto_book
         }
     )
 
@@ -5143,9 +8868,7 @@ async def get_upcoming_maintenance(current_user: dict = Depends(get_current_user
     
     upcoming = []
     for reminder in reminders:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({
-            "_id": reminder['category_id']
-        })
+        category = await category_cache.get(reminder['category_id'])
         
         days_until = (reminder['next_service_date'] - datetime.utcnow()).days
         
@@ -5165,6 +8888,177 @@ async def get_upcoming_maintenance(current_user: dict = Depends(get_current_user
         "this_week": len([u for u in upcoming if u['status'] == "upcoming"])
     }
 
+MAINTENANCE_INTERVALS = {
+    "weekly": timedelta(days=7),
+    "monthly": timedelta(days=30),
+    "quarterly": timedelta(days=91),
+    "yearly": timedelta(days=365)
+}
+
+
+async def check_due_maintenance():
+    """Background task to queue a job per maintenance reminder falling due"""
+    try:
+        horizon = datetime.utcnow() + timedelta(hours=settings.MAINTENANCE_REMINDER_LEAD_HOURS)
+        queued = await job_queue.enqueue_cursor(
+            "maintenance_reminder",
+            db[Collections.MAINTENANCE_REMINDERS].find(
+                {"is_active": True, "next_service_date": {"$lte": horizon}},
+                {"_id": 1, "next_service_date": 1}
+            ),
+            # One job per occurrence: the date is part of the key
+            lambda reminder: (
+                f"maintenance:{reminder['_id']}:{reminder['next_service_date'].isoformat()}",
+                {"reminder_id": str(reminder['_id']), "due": reminder['next_service_date'].isoformat()}
+            )
+        )
+        if queued:
+            print(f"📥 Queued {queued} maintenance reminder jobs")
+    except Exception as e:
+        print(f"❌ Maintenance check error: {e}")
+
+
+async def create_maintenance_booking(reminder: dict, due: datetime) -> Optional[dict]:
+    """Pending cash booking with the preferred servicer at the user's default address; None if not possible"""
+    # A retried job finds the booking its earlier attempt made
+    existing = await db[Collections.BOOKINGS].find_one({
+        "maintenance_reminder_id": reminder['_id'],
+        "booking_date": due.strftime("%Y-%m-%d")
+    })
+    if existing:
+        return existing
+    
+    servicer = await db[Collections.SERVICERS].find_one({
+        "_id": reminder['preferred_servicer_id'],
+        "verification_status": VerificationStatus.APPROVED,
+        "is_suspended": {"$ne": True}
+    }, {"user_id": 1})
+    category = await category_cache.get(reminder['category_id'])
+    address = await db[Collections.USER_ADDRESSES].find_one(
+        {"user_id": reminder['user_id']},
+        sort=[("is_default", -1), ("created_at", -1)]
+    )
+    if not servicer or not category or not address:
+        return None
+    
+    pricing = await db[Collections.SERVICER_PRICING].find_one({
+        "servicer_id": servicer['_id'],
+        "category_id": reminder['category_id']
+    })
+    base_amount = pricing.get('fixed_price') if pricing and pricing.get('fixed_price') else category['base_price']
+    platform_fee = calculate_platform_fee(base_amount)
+    servicer_amount = calculate_servicer_amount(base_amount, platform_fee)
+    
+    booking = {
+        'booking_number': generate_booking_number(),
+        'user_id': reminder['user_id'],
+        'servicer_id': servicer['_id'],
+        'service_category_id': reminder['category_id'],
+        'service_type': category['name'],
+        'booking_date': due.strftime("%Y-%m-%d"),
+        'booking_time': due.strftime("%H:%M"),
+        'service_location': {
+            "address": ", ".join(filter(None, [
+                address.get('address_line1'), address.get('address_line2'),
+                address.get('city'), address.get('state'), address.get('pincode')
+            ])),
+            "latitude": address.get('latitude'),
+            "longitude": address.get('longitude')
+        },
+        'problem_description': reminder.get('notes') or f"Scheduled {reminder['frequency']} {reminder['service_name']}",
+        'urgency_level': UrgencyLevel.LOW,
+        'payment_method': PaymentMethod.CASH,
+        'total_amount': base_amount,
+        'platform_fee': platform_fee,
+        'servicer_amount': servicer_amount,
+        'booking_status': BookingStatus.PENDING,
+        'payment_status': PaymentStatus.PENDING,
+        'maintenance_reminder_id': reminder['_id'],
+        'created_at': datetime.utcnow(),
+        'updated_at': datetime.utcnow()
+    }
+    result = await db[Collections.BOOKINGS].insert_one(booking)
+    booking['_id'] = result.inserted_id
+    metrics_store.touch(booking)
+    
+    await db[Collections.TRANSACTIONS].insert_one({
+        "booking_id": booking['_id'],
+        "user_id": reminder['user_id'],
+        "servicer_id": servicer['_id'],
+        "transaction_type": TransactionType.BOOKING_PAYMENT,
+        "payment_method": PaymentMethod.CASH,
+        "amount": base_amount,
+        "platform_fee": platform_fee,
+        "servicer_earnings": servicer_amount,
+        "transaction_status": PaymentStatus.PENDING,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    })
+    
+    await create_notification(
+        str(servicer['user_id']),
+        NotificationTypes.BOOKING_UPDATE,
+        "New Booking Request",
+        f"New scheduled {reminder['service_name']} booking for {booking['booking_date']}"
+    )
+    await sio.emit(
+        SocketEvents.NEW_BOOKING_REQUEST,
+        {
+            "booking_id": str(booking['_id']),
+            "booking_number": booking['booking_number'],
+            "auto_booked": True
+        },
+        room=f"user-{str(servicer['user_id'])}"
+    )
+    return booking
+
+
+@job_handler("maintenance_reminder")
+async def run_maintenance_reminder(payload: dict):
+    """Remind (and with auto_book, book) one due maintenance occurrence, then schedule the next"""
+    due = datetime.fromisoformat(payload['due'])
+    reminder = await db[Collections.MAINTENANCE_REMINDERS].find_one({
+        "_id": ObjectId(payload['reminder_id']),
+        "is_active": True,
+        "next_service_date": due
+    })
+    if not reminder:
+        return  # Already handled, paused or rescheduled
+    
+    booking = None
+    if reminder.get('auto_book') and reminder.get('preferred_servicer_id'):
+        booking = await create_maintenance_booking(reminder, due)
+    
+    # Next occurrence in the future, even after a long outage
+    interval = MAINTENANCE_INTERVALS.get(reminder['frequency'], MAINTENANCE_INTERVALS['monthly'])
+    next_date = due + interval
+    while next_date <= datetime.utcnow():
+        next_date += interval
+    
+    result = await db[Collections.MAINTENANCE_REMINDERS].update_one(
+        {"_id": reminder['_id'], "next_service_date": due},
+        {
+            "$set": {"next_service_date": next_date, "last_reminded_at": datetime.utcnow()},
+            "$inc": {"reminders_sent": 1}
+        }
+    )
+    if not result.modified_count:
+        return
+    
+    if booking:
+        message = f"Your {reminder['service_name']} is booked for {booking['booking_date']} (#{booking['booking_number']})"
+    elif reminder.get('auto_book'):
+        message = f"Your {reminder['service_name']} is due on {due.strftime('%Y-%m-%d')}. We couldn't book it automatically, please book it manually"
+    else:
+        message = f"Your {reminder['service_name']} is due on {due.strftime('%Y-%m-%d')}"
+    await create_notification(
+        str(reminder['user_id']),
+        NotificationTypes.BOOKING_UPDATE if booking else NotificationTypes.SYSTEM,
+        "Maintenance Reminder",
+        message,
+        metadata={"reminder_id": str(reminder['_id']), "booking_id": str(booking['_id']) if booking else None}
+    )
+
 
 # 10. MULTI-SERVICE BOOKING (Bundle Services)
 @app.post("/api/user/bookings/bundle")
@@ -5184,9 +9078,7 @@ async def create_bundle_booking(
     total_cost = 0
     
     for service in services:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({
-            "_id": ObjectId(service['category_id'])
-        })
+        category = await category_cache.get(service['category_id'])
         
         if not category:
             continue
@@ -5640,16 +9532,18 @@ async def apply_referral_code(
     # Add bonus to both users' wallets
     bonus_amount = 50.0
     
-    # Bonus for new user
-    await db[Collections.WALLETS].update_one(
-        {"user_id": ObjectId(current_user['_id'])},
-        {"$inc": {"balance": bonus_amount}}
+    # Bonus for new user (once per referred user, however often this is called)
+    await wallet_ledger.credit(
+        current_user['_id'], bonus_amount, TransactionType.REFERRAL_BONUS,
+        idempotency_key=f"referral-bonus:{current_user['_id']}",
+        reference_id=referrer['_id']
     )
     
     # Bonus for referrer
-    await db[Collections.WALLETS].update_one(
-        {"user_id": referrer['user_id']},
-        {"$inc": {"balance": bonus_amount}}
+    await wallet_ledger.credit(
+        referrer['user_id'], bonus_amount, TransactionType.REFERRAL_BONUS,
+        idempotency_key=f"referrer-bonus:{current_user['_id']}",
+        reference_id=referrer['_id']
     )
     
     await db[Collections.REFERRALS].update_one(
@@ -5748,32 +9642,29 @@ async def update_review(
     update_data = {"updated_at": datetime.utcnow()}
     
     if overall_rating:
+        if not (1 <= overall_rating <= 5):
+            raise HTTPException(status_code=400, detail="Rating must be between 1 and 5")
         update_data['overall_rating'] = overall_rating
     if review_text is not None:
         update_data['review_text'] = review_text
     
-    result = await db[Collections.RATINGS].update_one(
+    previous = await db[Collections.RATINGS].find_one_and_update(
         {
             "_id": ObjectId(review_id),
             "user_id": ObjectId(current_user['_id'])
         },
-        {"$set": update_data}
+        {"$set": update_data},
+        projection={"servicer_id": 1, "overall_rating": 1},
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count == 0:
+    if not previous:
         raise HTTPException(status_code=404, detail="Review not found")
-    
-    # Recalculate servicer rating
-    rating_doc = await db[Collections.RATINGS].find_one({"_id": ObjectId(review_id)})
-    if rating_doc:
-        ratings = await db[Collections.RATINGS].find(
-            {"servicer_id": rating_doc['servicer_id']}
-        ).to_list(1000)
-        avg_rating = sum(r['overall_rating'] for r in ratings) / len(ratings)
-        
-        await db[Collections.SERVICERS].update_one(
-            {"_id": rating_doc['servicer_id']},
-            {"$set": {"average_rating": round(avg_rating, 2)}}
+    
+    # Move the review between star buckets
+    if overall_rating and overall_rating != previous['overall_rating']:
+        await apply_rating_delta(
+            previous['servicer_id'], added=overall_rating, removed=previous['overall_rating']
         )
     
     return SuccessResponse(message="Review updated successfully")
@@ -5782,36 +9673,19 @@ async def update_review(
 @app.delete("/api/user/reviews/{review_id}")
 async def delete_review(review_id: str, current_user: dict = Depends(get_current_user)):
     """Delete a review"""
-    rating = await db[Collections.RATINGS].find_one({
-        "_id": ObjectId(review_id),
-        "user_id": ObjectId(current_user['_id'])
-    })
+    rating = await db[Collections.RATINGS].find_one_and_delete(
+        {
+            "_id": ObjectId(review_id),
+            "user_id": ObjectId(current_user['_id'])
+        },
+        projection={"servicer_id": 1, "overall_rating": 1}
+    )
     
     if not rating:
         raise HTTPException(status_code=404, detail="Review not found")
     
-    # Delete review
-    await db[Collections.RATINGS].delete_one({"_id": ObjectId(review_id)})
-    
-    # Recalculate servicer rating
-    ratings = await db[Collections.RATINGS].find(
-        {"servicer_id": rating['servicer_id']}
-    ).to_list(1000)
-    
-    if ratings:
-        avg_rating = sum(r['overall_rating'] for r in ratings) / len(ratings)
-        await db[Collections.SERVICERS].update_one(
-            {"_id": rating['servicer_id']},
-            {
-                "$set": {"average_rating": round(avg_rating, 2)},
-                "$inc": {"total_ratings": -1}
-            }
-        )
-    else:
-        await db[Collections.SERVICERS].update_one(
-            {"_id": rating['servicer_id']},
-            {"$set": {"average_rating": 0, "total_ratings": 0}}
-        )
+    # Take the review out of the servicer's aggregates
+    await apply_rating_delta(rating['servicer_id'], removed=rating['overall_rating'])
     
     return SuccessResponse(message="Review deleted successfully")
 
@@ -5821,28 +9695,35 @@ async def delete_review(review_id: str, current_user: dict = Depends(get_current
 @app.post("/api/user/emergency/request")
 async def request_emergency_service(
     category_id: str = Form(...),
-    location: dict = None,
     description: str = Form(...),
     contact_number: str = Form(...),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
+    address: Optional[str] = Form(None),
     current_user: dict = Depends(get_current_user)
 ):
-    """Request urgent/emergency service"""
-    # Find available servicers nearby
-    servicers = await db[Collections.SERVICERS].find({
-        "verification_status": VerificationStatus.APPROVED,
-        "availability_status": AvailabilityStatus.AVAILABLE,
-        "service_categories": category_id
-    }).to_list(50)
+    """Request urgent/emergency service - nearby servicers are paged in waves (see DispatchEngine)"""
+    if latitude is None or longitude is None:
+        # Fall back to the location saved on the profile
+        latitude, longitude = current_user.get('latitude'), current_user.get('longitude')
+    if latitude is None or longitude is None:
+        raise HTTPException(status_code=400, detail="Location is required for emergency requests")
+    if not ObjectId.is_valid(category_id):
+        raise HTTPException(status_code=400, detail="Invalid category ID")
     
     # Create high priority booking
-    booking = {
+    booking = await dispatch_engine.create({
         "booking_number": generate_booking_number(),
         "user_id": ObjectId(current_user['_id']),
         "service_category_id": ObjectId(category_id),
         "urgency_level": UrgencyLevel.HIGH,
         "booking_date": datetime.utcnow().strftime("%Y-%m-%d"),
         "booking_time": datetime.utcnow().strftime("%H:%M"),
-        "service_location": location or {},
+        "service_location": {
+            "address": address or current_user.get('address'),
+            "latitude": latitude,
+            "longitude": longitude
+        },
         "problem_description": description,
         "contact_number": contact_number,
         "booking_status": BookingStatus.PENDING,
@@ -5850,38 +9731,112 @@ async def request_emergency_service(
         "is_emergency": True,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
-    }
+    }, latitude, longitude)
     
-    result = await db[Collections.BOOKINGS].insert_one(booking)
-    booking_id = str(result.inserted_id)
+    candidates = booking['dispatch']['candidates']
+    return SuccessResponse(
+        message="Emergency request sent to nearby servicers" if candidates
+        else "No available servicers nearby right now",
+        data={
+            "booking_id": str(booking['_id']),
+            "booking_number": booking['booking_number'],
+            "servicers_in_range": len(candidates),
+            "nearest_eta_minutes": candidates[0]['eta_minutes'] if candidates else None
+        }
+    )
+
+
+@app.get("/api/servicer/emergency/requests")
+async def get_emergency_offers(
+    current_user: dict = Depends(get_current_user),
+    servicer: dict = Depends(get_current_servicer)
+):
+    """Open emergency requests offered to this servicer"""
+    servicer_id = ObjectId(servicer['_id'])
+    bookings = await db[Collections.BOOKINGS].find(
+        {
+            "is_emergency": True,
+            "dispatch.status": "dispatching",
+            "dispatch.offered": servicer_id,
+            "booking_status": BookingStatus.PENDING
+        },
+        {
+            "booking_number": 1, "service_location": 1, "problem_description": 1,
+            "created_at": 1, "dispatch.candidates": 1
+        }
+    ).sort("created_at", -1).to_list(20)
     
-    # Notify all available servicers
-    for servicer in servicers:
-        await create_notification(
-            str(servicer['user_id']),
-            NotificationTypes.BOOKING_UPDATE,
-            "⚠️ EMERGENCY SERVICE REQUEST",
-            f"Urgent service needed: {description[:50]}..."
+    offers = []
+    for booking in bookings:
+        offer = next(
+            (candidate for candidate in booking['dispatch']['candidates'] if candidate['servicer_id'] == servicer_id),
+            {}
         )
-        
-        # Emit socket event
-        await sio.emit(
-            SocketEvents.EMERGENCY_REQUEST,
-            {
-                "booking_id": booking_id,
-                "booking_number": booking['booking_number'],
-                "location": location,
-                "description": description
-            },
-            room=f"user-{str(servicer['user_id'])}"
+        offers.append({
+            "booking_id": str(booking['_id']),
+            "booking_number": booking['booking_number'],
+            "location": booking.get('service_location'),
+            "description": booking.get('problem_description'),
+            "distance_km": offer.get('distance_km'),
+            "eta_minutes": offer.get('eta_minutes'),
+            "created_at": booking['created_at'].isoformat()
+        })
+    
+    return SuccessResponse(message="Emergency requests retrieved", data=offers)
+
+
+@app.put("/api/servicer/emergency/{booking_id}/accept")
+async def accept_emergency_request(
+    booking_id: str,
+    current_user: dict = Depends(get_current_user),
+    servicer: dict = Depends(get_current_servicer)
+):
+    """Accept an emergency request - the first offered servicer to accept gets it"""
+    if not ObjectId.is_valid(booking_id):
+        raise HTTPException(status_code=400, detail="Invalid booking ID")
+    
+    booking = await dispatch_engine.claim(booking_id, servicer['_id'])
+    if not booking:
+        exists = await db[Collections.BOOKINGS].find_one(
+            {"_id": ObjectId(booking_id), "is_emergency": True, "dispatch.offered": ObjectId(servicer['_id'])},
+            {"_id": 1}
         )
+        if not exists:
+            raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
+        raise HTTPException(status_code=409, detail=Messages.EMERGENCY_ALREADY_TAKEN)
+    metrics_store.touch(booking)
+    
+    offer = next(
+        (candidate for candidate in booking['dispatch']['candidates'] if candidate['servicer_id'] == booking['servicer_id']),
+        {}
+    )
+    await create_notification(
+        str(booking['user_id']),
+        NotificationTypes.BOOKING_UPDATE,
+        "Emergency Request Accepted",
+        f"{current_user['name']} accepted emergency request #{booking['booking_number']}"
+        + (f" and is about {offer['eta_minutes']} min away" if offer else ""),
+        metadata={"booking_id": booking_id, "emergency": True}
+    )
+    await sio.emit(
+        SocketEvents.BOOKING_ACCEPTED,
+        {"booking_id": booking_id, "servicer_id": servicer['_id'], "eta_minutes": offer.get('eta_minutes')},
+        room=f"user-{str(booking['user_id'])}"
+    )
+    
+    # Withdraw the offer from everyone else who was paged
+    others = [
+        f"user-{str(candidate['user_id'])}"
+        for candidate in booking['dispatch']['candidates']
+        if candidate['servicer_id'] in booking['dispatch']['offered']
+        and candidate['servicer_id'] != booking['servicer_id']
+    ]
+    if others:
+        await sio.emit(SocketEvents.EMERGENCY_CLAIMED, {"booking_id": booking_id}, room=others)
     
     return SuccessResponse(
-        message="Emergency request sent to nearby servicers",
-        data={
-            "booking_id": booking_id,
-            "servicers_notified": len(servicers)
-        }
+        message=Messages.BOOKING_ACCEPTED,
+        data={"booking_id": booking_id, "booking_number": booking['booking_number']}
     )
 
 
@@ -5972,6 +9927,7 @@ async def get_user_transactions(
     status: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all user transactions"""
@@ -5982,11 +9938,9 @@ async def get_user_transactions(
     if status:
         query["transaction_status"] = status
     
-    skip = (page - 1) * limit
-    
-    transactions = await db[Collections.TRANSACTIONS].find(query).sort(
-        "created_at", -1
-    ).skip(skip).limit(limit).to_list(limit)
+    transactions, next_cursor = await fetch_page(
+        Collections.TRANSACTIONS, query, [("created_at", -1)], limit, page, cursor
+    )
     
     for txn in transactions:
         txn['_id'] = str(txn['_id'])
@@ -5998,13 +9952,14 @@ async def get_user_transactions(
             if booking:
                 txn['booking_number'] = booking.get('booking_number')
     
-    total = await db[Collections.TRANSACTIONS].count_documents(query)
+    total = await count_for_listing(Collections.TRANSACTIONS, query)
     
     return {
         "transactions": transactions,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 
@@ -6137,7 +10092,7 @@ async def get_wishlist(current_user: dict = Depends(get_current_user)):
     
     result = []
     for item in wishlist:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": item['category_id']})
+        category = await category_cache.get(item['category_id'])
         if category:
             result.append({
                 "_id": str(item['_id']),
@@ -6229,9 +10184,6 @@ async def repeat_booking(booking_id: str, current_user: dict = Depends(get_curre
     return await create_booking(booking_data, current_user)
 
 
-# Add to config.py SocketEvents:
-# EMERGENCY_REQUEST = "emergency_request"
-
 # Add to config.py Collections:
 # USER_ADDRESSES = "user_addresses"
 # USER_SETTINGS = "user_settings"
@@ -6260,46 +10212,8 @@ async def start_tracking(sid, data):
 
 @sio.event
 async def live_location(sid, data):
-    """Real-time location update via socket"""
-    booking_id = data.get('booking_id')
-    latitude = data.get('latitude')
-    longitude = data.get('longitude')
-    speed = data.get('speed')
-    heading = data.get('heading')
-    
-    booking = await db[Collections.BOOKINGS].find_one({"_id": ObjectId(booking_id)})
-    
-    if booking:
-        # Calculate distance and ETA
-        service_location = booking.get('service_location', {})
-        user_lat = service_location.get('latitude')
-        user_lng = service_location.get('longitude')
-        
-        distance_km = None
-        eta_minutes = None
-        
-        if user_lat and user_lng:
-            distance_km = calculate_distance(latitude, longitude, user_lat, user_lng)
-            actual_speed = speed if speed and speed > 0 else 30
-            eta_minutes = calculate_eta(distance_km, actual_speed)
-        
-        # Emit to user
-        await sio.emit(
-            SocketEvents.LOCATION_UPDATE,
-            {
-                "booking_id": booking_id,
-                "servicer_location": {
-                    "lat": latitude,
-                    "lng": longitude,
-                    "speed": speed,
-                    "heading": heading
-                },
-                "distance_km": round(distance_km, 2) if distance_km else None,
-                "eta_minutes": eta_minutes,
-                "timestamp": datetime.utcnow().isoformat()
-            },
-            room=f"user-{str(booking['user_id'])}"
-        )
+    """Real-time location update via socket (alias of the location stream)"""
+    return await location_stream(sid, data)
 
 
 @sio.event
@@ -6363,68 +10277,86 @@ async def get_servicer_dashboard(
         "total_jobs_completed": servicer.get('total_jobs_completed', 0)
     }
 
+# Document field -> storage folder
+SERVICER_DOCUMENT_FIELDS = {
+    "aadhaar_front": CloudinaryFolders.AADHAAR,
+    "aadhaar_back": CloudinaryFolders.AADHAAR,
+    "certificates": CloudinaryFolders.CERTIFICATES,
+    "vehicle_documents": CloudinaryFolders.VEHICLES
+}
+
+@app.post("/api/servicer/documents/upload-signature")
+async def get_document_upload_signature(
+    document: str = Form(...),  # aadhaar_front, aadhaar_back, certificates, vehicle_documents
+    current_user: dict = Depends(get_current_user),
+    servicer: dict = Depends(get_current_servicer)
+):
+    """Signed parameters for uploading a document straight to Cloudinary"""
+    if document not in SERVICER_DOCUMENT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown document: {document}")
+    folder = f"{SERVICER_DOCUMENT_FIELDS[document]}/{servicer['_id']}"
+    return upload_storage.sign(folder)
+
 @app.post("/api/servicer/documents")
 async def upload_servicer_documents(
     aadhaar_front: Optional[UploadFile] = File(None),
     aadhaar_back: Optional[UploadFile] = File(None),
     certificates: Optional[List[UploadFile]] = File(None),
     vehicle_documents: Optional[List[UploadFile]] = File(None),
+    direct_uploads: Optional[str] = Form(None),  # JSON: {"certificates": [<signed Cloudinary response>], ...}
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
 ):
-    """Upload verification documents"""
+    """Upload verification documents (as files, or as signed direct uploads)"""
     update_data = {"updated_at": datetime.utcnow()}
     
     # ✅ Allow both images and PDFs for documents
     allowed_document_types = ['image/*', 'application/pdf']
     
-    # Upload Aadhaar front
-    if aadhaar_front:
-        result = await upload_to_cloudinary(
-            aadhaar_front, 
-            CloudinaryFolders.AADHAAR,
-            allowed_types=allowed_document_types
-        )
-        update_data['aadhaar_front_url'] = result['url']
-    
-    # Upload Aadhaar back
-    if aadhaar_back:
-        result = await upload_to_cloudinary(
-            aadhaar_back, 
-            CloudinaryFolders.AADHAAR,
-            allowed_types=allowed_document_types
-        )
-        update_data['aadhaar_back_url'] = result['url']
-    
-    # Upload certificates
-    if certificates:
-        certificate_urls = []
-        for cert in certificates:
-            result = await upload_to_cloudinary(
-                cert, 
-                CloudinaryFolders.CERTIFICATES,
-                allowed_types=allowed_document_types
-            )
-            certificate_urls.append(result['url'])
-        update_data['certificate_urls'] = certificate_urls
-    
-    # Upload vehicle documents
-    if vehicle_documents:
-        vehicle_urls = []
-        for doc in vehicle_documents:
-            result = await upload_to_cloudinary(
-                doc, 
-                CloudinaryFolders.VEHICLES,
-                allowed_types=allowed_document_types
-            )
-            vehicle_urls.append(result['url'])
-        update_data['vehicle_document_urls'] = vehicle_urls
+    files = {
+        "aadhaar_front": [aadhaar_front] if aadhaar_front else [],
+        "aadhaar_back": [aadhaar_back] if aadhaar_back else [],
+        "certificates": certificates or [],
+        "vehicle_documents": vehicle_documents or []
+    }
+    # Validate every file before any upload starts
+    pending = [(field, file) for field, group in files.items() for file in group]
+    for _, file in pending:
+        validate_upload(file, allowed_document_types)
+    
+    # Files already on Cloudinary only need their signature checked
+    urls = {field: [] for field in SERVICER_DOCUMENT_FIELDS}
+    for field, uploads in parse_direct_uploads(direct_uploads).items():
+        if field not in SERVICER_DOCUMENT_FIELDS:
+            raise HTTPException(status_code=400, detail=f"Unknown document: {field}")
+        folder = f"{SERVICER_DOCUMENT_FIELDS[field]}/{servicer['_id']}"
+        for upload in uploads if isinstance(uploads, list) else [uploads]:
+            urls[field].append(upload_storage.verify(upload, folder)['url'])
+    
+    # Upload every file of the request concurrently
+    results = await upload_many(
+        [file for _, file in pending],
+        [SERVICER_DOCUMENT_FIELDS[field] for field, _ in pending],
+        allowed_document_types
+    )
+    for (field, _), result in zip(pending, results):
+        urls[field].append(result['url'])
+    
+    if urls['aadhaar_front']:
+        update_data['aadhaar_front_url'] = urls['aadhaar_front'][0]
+    if urls['aadhaar_back']:
+        update_data['aadhaar_back_url'] = urls['aadhaar_back'][0]
+    if urls['certificates']:
+        update_data['certificate_urls'] = urls['certificates']
+    if urls['vehicle_documents']:
+        update_data['vehicle_document_urls'] = urls['vehicle_documents']
     
     # Update servicer
     await db[Collections.SERVICERS].update_one(
         {"_id": ObjectId(servicer['_id'])},
         {"$set": update_data}
     )
+    invalidate_principal(user_id=servicer['user_id'])
     
     # Send notification to admin
     admins = await db[Collections.USERS].find({"role": UserRole.ADMIN}).to_list(100)
@@ -6570,6 +10502,7 @@ async def reject_service_request(
             }
         }
     )
+    metrics_store.touch(booking)
     
     # Send notification
     await create_notification(
@@ -6659,6 +10592,7 @@ async def get_servicer_chat_messages(
     service_id: str,
     page: int = 1,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
 ):
@@ -6673,14 +10607,14 @@ async def get_servicer_chat_messages(
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found or not assigned to you")
     
-    skip = (page - 1) * limit
-    
-    messages = await db[Collections.CHAT_MESSAGES].find(
+    messages, next_cursor = await fetch_page(
+        Collections.CHAT_MESSAGES,
         {
             "booking_id": ObjectId(service_id),
             "deleted_by": {"$ne": ObjectId(current_user['_id'])}
-        }
-    ).sort("created_at", 1).skip(skip).limit(limit).to_list(limit)
+        },
+        [("created_at", 1)], limit, page, cursor
+    )
     
     print(f"✅ Found {len(messages)} messages")
     
@@ -6690,7 +10624,7 @@ async def get_servicer_chat_messages(
         message['sender_id'] = str(message['sender_id'])
         message['receiver_id'] = str(message['receiver_id'])
     
-    return {"messages": messages}
+    return {"messages": messages, "next_cursor": next_cursor}
 
 @app.post("/api/servicer/services/{service_id}/chat")
 async def send_servicer_chat_message(
@@ -6704,35 +10638,28 @@ async def send_servicer_chat_message(
     """Send chat message as servicer - WITH NOTIFICATION"""
     print(f"💬 Servicer sending message to booking {service_id}")
     
-    booking = await db[Collections.BOOKINGS].find_one({
-        "_id": ObjectId(service_id),
-        "servicer_id": ObjectId(servicer['_id'])
-    })
+    user_id = str(current_user['_id'])
+    room = await chat_service.member_room('booking', service_id, user_id)
     
-    if not booking:
+    if not room or room['servicer_id'] != str(servicer['_id']):
         raise HTTPException(status_code=404, detail="Booking not found or not assigned to you")
     
+    receiver_id = chat_service.receiver(room, user_id, receiver_id)
+    
     # Create message
-    message_dict = {
+    now = datetime.utcnow()
+    message_dict = await chat_service.post('booking', {
         "booking_id": ObjectId(service_id),
-        "sender_id": ObjectId(current_user['_id']),
+        "sender_id": ObjectId(user_id),
         "receiver_id": ObjectId(receiver_id),
         "message_type": message_type,
         "message_text": message_text,
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow(),
+        "timestamp": now,
+        "created_at": now,
         "is_read": False
-    }
-    
-    result = await db[Collections.CHAT_MESSAGES].insert_one(message_dict)
-    
-    # Convert ObjectIds to strings for response
-    message_dict['_id'] = str(result.inserted_id)
-    message_dict['booking_id'] = str(message_dict['booking_id'])
-    message_dict['sender_id'] = str(message_dict['sender_id'])
-    message_dict['receiver_id'] = str(message_dict['receiver_id'])
+    })
     
-    print(f"✅ Message sent: {result.inserted_id}")
+    print(f"✅ Message sent: {message_dict['_id']}")
     
     # ✅ CREATE NOTIFICATION FOR USER
     try:
@@ -6743,10 +10670,11 @@ async def send_servicer_chat_message(
             f"{current_user['name']}: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
             metadata={
                 "booking_id": service_id,
-                "booking_number": booking.get('booking_number'),
+                "booking_number": room.get('booking_number'),
                 "sender_name": current_user['name'],
                 "message_preview": message_text[:100]
-            }
+            },
+            coalesce_key=f"booking-chat-{service_id}"
         )
         print(f"📢 Notification sent to user {receiver_id}")
     except Exception as e:
@@ -6961,6 +10889,7 @@ async def verify_otp_and_complete_service(
             }
         }
     )
+    metrics_store.touch(booking)
     
     # Update servicer stats
     servicer = await db[Collections.SERVICERS].find_one({"_id": ObjectId(booking['servicer_id'])})
@@ -6972,15 +10901,11 @@ async def verify_otp_and_complete_service(
     
     # Handle payment
     if booking['payment_status'] == PaymentStatus.COMPLETED:
-        await db[Collections.WALLETS].update_one(
-            {"user_id": servicer['user_id']},
-            {
-                "$inc": {
-                    "balance": booking['servicer_amount'],
-                    "total_earned": booking['servicer_amount']
-                },
-                "$set": {"last_transaction_at": datetime.utcnow()}
-            }
+        await wallet_ledger.credit(
+            servicer['user_id'], booking['servicer_amount'], TransactionType.SERVICE_EARNING,
+            idempotency_key=f"service-earning:{booking_id}",
+            reference_id=booking_id,
+            inc={"total_earned": booking['servicer_amount']}
         )
     
     # Send notifications
@@ -7125,53 +11050,25 @@ async def update_location(
     servicer: dict = Depends(get_current_servicer)
 ):
     """Update real-time location during service"""
-    booking = await db[Collections.BOOKINGS].find_one({
+    session = await location_tracker.get_session(service_id, {
         "_id": ObjectId(service_id),
         "servicer_id": ObjectId(servicer['_id']),
         "booking_status": BookingStatus.IN_PROGRESS
     })
     
-    if not booking:
+    if not session or session['servicer_id'] != servicer['_id']:
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
-    # Calculate distance and ETA
-    service_location = booking.get('service_location', {})
-    user_lat = service_location.get('latitude')
-    user_lng = service_location.get('longitude')
-    
-    distance_km = None
-    eta_minutes = None
-    
-    if user_lat and user_lng:
-        distance_km = calculate_distance(latitude, longitude, user_lat, user_lng)
-        eta_minutes = calculate_eta(distance_km)
-    
-    # Create tracking record
-    tracking = {
-        "booking_id": ObjectId(service_id),
-        "servicer_latitude": latitude,
-        "servicer_longitude": longitude,
-        "user_latitude": user_lat,
-        "user_longitude": user_lng,
-        "distance_remaining_km": distance_km,
-        "eta_minutes": eta_minutes,
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow()
-    }
-    
-    await db[Collections.BOOKING_TRACKING].insert_one(tracking)
+    payload = location_tracker.ingest(session, latitude, longitude, status="in_progress")
     
     # Emit socket event to user
-    tracking['_id'] = str(tracking['_id'])
-    tracking['booking_id'] = str(tracking['booking_id'])
-    
     await sio.emit(
         SocketEvents.LOCATION_UPDATE,
-        tracking,
-        room=f"user-{str(booking['user_id'])}"
+        payload,
+        room=f"user-{session['user_id']}"
     )
     
-    return SuccessResponse(message="Location updated", data=tracking)
+    return SuccessResponse(message="Location updated", data=payload)
 
 # Around line 4200 - Update the complete_service endpoint
 @app.put("/api/servicer/services/{service_id}/complete")
@@ -7202,6 +11099,8 @@ async def complete_service(
             }
         }
     )
+    metrics_store.touch(booking)
+    location_tracker.end(service_id)
     
     # Update servicer stats
     await db[Collections.SERVICERS].update_one(
@@ -7214,15 +11113,11 @@ async def complete_service(
         servicer_amount = booking.get('servicer_amount', 0)
         
         # Update servicer wallet
-        await db[Collections.WALLETS].update_one(
-            {"user_id": ObjectId(current_user['_id'])},
-            {
-                "$inc": {
-                    "balance": servicer_amount,
-                    "total_earned": servicer_amount
-                },
-                "$set": {"last_transaction_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
-            }
+        await wallet_ledger.credit(
+            current_user['_id'], servicer_amount, TransactionType.SERVICE_EARNING,
+            idempotency_key=f"service-earning:{service_id}",
+            reference_id=service_id,
+            inc={"total_earned": servicer_amount}
         )
         
         print(f"✅ Credited ₹{servicer_amount} to servicer {current_user['_id']}")
@@ -7253,35 +11148,42 @@ async def get_earnings(
         wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])})
         wallet_balance = wallet['balance'] if wallet else 0.0
         
-        # Get all completed transactions for this servicer
-        all_transactions = await db[Collections.TRANSACTIONS].find({
-            "servicer_id": ObjectId(servicer['_id']),
-            "transaction_status": "completed"
-        }).to_list(1000)
-        
-        # Calculate total earned (use .get() to handle missing fields)
-        total_earned = sum(t.get('servicer_earnings', 0) for t in all_transactions)
-        
-        # Get pending payouts
-        pending_payouts_cursor = await db[Collections.PAYOUT_REQUESTS].find({
-            "servicer_id": ObjectId(servicer['_id']),
-            "status": "pending"
-        }).to_list(100)
-        
-        pending_payouts = sum(p.get('amount_requested', 0) for p in pending_payouts_cursor)
-        
-        # Calculate this month's earnings
+        # Completed transaction totals for this servicer (all time and this month)
         now = datetime.utcnow()
         month_start = datetime(now.year, now.month, 1)
         
-        this_month_transactions = await db[Collections.TRANSACTIONS].find({
-            "servicer_id": ObjectId(servicer['_id']),
-            "transaction_status": "completed",
-            "created_at": {"$gte": month_start}
-        }).to_list(1000)
+        async def compute_earnings():
+            totals = await db[Collections.TRANSACTIONS].aggregate([
+                {"$match": {
+                    "servicer_id": ObjectId(servicer['_id']),
+                    "transaction_status": PaymentStatus.COMPLETED
+                }},
+                {"$group": {
+                    "_id": None,
+                    "total_earned": {"$sum": {"$ifNull": ["$servicer_earnings", 0]}},
+                    "transactions": {"$sum": 1},
+                    "this_month_earnings": {"$sum": {"$cond": [
+                        {"$gte": ["$created_at", month_start]}, {"$ifNull": ["$servicer_earnings", 0]}, 0
+                    ]}},
+                    "this_month_transactions": {"$sum": {"$cond": [{"$gte": ["$created_at", month_start]}, 1, 0]}}
+                }}
+            ]).to_list(1)
+            return totals[0] if totals else {
+                "total_earned": 0, "transactions": 0, "this_month_earnings": 0, "this_month_transactions": 0
+            }
+        
+        earnings = await insight_cache.get_or_compute(
+            ("servicer_earnings", servicer['_id'], month_start), compute_earnings
+        )
+        total_earned = earnings['total_earned']
+        this_month_earnings = earnings['this_month_earnings']
         
-        # Use .get() to safely access servicer_earnings
-        this_month_earnings = sum(t.get('servicer_earnings', 0) for t in this_month_transactions)
+        # Get pending payouts
+        pending = await db[Collections.PAYOUT_REQUESTS].aggregate([
+            {"$match": {"servicer_id": ObjectId(servicer['_id']), "status": "pending"}},
+            {"$group": {"_id": None, "amount": {"$sum": {"$ifNull": ["$amount_requested", 0]}}}}
+        ]).to_list(1)
+        pending_payouts = pending[0]['amount'] if pending else 0
         
         print("=" * 60)
         print("📊 EARNINGS SUMMARY:")
@@ -7289,8 +11191,8 @@ async def get_earnings(
         print(f"   Total Earned: ₹{total_earned}")
         print(f"   Pending Payouts: ₹{pending_payouts}")
         print(f"   This Month: ₹{this_month_earnings}")
-        print(f"   Total Transactions: {len(all_transactions)}")
-        print(f"   This Month Transactions: {len(this_month_transactions)}")
+        print(f"   Total Transactions: {earnings['transactions']}")
+        print(f"   This Month Transactions: {earnings['this_month_transactions']}")
         print("=" * 60)
         
         return {
@@ -7305,6 +11207,31 @@ async def get_earnings(
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to fetch earnings: {str(e)}")
+
+# A payout request is stored as "pending_debit" before the wallet is debited
+# and only becomes "pending" (visible to admins) once the debit is recorded.
+# A delayed payout_settle job resolves requests that died in between: it
+# promotes the request if the ledger holds its debit and cancels it if not.
+# Whichever of the request and the job moves it out of pending_debit first
+# wins; a request that loses after debiting credits the amount back.
+
+@job_handler("payout_settle")
+async def run_payout_settle(payload: dict):
+    payout_id = ObjectId(payload['payout_id'])
+    if not await db[Collections.PAYOUT_REQUESTS].find_one({"_id": payout_id, "status": "pending_debit"}, {"_id": 1}):
+        return
+    debited = await db[Collections.WALLET_LEDGER].find_one({"idempotency_key": f"payout:{payout_id}"}, {"_id": 1})
+    result = await db[Collections.PAYOUT_REQUESTS].update_one(
+        {"_id": payout_id, "status": "pending_debit"},
+        {"$set": {
+            "status": "pending" if debited else "cancelled",
+            "settled_by_job": True,
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    if result.modified_count:
+        print(f"{'✅' if debited else '⚠️'} Payout {payout_id} {'recovered' if debited else 'cancelled, wallet never debited'}")
+
 @app.post("/api/servicer/payout")
 async def request_payout(
     payout_data: PayoutRequestCreate,
@@ -7322,22 +11249,6 @@ async def request_payout(
     print(f"   Servicer: {current_user.get('name', 'Unknown')}")
     print("=" * 60)
     
-    # Check wallet balance
-    wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])})
-    
-    if not wallet:
-        print("❌ Wallet not found!")
-        raise HTTPException(status_code=400, detail="Wallet not found")
-    
-    print(f"💰 Current Wallet Balance: ₹{wallet['balance']}")
-    
-    if wallet['balance'] < payout_data.amount_requested:
-        print(f"❌ Insufficient balance: Has ₹{wallet['balance']}, needs ₹{payout_data.amount_requested}")
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Insufficient balance. Available: ₹{wallet['balance']}"
-        )
-    
     # Check minimum payout amount
     if payout_data.amount_requested < settings.MIN_PAYOUT_AMOUNT:
         print(f"❌ Amount ₹{payout_data.amount_requested} is below minimum ₹{settings.MIN_PAYOUT_AMOUNT}")
@@ -7351,20 +11262,54 @@ async def request_payout(
     # Create payout request
     payout_dict = payout_data.dict()
     payout_dict['servicer_id'] = ObjectId(servicer['_id'])
-    payout_dict['status'] = "pending"
+    payout_dict['status'] = "pending_debit"
     payout_dict['created_at'] = datetime.utcnow()
     payout_dict['updated_at'] = datetime.utcnow()
     
-    result = await db[Collections.PAYOUT_REQUESTS].insert_one(payout_dict)
-    print(f"✅ Payout request created with ID: {result.inserted_id}")
+    payout_dict['_id'] = ObjectId()
+    payout_id = payout_dict['_id']
     
-    # Deduct from wallet (hold until processed)
-    await db[Collections.WALLETS].update_one(
-        {"user_id": ObjectId(current_user['_id'])},
-        {"$inc": {"balance": -payout_data.amount_requested}}
+    # Record the request before moving money, with a job that settles it if we die midway
+    await db[Collections.PAYOUT_REQUESTS].insert_one(payout_dict)
+    await job_queue.enqueue(
+        "payout_settle", {"payout_id": str(payout_id)},
+        key=f"payout-settle:{payout_id}",
+        run_at=datetime.utcnow() + timedelta(seconds=settings.PAYOUT_SETTLE_DELAY_SECONDS)
+    )
+    
+    # Deduct from wallet (hold until processed); declined rather than overdrawn
+    entry = await wallet_ledger.debit(
+        current_user['_id'], payout_data.amount_requested, TransactionType.PAYOUT,
+        idempotency_key=f"payout:{payout_dict['_id']}",
+        reference_id=payout_id
     )
+    if not entry:
+        await db[Collections.PAYOUT_REQUESTS].delete_one({"_id": payout_id, "status": "pending_debit"})
+        wallet = await db[Collections.WALLETS].find_one({"user_id": ObjectId(current_user['_id'])}, {"balance": 1})
+        if not wallet:
+            print("❌ Wallet not found!")
+            raise HTTPException(status_code=400, detail="Wallet not found")
+        print(f"❌ Insufficient balance: Has ₹{wallet['balance']}, needs ₹{payout_data.amount_requested}")
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Insufficient balance. Available: ₹{wallet['balance']}"
+        )
     print(f"✅ Deducted ₹{payout_data.amount_requested} from wallet")
     
+    result = await db[Collections.PAYOUT_REQUESTS].update_one(
+        {"_id": payout_id, "status": "pending_debit"},
+        {"$set": {"status": "pending", "updated_at": datetime.utcnow()}}
+    )
+    if not result.modified_count:
+        # The settle job cancelled this request first - give the money back
+        await wallet_ledger.credit(
+            current_user['_id'], payout_data.amount_requested, TransactionType.REVERSAL,
+            idempotency_key=f"payout-cancel:{payout_id}",
+            reference_id=payout_id
+        )
+        raise HTTPException(status_code=409, detail="Payout request expired, please try again")
+    print(f"✅ Payout request created with ID: {payout_id}")
+    
     # Send notification to admins
     admins = await db[Collections.USERS].find({"role": UserRole.ADMIN}).to_list(100)
     for admin in admins:
@@ -7382,13 +11327,14 @@ async def request_payout(
     
     return SuccessResponse(
         message=Messages.PAYOUT_REQUESTED,
-        data={"payout_id": str(result.inserted_id)}
+        data={"payout_id": str(payout_id)}
     )
 @app.get("/api/servicer/reviews")
 async def get_servicer_reviews(
     rating: Optional[int] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
 ):
@@ -7398,9 +11344,20 @@ async def get_servicer_reviews(
     if rating:
         query["overall_rating"] = rating
     
-    skip = (page - 1) * limit
+    reviews, next_cursor = await fetch_page(
+        Collections.RATINGS, query, [("created_at", -1)], limit, page, cursor
+    )
+    
+    # Totals come from the servicer's rating counters rather than a count over ratings
+    aggregates = await db[Collections.SERVICERS].find_one(
+        {"_id": ObjectId(servicer['_id'])},
+        {"average_rating": 1, "total_ratings": 1, "rating_histogram": 1}
+    ) or {}
+    histogram = aggregates.get('rating_histogram') or {}
     
-    reviews = await db[Collections.RATINGS].find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    users = await fetch_by_ids(
+        Collections.USERS, [review['user_id'] for review in reviews], {"name": 1, "profile_image_url": 1}
+    )
     
     for review in reviews:
         review['_id'] = str(review['_id'])
@@ -7409,18 +11366,24 @@ async def get_servicer_reviews(
         review['servicer_id'] = str(review['servicer_id'])
         
         # Get user details
-        user = await db[Collections.USERS].find_one({"_id": ObjectId(review['user_id'])})
+        user = users.get(review['user_id'])
         if user:
             review['user_name'] = user.get('name', '')
             review['user_image'] = user.get('profile_image_url', '')
     
-    total = await db[Collections.RATINGS].count_documents(query)
+    total = histogram.get(str(rating), 0) if rating else aggregates.get('total_ratings', 0)
     
     return {
         "reviews": reviews,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor,
+        "rating_summary": {
+            "average_rating": aggregates.get('average_rating', 0),
+            "total_ratings": aggregates.get('total_ratings', 0),
+            "distribution": {str(star): histogram.get(str(star), 0) for star in RATING_STARS}
+        }
     }
 
 @app.post("/api/servicer/reviews/{review_id}/respond")
@@ -7473,7 +11436,7 @@ async def get_servicer_services(
     
     result = []
     for price in pricing:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": ObjectId(price['category_id'])})
+        category = await category_cache.get(price['category_id'])
         if category:
             result.append({
                 "_id": str(price['_id']),
@@ -7516,6 +11479,9 @@ async def add_servicer_service(
         {"_id": ObjectId(servicer['_id'])},
         {"$addToSet": {"service_categories": service_data.category_id}}
     )
+    invalidate_principal(user_id=servicer['user_id'])
+    category_cache.invalidate_servicer_counts()
+    await coverage_index.servicer_changed(servicer['_id'])
     
     return SuccessResponse(
         message="Service added successfully",
@@ -7565,6 +11531,7 @@ async def update_availability_status(
         {"_id": ObjectId(servicer['_id'])},
         {"$set": {"availability_status": status, "updated_at": datetime.utcnow()}}
     )
+    invalidate_principal(user_id=servicer['user_id'])
     
     # Emit socket event
     await sio.emit(
@@ -7628,6 +11595,8 @@ async def update_servicer_profile(
     bio: Optional[str] = Form(None),
     experience_years: Optional[int] = Form(None),
     service_radius_km: Optional[float] = Form(None),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
     profile_photo: Optional[UploadFile] = File(None),
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
@@ -7651,6 +11620,9 @@ async def update_servicer_profile(
         user_update_data['state'] = state
     if pincode:
         user_update_data['pincode'] = pincode
+    if latitude is not None and longitude is not None:
+        user_update_data['latitude'] = latitude
+        user_update_data['longitude'] = longitude
     
     # Update user table if there are any user fields to update
     if len(user_update_data) > 1:  # More than just updated_at
@@ -7669,6 +11641,9 @@ async def update_servicer_profile(
         servicer_update_data['experience_years'] = experience_years
     if service_radius_km is not None:
         servicer_update_data['service_radius_km'] = service_radius_km
+    if latitude is not None and longitude is not None:
+        # Mirrors users.latitude/longitude for the 2dsphere index
+        servicer_update_data['location'] = build_geo_point(latitude, longitude)
     
     # Handle profile photo
     if profile_photo:
@@ -7694,6 +11669,9 @@ async def update_servicer_profile(
         {"_id": ObjectId(servicer['_id'])},
         {"$set": servicer_update_data}
     )
+    invalidate_principal(user_id=current_user['_id'])
+    if 'service_radius_km' in servicer_update_data or 'location' in servicer_update_data:
+        await coverage_index.servicer_changed(servicer['_id'])
     print(f"✅ Updated servicer profile")
     
     # ===== FETCH AND RETURN UPDATED DATA =====
@@ -7770,6 +11748,7 @@ async def update_bank_details(
         {"_id": ObjectId(servicer['_id'])},
         {"$set": update_data}
     )
+    invalidate_principal(user_id=servicer['user_id'])
     
     return SuccessResponse(message="Bank details updated successfully")
 # ============= ADD THESE SERVICER NOTIFICATION ENDPOINTS =============
@@ -7779,58 +11758,42 @@ async def update_bank_details(
 async def get_servicer_notifications(
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
     servicer: dict = Depends(get_current_servicer)
 ):
     """Get all notifications for servicer"""
-    skip = (page - 1) * limit
-    
-    notifications = await db[Collections.NOTIFICATIONS].find(
-        {"user_id": ObjectId(current_user['_id'])}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    notifications, next_cursor = await fetch_page(
+        Collections.NOTIFICATIONS, {"user_id": ObjectId(current_user['_id'])},
+        [("created_at", -1)], limit, page, cursor
+    )
     
     for notif in notifications:
         notif['_id'] = str(notif['_id'])
         notif['user_id'] = str(notif['user_id'])
     
-    total = await db[Collections.NOTIFICATIONS].count_documents(
-        {"user_id": ObjectId(current_user['_id'])}
-    )
-    unread = await db[Collections.NOTIFICATIONS].count_documents({
-        "user_id": ObjectId(current_user['_id']),
-        "is_read": False
-    })
+    counters = await get_notification_counters(current_user['_id'])
+    total = counters['total']
+    unread = counters['unread']
     
     return {
         "notifications": notifications,
         "total": total,
         "unread": unread,
         "page": page,
-        "pages": math.ceil(total / limit)
-    }
-
-
-@app.put("/api/servicer/notifications/{notification_id}/read")
-async def mark_servicer_notification_read(
-    notification_id: str,
-    current_user: dict = Depends(get_current_user),
-    servicer: dict = Depends(get_current_servicer)
-):
-    """Mark notification as read for servicer"""
-    result = await db[Collections.NOTIFICATIONS].update_one(
-        {
-            "_id": ObjectId(notification_id),
-            "user_id": ObjectId(current_user['_id'])
-        },
-        {
-            "$set": {
-                "is_read": True,
-                "read_at": datetime.utcnow()
-            }
-        }
-    )
-    
-    if result.modified_count == 0:
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
+    }
+
+
+@app.put("/api/servicer/notifications/{notification_id}/read")
+async def mark_servicer_notification_read(
+    notification_id: str,
+    current_user: dict = Depends(get_current_user),
+    servicer: dict = Depends(get_current_servicer)
+):
+    """Mark notification as read for servicer"""
+    if not await mark_notification_as_read(notification_id, current_user['_id']):
         raise HTTPException(status_code=404, detail="Notification not found")
     
     return SuccessResponse(message="Notification marked as read")
@@ -7847,12 +11810,7 @@ async def delete_servicer_notification(
         if not ObjectId.is_valid(notification_id):
             raise HTTPException(status_code=400, detail="Invalid notification ID format")
         
-        result = await db[Collections.NOTIFICATIONS].delete_one({
-            "_id": ObjectId(notification_id),
-            "user_id": ObjectId(current_user['_id'])
-        })
-        
-        if result.deleted_count == 0:
+        if not await delete_user_notification(notification_id, current_user['_id']):
             raise HTTPException(status_code=404, detail="Notification not found")
         
         return SuccessResponse(message="Notification deleted successfully")
@@ -7870,12 +11828,9 @@ async def get_servicer_unread_count(
     servicer: dict = Depends(get_current_servicer)
 ):
     """Get unread notification count for servicer"""
-    unread = await db[Collections.NOTIFICATIONS].count_documents({
-        "user_id": ObjectId(current_user['_id']),
-        "is_read": False
-    })
+    counters = await get_notification_counters(current_user['_id'])
     
-    return {"unread_count": unread}
+    return {"unread_count": counters['unread']}
 
 # ============= ADD THESE ENDPOINTS TO YOUR MAIN.PY =============
 
@@ -7902,51 +11857,29 @@ async def start_location_tracking(
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
     # Update booking with tracking started flag
+    now = datetime.utcnow()
+    current_location = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "updated_at": now
+    }
     await db[Collections.BOOKINGS].update_one(
         {"_id": ObjectId(service_id)},
         {
             "$set": {
                 "tracking_started": True,
-                "tracking_started_at": datetime.utcnow(),
-                "servicer_current_location": {
-                    "latitude": latitude,
-                    "longitude": longitude,
-                    "updated_at": datetime.utcnow()
-                }
+                "tracking_started_at": now,
+                "servicer_current_location": current_location
             }
         }
     )
     
-    # Get user location from booking
-    service_location = booking.get('service_location', {})
-    user_lat = service_location.get('latitude')
-    user_lng = service_location.get('longitude')
-    
-    # Calculate initial distance and ETA
-    distance_km = None
-    eta_minutes = None
-    
-    if user_lat and user_lng:
-        distance_km = calculate_distance(latitude, longitude, user_lat, user_lng)
-        eta_minutes = calculate_eta(distance_km)
-    
-    # Create initial tracking record
-    tracking = {
-        "booking_id": ObjectId(service_id),
-        "servicer_id": ObjectId(servicer['_id']),
-        "user_id": booking['user_id'],
-        "servicer_latitude": latitude,
-        "servicer_longitude": longitude,
-        "user_latitude": user_lat,
-        "user_longitude": user_lng,
-        "distance_remaining_km": distance_km,
-        "eta_minutes": eta_minutes,
-        "status": "on_the_way",
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow()
-    }
-    
-    result = await db[Collections.BOOKING_TRACKING].insert_one(tracking)
+    # ✅ Register the booking with the in-memory tracker; the first point is always stored
+    booking['servicer_current_location'] = current_location
+    session = location_tracker.register(booking)
+    payload = location_tracker.ingest(session, latitude, longitude, force_persist=True)
+    distance_km = session['distance_km']
+    eta_minutes = session['eta_minutes']
     
     # Send notification to user
     await create_notification(
@@ -7959,14 +11892,7 @@ async def start_location_tracking(
     # Emit socket event
     await sio.emit(
         SocketEvents.LOCATION_UPDATE,
-        {
-            "booking_id": service_id,
-            "servicer_location": {"lat": latitude, "lng": longitude},
-            "user_location": {"lat": user_lat, "lng": user_lng},
-            "distance_km": distance_km,
-            "eta_minutes": eta_minutes,
-            "status": "on_the_way"
-        },
+        payload,
         room=f"user-{str(booking['user_id'])}"
     )
     
@@ -7975,7 +11901,7 @@ async def start_location_tracking(
         data={
             "distance_km": distance_km,
             "eta_minutes": eta_minutes,
-            "tracking_id": str(result.inserted_id)
+            "tracking_id": session['last_point_id']
         }
     )
 
@@ -7991,86 +11917,29 @@ async def update_servicer_location(
     servicer: dict = Depends(get_current_servicer)
 ):
     """Update location during tracking"""
-    booking = await db[Collections.BOOKINGS].find_one({
+    # ✅ Served from the tracker's memory - the booking is only loaded on the first ping
+    session = await location_tracker.get_session(service_id, {
         "_id": ObjectId(service_id),
-        "servicer_id": ObjectId(servicer['_id'])
+        "servicer_id": ObjectId(servicer['_id']),
+        "booking_status": {"$in": TRACKING_ACTIVE_STATUSES}
     })
     
-    if not booking:
+    if not session or session['servicer_id'] != servicer['_id']:
         raise HTTPException(status_code=404, detail=Messages.BOOKING_NOT_FOUND)
     
-    # Get user location
-    service_location = booking.get('service_location', {})
-    user_lat = service_location.get('latitude')
-    user_lng = service_location.get('longitude')
-    
-    # Calculate distance and ETA
-    distance_km = None
-    eta_minutes = None
-    
-    if user_lat and user_lng:
-        distance_km = calculate_distance(latitude, longitude, user_lat, user_lng)
-        actual_speed = speed if speed and speed > 0 else 30
-        eta_minutes = calculate_eta(distance_km, actual_speed)
-    
-    # Update booking with current location
-    await db[Collections.BOOKINGS].update_one(
-        {"_id": ObjectId(service_id)},
-        {
-            "$set": {
-                "servicer_current_location": {
-                    "latitude": latitude,
-                    "longitude": longitude,
-                    "speed": speed,
-                    "heading": heading,
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        }
-    )
-    
-    # Create tracking record
-    tracking = {
-        "booking_id": ObjectId(service_id),
-        "servicer_id": ObjectId(servicer['_id']),
-        "user_id": booking['user_id'],
-        "servicer_latitude": latitude,
-        "servicer_longitude": longitude,
-        "user_latitude": user_lat,
-        "user_longitude": user_lng,
-        "distance_remaining_km": distance_km,
-        "eta_minutes": eta_minutes,
-        "speed": speed,
-        "heading": heading,
-        "status": "on_the_way",
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow()
-    }
-    
-    await db[Collections.BOOKING_TRACKING].insert_one(tracking)
+    payload = location_tracker.ingest(session, latitude, longitude, speed, heading)
     
     # Emit to user
     await sio.emit(
         SocketEvents.LOCATION_UPDATE,
-        {
-            "booking_id": service_id,
-            "servicer_location": {
-                "lat": latitude,
-                "lng": longitude,
-                "speed": speed,
-                "heading": heading
-            },
-            "distance_km": round(distance_km, 2) if distance_km else None,
-            "eta_minutes": eta_minutes,
-            "timestamp": datetime.utcnow().isoformat()
-        },
-        room=f"user-{str(booking['user_id'])}"
+        payload,
+        room=f"user-{session['user_id']}"
     )
     
     return {
         "status": "success",
-        "distance_km": distance_km,
-        "eta_minutes": eta_minutes
+        "distance_km": session['distance_km'],
+        "eta_minutes": session['eta_minutes']
     }
 
 
@@ -8099,6 +11968,7 @@ async def mark_servicer_arrived(
             }
         }
     )
+    location_tracker.end(service_id)
     
     await create_notification(
         str(booking['user_id']),
@@ -8144,7 +12014,7 @@ async def create_first_admin(
     admin_dict = {
         "name": name,
         "email": email,
-        "password_hash": hash_password(password),
+        "password_hash": await hash_password(password),
         "phone": "0000000000",
         "role": UserRole.ADMIN,
         "email_verified": True,  # Auto-verified for admin
@@ -8181,8 +12051,13 @@ async def admin_login(credentials: UserLogin):
     """Admin login - same as regular login"""
     # Find user
     user = await db[Collections.USERS].find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user['password_hash']):
+    if not user:
         raise HTTPException(status_code=401, detail=Messages.INVALID_CREDENTIALS)
+    valid, new_hash = await password_hasher.verify(credentials.password, user.get('password_hash'))
+    if not valid:
+        raise HTTPException(status_code=401, detail=Messages.INVALID_CREDENTIALS)
+    if new_hash:
+        asyncio.create_task(update_password_hash_background(user['_id'], user['password_hash'], new_hash))
     
     # Check if user is admin
     if user['role'] != UserRole.ADMIN:
@@ -8203,351 +12078,118 @@ async def admin_login(credentials: UserLogin):
     user['_id'] = str(user['_id'])
     user.pop('password_hash', None)
     
-    return Token(
-        access_token=access_token,
-        user=user
-    )
-@app.get("/api/admin/dashboard")
-async def get_admin_dashboard(current_admin: dict = Depends(get_current_admin)):
-    """Platform statistics"""
-    # Total users
-    total_users = await db[Collections.USERS].count_documents({"role": UserRole.USER})
-    total_servicers = await db[Collections.SERVICERS].count_documents({})
-    
-    # Total bookings
-    total_bookings = await db[Collections.BOOKINGS].count_documents({})
-    
-    # Pending verifications
-    pending_verifications = await db[Collections.SERVICERS].count_documents({
-        "verification_status": VerificationStatus.PENDING
-    })
-    
-    # Total revenue
-    completed_transactions = await db[Collections.TRANSACTIONS].find({
-        "transaction_status": PaymentStatus.COMPLETED,
-        "transaction_type": TransactionType.BOOKING_PAYMENT
-    }).to_list(10000)
-    
-    total_revenue = sum(t['amount'] for t in completed_transactions)
-    platform_fees = sum(t['platform_fee'] for t in completed_transactions)
-    
-    # Pending payouts
-    pending_payouts = await db[Collections.PAYOUT_REQUESTS].find({
-        "status": "pending"
-    }).to_list(1000)
-    
-    pending_payout_amount = sum(p['amount_requested'] for p in pending_payouts)
-    
-    return {
-        "total_users": total_users,
-        "total_servicers": total_servicers,
-        "total_bookings": total_bookings,
-        "pending_verifications": pending_verifications,
-        "total_revenue": total_revenue,
-        "platform_fees_collected": platform_fees,
-        "pending_payouts": len(pending_payouts),
-        "pending_payout_amount": pending_payout_amount
-    }
-
-
-# ============= PLATFORM ANALYTICS =============
-
-@app.get("/api/admin/analytics/overview")
-async def get_platform_analytics(
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    current_admin: dict = Depends(get_current_admin)
-):
-    """Get comprehensive platform analytics"""
-    from datetime import datetime as dt
-    
-    # Date range
-    if start_date and end_date:
-        start = dt.fromisoformat(start_date)
-        end = dt.fromisoformat(end_date)
-    else:
-        # Last 30 days by default
-        end = datetime.utcnow()
-        start = end - timedelta(days=30)
-    
-    # User growth
-    total_users = await db[Collections.USERS].count_documents({"role": UserRole.USER})
-    new_users = await db[Collections.USERS].count_documents({
-        "role": UserRole.USER,
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    
-    # Servicer growth
-    total_servicers = await db[Collections.SERVICERS].count_documents({})
-    active_servicers = await db[Collections.SERVICERS].count_documents({
-        "verification_status": VerificationStatus.APPROVED
-    })
-    
-    # Booking stats
-    total_bookings = await db[Collections.BOOKINGS].count_documents({
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    completed_bookings = await db[Collections.BOOKINGS].count_documents({
-        "booking_status": BookingStatus.COMPLETED,
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    cancelled_bookings = await db[Collections.BOOKINGS].count_documents({
-        "booking_status": BookingStatus.CANCELLED,
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    
-    # Revenue
-    completed_transactions = await db[Collections.TRANSACTIONS].find({
-        "transaction_status": PaymentStatus.COMPLETED,
-        "transaction_type": TransactionType.BOOKING_PAYMENT,
-        "created_at": {"$gte": start, "$lte": end}
-    }).to_list(10000)
-    
-    total_revenue = sum(t['amount'] for t in completed_transactions)
-    platform_fees = sum(t['platform_fee'] for t in completed_transactions)
-    servicer_earnings = sum(t['servicer_earnings'] for t in completed_transactions)
-    
-    # Top categories
-    pipeline = [
-        {"$match": {
-            "booking_status": BookingStatus.COMPLETED,
-            "created_at": {"$gte": start, "$lte": end}
-        }},
-        {"$group": {"_id": "$service_category_id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
-    top_categories = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(5)
-    
-    # Enrich with category names
-    for cat in top_categories:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": cat['_id']})
-        cat['category_name'] = category.get('name') if category else 'Unknown'
-        cat['_id'] = str(cat['_id'])
-    
-    # Top servicers
-    pipeline = [
-        {"$match": {
-            "booking_status": BookingStatus.COMPLETED,
-            "created_at": {"$gte": start, "$lte": end}
-        }},
-        {"$group": {"_id": "$servicer_id", "total_jobs": {"$sum": 1}, "total_earned": {"$sum": "$servicer_amount"}}},
-        {"$sort": {"total_jobs": -1}},
-        {"$limit": 5}
-    ]
-    top_servicers = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(5)
-    
-    # Enrich with servicer names
-    for s in top_servicers:
-        servicer = await db[Collections.SERVICERS].find_one({"_id": s['_id']})
-        if servicer:
-            user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-            s['servicer_name'] = user.get('name') if user else 'Unknown'
-        s['_id'] = str(s['_id'])
-    
-    # Daily booking trend
-    pipeline = [
-        {"$match": {"created_at": {"$gte": start, "$lte": end}}},
-        {"$group": {
-            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    daily_trend = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(100)
-    
-    return {
-        "period": {"start": start.isoformat(), "end": end.isoformat()},
-        "users": {
-            "total": total_users,
-            "new": new_users
-        },
-        "servicers": {
-            "total": total_servicers,
-            "active": active_servicers
-        },
-        "bookings": {
-            "total": total_bookings,
-            "completed": completed_bookings,
-            "cancelled": cancelled_bookings,
-            "completion_rate": round((completed_bookings / total_bookings * 100) if total_bookings > 0 else 0, 2)
-        },
-        "revenue": {
-            "total": round(total_revenue, 2),
-            "platform_fees": round(platform_fees, 2),
-            "servicer_earnings": round(servicer_earnings, 2)
-        },
-        "top_categories": top_categories,
-        "top_servicers": top_servicers,
-        "daily_trend": daily_trend
-    }
-
-
-@app.get("/api/admin/analytics/revenue")
-async def get_revenue_analytics(
-    period: str = "month",  # day, week, month, year
-    current_admin: dict = Depends(get_current_admin)
-):
-    """Get detailed revenue breakdown"""
-    # Calculate date range based on period
-    now = datetime.utcnow()
-    
-    if period == "day":
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    elif period == "week":
-        start = now - timedelta(days=7)
-    elif period == "month":
-        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    else:  # year
-        start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    
-    # Get all completed transactions
-    transactions = await db[Collections.TRANSACTIONS].find({
-        "transaction_status": PaymentStatus.COMPLETED,
-        "created_at": {"$gte": start, "$lte": now}
-    }).to_list(10000)
-    
-    # Calculate metrics
-    total_revenue = sum(t['amount'] for t in transactions)
-    platform_revenue = sum(t.get('platform_fee', 0) for t in transactions)
-    
-    # Group by payment method
-    by_payment_method = {}
-    for txn in transactions:
-        method = txn.get('payment_method', 'unknown')
-        by_payment_method[method] = by_payment_method.get(method, 0) + txn['amount']
-    
-    # Group by transaction type
-    by_type = {}
-    for txn in transactions:
-        txn_type = txn.get('transaction_type', 'unknown')
-        by_type[txn_type] = by_type.get(txn_type, 0) + txn['amount']
-    
-    return {
-        "period": period,
-        "total_revenue": round(total_revenue, 2),
-        "platform_revenue": round(platform_revenue, 2),
-        "transaction_count": len(transactions),
-        "average_transaction": round(total_revenue / len(transactions) if transactions else 0, 2),
-        "by_payment_method": by_payment_method,
-        "by_type": by_type
-    }
-
-# ============= ADMIN NOTIFICATION ENDPOINTS =============
-# Add after admin endpoints
-
-
-# ============= PLATFORM ANALYTICS =============
-
-@app.get("/api/admin/analytics/overview")
-async def get_platform_analytics(
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    current_admin: dict = Depends(get_current_admin)
-):
-    """Get comprehensive platform analytics"""
-    from datetime import datetime as dt
-    
-    # Date range
-    if start_date and end_date:
-        start = dt.fromisoformat(start_date)
-        end = dt.fromisoformat(end_date)
-    else:
-        # Last 30 days by default
-        end = datetime.utcnow()
-        start = end - timedelta(days=30)
-    
-    # User growth
-    total_users = await db[Collections.USERS].count_documents({"role": UserRole.USER})
-    new_users = await db[Collections.USERS].count_documents({
-        "role": UserRole.USER,
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    
-    # Servicer growth
-    total_servicers = await db[Collections.SERVICERS].count_documents({})
-    active_servicers = await db[Collections.SERVICERS].count_documents({
-        "verification_status": VerificationStatus.APPROVED
-    })
+    return Token(
+        access_token=access_token,
+        user=user
+    )
+@app.get("/api/admin/dashboard")
+async def get_admin_dashboard(current_admin: dict = Depends(get_current_admin)):
+    """Platform statistics"""
+    (
+        total_users,
+        total_servicers,
+        total_bookings,
+        pending_verifications,
+        booking_payments,
+        pending_payouts
+    ) = await asyncio.gather(
+        db[Collections.USERS].count_documents({"role": UserRole.USER}),
+        db[Collections.SERVICERS].estimated_document_count(),
+        db[Collections.BOOKINGS].estimated_document_count(),
+        db[Collections.SERVICERS].count_documents({
+            "verification_status": VerificationStatus.PENDING
+        }),
+        # Total revenue (all-time daily rollups)
+        metrics_store.totals("transaction_type", key=TransactionType.BOOKING_PAYMENT.value),
+        db[Collections.PAYOUT_REQUESTS].aggregate([
+            {"$match": {"status": "pending"}},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "amount": {"$sum": "$amount_requested"}}}
+        ]).to_list(1)
+    )
     
-    # Booking stats
-    total_bookings = await db[Collections.BOOKINGS].count_documents({
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    completed_bookings = await db[Collections.BOOKINGS].count_documents({
-        "booking_status": BookingStatus.COMPLETED,
-        "created_at": {"$gte": start, "$lte": end}
-    })
-    cancelled_bookings = await db[Collections.BOOKINGS].count_documents({
-        "booking_status": BookingStatus.CANCELLED,
-        "created_at": {"$gte": start, "$lte": end}
-    })
+    revenue = booking_payments.get(TransactionType.BOOKING_PAYMENT.value, {})
+    payouts = pending_payouts[0] if pending_payouts else {"count": 0, "amount": 0}
     
-    # Revenue
-    completed_transactions = await db[Collections.TRANSACTIONS].find({
-        "transaction_status": PaymentStatus.COMPLETED,
-        "transaction_type": TransactionType.BOOKING_PAYMENT,
-        "created_at": {"$gte": start, "$lte": end}
-    }).to_list(10000)
+    return {
+        "total_users": total_users,
+        "total_servicers": total_servicers,
+        "total_bookings": total_bookings,
+        "pending_verifications": pending_verifications,
+        "total_revenue": revenue.get('amount', 0),
+        "platform_fees_collected": revenue.get('platform_fees', 0),
+        "pending_payouts": payouts['count'],
+        "pending_payout_amount": payouts['amount']
+    }
+
+# ============= PLATFORM ANALYTICS =============
+
+async def build_platform_analytics(start: datetime, end: datetime) -> dict:
+    """Overview analytics for [start, end] from the platform_analytics rollups"""
+    (
+        total_users,
+        total_servicers,
+        active_servicers,
+        platform,
+        categories,
+        servicers,
+        booking_payments,
+        daily_trend
+    ) = await asyncio.gather(
+        db[Collections.USERS].count_documents({"role": UserRole.USER}),
+        db[Collections.SERVICERS].estimated_document_count(),
+        db[Collections.SERVICERS].count_documents({
+            "verification_status": VerificationStatus.APPROVED
+        }),
+        metrics_store.totals("platform", start, end),
+        metrics_store.totals("category", start, end),
+        metrics_store.totals("servicer", start, end),
+        metrics_store.totals("transaction_type", start, end, key=TransactionType.BOOKING_PAYMENT.value),
+        metrics_store.daily_series("platform", "bookings_created", start, end)
+    )
     
-    total_revenue = sum(t['amount'] for t in completed_transactions)
-    platform_fees = sum(t['platform_fee'] for t in completed_transactions)
-    servicer_earnings = sum(t['servicer_earnings'] for t in completed_transactions)
+    bookings = platform.get("all", {})
+    total_bookings = bookings.get('bookings_created', 0)
+    completed_bookings = bookings.get('bookings_completed', 0)
+    revenue = booking_payments.get(TransactionType.BOOKING_PAYMENT.value, {})
     
     # Top categories
-    pipeline = [
-        {"$match": {
-            "booking_status": BookingStatus.COMPLETED,
-            "created_at": {"$gte": start, "$lte": end}
-        }},
-        {"$group": {"_id": "$service_category_id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
+    top_category_rows = sorted(
+        (row for row in categories.items() if row[1]['bookings_completed'] > 0),
+        key=lambda row: row[1]['bookings_completed'],
+        reverse=True
+    )[:5]
+    category_docs = await category_cache.get_many(key for key, _ in top_category_rows)
+    top_categories = [
+        {
+            "_id": key,
+            "count": row['bookings_completed'],
+            "category_name": category_docs[key].get('name') if key in category_docs else 'Unknown'
+        }
+        for key, row in top_category_rows
     ]
-    top_categories = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(5)
-    
-    # Enrich with category names
-    for cat in top_categories:
-        category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": cat['_id']})
-        cat['category_name'] = category.get('name') if category else 'Unknown'
-        cat['_id'] = str(cat['_id'])
     
     # Top servicers
-    pipeline = [
-        {"$match": {
-            "booking_status": BookingStatus.COMPLETED,
-            "created_at": {"$gte": start, "$lte": end}
-        }},
-        {"$group": {"_id": "$servicer_id", "total_jobs": {"$sum": 1}, "total_earned": {"$sum": "$servicer_amount"}}},
-        {"$sort": {"total_jobs": -1}},
-        {"$limit": 5}
-    ]
-    top_servicers = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(5)
-    
-    # Enrich with servicer names
-    for s in top_servicers:
-        servicer = await db[Collections.SERVICERS].find_one({"_id": s['_id']})
+    top_servicer_rows = sorted(
+        (row for row in servicers.items() if row[1]['bookings_completed'] > 0),
+        key=lambda row: row[1]['bookings_completed'],
+        reverse=True
+    )[:5]
+    servicer_docs = await fetch_servicers_with_users(
+        [key for key, _ in top_servicer_rows], {"_id": 1}, {"name": 1}
+    )
+    top_servicers = []
+    for key, row in top_servicer_rows:
+        entry = {"_id": key, "total_jobs": row['bookings_completed'], "total_earned": row['completed_earnings']}
+        servicer = servicer_docs.get(key)
         if servicer:
-            user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
-            s['servicer_name'] = user.get('name') if user else 'Unknown'
-        s['_id'] = str(s['_id'])
-    
-    # Daily booking trend
-    pipeline = [
-        {"$match": {"created_at": {"$gte": start, "$lte": end}}},
-        {"$group": {
-            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    daily_trend = await db[Collections.BOOKINGS].aggregate(pipeline).to_list(100)
+            entry['servicer_name'] = servicer['user'].get('name') if servicer['user'] else 'Unknown'
+        top_servicers.append(entry)
     
     return {
         "period": {"start": start.isoformat(), "end": end.isoformat()},
         "users": {
             "total": total_users,
-            "new": new_users
+            "new": bookings.get('new_users', 0)
         },
         "servicers": {
             "total": total_servicers,
@@ -8556,13 +12198,13 @@ async def get_platform_analytics(
         "bookings": {
             "total": total_bookings,
             "completed": completed_bookings,
-            "cancelled": cancelled_bookings,
+            "cancelled": bookings.get('bookings_cancelled', 0),
             "completion_rate": round((completed_bookings / total_bookings * 100) if total_bookings > 0 else 0, 2)
         },
         "revenue": {
-            "total": round(total_revenue, 2),
-            "platform_fees": round(platform_fees, 2),
-            "servicer_earnings": round(servicer_earnings, 2)
+            "total": round(revenue.get('amount', 0), 2),
+            "platform_fees": round(revenue.get('platform_fees', 0), 2),
+            "servicer_earnings": round(revenue.get('servicer_earnings', 0), 2)
         },
         "top_categories": top_categories,
         "top_servicers": top_servicers,
@@ -8570,12 +12212,8 @@ async def get_platform_analytics(
     }
 
 
-@app.get("/api/admin/analytics/revenue")
-async def get_revenue_analytics(
-    period: str = "month",  # day, week, month, year
-    current_admin: dict = Depends(get_current_admin)
-):
-    """Get detailed revenue breakdown"""
+async def build_revenue_analytics(period: str) -> dict:
+    """Revenue breakdown for the current day/week/month/year from the rollups"""
     # Calculate date range based on period
     now = datetime.utcnow()
     
@@ -8588,37 +12226,104 @@ async def get_revenue_analytics(
     else:  # year
         start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
     
-    # Get all completed transactions
-    transactions = await db[Collections.TRANSACTIONS].find({
-        "transaction_status": PaymentStatus.COMPLETED,
-        "created_at": {"$gte": start, "$lte": now}
-    }).to_list(10000)
-    
-    # Calculate metrics
-    total_revenue = sum(t['amount'] for t in transactions)
-    platform_revenue = sum(t.get('platform_fee', 0) for t in transactions)
-    
-    # Group by payment method
-    by_payment_method = {}
-    for txn in transactions:
-        method = txn.get('payment_method', 'unknown')
-        by_payment_method[method] = by_payment_method.get(method, 0) + txn['amount']
+    # Completed transactions, grouped by type and by payment method
+    by_type_rows, by_method_rows = await asyncio.gather(
+        metrics_store.totals("transaction_type", start, now),
+        metrics_store.totals("payment_method", start, now)
+    )
     
-    # Group by transaction type
-    by_type = {}
-    for txn in transactions:
-        txn_type = txn.get('transaction_type', 'unknown')
-        by_type[txn_type] = by_type.get(txn_type, 0) + txn['amount']
+    total_revenue = sum(row['amount'] for row in by_type_rows.values())
+    platform_revenue = sum(row['platform_fees'] for row in by_type_rows.values())
+    transaction_count = sum(row['transactions'] for row in by_type_rows.values())
     
     return {
         "period": period,
         "total_revenue": round(total_revenue, 2),
         "platform_revenue": round(platform_revenue, 2),
-        "transaction_count": len(transactions),
-        "average_transaction": round(total_revenue / len(transactions) if transactions else 0, 2),
-        "by_payment_method": by_payment_method,
-        "by_type": by_type
+        "transaction_count": transaction_count,
+        "average_transaction": round(total_revenue / transaction_count if transaction_count else 0, 2),
+        "by_payment_method": {method: row['amount'] for method, row in by_method_rows.items()},
+        "by_type": {txn_type: row['amount'] for txn_type, row in by_type_rows.items()}
     }
+
+
+@app.get("/api/admin/analytics/overview")
+async def get_platform_analytics(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Get comprehensive platform analytics"""
+    from datetime import datetime as dt
+    
+    # Date range
+    if start_date and end_date:
+        start = dt.fromisoformat(start_date)
+        end = dt.fromisoformat(end_date)
+    else:
+        # Last 30 days by default
+        end = datetime.utcnow()
+        start = end - timedelta(days=30)
+    
+    return await build_platform_analytics(start, end)
+
+
+@app.get("/api/admin/analytics/revenue")
+async def get_revenue_analytics(
+    period: str = "month",  # day, week, month, year
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Get detailed revenue breakdown"""
+    return await build_revenue_analytics(period)
+
+
+@app.post("/api/admin/analytics/rebuild")
+async def rebuild_platform_analytics(
+    days: Optional[int] = Form(None),
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Recompute metric rollups from bookings/transactions (all history when days is omitted)"""
+    if days is not None and days < 1:
+        raise HTTPException(status_code=400, detail="days must be at least 1")
+    
+    asyncio.create_task(metrics_store.backfill(days=days))
+    
+    return SuccessResponse(message="Analytics rebuild started")
+
+# ============= ADMIN NOTIFICATION ENDPOINTS =============
+# Add after admin endpoints
+
+
+# ============= PLATFORM ANALYTICS =============
+
+@app.get("/api/admin/analytics/overview")
+async def get_platform_analytics(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Get comprehensive platform analytics"""
+    from datetime import datetime as dt
+    
+    # Date range
+    if start_date and end_date:
+        start = dt.fromisoformat(start_date)
+        end = dt.fromisoformat(end_date)
+    else:
+        # Last 30 days by default
+        end = datetime.utcnow()
+        start = end - timedelta(days=30)
+    
+    return await build_platform_analytics(start, end)
+
+
+@app.get("/api/admin/analytics/revenue")
+async def get_revenue_analytics(
+    period: str = "month",  # day, week, month, year
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Get detailed revenue breakdown"""
+    return await build_revenue_analytics(period)
 @app.post("/api/admin/notifications/broadcast")
 async def broadcast_notification(
     title: str = Form(...),
@@ -8627,47 +12332,54 @@ async def broadcast_notification(
     notification_type: str = Form("system"),
     current_admin: dict = Depends(get_current_admin)
 ):
-    """Send notification to all users or specific group"""
-    query = {}
-    
-    if target == "users":
-        query["role"] = UserRole.USER
-    elif target == "servicers":
-        query["role"] = UserRole.SERVICER
-    
-    users = await db[Collections.USERS].find(query).to_list(10000)
-    
-    notifications = []
-    for user in users:
-        notification = {
-            "user_id": user['_id'],
-            "notification_type": notification_type,
-            "title": title,
-            "message": message,
-            "is_read": False,
-            "metadata": {"broadcast": True, "admin_id": current_admin['_id']},
-            "created_at": datetime.utcnow()
-        }
-        notifications.append(notification)
+    """Send notification to all users or specific group (runs as a background job)"""
+    if target not in BROADCAST_TARGETS:
+        raise HTTPException(status_code=400, detail="target must be one of: all, users, servicers")
     
-    if notifications:
-        await db[Collections.NOTIFICATIONS].insert_many(notifications)
+    broadcast = await broadcast_engine.create(current_admin['_id'], title, message, target, notification_type)
+    broadcast_id = str(broadcast['_id'])
     
     # Create audit log
     await db[Collections.AUDIT_LOGS].insert_one({
         "admin_id": ObjectId(current_admin['_id']),
         "action_type": "notification_broadcast",
         "target_type": "notification",
-        "details": {"target": target, "recipients": len(notifications)},
+        "target_id": broadcast['_id'],
+        "details": {"target": target, "recipients": broadcast['recipients_estimated']},
         "created_at": datetime.utcnow()
     })
     
     return SuccessResponse(
-        message=f"Notification sent to {len(notifications)} users",
-        data={"recipients": len(notifications)}
+        message=f"Broadcast to {broadcast['recipients_estimated']} users started",
+        data={"broadcast_id": broadcast_id, "recipients": broadcast['recipients_estimated']}
     )
 
 
+@app.get("/api/admin/notifications/broadcasts/{broadcast_id}")
+async def get_broadcast_progress(
+    broadcast_id: str,
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Progress of a broadcast job"""
+    broadcast = await db[Collections.BROADCASTS].find_one({"_id": ObjectId(broadcast_id)})
+    
+    if not broadcast:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    
+    estimated = broadcast.get('recipients_estimated', 0)
+    return {
+        "broadcast_id": broadcast_id,
+        "status": broadcast['status'],
+        "target": broadcast['target'],
+        "recipients_estimated": estimated,
+        "recipients_done": broadcast.get('recipients_done', 0),
+        "progress_percent": round(min(broadcast.get('recipients_done', 0) / estimated * 100, 100), 2) if estimated else 100,
+        "last_error": broadcast.get('last_error'),
+        "created_at": broadcast['created_at'].isoformat(),
+        "completed_at": broadcast['completed_at'].isoformat() if broadcast.get('completed_at') else None
+    }
+
+
 @app.get("/api/admin/notifications/stats")
 async def get_notification_stats(current_admin: dict = Depends(get_current_admin)):
     """Get notification statistics"""
@@ -8816,6 +12528,9 @@ async def approve_servicer(servicer_id: str, current_admin: dict = Depends(get_c
             }
         }
     )
+    invalidate_principal(servicer_id=servicer_id)
+    category_cache.invalidate_servicer_counts()
+    await coverage_index.servicer_changed(servicer_id)
     
     # Send notification to servicer
     await create_notification(
@@ -8875,6 +12590,9 @@ async def reject_servicer(
             }
         }
     )
+    invalidate_principal(servicer_id=servicer_id)
+    category_cache.invalidate_servicer_counts()
+    await coverage_index.servicer_changed(servicer_id)
     
     # Send notification
     await create_notification(
@@ -8902,6 +12620,7 @@ async def get_all_users(
     status: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_admin: dict = Depends(get_current_admin)
 ):
     """Get all users with filters"""
@@ -8914,21 +12633,22 @@ async def get_all_users(
     elif status == "blocked":
         query["is_blocked"] = True
     
-    skip = (page - 1) * limit
-    
-    users = await db[Collections.USERS].find(query).skip(skip).limit(limit).to_list(limit)
+    users, next_cursor = await fetch_page(
+        Collections.USERS, query, [("created_at", -1)], limit, page, cursor,
+        projection={"password_hash": 0}
+    )
     
     for user in users:
         user['_id'] = str(user['_id'])
-        user.pop('password_hash', None)
     
-    total = await db[Collections.USERS].count_documents(query)
+    total = await count_for_listing(Collections.USERS, query)
     
     return {
         "users": users,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 
@@ -8988,21 +12708,34 @@ async def get_comprehensive_user_details(
         ]
     }).sort("created_at", -1).limit(50)
     
+    booking_docs = await bookings_cursor.to_list(50)
+    
+    # Resolve the other party of every booking with batched $in queries
+    as_customer = [b for b in booking_docs if str(b['user_id']) == user_id]
+    servicers = await fetch_servicers_with_users(
+        [b.get('servicer_id') for b in as_customer], {"_id": 1}, {"name": 1}
+    )
+    customers = await fetch_by_ids(
+        Collections.USERS,
+        [b.get('user_id') for b in booking_docs if str(b['user_id']) != user_id],
+        {"name": 1}
+    )
+    
     bookings = []
-    async for booking in bookings_cursor:
+    for booking in booking_docs:
         booking_data = serialize_doc(booking)
         
         # Get related user/servicer name
         if str(booking['user_id']) == user_id:
             # User is customer - get servicer name
-            svc = await db[Collections.SERVICERS].find_one({"_id": booking['servicer_id']})
+            svc = servicers.get(str(booking.get('servicer_id')))
             if svc:
-                svc_user = await db[Collections.USERS].find_one({"_id": svc['user_id']})
+                svc_user = svc['user']
                 booking_data['other_party'] = svc_user.get('name') if svc_user else 'Unknown'
                 booking_data['user_role'] = 'customer'
         else:
             # User is servicer - get customer name
-            customer = await db[Collections.USERS].find_one({"_id": booking['user_id']})
+            customer = customers.get(str(booking['user_id']))
             booking_data['other_party'] = customer.get('name') if customer else 'Unknown'
             booking_data['user_role'] = 'servicer'
         
@@ -9016,13 +12749,18 @@ async def get_comprehensive_user_details(
         "user_id": ObjectId(user_id)
     }).sort("created_at", -1).limit(50)
     
+    txn_docs = await transactions_cursor.to_list(50)
+    txn_bookings = await fetch_by_ids(
+        Collections.BOOKINGS, [t.get('booking_id') for t in txn_docs], {"booking_number": 1}
+    )
+    
     transactions = []
-    async for txn in transactions_cursor:
+    for txn in txn_docs:
         txn_data = serialize_doc(txn)
         
         # Get booking number if exists
         if txn.get('booking_id'):
-            booking = await db[Collections.BOOKINGS].find_one({"_id": ObjectId(txn['booking_id'])})
+            booking = txn_bookings.get(str(txn['booking_id']))
             txn_data['booking_number'] = booking.get('booking_number') if booking else None
         
         transactions.append(txn_data)
@@ -9062,13 +12800,15 @@ async def get_comprehensive_user_details(
         "target_type": "user"
     }).sort("created_at", -1).limit(50).to_list(50)
     
+    log_admins = await fetch_by_ids(Collections.USERS, [log.get('admin_id') for log in audit_logs], {"name": 1})
+    
     processed_logs = []
     for log in audit_logs:
         log_data = serialize_doc(log)
         
         # Get admin name
         if log.get('admin_id'):
-            admin = await db[Collections.USERS].find_one({"_id": ObjectId(log['admin_id'])})
+            admin = log_admins.get(str(log['admin_id']))
             log_data['admin_name'] = admin.get('name') if admin else 'System'
         
         processed_logs.append(log_data)
@@ -9202,6 +12942,7 @@ async def block_unblock_user(
         {"_id": ObjectId(user_id)},
         {"$set": {"is_blocked": block, "updated_at": datetime.utcnow()}}
     )
+    invalidate_principal(user_id=user_id)
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
@@ -9231,6 +12972,7 @@ async def get_all_bookings_admin(
     status: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_admin: dict = Depends(get_current_admin)
 ):
     """Get all bookings with filters"""
@@ -9239,17 +12981,23 @@ async def get_all_bookings_admin(
     if status:
         query["booking_status"] = status
     
-    skip = (page - 1) * limit
-    
-    bookings = await db[Collections.BOOKINGS].find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    bookings, next_cursor = await fetch_page(
+        Collections.BOOKINGS, query, [("created_at", -1)], limit, page, cursor
+    )
     
     # ✅ FIX: Convert all ObjectIds and datetimes first
     bookings = [convert_objectid_to_str(booking) for booking in bookings]
     
-    # Then add user and servicer details
+    # Then add user and servicer details - one $in query per collection for the page
+    users = await fetch_by_ids(
+        Collections.USERS, [b.get('user_id') for b in bookings], {"name": 1, "email": 1}
+    )
+    servicers = await fetch_servicers_with_users(
+        [b.get('servicer_id') for b in bookings], {"_id": 1}, {"name": 1}
+    )
+    
     for booking in bookings:
-        # Get user details - ID is now a string after conversion
-        user = await db[Collections.USERS].find_one({"_id": ObjectId(booking['user_id'])})
+        user = users.get(booking.get('user_id'))
         if user:
             booking['user_name'] = user.get('name', '')
             booking['user_email'] = user.get('email', '')
@@ -9257,24 +13005,20 @@ async def get_all_bookings_admin(
             booking['user_name'] = 'Unknown'
             booking['user_email'] = ''
         
-        # Get servicer details
-        servicer_doc = await db[Collections.SERVICERS].find_one({"_id": ObjectId(booking['servicer_id'])})
-        if servicer_doc:
-            servicer_user = await db[Collections.USERS].find_one({"_id": servicer_doc['user_id']})
-            if servicer_user:
-                booking['servicer_name'] = servicer_user.get('name', '')
-            else:
-                booking['servicer_name'] = 'Unknown'
+        servicer_doc = servicers.get(booking.get('servicer_id'))
+        if servicer_doc and servicer_doc['user']:
+            booking['servicer_name'] = servicer_doc['user'].get('name', '')
         else:
             booking['servicer_name'] = 'Unknown'
     
-    total = await db[Collections.BOOKINGS].count_documents(query)
+    total = await count_for_listing(Collections.BOOKINGS, query)
     
     return {
         "bookings": bookings,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 
@@ -9333,7 +13077,7 @@ async def get_booking_details_admin(
         
         # Get service category details if available
         if booking.get('service_type'):
-            category = await db[Collections.SERVICE_CATEGORIES].find_one({"name": booking['service_type']})
+            category = await category_cache.get_by_name(booking['service_type'])
             if category:
                 booking['category_details'] = convert_objectid_to_str(category)
         
@@ -9362,6 +13106,7 @@ async def get_all_transactions_admin(
     status: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_admin: dict = Depends(get_current_admin)
 ):
     """Get all transactions with filters"""
@@ -9372,9 +13117,9 @@ async def get_all_transactions_admin(
     if status:
         query["transaction_status"] = status
     
-    skip = (page - 1) * limit
-    
-    transactions = await db[Collections.TRANSACTIONS].find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    transactions, next_cursor = await fetch_page(
+        Collections.TRANSACTIONS, query, [("created_at", -1)], limit, page, cursor
+    )
     
     for txn in transactions:
         txn['_id'] = str(txn['_id'])
@@ -9384,13 +13129,14 @@ async def get_all_transactions_admin(
         if txn.get('servicer_id'):
             txn['servicer_id'] = str(txn['servicer_id'])
     
-    total = await db[Collections.TRANSACTIONS].count_documents(query)
+    total = await count_for_listing(Collections.TRANSACTIONS, query)
     
     return {
         "transactions": transactions,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 @app.get("/api/admin/transactions/{transaction_id}")
@@ -9498,16 +13244,15 @@ async def send_transaction_issue_message_admin(
 ):
     """Admin sends message in transaction issue chat"""
     
-    issue = await db[Collections.TRANSACTION_ISSUES].find_one({"_id": ObjectId(issue_id)})
-    if not issue:
+    room = await chat_service.room('issue', issue_id)
+    if not room:
         raise HTTPException(status_code=404, detail="Transaction issue not found")
     
     # Upload attachments if any
     attachment_urls = []
     if attachments:
-        for file in attachments:
-            result = await upload_to_cloudinary(file, CloudinaryFolders.CHAT_ATTACHMENTS)
-            attachment_urls.append(result['url'])
+        uploaded = await upload_many(attachments, CloudinaryFolders.CHAT_ATTACHMENTS)
+        attachment_urls.extend(result['url'] for result in uploaded)
     
     # Create message
     message = {
@@ -9522,28 +13267,16 @@ async def send_transaction_issue_message_admin(
         "created_at": datetime.utcnow()
     }
     
-    result = await db[Collections.TRANSACTION_ISSUE_MESSAGES].insert_one(message)
-    
-    # Convert for response
-    message['_id'] = str(result.inserted_id)
-    message['issue_id'] = str(message['issue_id'])
-    message['sender_id'] = str(message['sender_id'])
+    message = await chat_service.post('issue', message)
     message['sender_name'] = current_admin['name']
     message['sender_image'] = current_admin.get('profile_image_url', '')
     
-    # Notify user
-    await create_notification(
-        str(issue['user_id']),
-        NotificationTypes.MESSAGE,
-        "Admin Message - Transaction Issue",
-        f"Admin: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
-        metadata={"issue_id": issue_id}
-    )
-    
-    # Notify servicer if exists
-    if issue.get('servicer_id'):
+    # Notify the user and the servicer, if any
+    for recipient_id, participant in chat_service.recipients(room, str(current_admin['_id'])).items():
+        if participant['role'] == "admin":
+            continue
         await create_notification(
-            str(issue['servicer_id']),
+            recipient_id,
             NotificationTypes.MESSAGE,
             "Admin Message - Transaction Issue",
             f"Admin: {message_text[:100]}{'...' if len(message_text) > 100 else ''}",
@@ -9616,20 +13349,17 @@ async def send_transaction_issue_message_user(
 ):
     """User sends message in transaction issue chat"""
     
-    issue = await db[Collections.TRANSACTION_ISSUES].find_one({
-        "_id": ObjectId(issue_id),
-        "user_id": ObjectId(current_user['_id'])
-    })
+    user_id = str(current_user['_id'])
+    room = await chat_service.member_room('issue', issue_id, user_id)
     
-    if not issue:
+    if not room or room['participants'][user_id]['role'] != "user":
         raise HTTPException(status_code=404, detail="Transaction issue not found")
     
     # Upload attachments
     attachment_urls = []
     if attachments:
-        for file in attachments:
-            result = await upload_to_cloudinary(file, CloudinaryFolders.CHAT_ATTACHMENTS)
-            attachment_urls.append(result['url'])
+        uploaded = await upload_many(attachments, CloudinaryFolders.CHAT_ATTACHMENTS)
+        attachment_urls.extend(result['url'] for result in uploaded)
     
     message = {
         "issue_id": ObjectId(issue_id),
@@ -9643,32 +13373,17 @@ async def send_transaction_issue_message_user(
         "created_at": datetime.utcnow()
     }
     
-    result = await db[Collections.TRANSACTION_ISSUE_MESSAGES].insert_one(message)
-    
-    message['_id'] = str(result.inserted_id)
-    message['issue_id'] = str(message['issue_id'])
-    message['sender_id'] = str(message['sender_id'])
+    message = await chat_service.post('issue', message)
     message['sender_name'] = current_user['name']
     message['sender_image'] = current_user.get('profile_image_url', '')
     
-    # Notify admins
-    admins = await db[Collections.USERS].find({"role": UserRole.ADMIN}).to_list(100)
-    for admin in admins:
-        await create_notification(
-            str(admin['_id']),
-            NotificationTypes.MESSAGE,
-            "New Message - Transaction Issue",
-            f"{current_user['name']}: {message_text[:100]}",
-            metadata={"issue_id": issue_id}
-        )
-    
-    # Notify servicer if exists
-    if issue.get('servicer_id'):
+    # Notify admins and the servicer, if any
+    for recipient_id, participant in chat_service.recipients(room, user_id).items():
         await create_notification(
-            str(issue['servicer_id']),
+            recipient_id,
             NotificationTypes.MESSAGE,
             "New Message - Transaction Issue",
-            f"User: {message_text[:100]}",
+            f"{current_user['name']}: {message_text[:100]}" if participant['role'] == "admin" else f"User: {message_text[:100]}",
             metadata={"issue_id": issue_id}
         )
     
@@ -9792,32 +13507,24 @@ async def send_transaction_issue_message_servicer(
 ):
     """Servicer sends message in transaction issue chat"""
     
-    # First, get the issue
-    issue = await db[Collections.TRANSACTION_ISSUES].find_one({
-        "_id": ObjectId(issue_id)
-    })
+    user_id = str(current_user['_id'])
+    room = await chat_service.room('issue', issue_id)
     
-    if not issue:
+    if not room:
         raise HTTPException(status_code=404, detail="Transaction issue not found")
     
-    # Verify the servicer owns this issue by checking the booking
-    if issue.get('booking_id'):
-        booking = await db[Collections.BOOKINGS].find_one({
-            "_id": ObjectId(issue['booking_id'])
-        })
-        if not booking or str(booking.get('servicer_id')) != str(servicer['_id']):
-            raise HTTPException(status_code=403, detail="Not authorized to access this issue")
-    else:
-        # If no booking_id, check if there's a direct servicer_id field
-        if not issue.get('servicer_id') or str(issue['servicer_id']) != str(servicer['_id']):
+    # The room's servicer comes from the issue's booking, or its servicer_id without one
+    if room['servicer_id'] != str(servicer['_id']):
+        # Re-check in case the servicer changed after the room was cached
+        room = await chat_service.room('issue', issue_id, refresh=True)
+        if not room or room['servicer_id'] != str(servicer['_id']):
             raise HTTPException(status_code=403, detail="Not authorized to access this issue")
     
     # Upload attachments
     attachment_urls = []
     if attachments:
-        for file in attachments:
-            result = await upload_to_cloudinary(file, CloudinaryFolders.CHAT_ATTACHMENTS)
-            attachment_urls.append(result['url'])
+        uploaded = await upload_many(attachments, CloudinaryFolders.CHAT_ATTACHMENTS)
+        attachment_urls.extend(result['url'] for result in uploaded)
     
     message = {
         "issue_id": ObjectId(issue_id),
@@ -9831,28 +13538,14 @@ async def send_transaction_issue_message_servicer(
         "created_at": datetime.utcnow()
     }
     
-    result = await db[Collections.TRANSACTION_ISSUE_MESSAGES].insert_one(message)
-    
-    message['_id'] = str(result.inserted_id)
-    message['issue_id'] = str(message['issue_id'])
-    message['sender_id'] = str(message['sender_id'])
+    message = await chat_service.post('issue', message)
     message['sender_name'] = current_user.get('name', 'Unknown')
     message['sender_image'] = current_user.get('profile_image_url', '')
     
-    # Notify user
-    await create_notification(
-        str(issue['user_id']),
-        NotificationTypes.MESSAGE,
-        "Servicer Message - Transaction Issue",
-        f"Servicer: {message_text[:100]}",
-        metadata={"issue_id": issue_id}
-    )
-    
-    # Notify admins
-    admins = await db[Collections.USERS].find({"role": UserRole.ADMIN}).to_list(100)
-    for admin in admins:
+    # Notify the user and admins
+    for recipient_id in chat_service.recipients(room, user_id):
         await create_notification(
-            str(admin['_id']),
+            recipient_id,
             NotificationTypes.MESSAGE,
             "Servicer Message - Transaction Issue",
             f"Servicer: {message_text[:100]}",
@@ -9916,6 +13609,7 @@ async def join_transaction_issue_chat(sid, data):
     """Join a transaction issue chat room"""
     try:
         issue_id = data.get('issue_id')
+        await chat_service.room('issue', issue_id)
         await sio.enter_room(sid, f"issue-{issue_id}")
         await sio.emit('joined_issue_chat', {'issue_id': issue_id}, room=sid)
         print(f"Socket {sid} joined issue chat: {issue_id}")
@@ -9981,7 +13675,11 @@ async def get_payout_requests_admin(
 @app.put("/api/admin/payouts/{payout_id}/approve")
 async def approve_payout_admin(payout_id: str, current_admin: dict = Depends(get_current_admin)):
     """Approve and process payout"""
-    payout = await db[Collections.PAYOUT_REQUESTS].find_one({"_id": ObjectId(payout_id)})
+    # Requests whose wallet debit is unconfirmed or that were cancelled cannot be paid out
+    payout = await db[Collections.PAYOUT_REQUESTS].find_one({
+        "_id": ObjectId(payout_id),
+        "status": {"$nin": ["pending_debit", "cancelled"]}
+    })
     
     if not payout:
         raise HTTPException(status_code=404, detail="Payout request not found")
@@ -10043,7 +13741,7 @@ async def approve_payout_admin(payout_id: str, current_admin: dict = Depends(get
 @app.get("/api/admin/categories")
 async def get_service_categories_admin(current_admin: dict = Depends(get_current_admin)):
     """Get all service categories"""
-    categories = await db[Collections.SERVICE_CATEGORIES].find({}).to_list(100)
+    categories = await category_cache.all()
     
     for cat in categories:
         cat['_id'] = str(cat['_id'])
@@ -10065,6 +13763,7 @@ async def create_service_category_admin(
     category_dict['updated_at'] = datetime.utcnow()
     
     result = await db[Collections.SERVICE_CATEGORIES].insert_one(category_dict)
+    category_cache.invalidate()
     
     # Create audit log
     await db[Collections.AUDIT_LOGS].insert_one({
@@ -10085,12 +13784,15 @@ async def create_service_category_admin(
 async def get_audit_logs_admin(
     page: int = 1,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_admin: dict = Depends(get_current_admin)
 ):
     """View all admin actions"""
-    skip = (page - 1) * limit
+    logs, next_cursor = await fetch_page(
+        Collections.AUDIT_LOGS, {}, [("created_at", -1)], limit, page, cursor
+    )
     
-    logs = await db[Collections.AUDIT_LOGS].find({}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    admins = await fetch_by_ids(Collections.USERS, [log.get('admin_id') for log in logs], {"name": 1})
     
     for log in logs:
         log['_id'] = str(log['_id'])
@@ -10099,16 +13801,17 @@ async def get_audit_logs_admin(
             log['target_id'] = str(log['target_id'])
         
         # Get admin name
-        admin = await db[Collections.USERS].find_one({"_id": ObjectId(log['admin_id'])})
-        log['admin_name'] = admin.get('name', '')
+        admin = admins.get(log['admin_id'])
+        log['admin_name'] = admin.get('name', '') if admin else ''
     
-    total = await db[Collections.AUDIT_LOGS].count_documents({})
+    total = await count_for_listing(Collections.AUDIT_LOGS, {})
     
     return {
         "logs": logs,
         "total": total,
         "page": page,
-        "pages": math.ceil(total / limit)
+        "pages": math.ceil(total / limit),
+        "next_cursor": next_cursor
     }
 
 
@@ -10268,6 +13971,7 @@ async def seed_service_categories(current_admin: dict = Depends(get_current_admi
     try:
         result = await db[Collections.SERVICE_CATEGORIES].insert_many(default_categories)
         inserted_count = len(result.inserted_ids)
+        category_cache.invalidate()
         
         # Create audit log
         await db[Collections.AUDIT_LOGS].insert_one({
@@ -10324,6 +14028,7 @@ async def clear_all_categories(current_admin: dict = Depends(get_current_admin))
         
         # Delete all
         result = await db[Collections.SERVICE_CATEGORIES].delete_many({})
+        category_cache.invalidate()
         
         # Create audit log
         await db[Collections.AUDIT_LOGS].insert_one({
@@ -10350,9 +14055,8 @@ async def clear_all_categories(current_admin: dict = Depends(get_current_admin))
 async def get_public_categories():
     """Get all active service categories (no authentication required)"""
     try:
-        categories = await db[Collections.SERVICE_CATEGORIES].find({
-            "is_active": True
-        }).to_list(100)
+        categories = await category_cache.all(active_only=True)
+        servicer_counts = await category_cache.servicer_counts()
         
         result = []
         for cat in categories:
@@ -10366,12 +14070,8 @@ async def get_public_categories():
                 "is_active": cat.get('is_active', True)
             }
             
-            # Count servicers offering this category
-            servicers_count = await db[Collections.SERVICERS].count_documents({
-                "service_categories": cat['_id'],
-                "verification_status": VerificationStatus.APPROVED
-            })
-            cat_dict['servicers_count'] = servicers_count
+            # Servicers offering this category (precomputed)
+            cat_dict['servicers_count'] = servicer_counts.get(str(cat['_id']), 0)
             
             result.append(cat_dict)
         
@@ -10408,7 +14108,7 @@ async def get_servicer_categories_debug(
         categories = []
         
         for cat_id in category_ids:
-            cat = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": cat_id})
+            cat = await category_cache.get(cat_id)
             if cat:
                 categories.append({
                     "id": str(cat['_id']),
@@ -10464,30 +14164,32 @@ async def stripe_webhook_handler(request: Request):
         payment_intent = event['data']['object']
         
         # Update transaction
-        await db[Collections.TRANSACTIONS].update_one(
+        transaction = await db[Collections.TRANSACTIONS].find_one_and_update(
             {"stripe_payment_intent_id": payment_intent['id']},
-            {"$set": {"transaction_status": PaymentStatus.COMPLETED}}
+            {"$set": {"transaction_status": PaymentStatus.COMPLETED}},
+            projection={"created_at": 1}
         )
+        if transaction:
+            metrics_store.touch(transaction)
         
-        # If wallet topup
+        # If wallet topup (redelivered events and /confirm-payment credit once)
         if payment_intent['metadata'].get('purpose') == 'wallet_topup':
             user_id = payment_intent['metadata'].get('user_id')
-            amount = payment_intent['amount'] / 100
-            
-            await db[Collections.WALLETS].update_one(
-                {"user_id": ObjectId(user_id)},
-                {
-                    "$inc": {"balance": amount},
-                    "$set": {"last_transaction_at": datetime.utcnow()}
-                }
-            )
+            amount = payment_intent['amount'] / 100
             
-            await create_notification(
-                user_id,
-                NotificationTypes.PAYMENT,
-                "Wallet Topped Up",
-                f"₹{amount} added to your wallet"
+            entry = await wallet_ledger.credit(
+                user_id, amount, TransactionType.WALLET_TOPUP,
+                idempotency_key=f"topup:{payment_intent['id']}",
+                reference_id=transaction['_id'] if transaction else None
             )
+            
+            if entry and not entry.get('duplicate'):
+                await create_notification(
+                    user_id,
+                    NotificationTypes.PAYMENT,
+                    "Wallet Topped Up",
+                    f"₹{amount} added to your wallet"
+                )
         
         # If booking payment
         elif payment_intent['metadata'].get('booking_id'):
@@ -10517,16 +14219,7 @@ async def stripe_webhook_handler(request: Request):
     return {"status": "success"}
 
 # ============= SOCKET.IO EVENTS =============
-@sio.event
-async def connect(sid, environ):
-    """Handle client connection"""
-    print(f"Client connected: {sid}")
-
-@sio.event
-async def disconnect(sid):
-    """Handle client disconnection"""
-    print(f"Client disconnected: {sid}")
-
+# connect/disconnect are registered with the chat events above
 @sio.event
 async def authenticate(sid, data):
     """Authenticate socket connection"""
@@ -10543,6 +14236,9 @@ async def authenticate(sid, data):
         if user and user['role'] == UserRole.ADMIN:
             await sio.enter_room(sid, "admins")
         
+        await save_socket_principal(sid, user)
+        await presence.connect(sid, user_id)
+        
         await sio.emit('authenticated', {'user_id': user_id}, room=sid)
     except Exception as e:
         await sio.emit('auth_error', {'message': str(e)}, room=sid)
@@ -10551,27 +14247,31 @@ async def authenticate(sid, data):
 async def send_message(sid, data):
     """Handle chat message"""
     booking_id = data.get('booking_id')
-    sender_id = data.get('sender_id')
-    receiver_id = data.get('receiver_id')
+    principal = await sio.get_session(sid)
+    sender_id = (principal or {}).get('user_id')
     message_text = data.get('message_text')
+    if not sender_id:
+        await sio.emit('message_error', {'message': 'Authenticate first'}, room=sid)
+        return
+    
+    room = await chat_service.member_room('booking', booking_id, sender_id) if booking_id else None
+    receiver_id = chat_service.receiver(room, sender_id, data.get('receiver_id')) if room else None
+    if not receiver_id:
+        await sio.emit('message_error', {'message': 'You are not a participant in this chat'}, room=sid)
+        return
     
     # Save to database
-    message = {
+    now = datetime.utcnow()
+    message = await chat_service.post('booking', {
         "booking_id": ObjectId(booking_id),
         "sender_id": ObjectId(sender_id),
         "receiver_id": ObjectId(receiver_id),
         "message_type": MessageType.TEXT,
         "message_text": message_text,
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow(),
+        "timestamp": now,
+        "created_at": now,
         "is_read": False
-    }
-    
-    result = await db[Collections.CHAT_MESSAGES].insert_one(message)
-    message['_id'] = str(result.inserted_id)
-    message['booking_id'] = str(message['booking_id'])
-    message['sender_id'] = str(message['sender_id'])
-    message['receiver_id'] = str(message['receiver_id'])
+    })
     
     # Emit to receiver
     await sio.emit('receive_message', message, room=f"user-{receiver_id}")
@@ -10586,30 +14286,8 @@ async def typing(sid, data):
 
 @sio.event
 async def location_update(sid, data):
-    """Handle location update from servicer"""
-    booking_id = data.get('booking_id')
-    latitude = data.get('latitude')
-    longitude = data.get('longitude')
-    
-    # Save to database
-    tracking = {
-        "booking_id": ObjectId(booking_id),
-        "servicer_latitude": latitude,
-        "servicer_longitude": longitude,
-        "timestamp": datetime.utcnow(),
-        "created_at": datetime.utcnow()
-    }
-    
-    await db[Collections.BOOKING_TRACKING].insert_one(tracking)
-    
-    # Get booking and emit to user
-    booking = await db[Collections.BOOKINGS].find_one({"_id": ObjectId(booking_id)})
-    if booking:
-        await sio.emit(
-            SocketEvents.LOCATION_UPDATE,
-            tracking,
-            room=f"user-{str(booking['user_id'])}"
-        )
+    """Handle location update from servicer (alias of the location stream)"""
+    return await location_stream(sid, data)
 
 
 
@@ -10978,7 +14656,7 @@ async def seed_demo_servicers():
         )
     
     # Get all active categories for assignment
-    all_categories = await db[Collections.SERVICE_CATEGORIES].find({"is_active": True}).to_list(100)
+    all_categories = await category_cache.all(active_only=True)
     
     if len(all_categories) < 3:
         raise HTTPException(
@@ -11089,7 +14767,7 @@ async def seed_demo_servicers():
                 "name": servicer_data["name"],
                 "email": servicer_data["email"],
                 "phone": servicer_data["phone"],
-                "password_hash": hash_password(servicer_data["password"]),
+                "password_hash": await hash_password(servicer_data["password"]),
                 "role": servicer_data["role"],
                 "profile_image_url": servicer_data["profile_image_url"],
                 "address_line1": servicer_data["address_line1"],
@@ -11125,7 +14803,7 @@ async def seed_demo_servicers():
             # 3. CONVERT CATEGORY NAMES TO OBJECTIDS
             category_ids = []
             for cat_name in servicer_data["service_categories"]:
-                category = await db[Collections.SERVICE_CATEGORIES].find_one({"name": cat_name})
+                category = await category_cache.get_by_name(cat_name)
                 if category:
                     category_ids.append(category['_id'])
                     print(f"  ✅ Found category: {cat_name} - {category['_id']}")
@@ -11147,6 +14825,7 @@ async def seed_demo_servicers():
                 "total_ratings": random.randint(15, 50),
                 "total_jobs_completed": random.randint(30, 100),
                 "service_radius_km": servicer_data["service_radius_km"],
+                "location": build_geo_point(servicer_data["latitude"], servicer_data["longitude"]),
                 "availability_status": AvailabilityStatus.AVAILABLE,
                 "bank_account_number": servicer_data["bank_account_number"],
                 "ifsc_code": servicer_data["ifsc_code"],
@@ -11164,11 +14843,13 @@ async def seed_demo_servicers():
             
             servicer_result = await db[Collections.SERVICERS].insert_one(servicer_profile)
             servicer_id = servicer_result.inserted_id
+            category_cache.invalidate_servicer_counts()
+            await coverage_index.servicer_changed(servicer_id)
             print(f"  ✅ Servicer profile created: {servicer_id}")
             
             # 5. CREATE PRICING FOR EACH CATEGORY
             for pricing_item in servicer_data["pricing"]:
-                category = await db[Collections.SERVICE_CATEGORIES].find_one({"name": pricing_item["category_name"]})
+                category = await category_cache.get_by_name(pricing_item["category_name"])
                 if category:
                     pricing_doc = {
                         "servicer_id": servicer_id,
@@ -11390,15 +15071,6 @@ async def resolve_transaction_issue(
     
     # Handle refund if needed
     if request.resolution in ['full_refund', 'partial_refund'] and request.refund_amount:
-        # Credit user wallet
-        await db[Collections.WALLETS].update_one(
-            {"user_id": issue['user_id']},
-            {
-                "$inc": {"balance": request.refund_amount},
-                "$set": {"last_transaction_at": datetime.utcnow()}
-            }
-        )
-        
         # Create refund transaction
         refund_transaction = {
             "user_id": issue['user_id'],
@@ -11413,7 +15085,13 @@ async def resolve_transaction_issue(
         if issue.get('booking_id'):
             refund_transaction['booking_id'] = issue['booking_id']
         
-        await db[Collections.TRANSACTIONS].insert_one(refund_transaction)
+        # Credit user wallet (one refund per issue)
+        await wallet_ledger.credit(
+            issue['user_id'], request.refund_amount, TransactionType.REFUND,
+            idempotency_key=f"issue-refund:{issue_id}",
+            reference_id=issue_id,
+            transaction=refund_transaction
+        )
         
         # Send notification
         await create_notification(
@@ -11632,6 +15310,7 @@ async def verify_user_email(
             }
         }
     )
+    invalidate_principal(user_id=current_user['_id'])
     
     # Send notification
     await create_notification(
@@ -11724,9 +15403,8 @@ async def report_transaction_issue(
     # Upload evidence if provided
     evidence_urls = []
     if evidence_images:
-        for img in evidence_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.ISSUE_EVIDENCE)
-            evidence_urls.append(result['url'])
+        uploaded = await upload_many(evidence_images, CloudinaryFolders.ISSUE_EVIDENCE)
+        evidence_urls.extend(result['url'] for result in uploaded)
     
     # Determine priority based on issue type
     priority = "medium"
@@ -11828,6 +15506,22 @@ async def health_check():
         return {
             "status": "healthy",
             "database": "connected",
+            "email": email_service.metrics(),
+            "platform_metrics": metrics_store.metrics(),
+            "password_hashing": password_hasher.metrics(),
+            "notifications": notification_pipeline.metrics(),
+            "category_cache": category_cache.metrics(),
+            "job_queue": job_queue.metrics(),
+            "wallet_ledger": wallet_ledger.metrics(),
+            "presence": presence.metrics(),
+            "chat": chat_service.metrics(),
+            "coverage": coverage_index.metrics(),
+            "emergency_dispatch": dispatch_engine.metrics(),
+            "socket_manager": {
+                "backend": settings.SOCKET_MANAGER,
+                "write_only": settings.SOCKET_WRITE_ONLY,
+                "host_id": getattr(socket_manager, 'host_id', None)
+            },
             "timestamp": datetime.utcnow().isoformat()
         }
     except Exception as e:
@@ -11922,9 +15616,8 @@ async def create_user_complaint(
     # Upload evidence
     evidence_urls = []
     if evidence_images:
-        for img in evidence_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.COMPLAINT_EVIDENCE)
-            evidence_urls.append(result['url'])
+        uploaded = await upload_many(evidence_images, CloudinaryFolders.COMPLAINT_EVIDENCE)
+        evidence_urls.extend(result['url'] for result in uploaded)
     
     # Create complaint
     complaint = {
@@ -12144,6 +15837,7 @@ async def get_all_complaints_admin(
     complaint_type: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_admin: dict = Depends(get_current_admin)
 ):
     """Get all complaints with filters"""
@@ -12156,13 +15850,24 @@ async def get_all_complaints_admin(
     if complaint_type:
         query["complaint_type"] = complaint_type
     
-    skip = (page - 1) * limit
-    
-    complaints_cursor = db[Collections.COMPLAINTS].find(query).sort(
-        [("priority", -1), ("created_at", -1)]
-    ).skip(skip).limit(limit)
+    complaints, next_cursor = await fetch_page(
+        Collections.COMPLAINTS, query, [("priority", -1), ("created_at", -1)], limit, page, cursor
+    )
     
-    complaints = await complaints_cursor.to_list(limit)
+    # ✅ Resolve filers, accused parties and bookings for the whole page at once
+    servicers = await fetch_servicers_with_users(
+        [c.get('complaint_against_id') for c in complaints if c.get('complaint_against_type') == 'servicer'],
+        {"_id": 1}, {"name": 1, "email": 1}
+    )
+    users = await fetch_by_ids(
+        Collections.USERS,
+        [c.get('filed_by') for c in complaints] +
+        [c.get('complaint_against_id') for c in complaints if c.get('complaint_against_type') != 'servicer'],
+        {"name": 1, "email": 1}
+    )
+    bookings = await fetch_by_ids(
+        Collections.BOOKINGS, [c.get('booking_id') for c in complaints], {"booking_number": 1}
+    )
     
     # Process complaints
     processed_complaints = []
@@ -12171,34 +15876,28 @@ async def get_all_complaints_admin(
         
         try:
             # Get filer details
-            filer = await db[Collections.USERS].find_one({"_id": ObjectId(complaint['filed_by'])})
+            filer = users.get(str(complaint['filed_by']))
             complaint_data['filed_by_name'] = filer.get('name') if filer else 'Unknown'
             complaint_data['filed_by_email'] = filer.get('email') if filer else ''
             
             # Get complaint against details
             if complaint['complaint_against_type'] == 'servicer':
-                servicer = await db[Collections.SERVICERS].find_one(
-                    {"_id": ObjectId(complaint['complaint_against_id'])}
-                )
+                servicer = servicers.get(str(complaint['complaint_against_id']))
                 if servicer:
-                    servicer_user = await db[Collections.USERS].find_one({"_id": servicer['user_id']})
+                    servicer_user = servicer['user']
                     complaint_data['against_name'] = servicer_user.get('name') if servicer_user else 'Unknown'
                     complaint_data['against_email'] = servicer_user.get('email') if servicer_user else ''
                 else:
                     complaint_data['against_name'] = 'Unknown'
                     complaint_data['against_email'] = ''
             else:  # user
-                user = await db[Collections.USERS].find_one(
-                    {"_id": ObjectId(complaint['complaint_against_id'])}
-                )
+                user = users.get(str(complaint['complaint_against_id']))
                 complaint_data['against_name'] = user.get('name') if user else 'Unknown'
                 complaint_data['against_email'] = user.get('email') if user else ''
             
             # Get booking details if exists
             if complaint.get('booking_id'):
-                booking = await db[Collections.BOOKINGS].find_one(
-                    {"_id": ObjectId(complaint['booking_id'])}
-                )
+                booking = bookings.get(str(complaint['booking_id']))
                 if booking:
                     complaint_data['booking_number'] = booking.get('booking_number')
         
@@ -12207,17 +15906,18 @@ async def get_all_complaints_admin(
         
         processed_complaints.append(complaint_data)
     
-    total = await db[Collections.COMPLAINTS].count_documents(query)
+    total = await count_for_listing(Collections.COMPLAINTS, query)
     
     # Get stats
-    pending_count = await db[Collections.COMPLAINTS].count_documents({"status": ComplaintStatus.PENDING})
-    investigating_count = await db[Collections.COMPLAINTS].count_documents({"status": ComplaintStatus.INVESTIGATING})
+    pending_count = await count_for_listing(Collections.COMPLAINTS, {"status": ComplaintStatus.PENDING})
+    investigating_count = await count_for_listing(Collections.COMPLAINTS, {"status": ComplaintStatus.INVESTIGATING})
     
     return {
         "complaints": processed_complaints,
         "total": total,
         "page": page,
         "pages": math.ceil(total / limit) if limit > 0 else 0,
+        "next_cursor": next_cursor,
         "stats": {
             "pending": pending_count,
             "investigating": investigating_count
@@ -12519,16 +16219,6 @@ async def resolve_complaint_admin(
     
     # Handle refund if approved
     if refund_approved and refund_amount and refund_amount > 0:
-        # Credit user wallet
-        await db[Collections.WALLETS].update_one(
-            {"user_id": complaint['filed_by']},
-            {
-                "$inc": {"balance": refund_amount},
-                "$set": {"last_transaction_at": datetime.utcnow()}
-            },
-            upsert=True
-        )
-        
         # Create refund transaction
         refund_txn = {
             "user_id": complaint['filed_by'],
@@ -12548,7 +16238,14 @@ async def resolve_complaint_admin(
         if complaint.get('booking_id'):
             refund_txn['booking_id'] = complaint['booking_id']
         
-        await db[Collections.TRANSACTIONS].insert_one(refund_txn)
+        # Credit user wallet (one refund per complaint)
+        await wallet_ledger.credit(
+            complaint['filed_by'], refund_amount, TransactionType.REFUND,
+            idempotency_key=f"complaint-refund:{complaint_id}",
+            reference_id=complaint_id,
+            transaction=refund_txn,
+            upsert=True
+        )
         
         # Notify about refund
         await create_notification(
@@ -12590,6 +16287,7 @@ async def resolve_complaint_admin(
                 }
             }
         )
+        invalidate_principal(user_id=complaint['complaint_against_id'])
         
         # Notify banned user
         ban_message = f"Your account has been {'permanently ' if not ban_duration_days else ''}suspended"
@@ -12719,6 +16417,9 @@ async def suspend_servicer_admin(
             }
         }
     )
+    invalidate_principal(user_id=servicer['user_id'])
+    category_cache.invalidate_servicer_counts()
+    await coverage_index.servicer_changed(servicer_id)
     
     # Cancel pending bookings
     pending_bookings = await db[Collections.BOOKINGS].find({
@@ -12739,34 +16440,31 @@ async def suspend_servicer_admin(
                 }
             }
         )
+        metrics_store.touch(booking)
         
-        # Refund user
+        # Refund user (with its refund transaction)
         if booking.get('total_amount', 0) > 0:
-            await db[Collections.WALLETS].update_one(
-                {"user_id": booking['user_id']},
-                {
-                    "$inc": {"balance": booking['total_amount']},
-                    "$set": {"last_transaction_at": datetime.utcnow()}
+            await wallet_ledger.credit(
+                booking['user_id'], booking['total_amount'], TransactionType.REFUND,
+                idempotency_key=f"suspension-refund:{booking['_id']}",
+                reference_id=booking['_id'],
+                transaction={
+                    "user_id": booking['user_id'],
+                    "booking_id": booking['_id'],
+                    "transaction_type": TransactionType.REFUND,
+                    "payment_method": PaymentMethod.WALLET,
+                    "amount": booking['total_amount'],
+                    "transaction_status": PaymentStatus.COMPLETED,
+                    "metadata": {
+                        "reason": "Servicer suspended",
+                        "booking_number": booking.get('booking_number', 'N/A')
+                    },
+                    "created_at": datetime.utcnow(),
+                    "updated_at": datetime.utcnow()
                 },
                 upsert=True
             )
             
-            # Create refund transaction
-            await db[Collections.TRANSACTIONS].insert_one({
-                "user_id": booking['user_id'],
-                "booking_id": booking['_id'],
-                "transaction_type": TransactionType.REFUND,
-                "payment_method": PaymentMethod.WALLET,
-                "amount": booking['total_amount'],
-                "transaction_status": PaymentStatus.COMPLETED,
-                "metadata": {
-                    "reason": "Servicer suspended",
-                    "booking_number": booking.get('booking_number', 'N/A')
-                },
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            })
-            
             # Notify user about refund
             await create_notification(
                 str(booking['user_id']),
@@ -12855,6 +16553,9 @@ async def unsuspend_servicer_admin(
             }
         }
     )
+    invalidate_principal(user_id=servicer['user_id'])
+    category_cache.invalidate_servicer_counts()
+    await coverage_index.servicer_changed(servicer_id)
     
     # Notify servicer
     await create_notification(
@@ -12906,7 +16607,7 @@ async def get_servicer_details_admin(
         # Get service categories with names
         category_details = []
         for cat_id in servicer.get('service_categories', []):
-            category = await db[Collections.SERVICE_CATEGORIES].find_one({"_id": ObjectId(cat_id)})
+            category = await category_cache.get(cat_id)
             if category:
                 category_details.append({
                     'id': str(category['_id']),
@@ -13022,6 +16723,7 @@ async def suspend_user_admin(
             }
         }
     )
+    invalidate_principal(user_id=user_id)
     
     # Notify user
     if notify_user:
@@ -13097,6 +16799,7 @@ async def unsuspend_user_admin(
             }
         }
     )
+    invalidate_principal(user_id=user_id)
     
     # Remove from blacklist
     await db[Collections.BLACKLIST].delete_many({
@@ -13190,6 +16893,7 @@ async def issue_warning_to_servicer(
                 }
             }
         )
+        invalidate_principal(user_id=servicer['user_id'])
         
         await create_notification(
             str(servicer['user_id']),
@@ -13267,6 +16971,7 @@ async def lift_expired_suspensions(
                 }
             }
         )
+        invalidate_principal(user_id=user['_id'])
         
         # Remove from blacklist
         await db[Collections.BLACKLIST].delete_many({
@@ -13430,6 +17135,7 @@ async def remove_from_blacklist_admin(
             }
         }
     )
+    invalidate_principal(user_id=user_id)
     
     # Notify user
     await create_notification(
@@ -13459,22 +17165,11 @@ async def process_automatic_refund(
     amount: float,
     reason: str,
     booking_id: Optional[str] = None,
-    complaint_id: Optional[str] = None
+    complaint_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None
 ):
-    """Process automatic refund to user wallet"""
+    """Process automatic refund to user wallet (once per idempotency_key)"""
     try:
-        # Credit user wallet
-        await db[Collections.WALLETS].update_one(
-            {"user_id": ObjectId(user_id)},
-            {
-                "$inc": {"balance": amount},
-                "$set": {
-                    "last_transaction_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
-        
         # Create refund transaction
         refund_txn = {
             "user_id": ObjectId(user_id),
@@ -13495,7 +17190,18 @@ async def process_automatic_refund(
         if booking_id:
             refund_txn['booking_id'] = ObjectId(booking_id)
         
-        result = await db[Collections.TRANSACTIONS].insert_one(refund_txn)
+        # Credit user wallet together with the transaction
+        entry = await wallet_ledger.credit(
+            user_id, amount, TransactionType.REFUND,
+            idempotency_key=idempotency_key,
+            reference_id=booking_id or complaint_id,
+            transaction=refund_txn
+        )
+        if not entry:
+            print(f"❌ Auto-refund failed: no wallet for user {user_id}")
+            return False
+        if entry.get('duplicate'):
+            return True
         
         # Send notification
         await create_notification(
@@ -13581,55 +17287,90 @@ async def process_bulk_refunds(
 # ============= SCHEDULED REFUND CHECKS (Background Task) =============
 
 async def check_pending_refunds():
-    """Background task to check for refunds that should be processed automatically"""
+    """Background task to queue an auto-refund job per cancelled, paid booking not yet refunded"""
     try:
-        # Find cancelled bookings with completed payments that need refunds
-        cancelled_bookings = await db[Collections.BOOKINGS].find({
-            "booking_status": BookingStatus.CANCELLED,
-            "payment_status": PaymentStatus.COMPLETED,
-            "refund_processed": {"$ne": True},
-            "payment_method": {"$in": [PaymentMethod.STRIPE, PaymentMethod.WALLET]}
-        }).to_list(100)
-        
-        for booking in cancelled_bookings:
-            # Check cancellation policy
-            booking_date = datetime.fromisoformat(booking['booking_date'])
-            hours_before = (booking_date - datetime.utcnow()).total_seconds() / 3600
-            
-            refund_percentage = 0
-            if hours_before >= 24:
-                refund_percentage = 100  # Full refund
-            elif hours_before >= 12:
-                refund_percentage = 50   # 50% refund
-            # else: No refund if less than 12 hours
-            
-            if refund_percentage > 0:
-                refund_amount = booking['total_amount'] * (refund_percentage / 100)
-                
-                success = await process_automatic_refund(
-                    user_id=str(booking['user_id']),
-                    amount=refund_amount,
-                    reason=f"{refund_percentage}% refund for cancelled booking",
-                    booking_id=str(booking['_id'])
-                )
-                
-                if success:
-                    await db[Collections.BOOKINGS].update_one(
-                        {"_id": booking['_id']},
-                        {
-                            "$set": {
-                                "refund_processed": True,
-                                "refund_amount": refund_amount,
-                                "refund_percentage": refund_percentage,
-                                "refunded_at": datetime.utcnow()
-                            }
-                        }
-                    )
-        
+        queued = await job_queue.enqueue_cursor(
+            "auto_refund",
+            db[Collections.BOOKINGS].find({
+                "booking_status": BookingStatus.CANCELLED,
+                "payment_status": PaymentStatus.COMPLETED,
+                "refund_processed": {"$ne": True},
+                "auto_refund_checked": {"$ne": True},
+                "payment_method": {"$in": [PaymentMethod.STRIPE, PaymentMethod.WALLET]}
+            }, {"_id": 1}),
+            lambda booking: (f"refund:{booking['_id']}", {"booking_id": str(booking['_id'])})
+        )
+        if queued:
+            print(f"📥 Queued {queued} auto-refund jobs")
     except Exception as e:
         print(f"❌ Refund check error: {e}")
 
 
+@job_handler("auto_refund")
+async def run_auto_refund(payload: dict):
+    """Refund one cancelled booking per the cancellation policy (safe to run twice)"""
+    booking = await db[Collections.BOOKINGS].find_one({"_id": ObjectId(payload['booking_id'])})
+    if not booking:
+        return
+
+    if booking.get('refund_processed'):
+        # Only resume our own claim (the credit failed or the worker died mid-way)
+        if booking.get('refund_processed_by') != "system_auto":
+            return
+    else:
+        if booking.get('auto_refund_checked'):
+            return
+        if booking['booking_status'] != BookingStatus.CANCELLED or booking['payment_status'] != PaymentStatus.COMPLETED:
+            return
+
+        # Check cancellation policy
+        booking_date = datetime.fromisoformat(booking['booking_date'])
+        hours_before = (booking_date - datetime.utcnow()).total_seconds() / 3600
+
+        refund_percentage = 0
+        if hours_before >= 24:
+            refund_percentage = 100  # Full refund
+        elif hours_before >= 12:
+            refund_percentage = 50   # 50% refund
+        # else: No refund if less than 12 hours
+
+        if refund_percentage == 0:
+            # Only gets later from here on, so never check this booking again
+            await db[Collections.BOOKINGS].update_one(
+                {"_id": booking['_id']},
+                {"$set": {"auto_refund_checked": True}}
+            )
+            return
+
+        # Claim the booking before crediting: a servicer/admin refund or another
+        # attempt of this job that got there first wins
+        booking = await db[Collections.BOOKINGS].find_one_and_update(
+            {"_id": booking['_id'], "refund_processed": {"$ne": True}},
+            {"$set": {
+                "refund_processed": True,
+                "refund_processed_by": "system_auto",
+                "refund_amount": booking['total_amount'] * (refund_percentage / 100),
+                "refund_percentage": refund_percentage,
+                "refunded_at": datetime.utcnow(),
+                "auto_refund_checked": True
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if not booking:
+            return
+
+    # Keyed by booking: a previous attempt that already credited the wallet makes this a no-op
+    success = await process_automatic_refund(
+        user_id=str(booking['user_id']),
+        amount=booking['refund_amount'],
+        reason=f"{booking['refund_percentage']}% refund for cancelled booking",
+        booking_id=str(booking['_id']),
+        idempotency_key=f"auto-refund:{booking['_id']}"
+    )
+    if not success:
+        raise RuntimeError("Wallet credit failed")
+
+
 # ============= BAN/SUSPENSION MANAGEMENT =============
 
 @app.post("/api/admin/users/{user_id}/suspend")
@@ -13680,16 +17421,21 @@ async def suspend_user(
             }
         }
     )
+    invalidate_principal(user_id=user_id)
     
     # Cancel all active bookings
+    active_bookings_query = {
+        "$or": [
+            {"user_id": ObjectId(user_id)},
+            {"servicer_id": ObjectId(user_id)}
+        ],
+        "booking_status": {"$in": [BookingStatus.PENDING, BookingStatus.ACCEPTED]}
+    }
+    metrics_store.touch(*await db[Collections.BOOKINGS].find(
+        active_bookings_query, {"created_at": 1}
+    ).to_list(None))
     await db[Collections.BOOKINGS].update_many(
-        {
-            "$or": [
-                {"user_id": ObjectId(user_id)},
-                {"servicer_id": ObjectId(user_id)}
-            ],
-            "booking_status": {"$in": [BookingStatus.PENDING, BookingStatus.ACCEPTED]}
-        },
+        active_bookings_query,
         {
             "$set": {
                 "booking_status": BookingStatus.CANCELLED,
@@ -13779,6 +17525,7 @@ async def unsuspend_user(
             }
         }
     )
+    invalidate_principal(user_id=user_id)
     
     # Notify user
     await create_notification(
@@ -13854,44 +17601,142 @@ async def get_user_suspension_history(
 # ============= AUTOMATIC BAN CHECK (Background Task) =============
 
 async def check_expired_bans():
-    """Background task to automatically unban users when ban expires"""
+    """Background task to queue an unban job per expired temporary ban"""
     try:
-        # Find expired temporary bans
-        expired_bans = await db[Collections.BLACKLIST].find({
-            "ban_until": {"$lte": datetime.utcnow()},
-            "is_permanent": False
-        }).to_list(100)
-        
-        for ban in expired_bans:
-            # Remove from blacklist
-            await db[Collections.BLACKLIST].delete_one({"_id": ban['_id']})
-            
-            # Unblock user
-            await db[Collections.USERS].update_one(
-                {"_id": ban['user_id']},
-                {
-                    "$set": {
-                        "is_blocked": False,
-                        "blocked_reason": None,
-                        "blocked_until": None
-                    }
-                }
-            )
-            
-            # Notify user
-            await create_notification(
-                str(ban['user_id']),
-                NotificationTypes.SYSTEM,
-                "Suspension Expired",
-                "Your account suspension has expired. You now have full access again."
-            )
-            
-            print(f"✅ Auto-unbanned user: {ban['user_id']}")
-            
+        queued = await job_queue.enqueue_cursor(
+            "ban_expiry",
+            db[Collections.BLACKLIST].find({
+                "ban_until": {"$lte": datetime.utcnow()},
+                "is_permanent": False
+            }, {"_id": 1}),
+            lambda ban: (f"ban-expiry:{ban['_id']}", {"ban_id": str(ban['_id'])})
+        )
+        if queued:
+            print(f"📥 Queued {queued} ban expiry jobs")
     except Exception as e:
         print(f"❌ Ban check error: {e}")
 
 
+@job_handler("ban_expiry")
+async def run_ban_expiry(payload: dict):
+    """Lift one expired ban (safe to run twice)"""
+    expired = {
+        "_id": ObjectId(payload['ban_id']),
+        "ban_until": {"$lte": datetime.utcnow()},
+        "is_permanent": False
+    }
+    ban = await db[Collections.BLACKLIST].find_one(expired)
+    if not ban:
+        return  # Already lifted, or extended / made permanent since it was queued
+
+    # Unblock user before dropping the entry, so a retry still finds it
+    await db[Collections.USERS].update_one(
+        {"_id": ban['user_id']},
+        {
+            "$set": {
+                "is_blocked": False,
+                "blocked_reason": None,
+                "blocked_until": None
+            }
+        }
+    )
+    invalidate_principal(user_id=ban['user_id'])
+
+    # Remove from blacklist; only the attempt that removes it notifies
+    result = await db[Collections.BLACKLIST].delete_one(expired)
+    if result.deleted_count:
+        await create_notification(
+            str(ban['user_id']),
+            NotificationTypes.SYSTEM,
+            "Suspension Expired",
+            "Your account suspension has expired. You now have full access again."
+        )
+        print(f"✅ Auto-unbanned user: {ban['user_id']}")
+
+
+async def check_wallet_reconcile():
+    """Background task to queue today's wallet ledger reconciliation"""
+    try:
+        await job_queue.enqueue(
+            "wallet_reconcile", {},
+            key=f"wallet-reconcile:{datetime.utcnow().strftime('%Y-%m-%d')}"
+        )
+    except Exception as e:
+        print(f"❌ Wallet reconcile check error: {e}")
+
+
+async def check_coverage_rebuild():
+    """Background task to queue today's coverage grid rebuild"""
+    try:
+        await job_queue.enqueue(
+            "coverage_rebuild", {},
+            key=f"coverage-rebuild:{datetime.utcnow().strftime('%Y-%m-%d')}"
+        )
+    except Exception as e:
+        print(f"❌ Coverage rebuild check error: {e}")
+
+
+async def reconcile_platform_metrics():
+    """Background task to recompute the most recent metric rollups from source"""
+    try:
+        await metrics_store.backfill(days=settings.ANALYTICS_RECONCILE_DAYS)
+    except Exception as e:
+        print(f"❌ Metrics reconcile error: {e}")
+
+
+# ============= JOB QUEUE ADMIN =============
+
+@app.get("/api/admin/jobs")
+async def get_job_queue_status(current_admin: dict = Depends(get_current_admin)):
+    """Job counts by type/status plus the most recent dead letters"""
+    counts = await db[Collections.JOBS].aggregate([
+        {"$group": {"_id": {"type": "$type", "status": "$status"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    dead_jobs = await db[Collections.DEAD_JOBS].find().sort("failed_at", -1).to_list(50)
+    
+    by_type = {}
+    for row in counts:
+        by_type.setdefault(row['_id']['type'], {})[row['_id']['status']] = row['count']
+    
+    return {
+        "jobs": by_type,
+        "dead_total": await db[Collections.DEAD_JOBS].count_documents({}),
+        "dead_recent": [
+            {
+                "job_id": str(job['_id']),
+                "type": job['type'],
+                "key": job.get('key'),
+                "payload": job['payload'],
+                "attempts": job.get('attempts', 0),
+                "last_error": job.get('last_error'),
+                "failed_at": job['failed_at'].isoformat()
+            }
+            for job in dead_jobs
+        ],
+        "worker": job_queue.metrics()
+    }
+
+
+@app.post("/api/admin/jobs/dead/{job_id}/retry")
+async def retry_dead_job(job_id: str, current_admin: dict = Depends(get_current_admin)):
+    """Put a dead-lettered job back on the queue"""
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=400, detail="Invalid job ID")
+    
+    if not await job_queue.retry_dead(ObjectId(job_id)):
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    
+    await db[Collections.AUDIT_LOGS].insert_one({
+        "admin_id": ObjectId(current_admin['_id']),
+        "action_type": "dead_job_retried",
+        "target_type": "job",
+        "target_id": ObjectId(job_id),
+        "created_at": datetime.utcnow()
+    })
+    
+    return SuccessResponse(message="Job queued again")
+
+
 # ============= SCHEDULER FOR BACKGROUND TASKS =============
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -13899,24 +17744,96 @@ from apscheduler.triggers.interval import IntervalTrigger
 
 scheduler = AsyncIOScheduler()
 
-# Run refund checks every hour
+# Queue refund jobs every 15 minutes (the job queue does the work)
 scheduler.add_job(
     check_pending_refunds,
-    IntervalTrigger(hours=1),
+    IntervalTrigger(minutes=15),
     id='refund_check',
     name='Check pending refunds',
     replace_existing=True
 )
 
-# Run ban expiry checks every 6 hours
+# Queue ban expiry jobs every hour
 scheduler.add_job(
     check_expired_bans,
-    IntervalTrigger(hours=6),
+    IntervalTrigger(hours=1),
     id='ban_check',
     name='Check expired bans',
     replace_existing=True
 )
 
+# Queue due maintenance reminders every hour
+scheduler.add_job(
+    check_due_maintenance,
+    IntervalTrigger(hours=1),
+    id='maintenance_check',
+    name='Check due maintenance reminders',
+    replace_existing=True
+)
+
+# Queue the daily wallet reconciliation (the date key lets one worker run it)
+scheduler.add_job(
+    check_wallet_reconcile,
+    IntervalTrigger(hours=1),
+    id='wallet_reconcile',
+    name='Queue wallet ledger reconciliation',
+    replace_existing=True
+)
+
+# Queue the daily coverage grid rebuild (repairs missed incremental updates)
+scheduler.add_job(
+    check_coverage_rebuild,
+    IntervalTrigger(hours=1),
+    id='coverage_rebuild',
+    name='Queue coverage grid rebuild',
+    replace_existing=True
+)
+
+# Resume broadcasts whose worker failed or died (lease expired)
+scheduler.add_job(
+    broadcast_engine.resume_pending,
+    IntervalTrigger(minutes=1),
+    id='broadcast_resume',
+    name='Resume broadcasts',
+    replace_existing=True
+)
+
+# Resume emergency dispatches left behind by a crashed worker (lease expired)
+scheduler.add_job(
+    dispatch_engine.resume_pending,
+    IntervalTrigger(minutes=1),
+    id='emergency_dispatch_resume',
+    name='Resume emergency dispatches',
+    replace_existing=True
+)
+
+# Repair servicer rating aggregates daily
+scheduler.add_job(
+    reconcile_rating_aggregates_background,
+    IntervalTrigger(hours=24),
+    id='rating_reconcile',
+    name='Reconcile rating aggregates',
+    replace_existing=True
+)
+
+# Recompute unread badges from source (repairs counter drift)
+scheduler.add_job(
+    reconcile_unread_counters_background,
+    IntervalTrigger(hours=settings.UNREAD_COUNTER_RECONCILE_HOURS),
+    id='unread_reconcile',
+    name='Reconcile unread counters',
+    replace_existing=True
+)
+
+# Rebuild recent metric rollups daily (catches writes that were never marked dirty)
+scheduler.add_job(
+    reconcile_platform_metrics,
+    IntervalTrigger(hours=24),
+    id='metrics_reconcile',
+    name='Reconcile platform metrics',
+    replace_existing=True
+)
+
 
 # ============= SERVICER REFUND MANAGEMENT ENDPOINTS =============
 # ============= SERVICER REFUND MANAGEMENT ENDPOINTS (FIXED) =============
@@ -14097,15 +18014,6 @@ async def servicer_process_refund(
             detail=f"Refund amount must be exactly ₹{expected_amount} ({booking.get('refund_percentage')}%)"
         )
     
-    # Process refund to user wallet
-    await db[Collections.WALLETS].update_one(
-        {"user_id": booking['user_id']},
-        {
-            "$inc": {"balance": refund_amount},
-            "$set": {"last_transaction_at": datetime.utcnow()}
-        }
-    )
-    
     # Create refund transaction
     refund_txn = {
         "user_id": booking['user_id'],
@@ -14122,7 +18030,16 @@ async def servicer_process_refund(
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
-    await db[Collections.TRANSACTIONS].insert_one(refund_txn)
+    
+    # Process refund to user wallet (a double submit credits once)
+    entry = await wallet_ledger.credit(
+        booking['user_id'], refund_amount, TransactionType.REFUND,
+        idempotency_key=f"servicer-refund:{booking_id}",
+        reference_id=booking_id,
+        transaction=refund_txn
+    )
+    if entry and entry.get('duplicate'):
+        raise HTTPException(status_code=400, detail="Refund already processed")
     
     # Mark booking as refunded
     await db[Collections.BOOKINGS].update_one(
@@ -14210,9 +18127,8 @@ async def report_refund_delay(
     # Upload evidence
     evidence_urls = []
     if evidence_images:
-        for img in evidence_images:
-            result = await upload_to_cloudinary(img, CloudinaryFolders.ISSUE_EVIDENCE)
-            evidence_urls.append(result['url'])
+        uploaded = await upload_many(evidence_images, CloudinaryFolders.ISSUE_EVIDENCE)
+        evidence_urls.extend(result['url'] for result in uploaded)
     
     # Create booking issue
     issue = {
@@ -14393,7 +18309,8 @@ async def process_delayed_refund(
         user_id=str(booking['user_id']),
         amount=refund_amount,
         reason=f"Admin processed - Servicer missed deadline",
-        booking_id=str(booking['_id'])
+        booking_id=str(booking['_id']),
+        idempotency_key=f"delayed-refund:{issue_id}"
     )
     
     if not success:
@@ -14446,6 +18363,7 @@ async def process_delayed_refund(
                 }
             }
         )
+        invalidate_principal(user_id=servicer['user_id'])
         
         # Add to blacklist
         await db[Collections.BLACKLIST].insert_one({
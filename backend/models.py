@@ -77,6 +77,9 @@ class TransactionType(str, Enum):
     REFUND = "refund"
     PAYOUT = "payout"
     WALLET_TOPUP = "wallet_topup"
+    SERVICE_EARNING = "service_earning"
+    REFERRAL_BONUS = "referral_bonus"
+    REVERSAL = "reversal"
 
 
 class MessageType(str, Enum):
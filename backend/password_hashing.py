@@ -0,0 +1,39 @@
+"""
+bcrypt work executed inside the credential hashing process pool.
+
+Kept separate from main.py and import-light so worker processes only load
+passlib, whatever the multiprocessing start method.
+"""
+import time
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+_context: Optional[CryptContext] = None
+
+
+def init_worker(rounds: int):
+    """Process pool initializer: build the CryptContext once per worker"""
+    global _context
+    _context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+
+
+def hash_password(password: str) -> Tuple[str, float]:
+    """Returns (hash, seconds spent hashing)"""
+    started = time.perf_counter()
+    hashed = _context.hash(password)
+    return hashed, time.perf_counter() - started
+
+
+def verify_and_update(password: str, hashed: str) -> Tuple[Tuple[bool, Optional[str]], float]:
+    """
+    Returns ((valid, new_hash), seconds spent). new_hash is set when the stored
+    hash was made with other parameters (e.g. fewer rounds) and should be replaced.
+    """
+    started = time.perf_counter()
+    try:
+        result = _context.verify_and_update(password, hashed)
+    except (ValueError, TypeError):
+        # Malformed or missing stored hash
+        result = (False, None)
+    return result, time.perf_counter() - started
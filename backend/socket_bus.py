@@ -0,0 +1,168 @@
+"""
+Cross-worker Socket.IO client managers.
+
+The default socketio manager only knows the sockets of its own process, so an
+emit from one uvicorn worker never reaches clients held by another. Every
+manager built here relays emits, room changes and disconnects over a pub/sub
+channel shared by all workers:
+
+- "redis": Redis pub/sub (a local `redis-server` is enough)
+- "fake": an in-process bus with the same semantics, for tests and for
+  running several servers inside one process (see the benchmark below)
+- "memory": socketio's default single-process manager
+
+Kept import-light (no app settings) so job workers and the benchmark can use
+it without loading main.py.
+
+Benchmark fan-out throughput per node:
+    python socket_bus.py --nodes 4 --clients 2000 --messages 5000
+    python socket_bus.py --manager redis --url redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import pickle
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+
+class InProcessPubSubManager(AsyncPubSubManager):
+    """Pub/sub manager over an in-process bus - messages are pickled like on Redis"""
+
+    name = 'inprocess'
+    _channels: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+    def __init__(self, channel: str = 'socketio', write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._queue: Optional[asyncio.Queue] = None
+
+    async def _publish(self, data):
+        message = pickle.dumps(data)
+        for queue in list(self._channels[self.channel]):
+            queue.put_nowait(message)
+
+    async def _listen(self):
+        self._queue = asyncio.Queue()
+        self._channels[self.channel].add(self._queue)
+        try:
+            while True:
+                yield await self._queue.get()
+        finally:
+            self._channels[self.channel].discard(self._queue)
+
+    @classmethod
+    def reset(cls):
+        """Drop every subscriber (between tests)"""
+        cls._channels.clear()
+
+
+def build_socket_manager(kind: str, url: Optional[str] = None, channel: str = 'socketio',
+                         write_only: bool = False):
+    """Client manager for AsyncServer(client_manager=...), or for emitting from outside one"""
+    if kind == "redis":
+        return socketio.AsyncRedisManager(url or 'redis://localhost:6379/0', channel=channel, write_only=write_only)
+    if kind == "fake":
+        return InProcessPubSubManager(channel=channel, write_only=write_only)
+    if kind == "memory":
+        if write_only:
+            raise ValueError("An emit-only socket manager needs a pub/sub backend (redis or fake)")
+        return socketio.AsyncManager()
+    raise ValueError(f"Unknown socket manager: {kind}")
+
+
+async def stop_socket_manager(manager):
+    """Cancel the pub/sub listener, if the manager started one"""
+    listener = getattr(manager, 'thread', None)
+    if listener is not None:
+        listener.cancel()
+        try:
+            await listener
+        except (asyncio.CancelledError, Exception):
+            pass
+    redis = getattr(manager, 'redis', None)
+    if redis is not None:
+        await redis.aclose()
+
+
+# ============= BENCHMARK =============
+
+async def benchmark_fanout(kind: str = "fake", url: Optional[str] = None, nodes: int = 4,
+                           clients: int = 2000, messages: int = 5000, timeout: float = 60.0) -> dict:
+    """
+    Emit `messages` events from one node to per-user rooms spread evenly over
+    `nodes` servers and time until every server has delivered its share.
+    Socket writes are counted instead of sent, so this measures the manager
+    and bus, not the network.
+    """
+    channel = f"socketio-bench-{time.monotonic_ns()}"
+    delivered = [0] * nodes
+    servers = []
+    for index in range(nodes):
+        server = socketio.AsyncServer(
+            async_mode='asgi',
+            client_manager=build_socket_manager(kind, url, channel)
+        )
+
+        async def count(eio_sid, packet, index=index):
+            delivered[index] += 1
+
+        server._send_eio_packet = count
+        server.manager_initialized = True
+        server.manager.initialize()
+        servers.append(server)
+
+    for client in range(clients):
+        manager = servers[client % nodes].manager
+        sid = await manager.connect(f"eio-{client}", '/')
+        manager.basic_enter_room(sid, '/', f"user-{client}")
+
+    # Let every listener subscribe before publishing
+    await asyncio.sleep(0.5 if kind == "redis" else 0)
+
+    emitter = servers[0]
+    started = time.perf_counter()
+    for number in range(messages):
+        await emitter.emit("benchmark", {"n": number}, room=f"user-{number % clients}")
+    published = time.perf_counter() - started
+
+    deadline = started + timeout
+    while sum(delivered) < messages and time.perf_counter() < deadline:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+
+    for server in servers:
+        await stop_socket_manager(server.manager)
+
+    return {
+        "manager": kind,
+        "nodes": nodes,
+        "clients": clients,
+        "messages": messages,
+        "delivered": sum(delivered),
+        "publish_seconds": round(published, 3),
+        "total_seconds": round(elapsed, 3),
+        "messages_per_second": round(sum(delivered) / elapsed, 1) if elapsed else None,
+        "per_node": [
+            {"node": index, "delivered": count, "per_second": round(count / elapsed, 1) if elapsed else None}
+            for index, count in enumerate(delivered)
+        ]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Socket.IO cross-worker fan-out benchmark")
+    parser.add_argument("--manager", choices=["fake", "redis"], default="fake")
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark_fanout(args.manager, args.url, args.nodes, args.clients, args.messages))
+    print(f"📊 {result['delivered']}/{result['messages']} delivered across {result['nodes']} nodes "
+          f"in {result['total_seconds']}s ({result['messages_per_second']} msg/s)")
+    for node in result["per_node"]:
+        print(f"   node {node['node']}: {node['delivered']} ({node['per_second']} msg/s)")